@@ -0,0 +1,103 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Benchmark the per-iteration bookkeeping of WESTDataManager (prepare_iteration and
+update_segments) for a range of ensemble sizes. Run with the WESTPA environment set up,
+e.g. ``$WEST_PYTHON bench_data_manager.py -n 1000 10000 100000``.'''
+
+import argparse, os, random, shutil, tempfile, time
+import numpy
+
+import westpa
+from west.data_manager import WESTDataManager
+from west.segment import Segment
+from west.states import BasisState
+from west.systems import WESTSystem
+
+def make_segments(system, n_segments):
+    segments = []
+    for seg_id in range(n_segments):
+        segment = Segment(n_iter=1, seg_id=seg_id, weight=1.0/n_segments, parent_id=-1, 
+                          wtg_parent_ids={-1}, pcoord=system.new_pcoord_array(),
+                          status=Segment.SEG_STATUS_PREPARED)
+        segment.pcoord[0] = random.random()
+        segments.append(segment)
+    return segments
+
+def run_benchmark(data_manager, system, n_segments, block_size, aux_shape=None):
+    segments = make_segments(system, n_segments)
+    
+    t0 = time.time()
+    data_manager.prepare_iteration(1, segments)
+    t_prepare = time.time() - t0
+    
+    # Complete segments and report them in blocks of arbitrary seg_ids, as a work manager would
+    for segment in segments:
+        segment.pcoord[1:] = numpy.random.random(segment.pcoord[1:].shape)
+        segment.status = Segment.SEG_STATUS_COMPLETE
+        segment.walltime = segment.cputime = 1.0
+        if aux_shape:
+            segment.data['coords'] = numpy.random.random(aux_shape).astype(numpy.float32)
+    random.shuffle(segments)
+    
+    t0 = time.time()
+    for istart in range(0, n_segments, block_size):
+        data_manager.update_segments(1, segments[istart:istart+block_size])
+    t_update = time.time() - t0
+    
+    return t_prepare, t_update
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-segments', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Ensemble sizes to benchmark (default: %(default)s).')
+    parser.add_argument('--block-size', type=int, default=1000,
+                        help='Number of segments per call to update_segments (default: %(default)d).')
+    parser.add_argument('--pcoord-len', type=int, default=21,
+                        help='Number of progress coordinate points per segment (default: %(default)d).')
+    parser.add_argument('--pcoord-ndim', type=int, default=1,
+                        help='Number of progress coordinate dimensions (default: %(default)d).')
+    parser.add_argument('--aux-shape', type=int, nargs='+',
+                        help='''Store an auxiliary dataset of this (per-segment) shape, as for coordinates
+                        (default: no auxiliary data).''')
+    args = parser.parse_args()
+    
+    system = WESTSystem()
+    system.pcoord_len = args.pcoord_len
+    system.pcoord_ndim = args.pcoord_ndim
+    westpa.rc._system = system
+    
+    tempdir = tempfile.mkdtemp()
+    try:
+        print('{:>10s}  {:>12s}  {:>12s}'.format('segments', 'prepare (s)', 'update (s)'))
+        for n_segments in args.n_segments:
+            data_manager = WESTDataManager(westpa.rc)
+            data_manager.system = system
+            data_manager.we_h5filename = os.path.join(tempdir, 'west_{:d}.h5'.format(n_segments))
+            data_manager.prepare_backing()
+            data_manager.create_ibstate_group([BasisState('basis', 1.0, pcoord=[0.0]*system.pcoord_ndim)], n_iter=1)
+            data_manager.save_target_states([], n_iter=1)
+            try:
+                t_prepare, t_update = run_benchmark(data_manager, system, n_segments, args.block_size, args.aux_shape)
+            finally:
+                data_manager.close_backing()
+            print('{:10d}  {:12.4f}  {:12.4f}'.format(n_segments, t_prepare, t_update))
+    finally:
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Benchmark the return-file loaders of the executable propagator, reading (per-segment)
+coordinate-sized auxiliary data from text (the default ``numpy.loadtxt`` loader), ``.npy``, raw
+binary, and HDF5 files. Run with the WESTPA environment set up, e.g.
+``$WEST_PYTHON bench_return_loaders.py -n 1000 10000 100000``.'''
+
+import argparse, os, shutil, tempfile, time
+import numpy, h5py
+
+from west.segment import Segment
+from west.propagators.executable import aux_data_loader, ArrayFileLoader
+
+def write_return_file(format, filename, data):
+    if format == 'text':
+        numpy.savetxt(filename, data.reshape(len(data), -1))
+    elif format == 'npy':
+        numpy.save(filename, data)
+    elif format == 'raw':
+        data.tofile(filename)
+    else:
+        with h5py.File(filename, 'w') as h5file:
+            h5file['coord'] = data
+
+def time_loader(loader, filename, repeats):
+    segment = Segment(n_iter=1, seg_id=0)
+    t0 = time.time()
+    for _i in range(repeats):
+        loader('coord', filename, segment, single_point=False)
+        # Touch all the data, so that memory-mapped files are actually read
+        segment.data['coord'].sum()
+    return (time.time() - t0) / repeats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-atoms', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of atoms for which to benchmark (default: %(default)s).')
+    parser.add_argument('--n-frames', type=int, default=11,
+                        help='Number of frames of coordinates per segment (default: %(default)d).')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='Number of times each file is read (default: %(default)d).')
+    args = parser.parse_args()
+
+    formats = ['text', 'npy', 'npy (no mmap)', 'raw', 'hdf5']
+    tempdir = tempfile.mkdtemp()
+    try:
+        print('# mean time to load one return file (s)')
+        print('{:>10s}  {}'.format('atoms', '  '.join('{:>14s}'.format(format) for format in formats)))
+        for n_atoms in args.n_atoms:
+            shape = (args.n_frames, n_atoms, 3)
+            data = numpy.random.random(shape).astype(numpy.float32)
+            times = []
+            for format in formats:
+                if format == 'text':
+                    loader = aux_data_loader
+                else:
+                    loader = ArrayFileLoader(format.split()[0], dtype=numpy.float32, shape=shape,
+                                             mmap=(format != 'npy (no mmap)'))
+                filename = os.path.join(tempdir, 'coord.{}'.format(format.split()[0]))
+                write_return_file(format.split()[0], filename, data)
+                times.append(time_loader(loader, filename, args.repeats))
+            print('{:10d}  {}'.format(n_atoms, '  '.join('{:14.6f}'.format(t) for t in times)))
+    finally:
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Benchmark the latency and throughput of a work manager: the round-trip time of a trivial task
+submitted and awaited one at a time, the rate at which many trivial tasks are completed, and the
+rate at which array data is passed to and returned from workers, along with the CPU time used by
+the master process (which competes with the master's own work) as a fraction of wallclock time
+while idle and overall. Work managers are configured as for WESTPA tools, so that e.g.
+``$WEST_PYTHON bench_work_managers.py --work-manager=processes --n-workers=4`` and
+``mpirun -n 5 $WEST_PYTHON bench_work_managers.py --work-manager=mpi --mpi-prefetch=4``
+may be compared.'''
+
+import argparse, time
+import numpy
+
+import work_managers
+from work_managers.environment import default_env
+
+def identity(x):
+    return x
+
+def time_latency(work_manager, n_tasks):
+    t0 = time.time()
+    for i in range(n_tasks):
+        work_manager.submit(identity, args=(i,)).get_result()
+    return (time.time() - t0) / n_tasks
+
+def time_small_tasks(work_manager, n_tasks):
+    t0 = time.time()
+    futures = work_manager.submit_many([(identity, (i,), {}) for i in range(n_tasks)])
+    for future in futures:
+        future.get_result()
+    return n_tasks / (time.time() - t0)
+
+def time_arrays(work_manager, size, n_tasks):
+    array = numpy.random.random(size*2**20//8)
+    t0 = time.time()
+    futures = work_manager.submit_many([(identity, (array,), {}) for _i in range(n_tasks)])
+    for future in futures:
+        future.get_result()
+    # Data passes to and from workers
+    return 2 * size * n_tasks / (time.time() - t0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-latency', type=int, default=200,
+                        help='Number of tasks awaited one at a time (default: %(default)d).')
+    parser.add_argument('--n-small', type=int, default=5000,
+                        help='Number of trivial tasks submitted at once (default: %(default)d).')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1, 10, 100],
+                        help='Sizes of array payloads (MB) for which to benchmark (default: %(default)s).')
+    parser.add_argument('--n-arrays', type=int, default=8,
+                        help='Number of tasks for each array size (default: %(default)d).')
+    default_env.add_wm_args(parser)
+    args = parser.parse_args()
+    default_env.process_wm_args(args)
+
+    work_manager = default_env.make_work_manager()
+    with work_manager:
+        if not work_manager.is_master:
+            work_manager.run()
+            return
+
+        # Let workers start up
+        work_manager.submit(identity, args=(None,)).get_result()
+
+        print('# {!r} with {:d} workers'.format(work_manager, work_manager.n_workers))
+        (cpu0, t0) = (time.process_time(), time.time())
+        # A slow task keeps workers busy while the master waits
+        work_manager.submit(time.sleep, args=(2.0,)).get_result()
+        print('master CPU while waiting (%): {:.1f}'.format(100 * (time.process_time()-cpu0) / (time.time()-t0)))
+        
+        (cpu0, t0) = (time.process_time(), time.time())
+        print('latency (ms): {:.3f}'.format(1000 * time_latency(work_manager, args.n_latency)))
+        print('trivial tasks (tasks/s): {:.1f}'.format(time_small_tasks(work_manager, args.n_small)))
+        for size in args.sizes:
+            print('{:d} MB arrays (MB/s): {:.1f}'.format(size, time_arrays(work_manager, size, args.n_arrays)))
+        print('master CPU overall (%): {:.1f}'.format(100 * (time.process_time()-cpu0) / (time.time()-t0)))
+
+if __name__ == '__main__':
+    main()
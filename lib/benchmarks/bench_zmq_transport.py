@@ -0,0 +1,88 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Benchmark the transport of messages carrying numpy arrays between ZeroMQ work manager
+processes, comparing plain pickling (``send_pyobj``) with the framing used by ``ZMQCore``, in
+which array data travels in separate frames. Framed messages are received both as in the master
+and worker (``frames``, arrays used in place) and as in the executor (``frames-writable``, arrays
+copied if their frames are read-only). Each message is sent from a child process to this
+one over an IPC socket. Run with the WESTPA environment set up, e.g.
+``$WEST_PYTHON bench_zmq_transport.py -s 1 10 100``.'''
+
+import argparse, multiprocessing, time
+import numpy, zmq
+
+from work_managers.zeromq.core import ZMQCore, Message, Result, dump_frames, load_frames
+
+def send_messages(endpoint, method, size, repeats):
+    context = zmq.Context()
+    socket = context.socket(zmq.PUSH)
+    socket.connect(endpoint)
+    # A result as returned by a worker, carrying an array of size MB
+    result = Result(task_id=0, result={'coord': numpy.random.random(size*2**20//8)})
+    message = Message(Message.RESULT, result)
+    for _i in range(repeats+1):
+        if method == 'pickle':
+            socket.send_pyobj(message)
+        else:
+            socket.send_multipart(dump_frames(message), copy=False)
+    socket.close(linger=-1)
+    context.term()
+
+def time_transport(method, size, repeats):
+    endpoint = ZMQCore.make_ipc_endpoint()
+    context = zmq.Context()
+    socket = context.socket(zmq.PULL)
+    socket.bind(endpoint)
+    sender = multiprocessing.Process(target=send_messages, args=(endpoint, method, size, repeats))
+    sender.start()
+    try:
+        # The first message is not timed, so that process startup is excluded
+        for i in range(repeats+1):
+            if i == 1:
+                t0 = time.time()
+            if method == 'pickle':
+                message = socket.recv_pyobj()
+            else:
+                message = load_frames(socket.recv_multipart(copy=False),
+                                      writable=(method == 'frames-writable'))
+            # Touch the data, as a consumer of the result would
+            message.payload.result['coord'].sum()
+        return size * repeats / (time.time() - t0)
+    finally:
+        sender.join()
+        socket.close(linger=0)
+        context.term()
+        ZMQCore.remove_ipc_endpoints()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1, 10, 100],
+                        help='Sizes of array payloads (MB) for which to benchmark (default: %(default)s).')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='Number of messages of each size sent (default: %(default)d).')
+    args = parser.parse_args()
+
+    methods = ['pickle', 'frames', 'frames-writable']
+    print('# throughput (MB/s)')
+    print('{:>10s}  {}'.format('size (MB)', '  '.join('{:>15s}'.format(method) for method in methods)))
+    for size in args.sizes:
+        rates = [time_transport(method, size, args.repeats) for method in methods]
+        print('{:10d}  {}'.format(size, '  '.join('{:15.1f}'.format(rate) for rate in rates)))
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,7 @@ import numpy
 log = logging.getLogger('w_fork')
 
 import westpa
+from westpa import h5io
 from west import Segment
 from west.states import InitialState
 from west.data_manager import n_iter_dtype, seg_id_dtype
@@ -90,7 +91,7 @@ old_pcoord_ds = old_iter_group['pcoord']
 n_segments = old_pcoord_ds.shape[0]
 pcoord_len = old_pcoord_ds.shape[1]
 pcoord_ndim = old_pcoord_ds.shape[2]
-old_final_pcoords = old_pcoord_ds[:,pcoord_len-1,:]
+old_final_pcoords = h5io.get_pcoord_points(old_iter_group, [-1])[:,0,:]
 
 istates = dm_new.create_initial_states(n_segments, n_iter=1)
 segments = []
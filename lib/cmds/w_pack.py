@@ -0,0 +1,135 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import sys, logging, argparse
+import h5py
+
+log = logging.getLogger('w_pack')
+
+import westpa
+from westpa import h5io
+
+parser = argparse.ArgumentParser('w_pack', description='''\
+Convert a WEST HDF5 file to packed storage, in which the segment index, progress
+coordinates, and weight transfer graph of all iterations are appended to a few
+large datasets, rather than stored in small datasets in each iteration group.
+For long simulations, this greatly reduces the size of HDF5 metadata (and the
+time spent reading it). A group is still created for each iteration, holding
+its auxiliary data, recycling information, and links to the state groups in
+use. A new HDF5 file is created; all other data is copied unchanged. Storage options for the progress coordinate (e.g. compression) are
+taken from the configuration file, if present.
+''')
+
+westpa.rc.add_args(parser)
+parser.add_argument('-i', '--input', dest='input_h5file',
+                    help='''Convert INPUT_H5FILE (default: read from configuration file).''')
+parser.add_argument('-o', '--output', dest='output_h5file', default='west_packed.h5',
+                    help='''Save packed HDF5 file as OUTPUT_H5FILE (default: %(default)s).''')
+args = parser.parse_args()
+westpa.rc.process_args(args, config_required=False)
+
+dm_old = westpa.rc.new_data_manager()
+if args.input_h5file:
+    dm_old.we_h5filename = args.input_h5file
+dm_old.open_backing(mode='r')
+old_h5file = dm_old.we_h5file
+
+if dm_old.packed_storage:
+    sys.stderr.write('{} already uses packed storage\n'.format(dm_old.we_h5filename))
+    sys.exit(1)
+elif dm_old.we_h5file_version != 7:
+    sys.stderr.write('cannot convert WEST HDF5 file version {:d}; only version 7 is supported\n'
+                     .format(int(dm_old.we_h5file_version)))
+    sys.exit(1)
+
+dm_new = westpa.rc.new_data_manager()
+dm_new.we_h5filename = args.output_h5file
+dm_new.iter_prec = dm_old.iter_prec
+dm_new.packed_storage = True
+dm_new.prepare_backing()
+new_h5file = dm_new.we_h5file
+
+# Copy everything but iteration groups (the summary table, states, bin topologies, ...)
+del new_h5file['summary']
+for name in old_h5file:
+    if name != 'iterations':
+        old_h5file.copy(name, new_h5file)
+for (attr, value) in old_h5file.attrs.items():
+    if attr != 'west_file_format_version':
+        new_h5file.attrs[attr] = value
+
+# Groups of basis/initial and target states are referred to by the index of each set of states,
+# and hard-linked from iteration groups; these must refer to the copies
+state_groups = []
+for master_group_name in ('ibstates', 'tstates'):
+    if master_group_name not in old_h5file:
+        continue
+    old_master_group = old_h5file[master_group_name]
+    for (name, group) in old_master_group.items():
+        if isinstance(group, h5py.Group):
+            state_groups.append((group, '/{}/{}'.format(master_group_name, name)))
+
+    master_index = new_h5file[master_group_name]['index'][...]
+    for row in master_index:
+        if row['group_ref']:
+            group = old_h5file[row['group_ref']]
+            path = next(path for (state_group, path) in state_groups if state_group == group)
+            row['group_ref'] = new_h5file[path].ref
+    new_h5file[master_group_name]['index'][...] = master_index
+
+# Copy iteration groups, appending their tables to packed storage
+iter_names = sorted(name for name in old_h5file['iterations'] if name.startswith('iter_'))
+
+# Progress coordinates already reduced in precision by the scale/offset filter are not filtered
+# again, since the offset (and so the result) depends on how the data is chunked
+pcoord_opts = dm_new.dataset_options.get('pcoord')
+if (pcoord_opts is not None and iter_names 
+    and old_h5file['iterations'][iter_names[0]]['pcoord'].scaleoffset is not None):
+    pcoord_opts.pop('scaleoffset', None)
+
+for iter_name in iter_names:
+    n_iter = int(iter_name[5:])
+    old_iter_group = old_h5file['iterations'][iter_name]
+    new_iter_group = dm_new.require_iter_group(n_iter)
+    for (attr, value) in old_iter_group.attrs.items():
+        new_iter_group.attrs[attr] = value
+
+    for name in old_iter_group:
+        link = old_iter_group.get(name, getlink=True)
+        if name in h5io.packed_datasets:
+            continue
+        elif isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            new_iter_group[name] = link
+        elif name in ('ibstates', 'tstates'):
+            group = old_iter_group[name]
+            path = next(path for (state_group, path) in state_groups if state_group == group)
+            new_iter_group[name] = new_h5file[path]
+        else:
+            old_iter_group.copy(name, new_iter_group)
+
+    pcoord = old_iter_group['pcoord'][...]
+    wtgraph = old_iter_group['wtgraph'][...] if 'wtgraph' in old_iter_group else None
+    dm_new.append_packed_iteration(n_iter, old_iter_group['seg_index'][...], pcoord.shape, pcoord.dtype,
+                                   pcoord, wtgraph)
+    log.debug('packed iteration {:d}'.format(n_iter))
+
+westpa.rc.pstatus('packed {:d} iterations of {} into {}'.format(len(iter_names), dm_old.we_h5filename, dm_new.we_h5filename))
+
+dm_new.close_backing()
+dm_old.close_backing()
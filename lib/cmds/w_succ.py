@@ -50,23 +50,14 @@ class WSucc(CommonOutputMixin,WESTDataReaderMixin,WESTAnalysisTool):
 # column>2:    final progress coordinate value
 ''')
         for n_iter in range(1, self.data_manager.current_iteration):
-            seg_index = self.get_seg_index(n_iter)
-            all_seg_ids = numpy.arange(len(seg_index), dtype=numpy.int_)
-            recycled_seg_ids = all_seg_ids[seg_index[:]['endpoint_type'] == west.Segment.SEG_ENDPOINT_RECYCLED]
-
-            if len(recycled_seg_ids) == 0:
-                # Attemping to retrieve a 0-length selection from HDF5 (the pcoords below) fails
-                continue
-            
-            pcoord_ds = self.get_pcoord_dataset(n_iter)
-            pcoord_len = pcoord_ds.shape[1]
-            pcoord_ndim = pcoord_ds.shape[2]
-            final_pcoords = self.get_pcoord_dataset(n_iter)[recycled_seg_ids,pcoord_len-1,:]
-            # The above HDF5 selection always returns a vector; we want a 2-d array
-            final_pcoords.shape = (len(recycled_seg_ids),pcoord_ndim)
+            # Only the final progress coordinate values are needed
+            segment_arrays = self.data_manager.get_segments_as_arrays(n_iter, pcoord_points=[-1], load_wtgraph=False)
+            recycled = numpy.flatnonzero(segment_arrays.endpoint_types == west.Segment.SEG_ENDPOINT_RECYCLED)
+            final_pcoords = segment_arrays.pcoord[recycled,0]
+            weights = segment_arrays.weights[recycled]
             
-            for (ipc, seg_id) in enumerate(recycled_seg_ids):
-                self.output_file.write('%8d    %8d    %20.14g' % (n_iter, seg_id, seg_index[seg_id]['weight']))
+            for (ipc, seg_id) in enumerate(segment_arrays.seg_ids[recycled]):
+                self.output_file.write('%8d    %8d    %20.14g' % (n_iter, seg_id, weights[ipc]))
                 fields = ['']
                 for field in final_pcoords[ipc]:
                     fields.append(pcoord_formats.get(field.dtype.str[1:], '%s') % field)
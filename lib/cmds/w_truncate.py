@@ -46,7 +46,8 @@ dm.open_backing()
 max_iter = dm.current_iteration
 n_iter = args.n_iter if args.n_iter > 0 else dm.current_iteration
 
-for i in range(n_iter, dm.current_iteration+1):
+# Delete from the end, as packed storage can only be truncated
+for i in reversed(range(n_iter, dm.current_iteration+1)):
     dm.del_iter_group(i)
 
 dm.del_iter_summary(n_iter)
@@ -5,7 +5,8 @@ ps aux | grep w_run | grep -v grep
 SFX=.d$$
 mv seg_logs{,$SFX}
 mv istates{,$SFX}
-rm -Rf seg_logs$SFX istates$SFX & disown %1
+mv restarts{,$SFX}
+rm -Rf seg_logs$SFX istates$SFX restarts$SFX & disown %1
 rm -f system.h5 west.h5 seg_logs.tar
 mkdir seg_logs istates
 
@@ -44,11 +44,16 @@ class OpenMMPropagator(WESTPropagator):
                     ('west', 'openmm', 'integrator', 'steps_per_tau'),
                     ('west', 'openmm', 'integrator', 'steps_per_write'),
                     ('west', 'openmm', 'platform', 'name'),
-                    ('west', 'data', 'data_refs', 'initial_state')]:
+                    ('west', 'data', 'data_refs', 'initial_state'),
+                    ('west', 'restart_store', 'directory')]:
             config.require(key)
 
         self.initial_state_ref_template = config['west','data','data_refs','initial_state']
 
+        # Final coordinates and velocities of segments are passed to their children through the
+        # restart store, rather than through the master
+        self.restart_store = self.rc.get_restart_store()
+
         system_xml_file = config['west', 'openmm', 'system', 'file']
         self.integrator_xml_file = config['west', 'openmm', 'integrator', 'file']
 
@@ -112,6 +117,14 @@ class OpenMMPropagator(WESTPropagator):
 
         state.pcoord = self.dist(coords[0,:], coords[1,:])
 
+    def create_context(self, platform_properties):
+        with open(self.integrator_xml_file, 'r') as f:
+            integrator = openmm.XmlSerializer.deserialize(f.read())
+            integrator.setRandomNumberSeed(random.randint(0, 2**16))
+
+        context = openmm.Context(self.mmsystem, integrator, self.platform, platform_properties)
+        return context, integrator
+
     def propagate(self, segments):
 
         platform_properties = self.platform_properties.copy()
@@ -123,11 +136,9 @@ class OpenMMPropagator(WESTPropagator):
         except KeyError:
             pass
 
-        with open(self.integrator_xml_file, 'r') as f:
-            integrator = openmm.XmlSerializer.deserialize(f.read())
-            integrator.setRandomNumberSeed(random.randint(0, 2**16))
-
-        context = openmm.Context(self.mmsystem, integrator, self.platform, platform_properties)
+        # Reuse the context (and its device buffers) for as long as this worker runs
+        context_key = (self.integrator_xml_file, self.platform.getName(), tuple(sorted(platform_properties.items())))
+        context, integrator = self.get_context(context_key, lambda: self.create_context(platform_properties))
 
         for segment in segments:
             starttime = time.time()
@@ -141,22 +152,18 @@ class OpenMMPropagator(WESTPropagator):
 
             # Get initial coordinates and velocities from restarts or initial state
             if segment.initpoint_type == Segment.SEG_INITPOINT_CONTINUES:
-                # Get restart data
-                assert 'restart_coord' in segment.data
-                assert 'restart_veloc' in segment.data
+                # Get restart data saved by the parent segment
+                restart_data = self.restart_store.load_parent(segment)
 
-                coordinates[0] = segment.data['restart_coord']
-                velocities[0] = segment.data['restart_veloc']
+                coordinates[0] = restart_data['coord']
+                velocities[0] = restart_data['veloc']
 
-                initial_coords = units.Quantity(segment.data['restart_coord'], units.nanometer)
-                initial_velocs = units.Quantity(segment.data['restart_veloc'], units.nanometer / units.picosecond)
+                initial_coords = units.Quantity(restart_data['coord'], units.nanometer)
+                initial_velocs = units.Quantity(restart_data['veloc'], units.nanometer / units.picosecond)
 
                 context.setPositions(initial_coords)
                 context.setVelocities(initial_velocs)
 
-                del segment.data['restart_coord']
-                del segment.data['restart_veloc']
-
             elif segment.initpoint_type == Segment.SEG_INITPOINT_NEWTRAJ:
                 initial_state = self.initial_states[segment.initial_state_id]
 
@@ -189,6 +196,7 @@ class OpenMMPropagator(WESTPropagator):
             segment.pcoord = pcoords[...].astype(pcoord_dtype)
             segment.data['coord'] = coordinates[...]
             segment.data['veloc'] = velocities[...]
+            self.restart_store.save(segment, coord=coordinates[-1], veloc=velocities[-1])
             segment.status = Segment.SEG_STATUS_COMPLETE
 
             segment.walltime = time.time() - starttime
@@ -126,6 +126,14 @@ class OpenMMPropagator(WESTPropagator):
 
         return parent_coords, parent_velocs
 
+    def create_context(self, platform_properties):
+        with open(self.integrator_xml_file, 'r') as f:
+            integrator = openmm.XmlSerializer.deserialize(f.read())
+            integrator.setRandomNumberSeed(random.randint(0, 2**16))
+
+        context = openmm.Context(self.mmsystem, integrator, self.platform, platform_properties)
+        return context, integrator
+
     def propagate(self, segments):
 
         platform_properties = {key: value for key, value in self.platform_properties.items() if key.startswith(self.platform.getName())}
@@ -141,11 +149,9 @@ class OpenMMPropagator(WESTPropagator):
         except KeyError:
             process_id = 0
 
-        with open(self.integrator_xml_file, 'r') as f:
-            integrator = openmm.XmlSerializer.deserialize(f.read())
-            integrator.setRandomNumberSeed(random.randint(0, 2**16))
-
-        context = openmm.Context(self.mmsystem, integrator, self.platform, platform_properties)
+        # Reuse the context (and its device buffers) for as long as this worker runs
+        context_key = (self.integrator_xml_file, self.platform.getName(), tuple(sorted(platform_properties.items())))
+        context, integrator = self.get_context(context_key, lambda: self.create_context(platform_properties))
 
         if segments[0].n_iter > 1:
             parent_coords, parent_velocs = self.load_parent_data(segments[0].n_iter - 1)
@@ -0,0 +1,188 @@
+import nose
+import nose.tools
+
+import os, shutil
+import numpy
+import h5py
+from westpa import h5io
+from west.tests.tsupport import SimulationRunTests
+import w_assign
+from w_assign import WAssign
+
+
+class AssignmentInterrupted(Exception):
+    pass
+
+
+class Test_W_Assign_Append(SimulationRunTests):
+    '''Tests that w_assign --append extends an existing output file with the iterations completed since
+    it was written, giving the same results as assigning all iterations anew, and that it assigns all
+    iterations anew when the existing output cannot be extended.'''
+
+    n_iters = 4
+    n_iters_partial = 2
+    bins = "[[0.0, 7.0, 7.5, 7.8, float('inf')]]"
+    states = ['low:6.5', 'high:7.9']
+
+    def setup(self):
+        super().setup()
+        self.h5filename = self.run_sim('sim', n_iters=self.n_iters)
+
+        # The same simulation, as it was when only the first iterations were complete
+        self.partial_filename = os.path.join(self.tempdir, 'west_partial.h5')
+        shutil.copyfile(self.h5filename, self.partial_filename)
+        with h5py.File(self.partial_filename, 'r+') as h5file:
+            h5file.attrs['west_current_iteration'] = self.n_iters_partial + 1
+
+        self.full_assign = os.path.join(self.tempdir, 'assign_full.h5')
+        self.run_w_assign(self.h5filename, self.full_assign, append=False)
+
+    def run_w_assign(self, h5filename, outfile, append=True, bins=None, states=None, subsample=False):
+        args = ['-W', h5filename, '-o', outfile, '--serial',
+                '--bins-from-expr', bins or self.bins, '--states'] + (states or self.states)
+        if append:
+            args.append('--append')
+        if subsample:
+            args.append('--subsample')
+        w = WAssign()
+        w.make_parser_and_process(args=args)
+        with w.work_manager:
+            try:
+                w.go()
+            finally:
+                # The serial work manager reads through files cached in this process
+                h5io.close_h5files()
+
+    @staticmethod
+    def mark(filename):
+        '''Mark an output file, so that it can be seen whether it was later replaced or extended.'''
+        with h5py.File(filename, 'r+') as h5file:
+            h5file.attrs['test_marker'] = True
+
+    @staticmethod
+    def is_marked(filename):
+        with h5py.File(filename, 'r') as h5file:
+            return 'test_marker' in h5file.attrs
+
+    @staticmethod
+    def compare_outputs(filename1, filename2):
+        '''Return a list of the differences between two w_assign output files, in their objects, the values
+        of their attributes (except those recording their creation), and the types, shapes, and bytes of
+        their datasets.'''
+        differences = []
+        with h5py.File(filename1, 'r') as f1, h5py.File(filename2, 'r') as f2:
+            names1, names2 = [], []
+            f1.visit(names1.append)
+            f2.visit(names2.append)
+            if sorted(names1) != sorted(names2):
+                differences.append(('names', sorted(set(names1) ^ set(names2))))
+            for name in ['/'] + sorted(set(names1) & set(names2)):
+                obj1, obj2 = f1[name], f2[name]
+                attrs1, attrs2 = ({key: value for (key, value) in obj.attrs.items()
+                                   if not key.startswith(('creation_', 'test_'))} for obj in (obj1, obj2))
+                if sorted(attrs1) != sorted(attrs2) \
+                  or not all(numpy.array_equal(attrs1[key], attrs2[key]) for key in attrs1):
+                    differences.append(('attrs', name))
+                if isinstance(obj1, h5py.Dataset):
+                    d1, d2 = obj1[()], obj2[()]
+                    if (d1.dtype, d1.shape) != (d2.dtype, d2.shape) or d1.tobytes() != d2.tobytes():
+                        differences.append(('data', name))
+        return differences
+
+    def test_append(self):
+        '''w_assign --append: appending gives the same output as assigning all iterations'''
+        outfile = os.path.join(self.tempdir, 'assign.h5')
+        self.run_w_assign(self.partial_filename, outfile)
+        with h5py.File(outfile, 'r') as h5file:
+            assert h5file.attrs['iter_stop'] == self.n_iters_partial + 1
+        self.mark(outfile)
+
+        self.run_w_assign(self.h5filename, outfile)
+        assert self.is_marked(outfile), 'output was not appended to'
+        differences = self.compare_outputs(outfile, self.full_assign)
+        assert not differences, differences
+
+    def test_trajectory_labels_carried(self):
+        '''w_assign --append: trajectories keep their macrostate labels across the iterations appended'''
+        outfile = os.path.join(self.tempdir, 'assign.h5')
+        self.run_w_assign(self.partial_filename, outfile)
+        self.run_w_assign(self.h5filename, outfile)
+
+        with h5py.File(outfile, 'r') as h5file, h5py.File(self.full_assign, 'r') as full_file:
+            iiter = self.n_iters_partial
+            nsegs, npts = h5file['nsegs'][iiter], h5file['npts'][iiter]
+            nstates = h5file.attrs['nstates']
+            trajlabels = h5file['trajlabels'][iiter, :nsegs, :npts]
+            statelabels = h5file['statelabels'][iiter, :nsegs, :npts]
+            assert numpy.array_equal(trajlabels, full_file['trajlabels'][iiter, :nsegs, :npts])
+            # Some segments start the first iteration appended outside of any state, but are labeled with
+            # the last state their trajectories visited in the iterations assigned before
+            carried = (statelabels[:, 0] == nstates) & (trajlabels[:, 0] != nstates)
+            assert carried.any()
+
+    def check_fallback(self, **first_args):
+        outfile = os.path.join(self.tempdir, 'assign.h5')
+        self.run_w_assign(self.partial_filename, outfile, **first_args)
+        self.mark(outfile)
+
+        self.run_w_assign(self.h5filename, outfile)
+        assert not self.is_marked(outfile), 'output was appended to'
+        differences = self.compare_outputs(outfile, self.full_assign)
+        assert not differences, differences
+
+    def test_fallback_binning(self):
+        '''w_assign --append: different bins cause all iterations to be assigned'''
+        self.check_fallback(bins="[[0.0, 7.0, 7.4, 7.8, float('inf')]]")
+
+    def test_fallback_state_labels(self):
+        '''w_assign --append: different state labels cause all iterations to be assigned'''
+        self.check_fallback(states=['bound:6.5', 'unbound:7.9'])
+
+    def test_fallback_state_map(self):
+        '''w_assign --append: different states cause all iterations to be assigned'''
+        self.check_fallback(states=['low:6.5', 'high:7.6'])
+
+    def test_fallback_subsample(self):
+        '''w_assign --append: a different subsampling setting causes all iterations to be assigned'''
+        self.check_fallback(subsample=True)
+
+    def test_no_new_iterations(self):
+        '''w_assign --append: the output file is not touched when there are no new iterations'''
+        outfile = os.path.join(self.tempdir, 'assign.h5')
+        shutil.copyfile(self.full_assign, outfile)
+        with open(outfile, 'rb') as f:
+            contents = f.read()
+        mtime = os.stat(outfile).st_mtime_ns
+
+        self.run_w_assign(self.h5filename, outfile)
+        assert os.stat(outfile).st_mtime_ns == mtime
+        with open(outfile, 'rb') as f:
+            assert f.read() == contents
+
+    def test_interrupted_append(self):
+        '''w_assign --append: an interrupted append is completed by the next'''
+        outfile = os.path.join(self.tempdir, 'assign.h5')
+        self.run_w_assign(self.partial_filename, outfile)
+
+        # Interrupt an append after its datasets are resized and filled, but before the range of
+        # complete iterations is stamped on the file
+        stamp_iter_range = w_assign.h5io.stamp_iter_range
+        def interrupt_stamp(h5object, start, stop):
+            if isinstance(h5object, h5py.File):
+                raise AssignmentInterrupted()
+            stamp_iter_range(h5object, start, stop)
+        w_assign.h5io.stamp_iter_range = interrupt_stamp
+        try:
+            with nose.tools.assert_raises(AssignmentInterrupted):
+                self.run_w_assign(self.h5filename, outfile)
+        finally:
+            w_assign.h5io.stamp_iter_range = stamp_iter_range
+        with h5py.File(outfile, 'r') as h5file:
+            assert h5file.attrs['iter_stop'] == self.n_iters_partial + 1
+            assert h5file['assignments'].shape[0] == self.n_iters
+
+        self.mark(outfile)
+        self.run_w_assign(self.h5filename, outfile)
+        assert self.is_marked(outfile), 'output was not appended to'
+        differences = self.compare_outputs(outfile, self.full_assign)
+        assert not differences, differences
@@ -0,0 +1,122 @@
+import nose
+import nose.tools
+
+import os, sys, runpy
+import numpy
+import h5py
+import westpa
+from west.states import TargetState
+from west.tests.tsupport import SimulationRunTests
+from w_assign import WAssign
+
+
+class Test_W_Pack(SimulationRunTests):
+    '''Tests that w_pack converts a simulation to packed storage without losing or altering data,
+    and that the packed file can be read as the original.'''
+
+    n_iters = 4
+
+    def setup(self):
+        super().setup()
+
+        # A second set of target states (and so a second state group) from iteration 3
+        def move_target():
+            sim_manager = westpa.rc.get_sim_manager()
+            if sim_manager.n_iter == 2:
+                sim_manager.data_manager.save_target_states([TargetState('sink', [7.8])], n_iter=3)
+
+        self.h5filename = self.run_sim('unpacked', n_iters=self.n_iters, callbacks=[('post_we', move_target)])
+        with h5py.File(self.h5filename, 'r+') as h5file:
+            for n_iter in range(1, self.n_iters+1):
+                iter_group = h5file['/iterations/iter_{:08d}'.format(n_iter)]
+                iter_group.create_dataset('auxdata/final_coord', data=iter_group['pcoord'][:,-1,0])
+                iter_group['final_coord'] = h5py.SoftLink(iter_group.name + '/auxdata/final_coord')
+
+        self.packed_filename = os.path.join(self.tempdir, 'west_packed.h5')
+        saved_argv = sys.argv
+        sys.argv = ['w_pack', '-r', os.path.join(os.path.dirname(self.h5filename), 'west.cfg'), '--quiet',
+                    '-i', self.h5filename, '-o', self.packed_filename]
+        try:
+            runpy.run_path(os.path.join(os.environ['WEST_ROOT'], 'lib', 'cmds', 'w_pack.py'), run_name='__main__')
+        finally:
+            sys.argv = saved_argv
+
+    def test_file_contents(self):
+        with h5py.File(self.h5filename, 'r') as old_file, h5py.File(self.packed_filename, 'r') as new_file:
+            assert new_file.attrs['west_file_format_version'] == 8
+            assert 'packed' in new_file
+            assert (new_file['summary'][...] == old_file['summary'][...]).all()
+
+            # State groups are referred to by the copies of the indices...
+            for master_group_name in ('ibstates', 'tstates'):
+                old_index = old_file[master_group_name]['index'][...]
+                new_index = new_file[master_group_name]['index'][...]
+                assert len(new_index) == len(old_index)
+                if master_group_name == 'tstates':
+                    assert len(new_index) == 2
+                for (old_row, new_row) in zip(old_index, new_index):
+                    old_group, new_group = old_file[old_row['group_ref']], new_file[new_row['group_ref']]
+                    assert new_group.name == old_group.name
+                    assert new_group.file == new_file
+
+                # ... and hard-linked from the iteration groups using them
+                for n_iter in range(1, self.n_iters+1):
+                    iter_name = '/iterations/iter_{:08d}'.format(n_iter)
+                    old_link, new_link = old_file[iter_name][master_group_name], new_file[iter_name][master_group_name]
+                    assert isinstance(new_file[iter_name].get(master_group_name, getlink=True), h5py.HardLink)
+                    (irow,) = [irow for irow in range(len(old_index)) if old_file[old_index[irow]['group_ref']] == old_link]
+                    assert new_file[new_index[irow]['group_ref']] == new_link
+
+            for n_iter in range(1, self.n_iters+1):
+                iter_name = '/iterations/iter_{:08d}'.format(n_iter)
+                old_group, new_group = old_file[iter_name], new_file[iter_name]
+                assert dict(new_group.attrs) == dict(old_group.attrs)
+                assert 'pcoord' not in new_group and 'seg_index' not in new_group
+                assert (new_group['auxdata/final_coord'][...] == old_group['auxdata/final_coord'][...]).all()
+                link = new_group.get('final_coord', getlink=True)
+                assert isinstance(link, h5py.SoftLink)
+                assert link.path == iter_name + '/auxdata/final_coord'
+                assert (new_group['final_coord'][...] == old_group['pcoord'][:,-1,0]).all()
+
+    def test_data_manager(self):
+        old_dm, new_dm = westpa.rc.new_data_manager(), westpa.rc.new_data_manager()
+        old_dm.we_h5filename, new_dm.we_h5filename = self.h5filename, self.packed_filename
+        old_dm.open_backing('r')
+        new_dm.open_backing('r')
+        try:
+            assert new_dm.packed_storage
+            assert new_dm.current_iteration == old_dm.current_iteration
+            for n_iter in range(1, self.n_iters+1):
+                old_segments, new_segments = old_dm.get_segments(n_iter), new_dm.get_segments(n_iter)
+                assert len(new_segments) == len(old_segments)
+                for (old_segment, new_segment) in zip(old_segments, new_segments):
+                    assert (new_segment.seg_id, new_segment.weight, new_segment.parent_id, new_segment.wtg_parent_ids) \
+                        == (old_segment.seg_id, old_segment.weight, old_segment.parent_id, old_segment.wtg_parent_ids)
+                    assert (new_segment.pcoord == old_segment.pcoord).all()
+
+                old_tstates, new_tstates = old_dm.get_target_states(n_iter), new_dm.get_target_states(n_iter)
+                assert [(tstate.label, tuple(tstate.pcoord)) for tstate in new_tstates] \
+                    == [(tstate.label, tuple(tstate.pcoord)) for tstate in old_tstates]
+                assert [(bstate.label, bstate.probability) for bstate in new_dm.get_basis_states(n_iter)] \
+                    == [(bstate.label, bstate.probability) for bstate in old_dm.get_basis_states(n_iter)]
+        finally:
+            old_dm.close_backing()
+            new_dm.close_backing()
+
+    def run_w_assign(self, h5filename, outfile):
+        w = WAssign()
+        w.make_parser_and_process(args=['-W', h5filename, '-o', outfile, '--serial',
+                                        '--bins-from-expr', "[[0.0, 7.0, 7.5, 7.8, float('inf')]]",
+                                        '--states', 'low:6.5', 'high:7.9'])
+        with w.work_manager:
+            w.go()
+
+    def test_w_assign(self):
+        old_assign = os.path.join(self.tempdir, 'assign.h5')
+        new_assign = os.path.join(self.tempdir, 'assign_packed.h5')
+        self.run_w_assign(self.h5filename, old_assign)
+        self.run_w_assign(self.packed_filename, new_assign)
+        with h5py.File(old_assign, 'r') as old_file, h5py.File(new_assign, 'r') as new_file:
+            assert new_file.attrs['iter_stop'] == old_file.attrs['iter_stop'] == self.n_iters + 1
+            for dsname in ('nsegs', 'npts', 'assignments', 'trajlabels', 'statelabels', 'labeled_populations'):
+                assert numpy.array_equal(new_file[dsname][...], old_file[dsname][...]), dsname
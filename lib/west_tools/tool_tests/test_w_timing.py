@@ -0,0 +1,71 @@
+
+import nose
+import nose.tools
+
+import os
+import westpa
+from west.tests.tsupport import SimulationRunTests
+from w_timing import WTiming
+
+
+class Test_W_Timing(SimulationRunTests):
+    '''Tests the output of w_timing for a short simulation run with timing information saved.'''
+
+    def setup(self):
+        super().setup()
+        self.h5filename = self.run_sim('timed', n_iters=3, options={'save_timing': 'true'})
+
+    def run_tool(self, *args):
+        outfile = os.path.join(self.tempdir, 'timing.txt')
+        self.w = WTiming()
+        self.w.make_parser_and_process(args=['-W', self.h5filename, '-o', outfile] + list(args))
+        self.w.go()
+        self.w.output_file.close()
+        with open(outfile, 'rt') as output:
+            return output.read().splitlines()
+
+    def get_timings(self):
+        data_manager = westpa.rc.get_data_manager()
+        data_manager.open_backing('r')
+        try:
+            return [data_manager.get_iter_timing(n_iter) for n_iter in (1, 2, 3)]
+        finally:
+            data_manager.close_backing()
+
+    def test_summary(self):
+        lines = self.run_tool()
+        timings = self.get_timings()
+        assert lines[0] == '# timing for 3 iterations (1 to 3), in seconds'
+        assert lines[1].split() == ['#', 'name', 'total', 'fraction', 'mean', 'max', 'first', '1/4', 'last', '1/4']
+
+        # Entries are reported in decreasing order of total time, the whole iteration first
+        rows = [line.split() for line in lines[2:]]
+        assert rows[0][:3] == ['iteration', '{:.6g}'.format(sum(timing['iteration'][0] for timing in timings)), '100.00%']
+        totals = [float(row[1]) for row in rows]
+        assert totals == sorted(totals, reverse=True)
+        assert {'propagate', 'run_we', 'data_manager:update_segments'} <= {row[0] for row in rows}
+
+        assert len(self.run_tool('-n', '3')) == 2 + 3
+
+    def test_per_iteration(self):
+        lines = self.run_tool('--per-iteration', 'propagate', 'run_we')
+        timings = self.get_timings()
+        assert lines[0].split() == ['#', 'n_iter', 'propagate', 'run_we']
+        for (n_iter, line, timing) in zip((1, 2, 3), lines[1:], timings):
+            assert line.split() == [str(n_iter), '{:.6g}'.format(timing['propagate'][0]), '{:.6g}'.format(timing['run_we'][0])]
+        assert len(lines) == 4
+
+    def test_events(self):
+        data_manager = westpa.rc.get_data_manager()
+        data_manager.open_backing('r+')
+        try:
+            data_manager.save_iter_events(1, [('propagate:straggler_resubmitted', 2)])
+            data_manager.save_iter_events(3, [('propagate:straggler_resubmitted', 1), ('propagate:speculative_won', 1)])
+        finally:
+            data_manager.close_backing()
+
+        lines = self.run_tool()
+        start = lines.index('# events in iterations 1 to 3')
+        assert [line.split() for line in lines[start+1:]] == [['#', 'name', 'count', 'iterations'],
+                                                              ['propagate:speculative_won', '1', '1'],
+                                                              ['propagate:straggler_resubmitted', '3', '2']]
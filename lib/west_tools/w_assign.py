@@ -15,9 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys
+import sys, os
 import logging
 import math
+import hashlib
+from pickle import PickleError
 from numpy import index_exp
 import h5py
 
@@ -211,6 +213,20 @@ populations, for all defined bins and
 per-trajectory-ensemble populations for all defined states. 
 
     
+-----------------------------------------------------------------------------
+Appending new iterations
+-----------------------------------------------------------------------------
+
+With --append, iterations already assigned in the output file are kept,
+and only iterations completed since are assigned and appended to it.
+Trajectories in the new iterations continue with the macrostate labels of
+the last iteration stored. This is only possible if the bin mapper and
+macrostate definitions (and subsampling) are those with which the output
+file was written; otherwise, a note is printed and all iterations are
+assigned anew. The same source data (--construct-dataset or --dsspecs) must
+be used, as this cannot be checked.
+
+    
 -----------------------------------------------------------------------------
 Parallelization
 -----------------------------------------------------------------------------
@@ -239,6 +255,7 @@ Command-line options
         self.output_filename = None
         self.states = []
         self.subsample = False
+        self.append = False
     
     def add_args(self, parser):
         self.data_reader.add_args(parser)
@@ -266,6 +283,10 @@ Command-line options
         agroup.add_argument('--subsample', dest='subsample', action='store_const', const=True,
                              help='''Determines whether or not the data should be subsampled.
                              This is rather useful for analysing steady state simulations.''')
+        agroup.add_argument('--append', dest='append', action='store_true',
+                            help='''Assign only iterations not already present in OUTPUT, appending them to it.
+                            If OUTPUT does not exist, or was written with different bin or macrostate
+                            definitions, all iterations are assigned (as without this option).''')
         agroup.add_argument('--config-from-file', dest='config_from_file', action='store_true', 
                             help='''Load bins/macrostates from a scheme specified in west.cfg.''')
         agroup.add_argument('--scheme-name', dest='scheme',
@@ -310,6 +331,7 @@ Command-line options
         log.debug('state list: {!r}'.format(self.states))
 
         self.subsample = args.subsample if args.subsample is not None else False
+        self.append = args.append
 
     def parse_cmdline_states(self, state_strings):
         states = []
@@ -439,6 +461,52 @@ Command-line options
         del futures
         return (assignments, trajlabels, pops, statelabels)
 
+    def definitions_hash(self, state_labels, state_map):
+        '''Return a hash identifying the bin mapper and the macrostate definitions (the labels of the
+        states and the bins they contain), or None if the bin mapper cannot be pickled.'''
+        try:
+            _pickle, mapper_hash = self.binning.mapper.pickle_and_hash()
+        except PickleError as e:
+            log.debug('could not pickle bin mapper: {}'.format(e))
+            return None
+        hasher = hashlib.sha256(mapper_hash.encode())
+        for label in state_labels:
+            hasher.update(label)
+            hasher.update(b'\0')
+        hasher.update(state_map.tobytes())
+        return hasher.hexdigest()
+
+    def find_append_start(self, definitions_hash, iter_stop):
+        '''Return the first iteration not yet assigned in an existing output file, or 1 if there is no
+        such file or it cannot be extended (in which case the entire simulation is assigned anew).'''
+        if not os.path.exists(self.output_filename):
+            return 1
+
+        with h5py.File(self.output_filename, 'r') as output_file:
+            try:
+                stored_stop = h5io.get_iter_range(output_file)[1]
+                stored_hash = output_file.attrs.get('definitions_hash')
+                subsampled = bool(output_file.attrs['subsampled'])
+                resizable = output_file['assignments'].maxshape[0] is None
+            except KeyError:
+                reason = 'it is incomplete or was not written by w_assign'
+            else:
+                if definitions_hash is None:
+                    reason = 'the bin mapper cannot be pickled, so bin definitions cannot be compared'
+                elif stored_hash != definitions_hash:
+                    reason = 'its bin or macrostate definitions differ from the current ones'
+                elif subsampled != bool(self.subsample):
+                    reason = 'its subsampling setting differs from the current one'
+                elif not resizable:
+                    reason = 'its datasets cannot be resized (it was written by an older w_assign)'
+                elif stored_stop > iter_stop:
+                    reason = 'it contains iterations beyond the last complete iteration'
+                else:
+                    return stored_stop
+
+        westpa.rc.pstatus('Cannot append to {}, as {}; assigning all iterations.'.format(self.output_filename, reason))
+        return 1
+
     def go(self):
         assert self.data_reader.parent_id_dsspec._h5file is None
         assert self.data_reader.weight_dsspec._h5file is None
@@ -446,63 +514,121 @@ Command-line options
             assert self.dssynth.dsspec._h5file is None
         pi = self.progress.indicator
         pi.operation = 'Initializing'
-        with pi, self.data_reader, WESTPAH5File(self.output_filename, 'w', creating_program=True) as self.output_file:
+        with pi, self.data_reader:
             assign = self.binning.mapper.assign
 
             # We always assign the entire simulation, so that no trajectory appears to start
-            # in a transition region that doesn't get initialized in one.
-            iter_start = 1 
+            # in a transition region that doesn't get initialized in one. When appending,
+            # the iterations already assigned are reused, and assignment continues from
+            # the labels of the last of them.
             iter_stop =  self.data_reader.current_iteration
 
-            h5io.stamp_iter_range(self.output_file, iter_start, iter_stop)
-
             nbins = self.binning.mapper.nbins
-            self.output_file.attrs['nbins'] = nbins 
 
             state_map = numpy.empty((self.binning.mapper.nbins+1,), index_dtype)
             state_map[:] = 0 # state_id == nstates => unknown state
 
-            # Recursive mappers produce a generator rather than a list of labels
-            # so consume the entire generator into a list
-            labels = [numpy.string_(label) for label in self.binning.mapper.labels]
-
-            self.output_file.create_dataset('bin_labels', data=labels, compression=9)
-
             if self.states:
                 nstates = len(self.states)
                 state_map[:] = nstates # state_id == nstates => unknown state
-                state_labels = [numpy.string_(state['label']) for state in self.states]
+                state_labels = [numpy.bytes_(state['label']) for state in self.states]
 
                 for istate, sdict in enumerate(self.states):
-                    assert state_labels[istate] == numpy.string_(sdict['label']) #sanity check
+                    assert state_labels[istate] == numpy.bytes_(sdict['label']) #sanity check
                     state_assignments = assign(sdict['coords'])
                     for assignment in state_assignments:
                         state_map[assignment] = istate
-                self.output_file.create_dataset('state_map', data=state_map, compression=9, shuffle=True)
-                self.output_file['state_labels'] = state_labels #+ ['(unknown)']
             else:
                 nstates = 0
+                state_labels = []
+
+            definitions_hash = self.definitions_hash(state_labels, state_map)
+            iter_start = self.find_append_start(definitions_hash, iter_stop) if self.append else 1
+            if iter_start == iter_stop:
+                westpa.rc.pstatus('No new iterations to append to {}'.format(self.output_filename))
+                return
+            elif iter_start > 1:
+                westpa.rc.pstatus('Appending iterations {:d} to {:d} to {}'.format(iter_start, iter_stop-1, self.output_filename))
+                self.output_file = WESTPAH5File(self.output_filename, 'r+', creating_program=True)
+            else:
+                self.output_file = WESTPAH5File(self.output_filename, 'w', creating_program=True)
+            
+            with self.output_file:
+                self.assign_iterations(iter_start, iter_stop, nbins, nstates, state_labels, state_map, definitions_hash)
+
+    def assign_iterations(self, iter_start, iter_stop, nbins, nstates, state_labels, state_map, definitions_hash):
+        '''Assign iterations ``iter_start`` <= n_iter < ``iter_stop`` to bins, storing the results in the
+        (open) output file. Unless ``iter_start`` is 1, the output file must already contain the assignments
+        of all prior iterations, which are extended.'''
+        pi = self.progress.indicator
+        appending = (iter_start > 1)
+
+        if not appending:
+            self.output_file.attrs['nbins'] = nbins 
+
+            # Recursive mappers produce a generator rather than a list of labels
+            # so consume the entire generator into a list
+            labels = [numpy.bytes_(label) for label in self.binning.mapper.labels]
+
+            self.output_file.create_dataset('bin_labels', data=labels, compression=9)
+
+            if self.states:
+                self.output_file.create_dataset('state_map', data=state_map, compression=9, shuffle=True)
+                self.output_file['state_labels'] = state_labels #+ ['(unknown)']
             self.output_file.attrs['nstates'] = nstates
             # Stamp if this has been subsampled.
             self.output_file.attrs['subsampled'] = self.subsample
+            # Stamp the definitions used, so that new iterations may later be appended
+            if definitions_hash is not None:
+                self.output_file.attrs['definitions_hash'] = definitions_hash
+
+        iter_count = iter_stop - iter_start
+        nsegs = numpy.empty((iter_count,), seg_id_dtype)
+        npts = numpy.empty((iter_count,), seg_id_dtype)
+
+        # scan for largest number of segments and largest number of points
+        pi.new_operation ('Scanning for segment and point counts', iter_stop-iter_start)
+        for iiter, n_iter in enumerate(range(iter_start,iter_stop)):
+            iter_group = self.data_reader.get_iter_group(n_iter)
+            nsegs[iiter], npts[iiter] = iter_group['pcoord'].shape[0:2]
+            pi.progress += 1
+            del iter_group
+
+        pi.new_operation('Preparing output')
+
+        if appending:
+            # Datasets are indexed by n_iter-1; extend them to hold the new iterations
+            nsegs_ds = self.output_file['nsegs']
+            npts_ds = self.output_file['npts']
+            assignments_ds = self.output_file['assignments']
+            pops_ds = self.output_file['labeled_populations']
+            if self.states:
+                trajlabels_ds = self.output_file['trajlabels']
+                statelabels_ds = self.output_file['statelabels']
 
-            iter_count = iter_stop - iter_start
-            nsegs = numpy.empty((iter_count,), seg_id_dtype)
-            npts = numpy.empty((iter_count,), seg_id_dtype)
-
-            # scan for largest number of segments and largest number of points
-            pi.new_operation ('Scanning for segment and point counts', iter_stop-iter_start)
-            for iiter, n_iter in enumerate(range(iter_start,iter_stop)):
-                iter_group = self.data_reader.get_iter_group(n_iter)
-                nsegs[iiter], npts[iiter] = iter_group['pcoord'].shape[0:2]
-                pi.progress += 1
-                del iter_group
+            # Labels of the last iteration assigned, from which trajectories continue
+            prev_nsegs, prev_npts = nsegs_ds[iter_start-2], npts_ds[iter_start-2]
+            if self.states:
+                last_labels = numpy.array(trajlabels_ds[iter_start-2, 0:prev_nsegs, prev_npts-1], dtype=index_dtype)
+            else:
+                last_labels = numpy.empty((prev_nsegs,), index_dtype)
+                last_labels[:] = nstates #unknown state
 
-            pi.new_operation('Preparing output')
+            for ds in (nsegs_ds, npts_ds, pops_ds):
+                ds.resize(iter_stop-1, axis=0)
+            nsegs_ds[iter_start-1:] = nsegs
+            npts_ds[iter_start-1:] = npts
 
+            assignments_shape = (iter_stop-1, max(nsegs.max(initial=0), assignments_ds.shape[1]),
+                                 max(npts.max(initial=0), assignments_ds.shape[2]))
+            assignments_ds.resize(assignments_shape)
+            if self.states:
+                trajlabels_ds.resize(assignments_shape)
+                statelabels_ds.resize(assignments_shape)
+        else:
             # create datasets
-            self.output_file.create_dataset('nsegs', data=nsegs, shuffle=True, compression=9)
-            self.output_file.create_dataset('npts', data=npts, shuffle=True, compression=9)
+            self.output_file.create_dataset('nsegs', data=nsegs, shuffle=True, compression=9, maxshape=(None,))
+            self.output_file.create_dataset('npts', data=npts, shuffle=True, compression=9, maxshape=(None,))
 
             max_nsegs = nsegs.max()
             max_npts = npts.max()
@@ -510,52 +636,55 @@ Command-line options
             assignments_shape = (iter_count,max_nsegs,max_npts)
             assignments_dtype = numpy.min_scalar_type(nbins)
             assignments_ds = self.output_file.create_dataset('assignments', dtype=assignments_dtype, shape=assignments_shape,
-                                                             compression=4, shuffle=True,
+                                                             maxshape=(None,None,None), compression=4, shuffle=True,
                                                              chunks=h5io.calc_chunksize(assignments_shape, assignments_dtype),
                                                              fillvalue=nbins)
             if self.states:
                 trajlabel_dtype = numpy.min_scalar_type(nstates)
                 trajlabels_ds = self.output_file.create_dataset('trajlabels', dtype=trajlabel_dtype, shape=assignments_shape,
-                                                                compression=4, shuffle=True,
+                                                                maxshape=(None,None,None), compression=4, shuffle=True,
                                                                 chunks=h5io.calc_chunksize(assignments_shape, trajlabel_dtype),
                                                                 fillvalue=nstates)
                 statelabels_ds = self.output_file.create_dataset('statelabels', dtype=trajlabel_dtype, shape=assignments_shape,
-                                                                compression=4, shuffle=True,
+                                                                maxshape=(None,None,None), compression=4, shuffle=True,
                                                                 chunks=h5io.calc_chunksize(assignments_shape, trajlabel_dtype),
                                                                 fillvalue=nstates)
 
             pops_shape = (iter_count,nstates+1,nbins+1)
             pops_ds = self.output_file.create_dataset('labeled_populations', dtype=weight_dtype, shape=pops_shape,
-                                                      compression=4, shuffle=True,
+                                                      maxshape=(None,nstates+1,nbins+1), compression=4, shuffle=True,
                                                       chunks=h5io.calc_chunksize(pops_shape, weight_dtype))
-            h5io.label_axes(pops_ds, [numpy.string_(i) for i in ['iteration', 'state', 'bin']])
-
-            pi.new_operation('Assigning to bins', iter_stop-iter_start)
+            h5io.label_axes(pops_ds, [numpy.bytes_(i) for i in ['iteration', 'state', 'bin']])
             last_labels = None # mapping of seg_id to last macrostate inhabited      
-            for iiter, n_iter in enumerate(range(iter_start,iter_stop)):
-                #get iteration info in this block
 
-                if iiter == 0:
-                    last_labels = numpy.empty((nsegs[iiter],), index_dtype)
-                    last_labels[:] = nstates #unknown state
+        pi.new_operation('Assigning to bins', iter_stop-iter_start)
+        for iiter, n_iter in enumerate(range(iter_start,iter_stop)):
+            #get iteration info in this block
 
-                #Slices this iteration into n_workers groups of segments, submits them to wm, splices results back together
-                assignments, trajlabels, pops, statelabels = self.assign_iteration(n_iter, nstates, nbins, state_map, last_labels)
+            if n_iter == 1:
+                last_labels = numpy.empty((nsegs[iiter],), index_dtype)
+                last_labels[:] = nstates #unknown state
 
-                ##Do stuff with this iteration's results
+            #Slices this iteration into n_workers groups of segments, submits them to wm, splices results back together
+            assignments, trajlabels, pops, statelabels = self.assign_iteration(n_iter, nstates, nbins, state_map, last_labels)
 
-                last_labels = trajlabels[:,-1].copy()
-                assignments_ds[iiter, 0:nsegs[iiter], 0:npts[iiter]] = assignments
-                pops_ds[iiter] = pops
-                if self.states:
-                    trajlabels_ds[iiter, 0:nsegs[iiter], 0:npts[iiter]]  = trajlabels
-                    statelabels_ds[iiter, 0:nsegs[iiter], 0:npts[iiter]]  = statelabels
+            ##Do stuff with this iteration's results
+
+            last_labels = trajlabels[:,-1].copy()
+            assignments_ds[n_iter-1, 0:nsegs[iiter], 0:npts[iiter]] = assignments
+            pops_ds[n_iter-1] = pops
+            if self.states:
+                trajlabels_ds[n_iter-1, 0:nsegs[iiter], 0:npts[iiter]]  = trajlabels
+                statelabels_ds[n_iter-1, 0:nsegs[iiter], 0:npts[iiter]]  = statelabels
 
-                pi.progress += 1
-                del assignments, trajlabels, pops, statelabels
+            pi.progress += 1
+            del assignments, trajlabels, pops, statelabels
 
-            for dsname in 'assignments', 'npts', 'nsegs', 'labeled_populations', 'statelabels':
-                h5io.stamp_iter_range(self.output_file[dsname], iter_start, iter_stop)
+        for dsname in 'assignments', 'npts', 'nsegs', 'labeled_populations', 'trajlabels', 'statelabels':
+            if dsname in self.output_file:
+                h5io.stamp_iter_range(self.output_file[dsname], 1, iter_stop)
+        # Stamped last, so that an interrupted run leaves the range of complete iterations in place
+        h5io.stamp_iter_range(self.output_file, 1, iter_stop)
 
 if __name__ == '__main__':
     WAssign().main()
@@ -22,6 +22,7 @@ log = logging.getLogger('w_bins')
 
 from westtools import WESTTool, WESTDataReader, BinMappingComponent
 import westpa
+from westpa import h5io
 
 from westtools.binning import write_bin_info
 
@@ -98,7 +99,7 @@ modify the binning for the current iteration of a WEST simulation.
         iter_group = self.data_reader.get_iter_group(self.n_iter)
         
         # bin initial pcoords for iteration n_iter
-        initial_pcoords = iter_group['pcoord'][:,0,:]
+        initial_pcoords = h5io.get_pcoord_points(iter_group, [0])[:,0,:]
         assignments = mapper.assign(initial_pcoords)
         del initial_pcoords
         
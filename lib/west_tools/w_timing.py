@@ -0,0 +1,184 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import numpy
+from westtools import WESTTool, WESTDataReader, IterRangeSelection
+
+import logging
+log = logging.getLogger('westtools.w_timing')
+
+class WTiming(WESTTool):
+    prog='w_timing'
+    description = '''\
+Summarize where the wallclock time of a WEST simulation goes, using the
+per-iteration timing information stored by ``w_run`` when the ``save_timing``
+option in the ``propagation`` section of west.cfg is enabled.
+
+Entries are named for the phase of the iteration in which time was spent
+(e.g. ``propagate``, ``run_we``), for time spent within a phase (e.g.
+``propagate:wait``, time spent waiting on the work manager;
+``propagate:tail``, time spent waiting on the last 5% of propagation tasks;
+and ``propagate:istate_generation``, the turnaround time of initial state
+generation tasks, summed over all such tasks), for plugin callbacks (``callback:HOOK:FUNCTION``) and for data manager
+operations (``data_manager:METHOD``). Times are inclusive; for instance, time
+spent in callbacks invoked during a phase is also counted in that phase.
+
+For each entry, the total and mean time per iteration are reported, along
+with the mean time over the first and last quarters of the iteration range,
+which indicates whether the cost of the entry is growing as the simulation
+proceeds. Counts of events recorded by ``w_run`` (e.g.
+``propagate:straggler_resubmitted``, the resubmission of a straggling block
+of segments) are reported after the timing entries, along with the number of
+iterations in which each occurred.
+
+-----------------------------------------------------------------------------
+Command-line options
+-----------------------------------------------------------------------------
+'''
+
+    def __init__(self):
+        super(WTiming,self).__init__()
+        self.data_reader = WESTDataReader()
+        self.iter_range = IterRangeSelection()
+        self.output_file = None
+        self.n_entries = None
+        self.per_iteration = None
+
+    def add_args(self, parser):
+        self.data_reader.add_args(parser)
+        self.iter_range.add_args(parser)
+
+        parser.add_argument('-n', '--count', dest='n_entries', type=int, default=25,
+                            help='''Report the COUNT entries with the largest total time (default: %(default)d;
+                            use 0 to report all entries).''')
+        parser.add_argument('--per-iteration', dest='per_iteration', nargs='+', metavar='NAME',
+                            help='''Instead of a summary, print the time spent in each of the named entries
+                            for every iteration.''')
+        parser.add_argument('-o', '--output', dest='output_file',
+                            help='Store output in OUTPUT_FILE (default: write to standard output).')
+
+    def process_args(self, args):
+        self.data_reader.process_args(args)
+        with self.data_reader:
+            self.iter_range.process_args(args)
+        self.output_file = open(args.output_file, 'wt') if args.output_file else sys.stdout
+        self.n_entries = args.n_entries
+        self.per_iteration = args.per_iteration
+
+    def load_timings(self):
+        '''Return the iterations with timing data, and a dictionary mapping entry name to
+        an array of wallclock times spent in that entry, indexed by iteration.'''
+
+        n_iters = []
+        timing_tables = []
+        for n_iter in range(self.iter_range.iter_start, self.iter_range.iter_stop):
+            timings = self.data_reader.get_iter_timing(n_iter)
+            if timings:
+                n_iters.append(n_iter)
+                timing_tables.append(timings)
+
+        walltimes = {}
+        for (iiter, timings) in enumerate(timing_tables):
+            for (name, (walltime, _count)) in timings.items():
+                try:
+                    entry = walltimes[name]
+                except KeyError:
+                    entry = walltimes[name] = numpy.zeros((len(timing_tables),), numpy.float64)
+                entry[iiter] = walltime
+        return numpy.array(n_iters), walltimes
+
+    def load_events(self):
+        '''Return a dictionary mapping event name to a list of the total number of occurrences
+        and the number of iterations in which the event occurred.'''
+
+        events = {}
+        for n_iter in range(self.iter_range.iter_start, self.iter_range.iter_stop):
+            for (name, count) in self.data_reader.get_iter_events(n_iter).items():
+                entry = events.setdefault(name, [0, 0])
+                entry[0] += count
+                entry[1] += 1
+        return events
+
+    def report_summary(self, n_iters, walltimes):
+        n_quarter = max(1, len(n_iters)//4)
+        iter_totals = walltimes.get('iteration')
+        total_time = iter_totals.sum() if iter_totals is not None else None
+
+        names = sorted(walltimes, key=lambda name: walltimes[name].sum(), reverse=True)
+        if self.n_entries:
+            names = names[:self.n_entries]
+        max_name_len = max(len(name) for name in names)
+
+        self.output_file.write('# timing for {:d} iterations ({:d} to {:d}), in seconds\n'
+                               .format(len(n_iters), int(n_iters[0]), int(n_iters[-1])))
+        self.output_file.write('# {:{width}s}  {:>12s}  {:>8s}  {:>12s}  {:>12s}  {:>12s}  {:>12s}\n'
+                               .format('name', 'total', 'fraction', 'mean', 'max', 'first 1/4', 'last 1/4',
+                                       width=max_name_len-2))
+        for name in names:
+            times = walltimes[name]
+            fraction = times.sum()/total_time if total_time else float('nan')
+            self.output_file.write('{:{width}s}  {:12.6g}  {:8.2%}  {:12.6g}  {:12.6g}  {:12.6g}  {:12.6g}\n'
+                                   .format(name, times.sum(), fraction, times.mean(), times.max(),
+                                           times[:n_quarter].mean(), times[-n_quarter:].mean(),
+                                           width=max_name_len))
+
+    def report_events(self, events):
+        names = sorted(events)
+        max_name_len = max(len(name) for name in names)
+
+        self.output_file.write('# events in iterations {:d} to {:d}\n'
+                               .format(self.iter_range.iter_start, self.iter_range.iter_stop-1))
+        self.output_file.write('# {:{width}s}  {:>12s}  {:>12s}\n'.format('name', 'count', 'iterations',
+                                                                       width=max_name_len-2))
+        for name in names:
+            self.output_file.write('{:{width}s}  {:12d}  {:12d}\n'.format(name, events[name][0], events[name][1],
+                                                                        width=max_name_len))
+
+    def report_per_iteration(self, n_iters, walltimes):
+        names = self.per_iteration
+        missing = [name for name in names if name not in walltimes]
+        if missing:
+            log.warning('no timing information for {}'.format(', '.join(missing)))
+
+        self.output_file.write('# {:>8s}  {}\n'.format('n_iter', '  '.join('{:>12s}'.format(name) for name in names)))
+        empty = numpy.zeros((len(n_iters),), numpy.float64)
+        for (iiter, n_iter) in enumerate(n_iters):
+            self.output_file.write('{:10d}  {}\n'.format(int(n_iter),
+                                                          '  '.join('{:12.6g}'.format(walltimes.get(name,empty)[iiter])
+                                                                    for name in names)))
+
+    def go(self):
+        with self.data_reader:
+            n_iters, walltimes = self.load_timings()
+            events = self.load_events()
+
+        if not len(n_iters) and (self.per_iteration or not events):
+            log.error('no timing information found for iterations {:d} to {:d}'
+                      .format(self.iter_range.iter_start, self.iter_range.iter_stop-1))
+            sys.exit(1)
+
+        if self.per_iteration:
+            self.report_per_iteration(n_iters, walltimes)
+        else:
+            if len(n_iters):
+                self.report_summary(n_iters, walltimes)
+            if events:
+                self.report_events(events)
+
+if __name__ == '__main__':
+    WTiming().main()
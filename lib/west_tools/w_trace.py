@@ -70,34 +70,25 @@ class Trace:
         
         while n_iter > 0 and parent_id >= 0:
             seg_id = parent_id
-            iter_group = data_manager.get_iter_group(n_iter)
-            pcoord_ds = iter_group['pcoord']
-            seg_index = iter_group['seg_index']
-            n_segs = pcoord_ds.shape[0]
-            pcoord_len = pcoord_ds.shape[1]
+            segment_arrays = data_manager.get_segments_as_arrays(n_iter, [seg_id], pcoord_points=[-1], 
+                                                                 load_wtgraph=False)
+            assert len(segment_arrays) == 1
             
-            assert seg_id < n_segs
-            
-            indexrow = seg_index[seg_id]
-            final_pcoord = pcoord_ds[seg_id, pcoord_len-1]
+            indexrow = segment_arrays.seg_index[0]
+            final_pcoord = segment_arrays.pcoord[0,0]
             weight = indexrow['weight']
             cputime = indexrow['cputime']
             walltime = indexrow['walltime']
-            
-            try:
-                parent_id = int(indexrow['parent_id'])
-            except IndexError:
-                # old HDF5 version
-                parent_id = int(iter_group['parents'][indexrow['parents_offset']])
+            parent_id = int(segment_arrays.parent_ids[0])
                 
             if endpoint_type is None:
                 endpoint_type = indexrow['endpoint_type']
-                pcoord_pt_shape = pcoord_ds.shape[2:]
-                pcoord_dtype = pcoord_ds.dtype
+                pcoord_pt_shape = segment_arrays.pcoord.shape[2:]
+                pcoord_dtype = segment_arrays.pcoord.dtype
                 
             seginfo.append((n_iter, seg_id, weight, walltime, cputime, final_pcoord))
             
-            del iter_group, pcoord_ds, seg_index
+            del segment_arrays
             n_iter -= 1
             
         # loop terminates with parent_id set to the identifier of the initial state, 
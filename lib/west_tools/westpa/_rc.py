@@ -110,6 +110,7 @@ class WESTRC:
         self._sim_manager = None
         self._we_driver = None
         self._propagator = None
+        self._restart_store = None
         
         self.work_manager = SerialWorkManager()
         
@@ -278,6 +279,8 @@ class WESTRC:
         drivername = self.config.get(['west', 'drivers', 'we_driver'], 'default')
         if drivername.lower() == 'default':
             we_driver = west.we_driver.WEDriver()
+        elif drivername.lower() == 'array':
+            we_driver = west.we_driver.ArrayWEDriver()
         else:
             we_driver = extloader.get_object(drivername)(rc=self)
         log.debug('loaded WE algorithm driver: {!r}'.format(we_driver))
@@ -303,6 +306,21 @@ class WESTRC:
             self._propagator = self.new_propagator()
         return self._propagator
             
+    def new_restart_store(self):
+        '''Return a new restart store, or None if none is configured.'''
+        if self.config.get(['west', 'restart_store', 'directory']) is None:
+            return None
+        
+        import west.restart_store
+        restart_store = west.restart_store.RestartStore(self.config.get_path(['west', 'restart_store', 'directory']))
+        log.debug('loaded restart store {!r}'.format(restart_store))
+        return restart_store
+    
+    def get_restart_store(self):
+        if self._restart_store is None:
+            self._restart_store = self.new_restart_store()
+        return self._restart_store
+            
     def new_system_driver(self):
         ''' 
         Returns a new system object either from the driver OR from the YAML
@@ -508,6 +526,7 @@ class WESTRC:
         return self.work_manager
     
     propagator = property(get_propagator)
+    restart_store = property(get_restart_store)
     we_driver = property(get_we_driver)
     system = property(get_system_driver)
     data_manager = property(get_data_manager)
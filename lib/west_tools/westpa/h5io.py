@@ -25,6 +25,10 @@ try:
     import psutil
 except ImportError:
     psutil = None
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 import posixpath, errno
 from collections import deque
 
@@ -87,6 +91,55 @@ def calc_chunksize(shape, dtype, max_chunksize=262144):
     chunk_shape = tuple(chunk_shape)
     return chunk_shape
 
+def calc_pcoord_chunksize(shape, dtype, layout='segments', max_chunksize=65536):
+    '''Calculate a chunk size for a progress coordinate dataset of the given ``shape``
+    (n_segments, pcoord_len, pcoord_ndim), suited to the way it will be read. The ``'segments'``
+    layout keeps the whole trajectory of each segment in one chunk where possible (as when
+    loading segments or tracing trajectories), and the ``'points'`` layout keeps each time point
+    of many segments together (as when reading ``pcoord[:,-1,:]`` for all segments).'''
+    
+    n_segments, pcoord_len, pcoord_ndim = shape
+    itemsize = numpy.dtype(dtype).itemsize
+    if layout == 'points':
+        n_chunk_segs = max_chunksize // (pcoord_ndim*itemsize)
+        return (max(1, min(n_segments, n_chunk_segs)), 1, pcoord_ndim)
+    elif layout == 'segments':
+        segment_nbytes = pcoord_len*pcoord_ndim*itemsize
+        if segment_nbytes > max_chunksize:
+            # Split long trajectories along the time axis
+            return calc_chunksize((1, pcoord_len, pcoord_ndim), dtype, max_chunksize)
+        return (max(1, min(n_segments, max_chunksize // segment_nbytes)), pcoord_len, pcoord_ndim)
+    else:
+        raise ValueError('invalid progress coordinate layout {!r}'.format(layout))
+
+def compression_opts(compression, level=None):
+    '''Return keyword arguments for h5py dataset creation selecting the named compression
+    filter (``'gzip'``, ``'lzf'``, ``'lz4'`` or ``'blosc'``), including whether the
+    HDF5 shuffle filter should be used. The ``'lz4'`` and ``'blosc'`` filters require the 
+    ``hdf5plugin`` package; if it is not installed, the LZF filter built into h5py, which is
+    similarly fast, is used instead.'''
+    
+    compression = compression.lower()
+    if compression in ('lz4', 'blosc') and hdf5plugin is None:
+        compression = 'lzf'
+        
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': level, 'shuffle': True}
+    elif compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    elif compression == 'lz4':
+        opts = dict(hdf5plugin.LZ4())
+        opts['shuffle'] = True
+        return opts
+    elif compression == 'blosc':
+        # Blosc shuffles internally
+        opts = dict(hdf5plugin.Blosc(cname='lz4', clevel=5 if level is None else level, 
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+        opts['shuffle'] = False
+        return opts
+    else:
+        raise ValueError('unknown compression filter {!r}'.format(compression))
+
 #
 # Group and dataset manipulation functions
 #
@@ -207,9 +260,217 @@ def get_iteration_slice(h5object, iter_start, iter_stop=None, iter_stride=None):
     stop_index = iter_stop - obj_iter_start
     return numpy.index_exp[start_index:stop_index:iter_stride]
 
+def get_pcoord_points(iter_group, points):
+    '''Return the progress coordinate values at the given time ``points`` (a sequence of indices,
+    which may be negative) for all segments in the given iteration group, indexed as
+    [segment, point, dimension]. If the iteration was stored with the ``final-point-hot``
+    layout, the first and last points are read from the small ``pcoord_ends`` dataset.'''
+    
+    pcoord_ds = iter_group['pcoord']
+    pcoord_len = pcoord_ds.shape[1]
+    points = numpy.atleast_1d(numpy.arange(pcoord_len)[points])
+    
+    ends_ds = iter_group.get('pcoord_ends')
+    if ends_ds is not None and numpy.isin(points, (0, pcoord_len-1)).all():
+        return ends_ds[...][:,numpy.where(points == 0, 0, 1)]
+    elif (numpy.diff(points) > 0).all():
+        return pcoord_ds[:,points.tolist()]
+    else:
+        return pcoord_ds[...][:,points]
 
+###
+# Packed per-iteration storage
+###
+
+# In packed files (WEST file format version 8), the segment index, progress coordinate
+# and weight transfer graph of all iterations are appended to a few extendable datasets in
+# this group, and ``iter_index`` records the rows belonging to each iteration
+packed_group_name = '/packed'
+packed_iter_index_dtype = numpy.dtype([('n_iter', numpy.uint32),
+                                       ('seg_offset', numpy.int64),
+                                       ('n_segments', numpy.int64),
+                                       ('wtg_offset', numpy.int64),
+                                       ('wtg_length', numpy.int64)])
+
+# Packed datasets, and the fields of ``iter_index`` giving the offset and number of rows
+# belonging to each iteration
+packed_datasets = {'seg_index':     ('seg_offset', 'n_segments'),
+                   'pcoord':        ('seg_offset', 'n_segments'),
+                   'pcoord_ends':   ('seg_offset', 'n_segments'),
+                   'wtgraph':       ('wtg_offset', 'wtg_length')}
+
+def find_packed_entry(iter_index, n_iter):
+    '''Return the entry for iteration ``n_iter`` in ``iter_index`` (an array or list of
+    ``packed_iter_index_dtype`` records), or None if the iteration is not stored.'''
+    # Iterations are stored consecutively
+    if not len(iter_index):
+        return None
+    irow = int(n_iter) - int(iter_index[0]['n_iter'])
+    if 0 <= irow < len(iter_index):
+        return iter_index[irow]
+    else:
+        return None
+
+def packed_views(datasets, entry):
+    '''Return a dictionary mapping the name of each of the given packed ``datasets`` (a dictionary
+    mapping name to dataset) to a ``PackedDatasetView`` of the rows belonging to the iteration
+    with the given ``iter_index`` entry.'''
+    views = {}
+    for (dsname, dataset) in datasets.items():
+        offset_field, length_field = packed_datasets[dsname]
+        views[dsname] = PackedDatasetView(dataset, int(entry[offset_field]), int(entry[length_field]))
+    return views
+
+def unpack_dataset_view(dataset):
+    '''Return the HDF5 dataset in which the rows of ``dataset`` are stored, and the offset of
+    the first of those rows. Apart from ``PackedDatasetView`` objects, datasets are returned
+    unchanged, with an offset of zero.'''
+    if isinstance(dataset, PackedDatasetView):
+        return dataset.dataset, dataset.offset
+    else:
+        return dataset, 0
 
+class PackedDatasetView:
+    '''The rows of a packed dataset belonging to one iteration, which can be read (and written)
+    like the corresponding dataset of an unpacked per-iteration group. Only the first index is
+    translated; other indices, and field names, are passed through to the packed dataset.'''
+    
+    def __init__(self, dataset, offset, length):
+        self.dataset = dataset
+        self.offset = offset
+        self.length = length
+        
+    def __repr__(self):
+        return '<{} of {!r}, rows {:d} to {:d}>'.format(self.__class__.__name__, self.dataset, 
+                                                          self.offset, self.offset+self.length)
+        
+    @property
+    def shape(self):
+        return (self.length,) + self.dataset.shape[1:]
+    
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+    
+    @property
+    def ndim(self):
+        return self.dataset.ndim
+    
+    @property
+    def size(self):
+        return int(numpy.multiply.reduce(self.shape))
+    
+    @property
+    def attrs(self):
+        return self.dataset.attrs
+    
+    @property
+    def name(self):
+        return self.dataset.name
+    
+    @property
+    def file(self):
+        return self.dataset.file
+    
+    def __len__(self):
+        return self.length
+    
+    def len(self):
+        return self.length
+    
+    def __iter__(self):
+        for irow in range(self.length):
+            yield self[irow]
+            
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+    
+    def _translate_index(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step < 1:
+                raise ValueError('step must be >= 1')
+            return slice(self.offset+start, self.offset+max(start,stop), step)
+        elif isinstance(index, (int, numpy.integer)):
+            if index < 0:
+                index += self.length
+            if not 0 <= index < self.length:
+                raise IndexError('index {:d} out of range for {:d} rows'.format(int(index), self.length))
+            return self.offset + int(index)
+        else:
+            index = numpy.asarray(index)
+            if index.dtype == numpy.bool_:
+                index = numpy.flatnonzero(index)
+            index = numpy.where(index < 0, index + self.length, index)
+            if ((index < 0) | (index >= self.length)).any():
+                raise IndexError('index out of range for {:d} rows'.format(self.length))
+            return index + self.offset
+        
+    def _translate_args(self, args):
+        if not isinstance(args, tuple):
+            args = (args,)
+        names = tuple(arg for arg in args if isinstance(arg, str))
+        args = tuple(arg for arg in args if not isinstance(arg, str))
+        if not args or args[0] is Ellipsis:
+            args = (slice(None),) + args
+        return names + (self._translate_index(args[0]),) + args[1:]
+        
+    def __getitem__(self, args):
+        return self.dataset[self._translate_args(args)]
+    
+    def __setitem__(self, args, value):
+        self.dataset[self._translate_args(args)] = value
+        
+class PackedIterGroup:
+    '''A per-iteration group of a packed file, in which the rows of the packed datasets belonging
+    to the iteration appear as members (``PackedDatasetView`` objects), alongside the datasets and
+    groups stored in the group itself. Other attributes are those of the underlying group.'''
+    
+    def __init__(self, group, views):
+        self.group = group
+        self.views = views
+        
+    def __repr__(self):
+        return '<{} of {!r}>'.format(self.__class__.__name__, self.group)
+        
+    def __getattr__(self, attr):
+        return getattr(self.group, attr)
+    
+    def __getitem__(self, name):
+        try:
+            return self.views[name]
+        except KeyError:
+            return self.group[name]
+        
+    def __setitem__(self, name, value):
+        self.group[name] = value
+        
+    def __delitem__(self, name):
+        del self.group[name]
         
+    def __contains__(self, name):
+        return name in self.views or name in self.group
+    
+    def get(self, name, default=None, **kwargs):
+        if name in self.views and not kwargs:
+            return self.views[name]
+        return self.group.get(name, default, **kwargs)
+    
+    def keys(self):
+        return sorted(set(self.views) | set(self.group.keys()))
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def values(self):
+        return [self[name] for name in self.keys()]
+    
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
     
 ###
 # Axis label metadata
@@ -227,10 +488,10 @@ def label_axes(h5object, labels, units=None):
     if len(units) and len(units) != len(labels):
         raise ValueError('number of units labels does not match number of axes')
     
-    h5object.attrs['axis_labels'] = numpy.array([numpy.string_(i) for i in labels])
+    h5object.attrs['axis_labels'] = numpy.array([numpy.bytes_(i) for i in labels])
      
     if len(units):
-        h5object.attrs['axis_units'] = numpy.array([numpy.string_(i) for i in units])
+        h5object.attrs['axis_units'] = numpy.array([numpy.bytes_(i) for i in units])
 
 NotGiven = object()
 def _get_one_attr(h5object, namelist, default=NotGiven):
@@ -264,6 +525,10 @@ class WESTPAH5File(h5py.File):
         # Initialize h5py file
         super(WESTPAH5File,self).__init__(*args, **kwargs)
         
+        # Index of packed iterations (loaded when needed)
+        self._packed_index = None
+        self._packed_datasets = {}
+        
         # Try to get iteration precision and I/O class version
         h5file_iter_prec = _get_one_attr(self, ['westpa_iter_prec', 'west_iter_prec', 'wemd_iter_prec'], None)
         h5file_fileformat_version = _get_one_attr(self,
@@ -322,11 +587,120 @@ class WESTPAH5File(h5py.File):
         
     def get_iter_group(self, n_iter, group=None):
         '''Get the per-iteration data group for iteration number ``n_iter`` from within
-        the group ``group`` ('/iterations' by default).'''
+        the group ``group`` ('/iterations' by default). For simulation data in packed files,
+        this is a ``PackedIterGroup``.'''
         if group is None:
-            group = self['/iterations']
+            iter_group = self['/iterations'][self.iter_object_name(n_iter)]
+            views = self.get_packed_views(n_iter)
+            return PackedIterGroup(iter_group, views) if views is not None else iter_group
         return group[self.iter_object_name(n_iter)]
     
+    # Packed storage
+    
+    def _load_packed_index(self):
+        try:
+            packed_group = self[packed_group_name]
+        except KeyError:
+            self._packed_index = ()
+            self._packed_datasets = {}
+        else:
+            self._packed_index = packed_group['iter_index'][...]
+            self._packed_datasets = {dsname: packed_group[dsname] for dsname in packed_datasets 
+                                     if dsname in packed_group}
+            
+    def get_packed_views(self, n_iter):
+        '''Return a dictionary mapping the name of each packed dataset to a ``PackedDatasetView``
+        of the rows belonging to iteration ``n_iter``, or None if the iteration is not stored in
+        packed form. The index of packed iterations is cached, and reloaded if an iteration
+        is not found in it.'''
+        if self._packed_index is None:
+            self._load_packed_index()
+        entry = find_packed_entry(self._packed_index, n_iter)
+        if entry is None and self._packed_datasets:
+            self._load_packed_index()
+            entry = find_packed_entry(self._packed_index, n_iter)
+        return packed_views(self._packed_datasets, entry) if entry is not None else None
+    
+### Per-process cache of open files
+
+# Raw data chunk cache settings for files opened by get_h5file(). Analysis tools read whole
+# per-iteration datasets, often in blocks of segments, so the cache should hold at least the
+# chunks of one dataset row (up to 1 MiB by default in HDF5, larger than which chunks are not cached
+# at all). As HDF5 recommends, the number of hash slots is a prime about rdcc_slots_per_chunk
+# times the number of chunks (of rdcc_typical_chunk_size bytes) that fit in the cache.
+rdcc_slots_per_chunk = 100
+rdcc_typical_chunk_size = 64*1024
+
+def rdcc_nslots_for(rdcc_nbytes):
+    '''Return the number of chunk cache hash slots recommended for a cache of ``rdcc_nbytes`` bytes:
+    the smallest prime at least ``rdcc_slots_per_chunk`` times the number of chunks of
+    ``rdcc_typical_chunk_size`` bytes which fit in the cache.'''
+    nslots = max(rdcc_slots_per_chunk * rdcc_nbytes // rdcc_typical_chunk_size, 2)
+    while any(nslots % factor == 0 for factor in range(2, int(nslots**0.5)+1)):
+        nslots += 1
+    return nslots
+
+default_rdcc_nbytes = 16*1024*1024
+default_rdcc_nslots = rdcc_nslots_for(default_rdcc_nbytes)
+
+# Files opened by get_h5file(), by (path, mode, driver), along with the modification time and size
+# of the file when opened, and the process which opened them
+_h5file_cache = {}
+_h5file_cache_pid = None
+
+def _file_signature(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def get_h5file(filename, mode='r', driver=None, rdcc_nbytes=None, rdcc_nslots=None):
+    '''Return a ``WESTPAH5File`` for ``filename``, opened with the given ``mode`` and ``driver``,
+    kept open for reuse for the life of the calling process. Files opened by a parent process are
+    not reused after a fork, as HDF5 file handles are not safely shared across a fork, but are
+    opened anew. A file opened read-only is reopened if it has been modified since it was opened
+    (for instance, by a running simulation), as the open file would not show the changes. The raw
+    data chunk cache size (``rdcc_nbytes``) and number of hash slots (``rdcc_nslots``) default to
+    ``default_rdcc_nbytes`` and ``default_rdcc_nslots``, and apply only when the file is first
+    opened.'''
+    global _h5file_cache_pid
+    if _h5file_cache_pid != os.getpid():
+        # Drop (without closing) any files opened before a fork
+        _h5file_cache.clear()
+        _h5file_cache_pid = os.getpid()
+        
+    key = (os.path.abspath(filename), mode, driver)
+    signature = _file_signature(filename) if mode == 'r' else None
+    try:
+        (h5file, cached_signature) = _h5file_cache[key]
+    except KeyError:
+        h5file = None
+    else:
+        if not h5file.id.valid:
+            # Closed elsewhere
+            h5file = None
+        elif signature != cached_signature:
+            # Modified since opened; HDF5 shares state between handles for the same file, so the
+            # stale handle must be closed before the file is reopened
+            h5file.close()
+            h5file = None
+    
+    if h5file is None:
+        h5file = WESTPAH5File(filename, mode, driver=driver,
+                              rdcc_nbytes=rdcc_nbytes or default_rdcc_nbytes,
+                              rdcc_nslots=rdcc_nslots or default_rdcc_nslots)
+        _h5file_cache[key] = (h5file, signature)
+    return h5file
+
+def close_h5files():
+    '''Close all files opened by ``get_h5file()`` in the calling process.'''
+    if _h5file_cache_pid == os.getpid():
+        for (h5file, _signature) in _h5file_cache.values():
+            if h5file.id.valid:
+                h5file.close()
+    _h5file_cache.clear()
+
 ### Generalized WE dataset access classes
     
 class DSSpec:
@@ -351,7 +725,12 @@ class DSSpec:
 class FileLinkedDSSpec(DSSpec):
     '''Provide facilities for accessing WESTPA HDF5 files, including auto-opening and the ability
     to pickle references to such files for transmission (through, e.g., the work manager), provided
-    that the HDF5 file can be accessed by the same path on both the sender and receiver.'''
+    that the HDF5 file can be accessed by the same path on both the sender and receiver. Files opened
+    automatically are shared by all dataset specifications in a process (see ``get_h5file()``),
+    using the given ``driver``.'''
+    
+    driver = None
+    
     def __init__(self, h5file_or_name):
         self._h5file = None
         self._h5filename = None
@@ -368,9 +747,10 @@ class FileLinkedDSSpec(DSSpec):
     def h5file(self):
         '''Lazily open HDF5 file. This is required because allowing an open HDF5
         file to cross a fork() boundary generally corrupts the internal state of
-        the HDF5 library.'''
+        the HDF5 library. The file remains open in this process, for use by later
+        tasks, but is not stored on this object.'''
         if self._h5file is None:
-            self._h5file = WESTPAH5File(self._h5filename, 'r')
+            return get_h5file(self._h5filename, 'r', self.driver)
         return self._h5file
     
 class SingleDSSpec(FileLinkedDSSpec):
@@ -17,6 +17,7 @@
 
 import numpy
 import westpa
+from westpa import h5io
 
 from itertools import zip_longest
 from collections import namedtuple
@@ -77,7 +78,6 @@ def process_iter_chunk(bin_mapper, iter_indices, iter_data=None):
     rate_matrix = numpy.zeros((nbins, nbins), numpy.float64)
     population_vector = numpy.zeros((nbins,), numpy.float64)
 
-    pcoord_len = system.pcoord_len
     assign = bin_mapper.assign
 
     for iiter, n_iter in enumerate(iter_indices):
@@ -126,8 +126,9 @@ def process_iter_chunk(bin_mapper, iter_indices, iter_data=None):
             final_pcoords = iter_group['final_pcoords']
         else:
             weights = iter_group['seg_index']['weight']
-            initial_pcoords = iter_group['pcoord'][:,0]
-            final_pcoords = iter_group['pcoord'][:,pcoord_len-1]
+            end_pcoords = h5io.get_pcoord_points(iter_group, [0,-1])
+            initial_pcoords = end_pcoords[:,0]
+            final_pcoords = end_pcoords[:,1]
 
         initial_assignments = assign(initial_pcoords)
         final_assignments = assign(final_pcoords)
@@ -171,7 +172,6 @@ class RateAverager():
         underlying layout.'''
 
         data = {}
-        pcoord_len = self.system.pcoord_len
 
         for n_iter in iter_indices:
             iter_group_name = 'iter_{:0{prec}d}'.format(int(n_iter), prec=self.data_manager.iter_prec)
@@ -190,8 +190,9 @@ class RateAverager():
                 di_nw['new_init_pcoord'] = nwgroup['new_init_pcoord'][...]
 
             di['weight'] = iter_group['seg_index']['weight']
-            di['initial_pcoords'] = iter_group['pcoord'][:,0]
-            di['final_pcoords'] = iter_group['pcoord'][:,pcoord_len-1]
+            end_pcoords = h5io.get_pcoord_points(iter_group, [0,-1])
+            di['initial_pcoords'] = end_pcoords[:,0]
+            di['final_pcoords'] = end_pcoords[:,1]
 
         return data
 
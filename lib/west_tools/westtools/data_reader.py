@@ -19,6 +19,7 @@ import numpy
 from numpy import index_exp
 from .core import WESTToolComponent
 import westpa
+from westpa import h5io
 from westpa.extloader import get_object
 from westpa.h5io import FnDSSpec, MultiDSSpec, SingleSegmentDSSpec, SingleIterDSSpec
 
@@ -54,12 +55,23 @@ class WESTDataReader(WESTToolComponent):
         group = parser.add_argument_group('WEST input data options')
         group.add_argument('-W', '--west-data', dest='we_h5filename', metavar='WEST_H5FILE',
                            help='''Take WEST data from WEST_H5FILE (default: read from the HDF5 file specified in west.cfg).''')
+        group.add_argument('--chunk-cache-size', dest='rdcc_nbytes', metavar='BYTES', type=int,
+                           help='''Use an HDF5 raw data chunk cache of BYTES bytes for each input file read by
+                           analysis tasks (default: %(default)s).''', default=h5io.default_rdcc_nbytes)
+        group.add_argument('--chunk-cache-slots', dest='rdcc_nslots', metavar='N_SLOTS', type=int,
+                           help='''Use N_SLOTS hash slots in the HDF5 raw data chunk cache; this should be a
+                           prime number, ideally about 100 times the number of chunks fitting in the cache
+                           (default: chosen from the cache size for 64 KiB chunks).''')
         
     def process_args(self, args):
         if args.we_h5filename:
             self.data_manager.we_h5filename = self.we_h5filename = args.we_h5filename
         else:
             self.we_h5filename = self.data_manager.we_h5filename
+            
+        # Workers are started after arguments are processed, and so use these settings too
+        h5io.default_rdcc_nbytes = args.rdcc_nbytes
+        h5io.default_rdcc_nslots = args.rdcc_nslots or h5io.rdcc_nslots_for(args.rdcc_nbytes)
         
     def open(self, mode='r'):
         self.data_manager.open_backing(mode)
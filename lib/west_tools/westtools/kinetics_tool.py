@@ -27,10 +27,10 @@ from westtools.dtypes import iter_block_ci_dtype as ci_dtype
 
 # A function to just help with creating future objects for the work manager.
 
-def generate_future(work_manager, name, eval_block, kwargs):
+def generate_future(work_manager, name, eval_block, kwargs, cost_hint=None):
     submit_kwargs = {'name': name}
     submit_kwargs.update(kwargs)
-    future = work_manager.submit(eval_block, kwargs=submit_kwargs)
+    future = work_manager.submit(eval_block, kwargs=submit_kwargs, cost_hint=cost_hint)
     return future
 
     
@@ -269,7 +269,9 @@ class AverageCommands(WESTKineticsBase):
                     #print(future_kwargs['data_input'][key])
 
                 # We create a future object with the appropriate name, and then append it to the work manager.
-                futures.append(generate_future(self.work_manager, name, eval_block, future_kwargs))
+                # Blocks spanning more iterations take longer (in cumulative mode, much longer), so are started first.
+                futures.append(generate_future(self.work_manager, name, eval_block, future_kwargs,
+                                               cost_hint=stop-block_start))
 
             # Now, we wait to get the result back; we'll store it in the result, and return it.
             for future in self.work_manager.as_completed(futures):
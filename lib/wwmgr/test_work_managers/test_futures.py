@@ -15,6 +15,8 @@
 # You should have received a copy of the GNU General Public License
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+from work_managers import WMFuture
 from work_managers.serial import SerialWorkManager
 from nose.tools import assert_raises #@UnresolvedImport
 from .tsupport import *
@@ -43,6 +45,23 @@ class TestWMFuture:
             exc = future.get_exception()
             assert exc.args[0] == 'failed as expected'
         
+    @raises(ExceptionForTest)
+    def test_remote_exception_raise(self):
+        # Work managers running tasks in other processes pass tracebacks as text
+        future = WMFuture()
+        future._set_exception(ExceptionForTest('failed remotely'), 'Traceback (most recent call last):\n')
+        future.get_result()
+
+    @raises(ExceptionForTest)
+    def test_remote_exception_wait(self):
+        future = WMFuture()
+        timer = threading.Timer(0.1, future._set_exception, args=(ExceptionForTest('failed remotely'), ''))
+        timer.start()
+        try:
+            future.get_result()
+        finally:
+            timer.join()
+        
     def test_callback(self):
         with SerialWorkManager() as work_manager:
             future = work_manager.submit(will_succeed)
@@ -0,0 +1,117 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests of the MPI work manager. These run under MPI, with at least two ranks; from lib/wwmgr:
+
+    mpirun -n 3 python -m nose test_work_managers.test_mpi
+
+Rank 0 runs the tests, while the other ranks serve as workers (reporting their tests as skipped).
+Run otherwise (as with the rest of the tests), this module runs itself as above, if mpi4py and
+mpirun are available.'''
+
+import os, sys, re, shutil, subprocess
+import importlib.util
+
+from .tsupport import *
+
+import nose.tools
+from nose.plugins.skip import SkipTest
+
+# MPI is initialized only when started by mpirun (as seen from the variables set by Open MPI and
+# by MPICH), as initializing it in the ordinary test process could disturb other tests (which fork)
+under_mpirun = any(var in os.environ for var in ('OMPI_COMM_WORLD_SIZE', 'PMI_SIZE'))
+have_mpi4py = importlib.util.find_spec('mpi4py') is not None
+
+# Shared by all tests, as the worker ranks serve only one work manager
+work_manager = None
+
+def setup_module():
+    global work_manager
+    if not (under_mpirun and have_mpi4py):
+        return
+    from mpi4py import MPI
+    if MPI.COMM_WORLD.Get_size() < 2:
+        return
+
+    from work_managers.mpi import MPIWorkManager
+    work_manager = MPIWorkManager()
+    work_manager.startup()
+    if not work_manager.is_master:
+        # Serve until the master shuts down
+        work_manager.run()
+
+def teardown_module():
+    if work_manager is not None and work_manager.is_master:
+        work_manager.shutdown()
+
+class MPITestBase:
+    def setUp(self):
+        if work_manager is None:
+            raise SkipTest('not running under MPI with at least two ranks')
+        elif not work_manager.is_master:
+            raise SkipTest('tests run on the master rank')
+        self.work_manager = work_manager
+
+    def tearDown(self):
+        # Let tasks left running finish, so that each test starts with idle workers
+        self.work_manager.wait_all(list(self.work_manager.pending_futures.values()))
+
+class TestMPIWorkManager(MPITestBase, CommonParallelTests, CommonWorkManagerTests):
+    pass
+
+# The tests of random number generation are not repeated, as workers (shared by all tests) are left
+# with identical generator states by test_random_seq_improper_seeding
+class TestMPIWorkManagerPrefetch(MPITestBase, CommonWorkManagerTests):
+    def setUp(self):
+        super(TestMPIWorkManagerPrefetch,self).setUp()
+        self.work_manager.prefetch = 4
+
+    def tearDown(self):
+        super(TestMPIWorkManagerPrefetch,self).tearDown()
+        self.work_manager.prefetch = 1
+
+class TestMPIWorkManagerPriority(MPITestBase, CommonPriorityTests):
+    def setUp(self):
+        super(TestMPIWorkManagerPriority,self).setUp()
+        # Occupy all workers but one while the test runs
+        self.blockers = [self.work_manager.submit(sleep_identity, args=(None, 2.0))
+                         for _i in range(self.work_manager.n_workers - 1)]
+
+class TestMPIRun:
+    @nose.tools.timed(600)
+    def test_mpirun(self):
+        if under_mpirun:
+            raise SkipTest('already running under MPI')
+        elif not have_mpi4py:
+            raise SkipTest('mpi4py is not available')
+        mpirun = shutil.which('mpirun') or shutil.which('mpiexec')
+        if mpirun is None:
+            raise SkipTest('mpirun is not available')
+
+        wwmgr_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([wwmgr_dir] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        # Let Open MPI run as root (as in containers) and with more ranks than CPUs
+        env.update(OMPI_ALLOW_RUN_AS_ROOT='1', OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1',
+                   OMPI_MCA_rmaps_base_oversubscribe='1')
+        result = subprocess.run([mpirun, '-n', '3', sys.executable, '-m', 'nose', '-v', 'test_work_managers.test_mpi'],
+                                cwd=wwmgr_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                timeout=600)
+        output = result.stdout.decode(errors='replace')
+        assert result.returncode == 0, output
+        # Tests were run (on the master rank), not just skipped
+        assert re.search(r'\.test_priority \.\.\. ok$', output, re.MULTILINE), output
@@ -16,8 +16,9 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 import os, signal
+import numpy
 
-from work_managers.processes import ProcessWorkManager
+from work_managers.processes import ProcessWorkManager, SharedMemoryTransport
 from .tsupport import *
 
 import nose.tools
@@ -30,6 +31,74 @@ class TestProcessWorkManager(CommonParallelTests,CommonWorkManagerTests):
     def tearDown(self):
         self.work_manager.shutdown()
 
+class TestProcessWorkManagerSharedMemory(CommonParallelTests,CommonWorkManagerTests):
+    def setUp(self):
+        self.work_manager = ProcessWorkManager(shm_threshold=1024)
+        self.work_manager.startup()
+    def tearDown(self):
+        self.work_manager.shutdown()
+        
+    def test_array_args_and_results(self):
+        arrays = [numpy.arange(n, dtype=numpy.float64) for n in (10, 1000, 100000)]
+        futures = [self.work_manager.submit(identity, args=(array,)) for array in arrays*4]
+        for (array, future) in zip(arrays*4, futures):
+            result = future.get_result()
+            assert (result == array).all()
+            assert result.flags.writeable
+            
+    def test_segments_reused(self):
+        array = numpy.ones(100000)
+        for _i in range(10):
+            self.work_manager.submit(identity, args=(array,)).get_result()
+        transport = self.work_manager.shm_transport
+        assert len(transport.owned) == 1, transport.owned
+        assert len(transport.free) == 1
+
+class TestProcessWorkManagerPriority(CommonPriorityTests):
+    def setUp(self):
+        self.work_manager = ProcessWorkManager(n_workers=1)
+        self.work_manager.startup()
+    def tearDown(self):
+        self.work_manager.shutdown()
+
+class TestSharedMemoryTransport:
+    def setup(self):
+        self.sender = SharedMemoryTransport(1024, max_free=2)
+        self.receiver = SharedMemoryTransport(1024)
+    
+    def teardown(self):
+        self.receiver.close()
+        self.sender.close()
+        
+    def test_small_inband(self):
+        payload = self.sender.dumps({'small': numpy.arange(10), 'other': 'data'})
+        assert payload.segments == []
+        obj = self.receiver.loads(payload)
+        assert (obj['small'] == numpy.arange(10)).all()
+        assert obj['other'] == 'data'
+        
+    def test_release_and_remove(self):
+        payloads = [self.sender.dumps(numpy.arange(1000*(n+1))) for n in range(3)]
+        assert [len(payload.segments) for payload in payloads] == [1,1,1]
+        for payload in payloads:
+            self.receiver.loads(payload)
+            self.sender.release([name for (name, _nbytes) in payload.segments])
+        # Only max_free unused segments are kept
+        assert len(self.sender.owned) == 2
+        
+        # The smallest free segment large enough is reused
+        payload = self.sender.dumps(numpy.arange(1500))
+        assert payload.segments[0][0] == payloads[1].segments[0][0]
+        
+    def test_close(self):
+        payload = self.sender.dumps(numpy.arange(1000))
+        (name, _nbytes) = payload.segments[0]
+        self.receiver.loads(payload)
+        self.receiver.close()
+        self.sender.close()
+        assert not self.sender.owned
+        assert not os.path.exists(os.path.join('/dev/shm', name.lstrip('/')))
+
 class TestProcessWorkManagerAux:            
     @nose.tools.timed(2)
     def test_shutdown(self):
@@ -29,11 +29,27 @@ class TestThreadsWorkManager(CommonWorkManagerTests,CommonParallelTests):
     def tearDown(self):
         self.work_manager.shutdown()
 
+class TestThreadsWorkManagerPriority(CommonPriorityTests):
+    def setUp(self):
+        self.work_manager = ThreadsWorkManager(n_workers=1)
+        self.work_manager.startup()
+        
+    def tearDown(self):
+        self.work_manager.shutdown()
+
 class TestThreadsWorkManagerAux:
     def test_shutdown(self):
         work_manager = ThreadsWorkManager()
         work_manager.startup()
         work_manager.shutdown()
         for worker in work_manager.workers:
-            assert not worker.is_alive() 
+            assert not worker.is_alive()
+            
+    def test_wait_any_timeout(self):
+        with ThreadsWorkManager(n_workers=1) as work_manager:
+            future = work_manager.submit(sleep_identity, args=(1,))
+            assert work_manager.wait_any([future], timeout=0.05) is None
+            assert work_manager.wait_any([future], timeout=0) is None
+            assert work_manager.wait_any([future], timeout=5) is future
+            assert work_manager.wait_any([future], timeout=0) is future 
 
@@ -6,8 +6,9 @@ Created on Jun 2, 2015
 
 
 import time
+import numpy
 from work_managers.zeromq import ZMQWorkManager, ZMQWorker, ZMQWorkerMissing
-from work_managers.zeromq.core import Message, Task
+from work_managers.zeromq.core import ZMQCore, ZMQWMEnvironmentError, Message, Task, dump_frames, load_frames
 from test_work_managers.tsupport import *
 
 from contextlib import contextmanager
@@ -174,8 +175,101 @@ class TestZMQWorkManagerBasic(ZMQTestBase):
             result = task.execute()
             self.test_core.send_message(s, Message.RESULT, result)
         assert future.result == r
+        
+    def test_array_result_return(self):
+        # Large arrays travel in separate message frames
+        array = numpy.random.random((256,256))
+        future = self.test_wm.submit(identity, (array,))
+        with self.rr_socket() as s:
+            self.test_core.send_message(s,Message.TASK_REQUEST)
+            msg = self.test_core.recv_message(s)
+            task = msg.payload
+            assert (task.args[0] == array).all()
+            result = task.execute()
+            self.test_core.send_message(s, Message.RESULT, result)
+        assert (future.result == array).all()
+        
+    def test_array_frames_zero_copy(self):
+        array = numpy.random.random((256,256))
+        frames = dump_frames(array)
+        assert len(frames) == 2
+        assert numpy.shares_memory(load_frames(frames), array)
+        
+    def test_array_frames_writable(self):
+        # Read-only frame buffers are copied only if writable arrays are needed
+        array = numpy.random.random((256,256))
+        frames = dump_frames(array)
+        frames[1] = frames[1].toreadonly()
+        assert not load_frames(frames).flags.writeable
+        copied = load_frames(frames, writable=True)
+        assert copied.flags.writeable
+        assert (copied == array).all()
+        
+    def test_protocol_version_mismatch(self):
+        message = Message(Message.TASK_REQUEST, src_id=self.test_core.node_id)
+        message.protocol_version = self.test_wm.PROTOCOL_VERSION
+        self.test_wm.validate_message(message)
+        for protocol_version in [None, (ZMQCore.PROTOCOL_MAJOR, ZMQCore.PROTOCOL_MINOR-1, 0)]:
+            message.protocol_version = protocol_version
+            assert_raises(ZMQWMEnvironmentError, self.test_wm.validate_message, message)
+        
+    def test_batch_task_send(self):
+        futures = self.test_wm.submit_many([(identity, (i,), {}) for i in range(3)])
+        with self.rr_socket() as s:
+            self.test_core.send_message(s,Message.TASK_REQUEST, 2)
+            msg = self.test_core.recv_message(s)
+            assert msg.message == Message.TASKS
+            assert [task.args for task in msg.payload] == [(0,), (1,)]
+            
+            # Results are returned along with a request for more tasks
+            results = [task.execute() for task in msg.payload]
+            self.test_core.send_message(s, Message.RESULTS, (results, 2))
+            msg = self.test_core.recv_message(s)
+            assert msg.message == Message.TASKS
+            assert [task.args for task in msg.payload] == [(2,)]
+            
+            self.test_core.send_message(s, Message.RESULTS, ([msg.payload[0].execute()], 2))
+            msg = self.test_core.recv_message(s)
+            assert msg.message == Message.ACK
+        assert [future.result for future in futures] == [0, 1, 2]
+
+    def test_task_priority(self):
+        self.test_wm.submit_many([(identity, (0,), {}), (identity, (1,), {}, 1), (identity, (2,), {}, 0, 5)])
+        with self.rr_socket() as s:
+            self.test_core.send_message(s,Message.TASK_REQUEST, 3)
+            msg = self.test_core.recv_message(s)
+            assert [task.args for task in msg.payload] == [(1,), (2,), (0,)]
+            
+    def test_steal_and_return_tasks(self):
+        futures = self.test_wm.submit_many([(identity, (i,), {}) for i in range(3)])
+        idle_core = ZMQCore()
+        idle_core.master_id = self.test_wm.master_id
+        with self.rr_socket() as s, self.rr_socket() as idle_s:
+            self.test_core.send_message(s, Message.TASK_REQUEST, 3)
+            tasks = self.test_core.recv_message(s).payload
+            assert len(tasks) == 3
+            
+            # A worker finding no tasks prompts a request that the worker holding them return some
+            with self.expect_announcement(Message.STEAL):
+                idle_core.send_message(idle_s, Message.TASK_REQUEST)
+                assert idle_core.recv_message(idle_s).message == Message.NAK
+            
+            self.test_core.send_message(s, Message.TASKS_RETURNED, [tasks[2].task_id])
+            assert self.test_core.recv_message(s).message == Message.ACK
+            idle_core.send_message(idle_s, Message.TASK_REQUEST)
+            msg = idle_core.recv_message(idle_s)
+            assert msg.message == Message.TASK
+            assert msg.payload.args == (2,)
+            
+            idle_core.send_message(idle_s, Message.RESULT, msg.payload.execute())
+            idle_core.recv_message(idle_s)
+            self.test_core.send_message(s, Message.RESULTS, ([task.execute() for task in tasks[:2]], 0))
+            assert self.test_core.recv_message(s).message == Message.ACK
+        assert [future.result for future in futures] == [0, 1, 2]
 
 class BaseInternal(ZMQTestBase,CommonWorkManagerTests):
+    prefetch = 1
+    
     def setUp(self):
         super(BaseInternal,self).setUp()
         
@@ -184,6 +278,7 @@ class BaseInternal(ZMQTestBase,CommonWorkManagerTests):
         for worker in self.test_wm.local_workers:
             worker.validation_fail_action = 'raise'
             worker.shutdown_timeout = 0.5
+            worker.prefetch = self.prefetch
 
         # Set operation parameters 
         self.test_wm.validation_fail_action = 'raise'
@@ -294,6 +389,20 @@ class TestZMQWorkManagerInternalSingle(BaseInternal):
     
 class TestZMQWorkManagerInternalMultiple(BaseInternal):
     n_workers = 4
+    
+class TestZMQWorkManagerInternalPrefetch(BaseInternal):
+    n_workers = 2
+    prefetch = 8
+    
+    def test_idle_worker_steals_tasks(self):
+        # Whichever worker takes the slow task holds quick tasks behind it, which the other takes
+        # once it runs out of work
+        t0 = time.time()
+        futures = self.test_wm.submit_many([(sleep_identity, (0, 2.0), {})]
+                                           + [(sleep_identity, (i, 0.1), {}) for i in range(1, 8)])
+        self.test_wm.wait_all(futures[1:])
+        assert time.time() - t0 < 1.5
+        assert [future.get_result() for future in futures] == list(range(8))
 
 class BaseExternal(ZMQTestBase,CommonWorkManagerTests):
 
@@ -1,5 +1,6 @@
 
 import time
+import numpy
 from work_managers.zeromq import ZMQWorker
 from work_managers.zeromq.core import Message, Task, Result, TIMEOUT_MASTER_BEACON
 from test_work_managers.tsupport import *
@@ -105,6 +106,56 @@ class TestZMQWorkerBasic(ZMQTestBase):
         task = Task(identity, (r,), {})
         rsl = self.roundtrip_task(task) 
         assert rsl.result == r
+        
+    def test_worker_modifies_array_task(self):
+        # Large arrays received by the executor are writable
+        array = numpy.random.random((256,256))
+        task = Task(negate_in_place, (array,), {})
+        rsl = self.roundtrip_task(task)
+        assert (rsl.result == -array).all()
+                
+    def test_worker_processes_batch(self):
+        self.test_worker.prefetch = 3
+        tasks = [Task(identity, (i,), {}) for i in range(3)]
+        self.test_core.send_message(self.ann_socket, Message.TASKS_AVAILABLE)
+        msg = self.test_core.recv_message(self.rr_socket)
+        assert msg.message == Message.TASK_REQUEST
+        assert msg.payload == 3
+        self.test_core.send_message(self.rr_socket, Message.TASKS, payload=tasks)
+        
+        results = []
+        while len(results) < 3:
+            msg = self.test_core.recv_message(self.rr_socket)
+            assert msg.message == Message.RESULTS
+            batch, n_wanted = msg.payload
+            results.extend(batch)
+            assert n_wanted == 3 - len(self.test_worker.pending_tasks)
+            self.test_core.send_ack(self.rr_socket, msg)
+        assert [result.result for result in results] == [0, 1, 2]
+                
+    def test_worker_returns_tasks(self):
+        self.test_worker.prefetch = 3
+        tasks = [Task(sleep_identity, (0, 0.5), {})] + [Task(identity, (i,), {}) for i in (1,2)]
+        self.test_core.send_message(self.ann_socket, Message.TASKS_AVAILABLE)
+        msg = self.test_core.recv_message(self.rr_socket)
+        assert msg.message == Message.TASK_REQUEST
+        self.test_core.send_message(self.rr_socket, Message.TASKS, payload=tasks)
+        
+        # The first task is running; the last is returned
+        time.sleep(0.1)
+        self.test_core.send_message(self.ann_socket, Message.STEAL, (self.test_worker.node_id, 1))
+        msg = self.test_core.recv_message(self.rr_socket)
+        assert msg.message == Message.TASKS_RETURNED
+        assert msg.payload == [tasks[2].task_id]
+        self.test_core.send_ack(self.rr_socket, msg)
+        
+        results = []
+        while len(results) < 2:
+            msg = self.test_core.recv_message(self.rr_socket)
+            assert msg.message == Message.RESULTS
+            results.extend(msg.payload[0])
+            self.test_core.send_ack(self.rr_socket, msg)
+        assert [result.result for result in results] == [0, 1]
                 
     def test_worker_processes_exception(self):
         task = Task(will_fail, (), {})
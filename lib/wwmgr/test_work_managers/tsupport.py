@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
 from nose.tools import raises, nottest, timed
 
 class ExceptionForTest(Exception):
@@ -52,6 +53,15 @@ def will_busyhang_uninterruptible():
 def identity(x):
     return x
 
+def negate_in_place(x):
+    x *= -1
+    return x
+
+def sleep_identity(x, delay=0.5):
+    import time
+    time.sleep(delay)
+    return x
+
 def busy_identity(x):
     import time
     delay = 0.01
@@ -60,6 +70,10 @@ def busy_identity(x):
         pass
     return x 
 
+def timestamp():
+    import time
+    return time.time()
+
 def random_int(seed=None):
     import random,sys
     
@@ -138,3 +152,17 @@ class CommonParallelTests:
         
         assert len(result_list) != len(result_set)
     
+
+class CommonPriorityTests:
+    '''Tests of the order in which queued tasks are dispatched, for work managers with one worker'''
+    def test_priority(self):
+        # Occupy the worker, and any task prefetched for it, while the remaining tasks are queued
+        for _i in range(2):
+            self.work_manager.submit(sleep_identity, args=(None, 0.2))
+        # Let the work manager dispatch them (as it may do so in another thread)
+        time.sleep(0.05)
+        prioritized = [(0, None), (1, None), (0, 10), (1, 5), (0, None)]
+        futures = [self.work_manager.submit(timestamp, priority=priority, cost_hint=cost_hint) 
+                   for (priority, cost_hint) in prioritized]
+        times = [future.get_result() for future in futures]
+        assert sorted(range(len(futures)), key=times.__getitem__) == [3,1,2,0,4]
@@ -20,9 +20,8 @@
 # Foundation. See http://docs.python.org/3/license.html for more information.
 
 import logging
-import uuid, threading, signal
-import h5py
-from itertools import islice
+import uuid, threading, signal, heapq
+from itertools import islice, count
 from contextlib import contextmanager
 log = logging.getLogger(__name__)
 
@@ -82,22 +81,27 @@ class WorkManager:
         '''Run the worker loop (in clients only).'''
         pass
         
-    def submit(self, fn, args=None, kwargs=None):
+    def submit(self, fn, args=None, kwargs=None, priority=0, cost_hint=None):
         '''Submit a task to the work manager, returning a `WMFuture` object representing the pending
         result. ``fn(*args,**kwargs)`` will be executed by a worker, and the return value assigned as the
         result of the returned future.  The function ``fn`` and all arguments must be picklable; note
         particularly that off-path modules (like the system module and any active plugins) are not
-        picklable unless pre-loaded in the worker process (i.e. prior to forking the master).''' 
+        picklable unless pre-loaded in the worker process (i.e. prior to forking the master).
+        
+        Tasks waiting for a worker are dispatched in order of decreasing ``priority``, then of
+        decreasing ``cost_hint`` (an estimate, in any consistent units, of the time the task will
+        take; zero if not given), so that long tasks start early and short tasks fill in around them,
+        then in the order submitted.''' 
         raise NotImplementedError
     
     def submit_many(self, tasks):
         '''Submit a set of tasks to the work manager, returning a list of `WMFuture` objects representing
         pending results. Each entry in ``tasks`` should be a triple (fn, args, kwargs), which will result in
-        fn(*args, **kwargs) being executed by a worker. The function ``fn`` and all arguments must be
-        picklable; note particularly that off-path modules are not picklable unless pre-loaded in the worker
-        process.'''
+        fn(*args, **kwargs) being executed by a worker, optionally followed by the priority and cost hint of
+        the task (see ``submit()``). The function ``fn`` and all arguments must be picklable; note
+        particularly that off-path modules are not picklable unless pre-loaded in the worker process.'''
         
-        return [self.submit(fn,args,kwargs) for (fn,args,kwargs) in tasks]
+        return [self.submit(*task) for task in tasks]
     
     def as_completed(self, futures):
         '''Return a generator which yields results from the given ``futures`` as they become
@@ -125,12 +129,12 @@ class WorkManager:
 
     def submit_as_completed(self, task_generator, queue_size=None):
         '''Return a generator which yields results from a set of ``futures`` as they become
-        available. Futures are generated by the ``task_generator``, which must return a triple of the form
-        expected by ``submit``. The method also accepts an int ``queue_size`` that dictates the
+        available. Futures are generated by the ``task_generator``, which must return tasks of the form
+        expected by ``submit_many``. The method also accepts an int ``queue_size`` that dictates the
         maximum number of Futures that should be pending at any given time. The default value of
         ``None`` submits all of the tasks at once.'''
 
-        futures = [self.submit(fn,args,kwargs) for (fn,args,kwargs) in islice(task_generator, queue_size)]
+        futures = [self.submit(*task) for task in islice(task_generator, queue_size)]
         pending = set(futures)
 
         with WMFuture.all_acquired(pending):
@@ -139,7 +143,7 @@ class WorkManager:
         while pending:
             watcher.wait()
             completed = watcher.reset()
-            new_futures = [self.submit(fn,args,kwargs) for (fn,args,kwargs) in islice(task_generator, len(completed))]
+            new_futures = [self.submit(*task) for task in islice(task_generator, len(completed))]
             pending.update(new_futures)
 
             with WMFuture.all_acquired(new_futures):
@@ -149,9 +153,10 @@ class WorkManager:
                 yield future
                 pending.remove(future)
 
-    def wait_any(self, futures):
+    def wait_any(self, futures, timeout=None):
         '''Wait on any of the given ``futures`` and return the first one which has a result available.
-        If more than one result is or becomes available simultaneously, any completed future may be returned.'''
+        If more than one result is or becomes available simultaneously, any completed future may be returned.
+        If ``timeout`` is given and no result becomes available within ``timeout`` seconds, returns None.'''
         pending = set(futures)
         with WMFuture.all_acquired(pending):
             completed = {future for future in futures if future.done}
@@ -159,14 +164,24 @@ class WorkManager:
             if completed:
                 # If any futures are complete, then we don't need to do anything else
                 return completed.pop()
+            elif timeout is not None and timeout <= 0:
+                return None
             else:
                 # Otherwise, we need to install a watcher
                 watcher = FutureWatcher(futures, threshold = 1)
         
-        watcher.wait()
+        if not watcher.wait(timeout):
+            return None
         completed = watcher.reset()
         return completed.pop()        
             
+    def cancel(self, future):
+        '''Request that the task represented by ``future`` not be run, and return True if it will not
+        be (in which case ``future`` raises ``concurrent.futures.CancelledError``). Tasks already handed
+        to a worker are not interrupted, and their results are delivered as usual. This default
+        implementation cannot withdraw tasks, and always returns False.'''
+        return False
+            
     def wait_all(self, futures):
         '''A convenience function which waits on all the given ``futures`` in order.  This function returns
         the same ``futures`` as submitted to the function as a list, indicating the order in which waits
@@ -184,6 +199,62 @@ class WorkManager:
         return True
             
 
+class TaskQueue:
+    '''Tasks awaiting dispatch to workers, kept in the order in which they are to be dispatched (see
+    ``WorkManager.submit()``). Each task's place in this order is given by ``next_order()`` when it is
+    submitted, so that a task reclaimed from a worker may be returned to its original place. Safe
+    for use by multiple threads.'''
+    
+    def __init__(self):
+        self._heap = []
+        self._counter = count()
+        self._lock = threading.Lock()
+        
+    def next_order(self, priority=0, cost_hint=None):
+        '''Return the place in the order of dispatch of a task submitted now with the given
+        ``priority`` and ``cost_hint``.'''
+        return (-priority, -(cost_hint or 0), next(self._counter))
+        
+    def put(self, task, priority=0, cost_hint=None, order=None):
+        '''Queue ``task``, in the place given by ``order`` if given, and otherwise in that given by
+        ``priority`` and ``cost_hint``. Returns the place of the task.'''
+        if order is None:
+            order = self.next_order(priority, cost_hint)
+        with self._lock:
+            heapq.heappush(self._heap, (order, task))
+        return order
+        
+    def get(self):
+        '''Remove and return the next task to dispatch, raising IndexError if none are queued.'''
+        with self._lock:
+            return heapq.heappop(self._heap)[1]
+        
+    def remove(self, task):
+        '''Remove ``task``, raising ValueError if it is not queued.'''
+        with self._lock:
+            for (i, (_order, queued_task)) in enumerate(self._heap):
+                if queued_task is task:
+                    self._heap[i] = self._heap[-1]
+                    self._heap.pop()
+                    heapq.heapify(self._heap)
+                    return
+        raise ValueError('task not queued')
+    
+    def clear(self):
+        '''Remove all tasks, returning them in order of dispatch.'''
+        with self._lock:
+            tasks = [task for (_order, task) in sorted(self._heap, key=lambda entry: entry[0])]
+            self._heap = []
+        return tasks
+    
+    def __iter__(self):
+        '''Iterate over the queued tasks (in no particular order).'''
+        with self._lock:
+            return iter([task for (_order, task) in self._heap])
+        
+    def __len__(self):
+        return len(self._heap)
+
 class FutureWatcher:
     '''A device to wait on multiple results and/or exceptions with only one lock.'''
     
@@ -205,9 +276,10 @@ class FutureWatcher:
             if len(self.completed) >= self.threshold:
                 self.event.set()
                 
-    def wait(self):
-        '''Wait on one or more futures.'''
-        return self.event.wait()
+    def wait(self, timeout=None):
+        '''Wait on one or more futures, for at most ``timeout`` seconds if given. Returns False
+        if the wait timed out.'''
+        return self.event.wait(timeout)
             
     def reset(self):
         '''Reset this watcher's list of completed futures, returning the list of completed futures
@@ -337,7 +409,7 @@ class WMFuture:
         with self._condition:
             if self._done:
                 if self._exception:
-                    if isinstance(self._traceback, h5py.string_dtype(encoding='utf-8')):
+                    if isinstance(self._traceback, str):
                         if self._traceback:
                             log.error('uncaught exception in remote function\n{}'.format(self._traceback))
                         raise self._exception
@@ -18,18 +18,38 @@
 
 """
 A work manager which uses MPI to distribute tasks and collect results.
+
+The master rank runs a single communication thread, which sends each worker rank up to
+``prefetch`` tasks at a time (so that workers need not wait on the master between tasks), in order
+of priority, and collects results. For a short time after tasks are sent or a result is received,
+this thread checks for results continuously (yielding to other threads), so that short tasks see no
+added latency. After that, it sleeps between checks for results for a tenth of the time waited so far
+(up to a limit), or until a task is submitted, so that it does not compete for the CPU (and the GIL)
+with the thread submitting tasks while long tasks run, yet delays results by at most a tenth of the
+time taken to run them. With no tasks outstanding, it sleeps until a task is submitted.
+Large buffers in tasks and results, such as the data of numpy arrays, are sent as raw MPI messages
+rather than being copied into pickles.
+
+Once no tasks remain on the master, a worker left idle steals work from the worker holding the
+most: the master asks that worker to return half of the tasks it has not yet started, and queues
+them again in their original places. Each worker rank runs tasks in one thread and communicates in
+another (which alone makes MPI calls), so that it can answer such requests while running a task.
 """
 
 
-import logging, re, threading
+import logging, pickle, threading, time, traceback
 from collections import deque
+from concurrent.futures import CancelledError
 from mpi4py import MPI
 
 import work_managers
-from work_managers import WorkManager, WMFuture
+from work_managers import WorkManager, WMFuture, TaskQueue
 
 log = logging.getLogger(__name__)
 
+# Buffers at least this large are sent as separate (uncopied) messages, rather than pickled
+OUT_OF_BAND_THRESHOLD = 65536
+
 class Task:
     # tasks are tuples of (task_id, function, args, keyword args)
     def __init__(self, task_id, fn, args, kwargs):
@@ -38,6 +58,9 @@ class Task:
         self.args = args
         self.kwargs = kwargs
         
+        # Place in order of dispatch (see TaskQueue)
+        self.order = None
+        
     def __repr__(self):
         return '<Task {self.task_id}: {self.fn!r}(*{self.args!r}, **{self.kwargs!r})>'\
                .format(self=self)
@@ -56,13 +79,13 @@ class MPIBase:
         # Define master rank
         self.master_rank = 0
 
-        # Define message tags for task, result, and announce
+        # Define message tags for task, result, announce, and steal (requests for a worker to
+        # return unstarted tasks), and for the buffers following tasks and results
         self.task_tag = 10
         self.result_tag = 20
         self.announce_tag = 30
-
-        # create an empty message buffer
-        messages = []
+        self.data_tag = 40
+        self.steal_tag = 50
 
     def startup(self):
         raise NotImplementedError
@@ -78,143 +101,327 @@ class MPIBase:
             return True
         else:
             return False
+        
+    def send_object(self, obj, dest, tag, blocking=True):
+        '''Send ``obj`` to rank ``dest``. The object is pickled, except for large out-of-band buffers
+        (such as those of contiguous numpy arrays), which follow as raw messages. If ``blocking``
+        is false, return the requests and buffers involved, which must be kept until the requests
+        complete.'''
+        buffers = []
+        def buffer_callback(pickle_buffer):
+            # Returning a true value serializes the buffer in-band
+            raw = pickle_buffer.raw()
+            if raw.nbytes < OUT_OF_BAND_THRESHOLD:
+                return True
+            buffers.append(raw)
+            return False
+        header = (pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback),
+                  [buffer.nbytes for buffer in buffers])
+        
+        if blocking:
+            self.comm.send(header, dest=dest, tag=tag)
+            for buffer in buffers:
+                self.comm.Send([buffer, MPI.BYTE], dest=dest, tag=self.data_tag)
+        else:
+            requests = [self.comm.isend(header, dest=dest, tag=tag)]
+            requests.extend(self.comm.Isend([buffer, MPI.BYTE], dest=dest, tag=self.data_tag) for buffer in buffers)
+            return (requests, buffers)
+        
+    def recv_object(self, message, source):
+        '''Receive an object sent by rank ``source`` with ``send_object()``, given the matched
+        message (from ``mprobe()`` or ``improbe()``) containing its header.'''
+        (pickled, sizes) = message.recv()
+        buffers = [bytearray(size) for size in sizes]
+        for buffer in buffers:
+            self.comm.Recv([buffer, MPI.BYTE], source=source, tag=self.data_tag)
+        return pickle.loads(pickled, buffers=buffers)
     
 class MPIWMServer(MPIBase):
     
-    def __init__(self):
+    # Time after the last activity (tasks sent or a result received) for which results are checked for
+    # continuously, the fraction of the time since then for which to sleep between later checks, and
+    # the longest such sleep
+    spin_period = 0.001
+    poll_fraction = 0.1
+    max_poll_interval = 0.01
+    
+    # Interval between checks for the completion of sends on shutdown
+    min_poll_interval = 0.00002
+    
+    def __init__(self, prefetch=1):
         super(MPIWMServer, self).__init__()
         
         # tasks awaiting dispatch
-        self.task_queue = deque()
+        self.task_queue = TaskQueue()
+        
+        # Number of tasks each worker holds at once
+        self.prefetch = prefetch
         
-        # MPI destination ranks for tasks; exclude master_rank
-        self.task_dest = deque()
-        for rank in range(self.num_procs):
-            if rank != self.master_rank:
-                self.task_dest.append(rank)
+        # Tasks held by each MPI destination rank, by ID; exclude master_rank
+        self.worker_tasks = {rank: dict() for rank in range(self.num_procs) if rank != self.master_rank}
+        
+        # Ranks asked to return tasks, which have not yet replied
+        self.steals_requested = set()
+        
+        # Incomplete non-blocking sends, as (requests, buffers)
+        self.send_requests = []
 
         # futures corresponding to tasks
         self.pending_futures = dict()
-
-    def _dispatch_loop(self):
-        comm = self.comm        
-
-        while True:
-
-            # Dispatch as many tasks as possible before checking for shutdown
-            while self.task_dest:
+        
+        # Wakes the communication thread when tasks are submitted, or on shutdown
+        self._wakeup = threading.Event()
+        self._shutdown_requested = False
+        
+    @property
+    def n_workers(self):
+        return len(self.worker_tasks)
+        
+    def _dispatch(self):
+        '''Send queued tasks to workers with free slots, as one message per worker, to those holding
+        the fewest tasks first.'''
+        if not self.task_queue:
+            return
+        for (rank, held_tasks) in sorted(self.worker_tasks.items(), key=lambda item: len(item[1])):
+            tasks = []
+            while len(held_tasks) + len(tasks) < self.prefetch:
                 try:
-                    task = self.task_queue.popleft()
-                    task_dest = self.task_dest.popleft()
+                    tasks.append(self.task_queue.get())
                 except IndexError:
                     break
-                else:
-                    comm.send(task, dest = task_dest, tag = self.task_tag )
-
-            status = MPI.Status()
-            comm.Iprobe(self.master_rank, self.announce_tag, status)
-            message_tag = status.Get_tag()
+            if tasks:
+                held_tasks.update((task.task_id, task) for task in tasks)
+                self.send_requests.append(self.send_object(tasks, dest=rank, tag=self.task_tag, blocking=False))
+            if not self.task_queue:
+                break
+            
+    def _steal(self):
+        '''If workers are idle while others hold tasks they have not started, ask the workers holding
+        the most tasks to return half of them.'''
+        n_idle = sum(1 for held_tasks in self.worker_tasks.values() if not held_tasks)
+        while n_idle > len(self.steals_requested):
+            (n_held, rank) = max((len(held_tasks), rank) for (rank, held_tasks) in self.worker_tasks.items()
+                                 if rank not in self.steals_requested)
+            # One task held by each worker may be running
+            if n_held < 2:
+                break
+            log.debug('asking rank {:d} to return {:d} tasks'.format(rank, n_held//2))
+            self.steals_requested.add(rank)
+            self.send_requests.append(([self.comm.isend(n_held//2, dest=rank, tag=self.steal_tag)], []))
+
+    def _test_sends(self):
+        self.send_requests = [(requests, buffers) for (requests, buffers) in self.send_requests
+                              if not MPI.Request.Testall(requests)]
+        
+    def _receive_result(self, message, source):
+        # results are tuples of (task_id, {'result', 'exception'}, value), or (None, 'returned', task_ids)
+        # in reply to a steal request
+        (task_id, result_stat, result_value) = self.recv_object(message, source)
+        if result_stat == 'returned':
+            self.steals_requested.discard(source)
+            for returned_id in result_value:
+                task = self.worker_tasks[source].pop(returned_id)
+                self.task_queue.put(task, order=task.order)
+            return
+        
+        self.worker_tasks[source].pop(task_id, None)
 
-            # Check for announcements
-            if message_tag == self.announce_tag:
-                messages = comm.recv(source = self.master_rank, tag = self.announce_tag)
-                if 'shutdown' in messages:
-                    log.debug('exiting _dispatch_loop()')
-                    return
+        ft = self.pending_futures.pop(task_id)
+        if result_stat == 'exception':
+            ft._set_exception(*result_value)
+        else:
+            ft._set_result(result_value)
 
-    def _receive_loop(self):
-        comm = self.comm 
+    def _comm_loop(self):
+        comm = self.comm
+        last_activity = time.time()
 
         while True:
+            self._dispatch()
+            if self.prefetch > 1 and not self.task_queue:
+                self._steal()
+            if self.send_requests:
+                self._test_sends()
 
             status = MPI.Status()
-            comm.Iprobe(MPI.ANY_SOURCE, MPI.ANY_TAG, status)
-            message_src = status.Get_source()
-            message_tag = status.Get_tag()
-
-            # results are tuples of (task_id, {'result', 'exception'}, value)
-            if message_tag == self.result_tag:
-                (task_id, result_stat, result_value) = comm.recv(source = message_src, tag = message_tag)
-
-                ft = self.pending_futures.pop(task_id)
-
-                if result_stat == 'exception':
-                    ft._set_exception(*result_value)
-# Check with Matt on what else to do for an exception
+            message = comm.improbe(MPI.ANY_SOURCE, self.result_tag, status)
+            if message is not None:
+                self._receive_result(message, status.Get_source())
+                last_activity = time.time()
+                continue
+            
+            if self._shutdown_requested:
+                break
+
+            # Nothing has arrived. While results are awaited, check again immediately (letting other
+            # threads run) soon after the last activity, and otherwise after a sleep proportional to
+            # the time waited; with nothing outstanding, sleep until a task is submitted
+            if self.send_requests or any(self.worker_tasks.values()):
+                waited = time.time() - last_activity
+                if waited < self.spin_period:
+                    time.sleep(0)
+                    woken = self._wakeup.is_set()
                 else:
-                    ft._set_result(result_value)
-                    self.task_dest.append(message_src)
-
-            # Check for announcements
-            elif message_tag == self.announce_tag:
-                messages = comm.recv(source = message_src, tag = message_tag)
-                if 'shutdown' in messages:
-                    log.debug('exiting _receive_loop()')
-                    return
+                    woken = self._wakeup.wait(min(self.poll_fraction*waited, self.max_poll_interval))
+            else:
+                woken = self._wakeup.wait()
+            if woken:
+                self._wakeup.clear()
+                last_activity = time.time()
+                
+        # send 'shutdown' to client threads
+        for rank in self.worker_tasks:
+            comm.send('shutdown', dest = rank, tag = self.announce_tag)
+        while self.send_requests:
+            self._test_sends()
+            time.sleep(self.min_poll_interval)
+        log.debug('exiting _comm_loop()')
                 
-    def _make_append_task(self, fn, args, kwargs):
+    def _make_append_task(self, fn, args, kwargs, priority=0, cost_hint=None):
         ft = WMFuture()
         task_id = ft.task_id
         task = Task(task_id, fn, args, kwargs)
+        task.order = self.task_queue.next_order(priority, cost_hint)
         self.pending_futures[task_id] = ft
-        self.task_queue.append(task)
+        self.task_queue.put(task, order=task.order)
         return ft
     
-    def submit(self, fn, args=None, kwargs=None):
-        ft = self._make_append_task(fn, args if args is not None else [], kwargs if kwargs is not None else {})
+    def submit(self, fn, args=None, kwargs=None, priority=0, cost_hint=None):
+        ft = self._make_append_task(fn, args if args is not None else [], kwargs if kwargs is not None else {},
+                                    priority, cost_hint)
+        self._wakeup.set()
         return ft
+    
+    def submit_many(self, tasks):
+        futures = [self._make_append_task(fn, args if args is not None else [], kwargs if kwargs is not None else {},
+                                          *priority)
+                   for (fn, args, kwargs, *priority) in tasks]
+        self._wakeup.set()
+        return futures
+    
+    def cancel(self, future):
+        # Only tasks not yet sent to a worker can be withdrawn
+        for task in list(self.task_queue):
+            if task.task_id == future.task_id:
+                try:
+                    self.task_queue.remove(task)
+                except ValueError:
+                    # Sent to a worker in the meantime
+                    return False
+                self.pending_futures.pop(task.task_id, None)
+                future._set_exception(CancelledError('task {!s} cancelled'.format(task.task_id)))
+                return True
+        return False
 
     def startup(self):
-        # start up server threads
-        server_threads = []
-
-        self._dispatch_thread = threading.Thread(target=self._dispatch_loop)
-        self._dispatch_thread.start()
-        server_threads.append(self._dispatch_thread)
-
-        self._receive_thread = threading.Thread(target=self._receive_loop)
-        self._receive_thread.start()
-        server_threads.append(self._receive_thread)
-
-        self.server_threads = server_threads 
+        # start up server thread
+        self._comm_thread = threading.Thread(target=self._comm_loop)
+        self._comm_thread.start()
+        self.server_threads = [self._comm_thread]
 
 class MPIClient(MPIBase):
+    
+    # Shortest and longest intervals between checks for messages while a task runs
+    min_poll_interval = 0.00002
+    max_poll_interval = 0.01
 
     def __init__(self):
         super(MPIClient,self).__init__()
         
+        # Tasks received but not yet started, guarded by a condition on which the task thread waits;
+        # None tells the task thread to exit
+        self._tasks = deque()
+        self._tasks_cond = threading.Condition()
+        
+        # Results awaiting return to the master, and an event set as each is added
+        self._results = deque()
+        self._result_ready = threading.Event()
+        
+    def _run_tasks(self):
+        while True:
+            with self._tasks_cond:
+                while not self._tasks:
+                    self._tasks_cond.wait()
+                task = self._tasks.popleft()
+            if task is None:
+                return
+            
+            try:
+                result_value = task.fn(*task.args, **task.kwargs)
+            except Exception as e:
+                result_object = (task.task_id, 'exception', (e, traceback.format_exc()))
+            else:
+                result_object = (task.task_id, 'result', result_value)
+            self._results.append(result_object)
+            self._result_ready.set()
+        
     def _create_worker(self):
         comm = self.comm
+        poll_interval = self.min_poll_interval
+        
+        # Number of tasks received whose results have not yet been returned
+        n_held = 0
 
         while True:
-
+            while self._results:
+                self.send_object(self._results.popleft(), dest = self.master_rank, tag = self.result_tag)
+                n_held -= 1
+                
+            # Block waiting for messages only if no task is running or waiting to run
             status = MPI.Status()
-            comm.Probe(self.master_rank, MPI.ANY_TAG, status)
-            message_src = self.master_rank
-            message_tag = status.Get_tag()
-
-            # Check for available task 
-            if message_tag == self.task_tag:
-
-                task = comm.recv(source = message_src, tag = message_tag)
-
-                try:
-                    result_value = task.fn(*task.args, **task.kwargs)
-                except Exception as e:
-                    result_object = (task.task_id, 'exception', result_value)
-                else:
-                    result_object = (task.task_id, 'result', result_value)
-
-                comm.send(result_object, dest = self.master_rank, tag = self.result_tag)
-
-            # Check for announcements
-            if message_tag == self.announce_tag:
-                messages = comm.recv(source = message_src, tag = message_tag)
-                if 'shutdown' in messages:
-                    return
+            if n_held:
+                message = comm.improbe(self.master_rank, MPI.ANY_TAG, status)
+            else:
+                message = comm.mprobe(self.master_rank, MPI.ANY_TAG, status)
+            
+            if message is not None:
+                poll_interval = self.min_poll_interval
+                message_tag = status.Get_tag()
+
+                # Check for available tasks
+                if message_tag == self.task_tag:
+                    tasks = self.recv_object(message, self.master_rank)
+                    n_held += len(tasks)
+                    with self._tasks_cond:
+                        self._tasks.extend(tasks)
+                        self._tasks_cond.notify()
+                        
+                # Return up to the requested number of tasks not yet started, keeping the
+                # earliest in order of dispatch
+                elif message_tag == self.steal_tag:
+                    n_requested = message.recv()
+                    returned = []
+                    with self._tasks_cond:
+                        while self._tasks and len(returned) < n_requested:
+                            returned.append(self._tasks.pop())
+                    n_held -= len(returned)
+                    self.send_object((None, 'returned', [task.task_id for task in returned]), 
+                                     dest = self.master_rank, tag = self.result_tag)
+
+                # Check for announcements
+                elif message_tag == self.announce_tag:
+                    messages = message.recv()
+                    if 'shutdown' in messages:
+                        with self._tasks_cond:
+                            self._tasks.clear()
+                            self._tasks.append(None)
+                            self._tasks_cond.notify()
+                        self._task_thread.join()
+                        return
+                continue
+            
+            # Nothing has arrived while a task runs; sleep until it completes, or for increasingly
+            # long intervals
+            if self._result_ready.wait(poll_interval):
+                self._result_ready.clear()
+                poll_interval = self.min_poll_interval
+            else:
+                poll_interval = min(2*poll_interval, self.max_poll_interval)
 
     def startup(self):
-        # start up client thread
+        # start up client threads
+        self._task_thread = threading.Thread(target=self._run_tasks)
+        self._task_thread.start()
         self._worker_thread = threading.Thread(target=self._create_worker)
         self._worker_thread.start()
 
@@ -223,13 +430,28 @@ class MPIClient(MPIBase):
 
 class MPIWorkManager(MPIWMServer,MPIClient,WorkManager):
     '''A work manager using MPI.'''
+    
+    @classmethod
+    def add_wm_args(cls, parser, wmenv=None):
+        if wmenv is None:
+            wmenv = work_managers.environment.default_env
+            
+        wm_group = parser.add_argument_group('options for MPI ("mpi") work manager')
+        wm_group.add_argument(wmenv.arg_flag('mpi_prefetch'), metavar='N_TASKS', type=int,
+                              help='Send each worker up to N_TASKS tasks at once, so that workers need '
+                                  +'not wait on the master between tasks. Values greater than one (the '
+                                  +'default) help with many small tasks, at some cost in load balance for '
+                                  +'long tasks.')
+        
     @classmethod
     def from_environ(cls, wmenv=None):
-        return cls()
+        if wmenv is None:
+            wmenv = work_managers.environment.default_env
+        return cls(prefetch=wmenv.get_val('mpi_prefetch', 1, int))
 
-    def __init__(self):
+    def __init__(self, prefetch=1):
         WorkManager.__init__(self)
-        MPIWMServer.__init__(self)
+        MPIWMServer.__init__(self, prefetch)
         MPIClient.__init__(self)
         
     def startup(self):
@@ -239,14 +461,11 @@ class MPIWorkManager(MPIWMServer,MPIClient,WorkManager):
             MPIClient.startup(self)
             
     def shutdown(self):
-        comm = self.comm
         if self.rank == self.master_rank:
-            # send 'shutdown' to client threads
-            for x in self.task_dest:
-                comm.send('shutdown', dest = x, tag = self.announce_tag )
-            # send 'shutdown' to server threads
+            # the server thread sends 'shutdown' to client threads as it exits
+            self._shutdown_requested = True
+            self._wakeup.set()
             for thread in self.server_threads:
-                comm.send('shutdown', dest = 0, tag = self.announce_tag )
+                thread.join()
 
         log.info( "MPIWMServer.shutdown complete" )
-
@@ -16,29 +16,200 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import sys, logging, multiprocessing, threading, traceback, signal, os, random
+import sys, logging, multiprocessing, threading, traceback, signal, os, random, io, mmap, pickle
+from collections import OrderedDict
+from multiprocessing.reduction import ForkingPickler
 import work_managers
-from . import WorkManager, WMFuture
+from . import WorkManager, WMFuture, TaskQueue
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
 
 log = logging.getLogger(__name__)
 
-# Tasks are tuples ('task', task_id, fn, args, kwargs).
-# Results are tuples (rtype, task_id, payload) where rtype is 'result' or 'exception' and payload is the return value
-# or exception, respectively.
+# Tasks are tuples ('task', task_id, fn, args, kwargs), or ('shm_task', task_id, payload, None, None) where payload
+# is a SharedMemoryPayload containing (fn, args, kwargs).
+# Results are tuples (rtype, task_id, payload, released) where rtype is 'result', 'shm_result', or 'exception' and
+# payload is the return value (a SharedMemoryPayload containing it for 'shm_result') or exception, respectively.
+# released lists the names of the shared memory segments of the task, whose contents the worker has copied.
 
 task_shutdown_sentinel   = ('shutdown', None, None, (), {})
-result_shutdown_sentinel = ('shutdown', None, None)
+result_shutdown_sentinel = ('shutdown', None, None, ())
+
+class SharedMemoryPayload:
+    '''A pickled object whose large buffers have been placed in shared memory segments, so that only
+    the pickle itself and the names of the segments need pass through a queue.'''
+    
+    def __init__(self, pickled, segments, owner=None):
+        self.pickled = pickled
+        
+        # (name, nbytes) of the segment holding each out-of-band buffer, in order
+        self.segments = segments
+        
+        # Index of the worker which owns the segments, or None for the master
+        self.owner = owner
+        
+class SharedMemoryTransport:
+    '''Pickling of objects for transfer between processes, in which buffers of at least ``threshold``
+    bytes that support out-of-band pickling (such as those of contiguous numpy arrays) are copied
+    into shared memory segments rather than into the pickle. Smaller buffers and other data are
+    pickled as usual.
+    
+    Segments belong to the process which created them. The receiving process copies the contents of
+    a segment out, after which the owner may release the segment for reuse; up to ``max_free``
+    released segments are kept, and the rest are removed. Segments of other processes remain
+    attached (up to ``max_attached`` at a time), so that reused segments need not be mapped again.'''
+    
+    def __init__(self, threshold, max_free=4, max_attached=8):
+        self.threshold = threshold
+        self.max_free = max_free
+        self.max_attached = max_attached
+        
+        # All segments created by this process, by name
+        self.owned = {}
+        
+        # Names of owned segments available for reuse, oldest first
+        self.free = []
+        
+        # Segments of other processes, least recently used first
+        self.attached = OrderedDict()
+        
+        # Segments are acquired by a submitting thread and released by a receiving thread
+        self.lock = threading.Lock()
+        
+    def _acquire(self, nbytes):
+        with self.lock:
+            # Reuse the smallest free segment large enough
+            candidates = [name for name in self.free if self.owned[name].size >= nbytes]
+            if candidates:
+                name = min(candidates, key=lambda name: self.owned[name].size)
+                self.free.remove(name)
+                return self.owned[name]
+            
+            size = -(-nbytes // mmap.PAGESIZE) * mmap.PAGESIZE
+            segment = shared_memory.SharedMemory(create=True, size=size)
+            if hasattr(os, 'posix_fallocate'):
+                # Reserve memory now, so that a lack of space raises an error here rather than
+                # killing this process with SIGBUS on writing to the segment
+                try:
+                    os.posix_fallocate(segment._fd, 0, size)
+                except OSError:
+                    segment.close()
+                    segment.unlink()
+                    raise
+            self.owned[segment.name] = segment
+            return segment
+        
+    def _remove(self, name):
+        segment = self.owned.pop(name)
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+    
+    def release(self, names):
+        '''Release the given owned segments, whose contents have been copied by their receiver.'''
+        with self.lock:
+            for name in names:
+                if name in self.owned and name not in self.free:
+                    self.free.append(name)
+            while len(self.free) > self.max_free:
+                self._remove(self.free.pop(0))
+    
+    def _attach(self, name):
+        try:
+            segment = self.attached.pop(name)
+        except KeyError:
+            segment = shared_memory.SharedMemory(name=name)
+        self.attached[name] = segment
+        while len(self.attached) > self.max_attached:
+            self.attached.popitem(last=False)[1].close()
+        return segment
+    
+    def dumps(self, obj, owner=None):
+        '''Pickle ``obj`` into a ``SharedMemoryPayload``, placing large buffers in owned segments.
+        Buffers for which no segment can be allocated are pickled as usual.'''
+        segments = []
+        def buffer_callback(pickle_buffer):
+            # Returning a true value serializes the buffer in-band
+            raw = pickle_buffer.raw()
+            if raw.nbytes < self.threshold:
+                return True
+            try:
+                segment = self._acquire(raw.nbytes)
+            except OSError as e:
+                log.debug('cannot allocate shared memory for {:d} bytes: {!s}'.format(raw.nbytes, e))
+                return True
+            segment.buf[:raw.nbytes] = raw
+            segments.append((segment.name, raw.nbytes))
+            return False
+        
+        pickled = io.BytesIO()
+        try:
+            ForkingPickler(pickled, 5, True, buffer_callback).dump(obj)
+        except:
+            self.release([name for (name, _nbytes) in segments])
+            raise
+        return SharedMemoryPayload(pickled.getvalue(), segments, owner)
+    
+    def worth_sending(self, payload):
+        '''Whether ``payload`` should be sent in place of the object it contains. If the payload
+        has no segments and its pickle is small, the object itself may be sent more cheaply.'''
+        return bool(payload.segments) or len(payload.pickled) >= self.threshold
+    
+    def loads(self, payload):
+        '''Unpickle an object from ``payload``, copying its buffers out of shared memory (so that
+        arrays received are writable, as with ordinary pickling). Afterwards, the segments of
+        ``payload`` may be released by their owner.'''
+        buffers = []
+        for (name, nbytes) in payload.segments:
+            with self._attach(name).buf[:nbytes] as view:
+                buffers.append(bytearray(view))
+        return pickle.loads(payload.pickled, buffers=buffers)
+    
+    def close(self):
+        '''Detach from the segments of other processes and remove all owned segments, including
+        any not yet released.'''
+        while self.attached:
+            self.attached.popitem()[1].close()
+        with self.lock:
+            for name in list(self.owned):
+                self._remove(name)
+            self.free = []
 
 class ProcessWorkManager(WorkManager):
-    '''A work manager using the ``multiprocessing`` module.'''
+    '''A work manager using the ``multiprocessing`` module. If ``shm_threshold`` is given, array
+    arguments and results of at least that many bytes pass between processes through shared memory
+    (see ``SharedMemoryTransport``) rather than being pickled through a pipe.
+    
+    Submitted tasks wait on the master, in order of priority (see ``WorkManager.submit()``), and
+    are fed to the queue shared by all workers only as workers become free to run them; whichever
+    worker is idle takes the next task from that queue.'''
+    
+    @classmethod
+    def add_wm_args(cls, parser, wmenv=None):
+        if wmenv is None:
+            wmenv = work_managers.environment.default_env
+            
+        wm_group = parser.add_argument_group('options for multiprocessing ("processes") work manager')
+        wm_group.add_argument(wmenv.arg_flag('processes_shm_threshold'), metavar='BYTES', type=int,
+                              help='Pass arrays of at least BYTES bytes (such as those of numpy arrays) '
+                                  +'between processes through shared memory rather than pickling them '
+                                  +'through a pipe. This is much faster for large arrays, but requires '
+                                  +'enough space in shared memory (/dev/shm) for the arrays in transit. '
+                                  +'Disabled by default.')
     
     @classmethod
     def from_environ(cls, wmenv=None): 
         if wmenv is None:
             wmenv = work_managers.environment.default_env 
-        return cls(wmenv.get_val('n_workers', multiprocessing.cpu_count(), int))
+        return cls(wmenv.get_val('n_workers', multiprocessing.cpu_count(), int),
+                   shm_threshold=wmenv.get_val('processes_shm_threshold', 0, int))
     
-    def __init__(self, n_workers = None, shutdown_timeout = 1):
+    def __init__(self, n_workers = None, shutdown_timeout = 1, shm_threshold = None):
         super(ProcessWorkManager,self).__init__()
         self.n_workers = n_workers or multiprocessing.cpu_count()
         self.workers = None
@@ -47,10 +218,28 @@ class ProcessWorkManager(WorkManager):
         self.receive_thread = None
         self.pending = None
         
+        # Tasks not yet put on the task queue, and the number put there but not yet complete, which
+        # is kept to twice the number of workers so that a worker finishing a task need not wait
+        # for the master to send it another
+        self.waiting_tasks = TaskQueue()
+        self.n_dispatched = 0
+        self.dispatch_limit = 2*self.n_workers
+        self.dispatch_lock = threading.Lock()
+        
         self.shutdown_received = False
         self.shutdown_timeout = shutdown_timeout or 1
         
-    def task_loop(self):
+        if shm_threshold and shared_memory is None:
+            log.warning('shared memory is not available; passing arrays through pipes')
+            shm_threshold = None
+        self.shm_threshold = shm_threshold or None
+        
+        # The master's SharedMemoryTransport, and pipes on which the master releases the shared
+        # memory segments of each worker
+        self.shm_transport = None
+        self.release_pipes = None
+        
+    def task_loop(self, iworker=None):
         # Close standard input, so we don't get SIGINT from ^C
         try:
             sys.stdin.close()
@@ -60,45 +249,105 @@ class ProcessWorkManager(WorkManager):
         # (re)initialize random number generator in this process
         random.seed()
         
-        while not self.shutdown_received:
-            message, task_id, fn, args, kwargs = self.task_queue.get()[:5]
-            
-            if message == 'shutdown':
-                break
-            
-            try:
-                result = fn(*args, **kwargs)
-            except BaseException as e:
-                result_tuple = ('exception', task_id, (e, traceback.format_exc()))
-            else:
-                result_tuple = ('result', task_id, result)
-            self.result_queue.put(result_tuple)
+        if self.shm_threshold:
+            transport = SharedMemoryTransport(self.shm_threshold)
+            release_conn = self.release_pipes[iworker][0]
+        else:
+            transport = None
+        
+        try:
+            while not self.shutdown_received:
+                message, task_id, fn, args, kwargs = self.task_queue.get()[:5]
+                
+                if message == 'shutdown':
+                    break
+                
+                released = ()
+                try:
+                    if message == 'shm_task':
+                        released = [name for (name, _nbytes) in fn.segments]
+                        fn, args, kwargs = transport.loads(fn)
+                    result = fn(*args, **kwargs)
+                    if transport is not None:
+                        while release_conn.poll():
+                            transport.release(release_conn.recv())
+                        payload = transport.dumps(result, owner=iworker)
+                        if transport.worth_sending(payload):
+                            result_tuple = ('shm_result', task_id, payload, released)
+                        else:
+                            result_tuple = ('result', task_id, result, released)
+                    else:
+                        result_tuple = ('result', task_id, result, released)
+                except BaseException as e:
+                    result_tuple = ('exception', task_id, (e, traceback.format_exc()), released)
+                self.result_queue.put(result_tuple)
+        finally:
+            if transport is not None:
+                transport.close()
 
         log.debug('exiting task_loop')
         return
         
     def results_loop(self):
         while not self.shutdown_received:
-            message, task_id, payload = self.result_queue.get()[:3]
+            message, task_id, payload, released = self.result_queue.get()[:4]
             
             if message == 'shutdown':
                 break
-            elif message == 'exception':
+            
+            if released:
+                self.shm_transport.release(released)
+            
+            with self.dispatch_lock:
+                self.n_dispatched -= 1
+                refill = (self.n_dispatched <= self.n_workers)
+            if refill:
+                self._dispatch()
+                
+            if message == 'exception':
                 future = self.pending.pop(task_id)
                 future._set_exception(*payload)
             elif message == 'result':
                 future = self.pending.pop(task_id)
                 future._set_result(payload)
+            elif message == 'shm_result':
+                future = self.pending.pop(task_id)
+                try:
+                    result = self.shm_transport.loads(payload)
+                except Exception as e:
+                    future._set_exception(e, traceback.format_exc())
+                else:
+                    future._set_result(result)
+                finally:
+                    if payload.segments:
+                        self.release_pipes[payload.owner][1].send([name for (name, _nbytes) in payload.segments])
             else:
                 raise AssertionError('unknown message {!r}'.format((message, task_id, payload)))
 
         log.debug('exiting results_loop')
+        
+    def _dispatch(self):
+        '''Move tasks from the master to the task queue, while workers can take them.'''
+        with self.dispatch_lock:
+            while self.n_dispatched < self.dispatch_limit:
+                try:
+                    task = self.waiting_tasks.get()
+                except IndexError:
+                    break
+                self.task_queue.put(task)
+                self.n_dispatched += 1
 
-    def submit(self, fn, args=None, kwargs=None):
+    def submit(self, fn, args=None, kwargs=None, priority=0, cost_hint=None):
         ft = WMFuture()
         log.debug('dispatching {!r}'.format(fn))
+        task = ('task', ft.task_id, fn, args or (), kwargs or {})
+        if self.shm_transport is not None:
+            payload = self.shm_transport.dumps(task[2:])
+            if self.shm_transport.worth_sending(payload):
+                task = ('shm_task', ft.task_id, payload, None, None)
         self.pending[ft.task_id] = ft
-        self.task_queue.put(('task', ft.task_id, fn, args or (), kwargs or {}))        
+        self.waiting_tasks.put(task, priority, cost_hint)
+        self._dispatch()
         return ft
                 
     def startup(self):
@@ -106,7 +355,14 @@ class ProcessWorkManager(WorkManager):
         if not self.running:
             log.debug('starting up work manager {!r}'.format(self))
             self.running = True
-            self.workers = [multiprocessing.Process(target=self.task_loop, 
+            
+            if self.shm_threshold:
+                # Workers must share the master's resource tracker, which otherwise would remove
+                # segments that a worker has attached to when that worker exits
+                resource_tracker.ensure_running()
+                self.release_pipes = [multiprocessing.Pipe(duplex=False) for _i in range(self.n_workers)]
+            
+            self.workers = [multiprocessing.Process(target=self.task_loop, args=(i,),
                                                     name='worker-{:d}-{:x}'.format(i,id(self))) for i in range(self.n_workers)]
             
             pi_name = '{}_PROCESS_INDEX'.format(environment.WMEnvironment.env_prefix)
@@ -119,6 +375,10 @@ class ProcessWorkManager(WorkManager):
                 pass
                 
             self.pending = dict()
+            self.n_dispatched = 0
+            
+            if self.shm_threshold:
+                self.shm_transport = SharedMemoryTransport(self.shm_threshold)
     
             self.receive_thread = threading.Thread(target=self.results_loop, name='receiver')
             self.receive_thread.daemon = True
@@ -140,6 +400,7 @@ class ProcessWorkManager(WorkManager):
     def shutdown(self):
         if self.running:
             log.debug('shutting down {!r}'.format(self))
+            self.waiting_tasks.clear()
             self._empty_queues()
     
             # Send shutdown signal
@@ -163,7 +424,16 @@ class ProcessWorkManager(WorkManager):
             
             self._empty_queues()
             self.result_queue.put(result_shutdown_sentinel)
+            
+            if self.shm_transport is not None:
+                # The receiver may be reading from shared memory
+                self.receive_thread.join(self.shutdown_timeout)
+                self.shm_transport.close()
+                self.shm_transport = None
+                for pipe_ends in self.release_pipes:
+                    for conn in pipe_ends:
+                        conn.close()
+                self.release_pipes = None
             self.running = False
         
     
-    
\ No newline at end of file
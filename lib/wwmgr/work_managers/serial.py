@@ -32,7 +32,8 @@ class SerialWorkManager(WorkManager):
         super(SerialWorkManager,self).__init__()
         self.n_workers = 1
         
-    def submit(self, fn, args=None, kwargs=None):
+    def submit(self, fn, args=None, kwargs=None, priority=0, cost_hint=None):
+        # Tasks run as they are submitted, so there is nothing to order
         ft = WMFuture()
         try:
             result = fn(*(args if args is not None else ()), **(kwargs if kwargs is not None else {}))
@@ -17,8 +17,7 @@
 
 
 import sys, logging, threading, multiprocessing
-import queue
-from . import WorkManager, WMFuture
+from . import WorkManager, WMFuture, TaskQueue
 import work_managers
 
 log = logging.getLogger(__name__)
@@ -52,20 +51,25 @@ class ThreadsWorkManager(WorkManager):
         super(ThreadsWorkManager,self).__init__()
         self.n_workers = n_workers or multiprocessing.cpu_count()
         self.workers = []
-        self.task_queue = queue.Queue()
+        self.task_queue = TaskQueue()
+        
+        # Counts the tasks (and shutdown sentinels) on the task queue, on which idle workers wait
+        self.tasks_queued = threading.Semaphore(0)
         
     def runtask(self, task_queue):
         while True:
+            self.tasks_queued.acquire()
             task = task_queue.get()
             if task is ShutdownSentinel:
                 return
             else:
                 task.run()
 
-    def submit(self, fn, args=None, kwargs=None):
+    def submit(self, fn, args=None, kwargs=None, priority=0, cost_hint=None):
         ft = WMFuture()
         task = Task(fn, args if args is not None else (), kwargs if kwargs is not None else {}, ft)
-        self.task_queue.put(task)
+        self.task_queue.put(task, priority, cost_hint)
+        self.tasks_queued.release()
         return ft
                 
     def startup(self):
@@ -79,9 +83,10 @@ class ThreadsWorkManager(WorkManager):
         
     def shutdown(self):
         if self.running:
-            # Put one sentinel on the queue per worker, then wait for threads to terminate
+            # Put one sentinel on the queue per worker, after all tasks, then wait for threads to terminate
             for i in range(0, self.n_workers):
-                self.task_queue.put(ShutdownSentinel)
+                self.task_queue.put(ShutdownSentinel, order=(float('inf'), i))
+                self.tasks_queued.release()
             for thread in self.workers:
                 thread.join()
             self.running = False
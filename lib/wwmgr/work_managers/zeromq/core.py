@@ -4,6 +4,7 @@ Created on May 29, 2015
 @author: mzwier
 '''
 
+import pickle
 from pickle import UnpicklingError
 
 # Every ten seconds the master requests a status report from workers.
@@ -31,6 +32,36 @@ import numpy
 
 DEFAULT_LINGER = 1
 
+# Buffers (e.g. the data of numpy arrays) at least this large are sent as separate message frames,
+# rather than being copied into the pickled message
+OUT_OF_BAND_THRESHOLD = 65536
+
+def dump_frames(obj, threshold=OUT_OF_BAND_THRESHOLD):
+    '''Pickle ``obj`` into a list of message frames: the pickle itself, followed by the (uncopied)
+    contents of large buffers which support out-of-band pickling, such as those of contiguous numpy
+    arrays.'''
+    buffers = []
+    def buffer_callback(pickle_buffer):
+        # Returning a true value serializes the buffer in-band
+        raw = pickle_buffer.raw()
+        if raw.nbytes < threshold:
+            return True
+        buffers.append(raw)
+        return False
+    return [pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)] + buffers
+
+def load_frames(frames, writable=False):
+    '''Unpickle an object from the message frames created by ``dump_frames()`` (or a single frame
+    containing an ordinary pickle). Out-of-band buffers are used in place, without copying, so
+    arrays backed by them share memory with (and keep alive) their frames. Frame buffers are
+    read-only with some versions of pyzmq; if ``writable`` is true, such buffers are copied once
+    into writable memory, so that the arrays received are writable, as with ordinary pickling.'''
+    frames = [frame.buffer if isinstance(frame, zmq.Frame) else frame for frame in frames]
+    buffers = frames[1:]
+    if writable:
+        buffers = [bytearray(buffer) if memoryview(buffer).readonly else buffer for buffer in buffers]
+    return pickle.loads(frames[0], buffers=buffers)
+
 def randport(address='127.0.0.1'):
     '''Select a random unused TCP port number on the given address.''' 
     s = socket.socket()
@@ -72,6 +103,18 @@ class Message:
     TASK = 'task'
     RESULT = 'result'
     
+    # Batched operation: a TASK_REQUEST whose payload is a number of tasks is answered with
+    # TASKS (a list of tasks), and RESULTS carries a list of results along with the number of
+    # further tasks wanted, and is answered with TASKS or ACK
+    TASKS = 'tasks'
+    RESULTS = 'results'
+    
+    # Work stealing: STEAL announces that the worker whose ID is in the payload should return
+    # (up to) the given number of the tasks it holds but has not started, which it does with
+    # TASKS_RETURNED carrying their IDs, answered with ACK
+    STEAL = 'steal'
+    TASKS_RETURNED = 'tasks_returned'
+    
     idempotent_announcement_messages = {SHUTDOWN, TASKS_AVAILABLE, MASTER_BEACON}
 
     
@@ -87,6 +130,9 @@ class Message:
             self.src_id     = src_id
             self.message = message
             self.payload = payload
+            
+        # Set by the sender
+        self.protocol_version = None
         
     def __repr__(self):
         return ('<{!s} master_id={master_id!s} src_id={src_id!s} message={message!r} payload={payload!r}>'
@@ -115,6 +161,9 @@ class Task:
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        
+        # Place in order of dispatch on the master (see work_managers.TaskQueue)
+        self.order = None
                 
     def __repr__(self):
         try:
@@ -246,12 +295,12 @@ class ZMQCore:
     # The set of messages and replies in use.
     # Cannot be updated without changing existing communications logic. (Changes break
     # the ZMQ WM library.)
-    PROTOCOL_MINOR = 0  
+    PROTOCOL_MINOR = 1
     
     # Minor updates and additions to the protocol.
     # Changes do not break the ZMQ WM library, but only add new
     # functionality/code paths without changing existing code paths.    
-    PROTOCOL_UPDATE = 0 
+    PROTOCOL_UPDATE = 0
     
     PROTOCOL_VERSION = (PROTOCOL_MAJOR, PROTOCOL_MINOR, PROTOCOL_UPDATE)
     
@@ -265,6 +314,11 @@ class ZMQCore:
     default_timeout_factor = 5.0
     default_startup_timeout = 120.0
     default_shutdown_timeout = 5.0
+    default_prefetch = 1
+    
+    # Whether large arrays received out-of-band in read-only frames must be copied so that
+    # they are writable. Components which only read or forward messages never copy them.
+    writable_arrays = False
         
     
     
@@ -389,6 +443,12 @@ class ZMQCore:
             raise TypeError('message is not an instance of core.Message')
         if message.src_id is None:
             raise ZMQWMEnvironmentError('message src_id is not set')
+        # Peers must agree on the protocol major and minor versions; messages from peers predating
+        # the version check carry no version at all
+        protocol_version = getattr(message, 'protocol_version', None)
+        if protocol_version is None or tuple(protocol_version[:2]) != self.PROTOCOL_VERSION[:2]:
+            raise ZMQWMEnvironmentError('incoming message uses incompatible protocol version (this={!r}, incoming={!r})'
+                                        .format(self.PROTOCOL_VERSION, protocol_version))
         if self.master_id is not None and message.master_id is not None and message.master_id != self.master_id:
             raise ZMQWMEnvironmentError('incoming message associated with another master (this={!s}, incoming={!s}'.format(self.master_id, message.master_id))
                 
@@ -419,18 +479,19 @@ class ZMQCore:
         ``flags`` includes ``zmq.NOBLOCK``.'''
         
         if timeout is None or flags & zmq.NOBLOCK:
-            message = socket.recv_pyobj(flags)
+            frames = socket.recv_multipart(flags, copy=False)
         else:        
             poller = zmq.Poller()
             poller.register(socket, zmq.POLLIN)
             try:
                 poll_results = dict(poller.poll(timeout=timeout))
                 if socket in poll_results:
-                    message = socket.recv_pyobj(flags)
+                    frames = socket.recv_multipart(flags, copy=False)
                 else:
                     raise ZMQWMTimeout('recv timed out')
             finally:
                 poller.unregister(socket)
+        message = load_frames(frames, writable=self.writable_arrays)
         
         if self._super_debug:
             self.log.debug('received {!r}'.format(message))
@@ -466,10 +527,12 @@ class ZMQCore:
         if message.master_id is None:
             message.master_id = self.master_id
         message.src_id=self.node_id
+        message.protocol_version = self.PROTOCOL_VERSION
         
         if self._super_debug:
             self.log.debug('sending {!r}'.format(message))
-        socket.send_pyobj(message,flags)
+        # Large array data is sent without copying it into the pickle
+        socket.send_multipart(dump_frames(message), flags, copy=False)
                     
     def send_reply(self, socket, original_message, reply=Message.ACK, payload=None,flags=0):
         '''Send a reply to ``original_message`` on ``socket``. The reply message
@@ -12,16 +12,16 @@ from .core import randport
 from .worker import ZMQWorker
 from .node import ZMQNode
 import work_managers
-from work_managers import WorkManager, WMFuture
+from work_managers import WorkManager, WMFuture, TaskQueue
 import multiprocessing
 
 from .core import PassiveMultiTimer
 
 import zmq
 
-from collections import deque
+from concurrent.futures import CancelledError
 
-import socket, re, json
+import socket, re, json, math
 
 class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
     
@@ -92,6 +92,11 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         wm_group.add_argument(wmenv.arg_flag('zmq_shutdown_timeout'), metavar='SHUTDOWN_TIMEOUT', 
                               type=float,
                               help='Amount of time (in seconds) to wait for workers to shut down.')
+        wm_group.add_argument(wmenv.arg_flag('zmq_prefetch'), metavar='N_TASKS', type=int,
+                              help='Each worker holds up to N_TASKS tasks at once, requesting tasks and '
+                                  +'returning results in batches. Values greater than one (the default) '
+                                  +'reduce communication overhead for many small tasks, at some cost in '
+                                  +'load balance for long tasks.')
     
     @classmethod
     def from_environ(cls, wmenv=None):
@@ -126,6 +131,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         worker_heartbeat = wmenv.get_val('zmq_worker_heartbeat', cls.default_worker_heartbeat, float)
         timeout_factor = wmenv.get_val('zmq_timeout_factor', cls.default_timeout_factor, float)
         startup_timeout = wmenv.get_val('zmq_startup_timeout', cls.default_startup_timeout, float)
+        prefetch = wmenv.get_val('zmq_prefetch', cls.default_prefetch, int)
         
         
         if mode == 'master':
@@ -177,6 +183,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             worker.worker_beacon_period = worker_heartbeat
             worker.timeout_factor = timeout_factor
             worker.startup_timeout = startup_timeout
+            worker.prefetch = prefetch
         
         # We always write host info (since we are always either master or node)
         # we choose not to in the special case that read_host_info is '' but not None
@@ -187,6 +194,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
 
         log.debug('prepared {!r} with:'.format(instance))
         log.debug('n_workers = {}'.format(n_workers))
+        log.debug('prefetch = {}'.format(prefetch))
         for attr in ('master_beacon_period', 'worker_beacon_period', 'startup_timeout', 'timeout_factor',
                      'downstream_rr_endpoint', 'downstream_ann_endpoint'):
             log.debug('{} = {!r}'.format(attr, getattr(instance, attr)))
@@ -237,11 +245,17 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         self.futures = dict()
         
         # Tasks pending distribution
-        self.outgoing_tasks = deque()
+        self.outgoing_tasks = TaskQueue()
         
-        # Tasks being processed by workers (indexed by worker_id)
+        # Tasks being processed by workers (indexed by worker_id, then by task_id)
         self.assigned_tasks = dict()
         
+        # Workers asked to return tasks they have not started, which have not yet replied, and
+        # workers which have returned tasks, which are given no more until they have completed
+        # those they kept (so that they do not simply take back those they returned)
+        self.steals_requested = set()
+        self.stolen_from = set()
+        
         # Identity information and last contact from workers
         self.worker_information = dict() # indexed by worker_id
         self.worker_timeouts = PassiveMultiTimer() # indexed by worker_id
@@ -258,14 +272,15 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
     def n_workers(self):
         return len(self.worker_information)
                 
-    def submit(self, fn, args=None, kwargs=None):
+    def submit(self, fn, args=None, kwargs=None, priority=0, cost_hint=None):
         if self.futures is None:
             # We are shutting down
             raise ZMQWMEnvironmentError('work manager is shutting down')
         future = WMFuture()
         task = Task(fn, args or (), kwargs or {}, task_id = future.task_id)
+        task.order = self.outgoing_tasks.next_order(priority, cost_hint)
         self.futures[task.task_id] = future
-        self.outgoing_tasks.append(task)
+        self.outgoing_tasks.put(task, order=task.order)
         # Wake up the communications loop (if necessary) to announce new tasks
         self.send_inproc_message(Message.TASKS_AVAILABLE)
         return future
@@ -275,16 +290,31 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             # We are shutting down
             raise ZMQWMEnvironmentError('work manager is shutting down')
         futures = []        
-        for (fn,args,kwargs) in tasks:
+        for (fn,args,kwargs,*priority) in tasks:
             future = WMFuture()
             task = Task(fn, args, kwargs, task_id = future.task_id)
+            task.order = self.outgoing_tasks.next_order(*priority)
             self.futures[task.task_id] = future
-            self.outgoing_tasks.append(task)
+            self.outgoing_tasks.put(task, order=task.order)
             futures.append(future)
         # Wake up the communications loop (if necessary) to announce new tasks            
         self.send_inproc_message(Message.TASKS_AVAILABLE)
         return futures
 
+    def cancel(self, future):
+        # Only tasks not yet handed to a worker can be withdrawn
+        for task in list(self.outgoing_tasks):
+            if task.task_id == future.task_id:
+                try:
+                    self.outgoing_tasks.remove(task)
+                except ValueError:
+                    # Handed to a worker in the meantime
+                    return False
+                self.futures.pop(task.task_id, None)
+                future._set_exception(CancelledError('task {!s} cancelled'.format(task.task_id)))
+                return True
+        return False
+
     def send_message(self, socket, message, payload=None, flags=0):
         message = Message(message, payload)
         message.master_id = self.node_id
@@ -295,29 +325,111 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         with self.message_validation(msg):
             assert msg.message == Message.RESULT
             assert isinstance(msg.payload, Result)
-            assert msg.payload.task_id in self.futures
-            assert self.assigned_tasks[msg.src_id].task_id == msg.payload.task_id
-                        
-        result = msg.payload
+            
+        self.complete_task(msg.src_id, msg.payload)
+        
+    def handle_results(self, socket, msg):
+        with self.message_validation(msg):
+            assert msg.message == Message.RESULTS
+            results, n_wanted = msg.payload
+            assert all(isinstance(result, Result) for result in results)
+            
+        for result in results:
+            self.complete_task(msg.src_id, result)
         
+        # Hand out further tasks in the reply, saving the worker a separate request
+        tasks = self.assign_tasks(msg.src_id, n_wanted)
+        if tasks:
+            self.send_message(socket, Message.TASKS, tasks)
+        else:
+            self.send_ack(socket, msg)
+            
+    def complete_task(self, worker_id, result):
+        with self.message_validation(result):
+            assert result.task_id in self.futures
+            assert result.task_id in self.assigned_tasks.get(worker_id, ())
+            
         future = self.futures.pop(result.task_id)
-        del self.assigned_tasks[msg.src_id]
+        worker_tasks = self.assigned_tasks[worker_id]
+        del worker_tasks[result.task_id]
+        if not worker_tasks:
+            del self.assigned_tasks[worker_id]
         if result.exception is not None:
             future._set_exception(result.exception, result.traceback)
         else:
             future._set_result(result.result)
             
+    def assign_tasks(self, worker_id, n_wanted):
+        '''Remove up to ``n_wanted`` tasks from the queue of outgoing tasks and record them as
+        assigned to worker ``worker_id``. No worker is given more than its share of the tasks
+        available, so that workers (and nodes) asking first do not starve the others.'''
+        if not n_wanted or not self.outgoing_tasks:
+            return []
+        if worker_id in self.stolen_from:
+            if worker_id in self.assigned_tasks:
+                return []
+            self.stolen_from.discard(worker_id)
+        fair_share = math.ceil(len(self.outgoing_tasks) / max(1, self.n_workers))
+        n_tasks = max(1, min(n_wanted, fair_share))
+        
+        tasks = []
+        for _i in range(n_tasks):
+            try:
+                tasks.append(self.outgoing_tasks.get())
+            except IndexError:
+                # Cancelled in the meantime
+                break
+        worker_tasks = self.assigned_tasks.setdefault(worker_id, dict())
+        for task in tasks:
+            worker_tasks[task.task_id] = task
+        return tasks
+            
     def handle_task_request(self, socket, msg):
-        if not self.outgoing_tasks:
+        # A request without a payload is for a single task
+        tasks = self.assign_tasks(msg.src_id, msg.payload or 1)
+        if not tasks:
             # No tasks available
             self.send_nak(socket,msg)
+        elif msg.payload is None:
+            self.send_message(socket, Message.TASK, tasks[0])
         else:
-            task = self.outgoing_tasks.popleft()
-            
-            worker_id = msg.src_id
-            self.assigned_tasks[worker_id] = task
+            self.send_message(socket, Message.TASKS, tasks)
             
-            self.send_message(socket, Message.TASK, task)
+    def steal_tasks(self, ann_socket):
+        '''If workers are idle while no tasks are queued, ask the worker holding the most tasks to
+        return half of them, for idle workers to take, unless that worker holds only the task it is
+        running or has yet to answer an earlier request.'''
+        if self.outgoing_tasks or not self.assigned_tasks:
+            return
+        n_idle = sum(1 for worker_id in self.worker_information if worker_id not in self.assigned_tasks)
+        if n_idle <= len(self.steals_requested):
+            return
+        held = [(len(worker_tasks), worker_id) for (worker_id, worker_tasks) in self.assigned_tasks.items()
+                if worker_id not in self.steals_requested]
+        if not held:
+            return
+        (n_held, worker_id) = max(held, key=lambda item: item[0])
+        if n_held < 2:
+            return
+        self.log.debug('asking worker {!s} to return {:d} tasks'.format(worker_id, n_held//2))
+        self.steals_requested.add(worker_id)
+        self.send_message(ann_socket, Message.STEAL, (worker_id, n_held//2))
+        
+    def handle_tasks_returned(self, socket, msg):
+        '''Queue again, in their original places, the tasks returned by a worker.'''
+        self.send_ack(socket, msg)
+        with self.message_validation(msg):
+            assert msg.message == Message.TASKS_RETURNED
+            assert all(task_id in self.assigned_tasks.get(msg.src_id, ()) for task_id in msg.payload)
+        
+        self.steals_requested.discard(msg.src_id)
+        self.stolen_from.add(msg.src_id)
+        worker_tasks = self.assigned_tasks.get(msg.src_id, {})
+        for task_id in msg.payload:
+            task = worker_tasks.pop(task_id)
+            self.outgoing_tasks.put(task, order=task.order)
+        if not worker_tasks:
+            self.assigned_tasks.pop(msg.src_id, None)
             
     def update_worker_information(self, msg):
         if msg.message == Message.IDENTIFY:
@@ -346,15 +458,13 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             self.remove_worker(expired_worker_id)            
                                         
     def remove_worker(self, worker_id):
-        try:
-            expired_task = self.assigned_tasks.pop(worker_id)
-        except KeyError:
-            pass
-        else:
+        for expired_task in self.assigned_tasks.pop(worker_id, {}).values():
             self.log.error('aborting task {!r} running on expired worker {!s}'
                            .format(expired_task, worker_id))
             future = self.futures.pop(expired_task.task_id)
             future._set_exception(ZMQWorkerMissing('worker running this task disappeared'))
+        self.steals_requested.discard(worker_id)
+        self.stolen_from.discard(worker_id)
         del self.worker_information[worker_id]
         
     def shutdown_clear_tasks(self):
@@ -429,9 +539,17 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
                         self.handle_task_request(rr_socket, msg)
                     elif msg.message == Message.RESULT:
                         self.handle_result(rr_socket, msg)
+                    elif msg.message == Message.RESULTS:
+                        self.handle_results(rr_socket, msg)
+                    elif msg.message == Message.TASKS_RETURNED:
+                        self.handle_tasks_returned(rr_socket, msg)
+                        if self.outgoing_tasks:
+                            self.send_message(ann_socket, Message.TASKS_AVAILABLE)
                     else:
                         self.send_ack(rr_socket, msg)
                         
+                    self.steal_tasks(ann_socket)
+                        
                     if self.worker_information:
                         peer_found = True
                 
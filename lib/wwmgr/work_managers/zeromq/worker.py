@@ -12,6 +12,7 @@ log = logging.getLogger(__name__)
 
 from .core import ZMQCore, Message, ZMQWMTimeout, PassiveMultiTimer, Task, Result, TIMEOUT_MASTER_BEACON
 import threading, multiprocessing, os, signal
+from collections import OrderedDict, deque
 from contextlib import contextmanager
 
 
@@ -37,8 +38,17 @@ class ZMQWorker(ZMQCore):
         self.master_id = None
         self.identified = False
         
-        # The task currently being processed
-        self.pending_task = None
+        # Tasks received and not yet completed, indexed by task_id
+        self.pending_tasks = OrderedDict()
+        
+        # Tasks received but not yet handed to the executor, which is given one at a time (so that
+        # none waits there behind a long task); these may be returned to the master for idle
+        # workers to take
+        self.queued_tasks = deque()
+        
+        # Number of tasks to hold at once; if greater than one, tasks are requested and results
+        # returned in batches
+        self.prefetch = self.default_prefetch
         
         # Executor process
         
@@ -61,23 +71,59 @@ class ZMQWorker(ZMQCore):
         self.recv_ack(rr_socket,timeout=self.master_beacon_period*self.timeout_factor*1000)
         self.identified = True
         
+    @property
+    def n_wanted(self):
+        '''The number of tasks this worker can accept.'''
+        return max(0, self.prefetch - len(self.pending_tasks))
+        
     def request_task(self, rr_socket, task_socket):
         if self.master_id is None: return
-        elif self.pending_task is not None: return
+        elif not self.n_wanted: return
         elif self.timers.expired(TIMEOUT_MASTER_BEACON): return
         else:
-            self.send_message(rr_socket, Message.TASK_REQUEST)
+            # Request one task at a time unless prefetching
+            self.send_message(rr_socket, Message.TASK_REQUEST, self.n_wanted if self.prefetch > 1 else None)
             reply = self.recv_message(rr_socket,timeout=self.master_beacon_period*self.timeout_factor*1000)
             self.update_master_info(reply)
             if reply.message == Message.NAK:
                 # No task available
                 return 
             else:
-                with self.message_validation(reply):
-                    assert isinstance(reply.payload, Task)
-                    task = reply.payload
-                self.pending_task = task
-                self.send_message(task_socket, Message.TASK, task)                       
+                self.dispatch_tasks(reply, task_socket)
+                
+    def dispatch_tasks(self, reply, task_socket):
+        '''Pass the task(s) in the master's reply ``reply`` to the executor.'''
+        with self.message_validation(reply):
+            assert reply.message in (Message.TASK, Message.TASKS)
+            tasks = [reply.payload] if reply.message == Message.TASK else reply.payload
+            assert all(isinstance(task, Task) for task in tasks)
+        for task in tasks:
+            self.pending_tasks[task.task_id] = task
+            self.queued_tasks.append(task)
+        self.feed_executor(task_socket)
+        
+    def feed_executor(self, task_socket):
+        '''Hand the next queued task to the executor, if it has none.'''
+        if self.queued_tasks and len(self.pending_tasks) == len(self.queued_tasks):
+            self.send_message(task_socket, Message.TASK, self.queued_tasks.popleft())
+            
+    def return_tasks(self, rr_socket, msg):
+        '''Return to the master tasks not yet started, if asked to in the STEAL announcement ``msg``.'''
+        with self.message_validation(msg):
+            assert msg.message == Message.STEAL
+            worker_id, n_requested = msg.payload
+        if worker_id != self.node_id or self.timers.expired(TIMEOUT_MASTER_BEACON):
+            return
+        
+        # Keep the tasks which would run first
+        returned = []
+        while self.queued_tasks and len(returned) < n_requested:
+            task = self.queued_tasks.pop()
+            del self.pending_tasks[task.task_id]
+            returned.append(task.task_id)
+        self.send_message(rr_socket, Message.TASKS_RETURNED, returned)
+        reply = self.recv_ack(rr_socket, timeout=self.master_beacon_period*self.timeout_factor*1000)
+        self.update_master_info(reply)
             
     def handle_reconfigure_timeout(self, msg, timers):
         with self.message_validation(msg):
@@ -86,18 +132,34 @@ class ZMQWorker(ZMQCore):
         timers.change_duration(timer, new_period)
         timers.reset(timer)
         
-    def handle_result(self, result_socket, rr_socket):
-        msg = self.recv_message(result_socket)
-        with self.message_validation(msg):
-            assert msg.message == Message.RESULT
-            assert isinstance(msg.payload, Result)
-            assert msg.payload.task_id == self.pending_task.task_id
+    def handle_result(self, result_socket, rr_socket, task_socket):
+        # Return all results the executor has ready at once
+        msgs = self.recv_all(result_socket)
+        for msg in msgs:
+            with self.message_validation(msg):
+                assert msg.message == Message.RESULT
+                assert isinstance(msg.payload, Result)
+                assert msg.payload.task_id in self.pending_tasks
+            del self.pending_tasks[msg.payload.task_id]
+        self.feed_executor(task_socket)
         
-        msg.src_id = self.node_id
-        self.pending_task = None
-        self.send_message(rr_socket, msg)
-        reply = self.recv_ack(rr_socket, timeout=self.master_beacon_period*self.timeout_factor*1000)
-        self.update_master_info(reply)
+        if self.prefetch == 1 and len(msgs) == 1:
+            msg = msgs[0]
+            msg.src_id = self.node_id
+            self.send_message(rr_socket, msg)
+            reply = self.recv_ack(rr_socket, timeout=self.master_beacon_period*self.timeout_factor*1000)
+            self.update_master_info(reply)
+        elif msgs:
+            # Ask for more tasks in the same round trip, unless the master may be gone
+            n_wanted = self.n_wanted if not self.timers.expired(TIMEOUT_MASTER_BEACON) else 0
+            self.send_message(rr_socket, Message.RESULTS, ([msg.payload for msg in msgs], n_wanted))
+            reply = self.recv_message(rr_socket, timeout=self.master_beacon_period*self.timeout_factor*1000)
+            self.update_master_info(reply)
+            if reply.message == Message.TASKS:
+                self.dispatch_tasks(reply, task_socket)
+            else:
+                with self.message_validation(reply):
+                    assert reply.message == Message.ACK
             
     def comm_loop(self):
         '''Master communication loop for the worker process.'''
@@ -178,9 +240,10 @@ class ZMQWorker(ZMQCore):
                 # Handle results, so that we clear ourselves of completed tasks
                 # before asking for more
                 if result_socket in poll_results:
-                    self.handle_result(result_socket, rr_socket)
-                    # immediately request another task if available
-                    if not timers.expired(TIMEOUT_MASTER_BEACON):
+                    self.handle_result(result_socket, rr_socket, task_socket)
+                    # immediately request another task if available (when prefetching, this
+                    # was done along with returning results)
+                    if self.prefetch == 1 and not timers.expired(TIMEOUT_MASTER_BEACON):
                         self.request_task(rr_socket, task_socket)
                 
                 # Handle any remaining messages
@@ -192,6 +255,9 @@ class ZMQWorker(ZMQCore):
                             self.handle_reconfigure_timeout(msg, timers)
                     elif tag == Message.TASKS_AVAILABLE:
                         self.request_task(rr_socket,task_socket)      
+                    elif tag == Message.STEAL:
+                        for msg in msgs:
+                            self.return_tasks(rr_socket, msg)
                         
                 del announcements, messages_by_tag
             
@@ -271,6 +337,9 @@ class ZMQExecutor(ZMQCore):
     This is isolated in a separate process and controlled via ZMQ from 
     the ZMQWorker.'''
     
+    # Task functions may modify their arguments (e.g. segment progress coordinates) in place
+    writable_arrays = True
+    
     def __init__(self, task_endpoint, result_endpoint):
         super(ZMQExecutor,self).__init__()
         
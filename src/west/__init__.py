@@ -2,11 +2,11 @@ import logging
 logging.getLogger('')
 log = logging.getLogger('west')
 
-from .segment import Segment
+from .segment import Segment, SegmentArrays
 from .systems import WESTSystem
 from .states import BasisState, TargetState
 
-from . import segment, propagators, data_manager, sim_manager, we_driver, states, systems
+from . import segment, propagators, data_manager, sim_manager, we_driver, states, systems, restart_store
 import work_managers
 
 from westpa import rc
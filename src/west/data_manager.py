@@ -35,12 +35,26 @@ The data is laid out in HDF5 as follows:
             - wtg_parents -- data used to reconstruct the split/merge history of trajectories
             - recycling -- flux and event count for recycled particles, on a per-target-state basis
             - aux_data/ -- auxiliary datasets (data stored on the 'data' field of Segment objects)
+            - timing -- wallclock time spent in each phase of the iteration, in plugin callbacks,
+                        and in data manager operations (optional)
+            - events -- number of times each notable event (such as the resubmission of a
+                        straggling block of segments) occurred in the iteration, if any did
 
 The file root object has an integer attribute 'west_file_format_version' which can be used to
 determine how to access data even as the file format (i.e. organization of data within HDF5 file)
 evolves. 
 
+Packed files (created with the ``packed_storage`` option) instead append the seg_index, pcoord
+(and pcoord_ends) and wtgraph tables of every iteration to extendable datasets in a top-level group:
+    - /packed/ -- per-iteration tables of all iterations
+        - iter_index -- the first row and number of rows of each iteration in the tables below
+        - seg_index, pcoord, pcoord_ends, wtgraph -- as for unpacked iteration groups
+Iteration groups (holding auxiliary data, recycling and timing information, and so on) are still
+created, and get_iter_group() presents the packed tables of an iteration as if stored in its group.
+
 Version history:
+    Version 8
+        - Packed storage of per-iteration tables (only used when requested)
     Version 7
         - Removed bin_assignments, bin_populations, and bin_rates from iteration group.
         - Added new_segments subgroup to iteration group
@@ -52,6 +66,9 @@ Version history:
 """        
 import sys, time
 import posixpath
+import functools
+import collections
+import itertools
 from operator import attrgetter
 
 import pickle as pickle
@@ -59,19 +76,51 @@ import numpy
 import h5py
 from westpa import h5io
 from h5py import h5s
-import threading
+import threading, queue
 import os
 
 import logging
 log = logging.getLogger(__name__)
 
 import westpa
-from west.segment import Segment
+from west.segment import Segment, SegmentArrays
 from west.states import BasisState, TargetState, InitialState
 from west.we_driver import NewWeightEntry
 
 file_format_version = 7
+packed_file_format_version = 8
         
+def timed_method(method):
+    '''Decorator accumulating the wallclock time spent in a data manager method, for
+    later retrieval with ``WESTDataManager.pop_call_times()``.'''
+    
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        t0 = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._record_call_time(method.__name__, time.time()-t0)
+    return wrapper
+
+def writer_method(method):
+    '''Decorator making a data manager method execute on the background writer thread (if one is
+    running), in order with queued writes, so that the writer is the only thread using the HDF5 file.
+    Threads holding the data manager lock (which must not wait for the writer) and the writer itself
+    execute the method directly.'''
+    
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        writer = self._writer
+        if writer is None or self.lock.held():
+            return method(self, *args, **kwargs)
+        elif writer.on_thread():
+            with self.lock:
+                return method(self, *args, **kwargs)
+        else:
+            return writer.call(wrapper, self, *args, **kwargs)
+    return wrapper
+
 class flushing_lock:
     def __init__(self, lock, fileobj):
         self.lock = lock
@@ -99,6 +148,116 @@ class expiring_flushing_lock:
         self.lock.release()
         
 
+class write_barrier_lock:
+    '''A reentrant lock which, when first acquired by any thread other than the data manager's 
+    background writer, waits for all queued writes to complete. Code holding the lock may therefore
+    use the HDF5 file directly, and sees (and modifies) it as if queued writes had been made 
+    synchronously. While holding the lock, a thread must not wait for the background writer; 
+    data manager operations performed under the lock are carried out directly instead.'''
+    def __init__(self, data_manager):
+        self.data_manager = data_manager
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        
+    def held(self):
+        '''Whether the calling thread holds the lock.'''
+        return getattr(self._local, 'depth', 0) > 0
+        
+    def acquire(self, blocking=True, timeout=-1):
+        depth = getattr(self._local, 'depth', 0)
+        if not depth:
+            self.data_manager.sync_writes()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._local.depth = depth + 1
+        return acquired
+    
+    def release(self):
+        self._local.depth -= 1
+        self._lock.release()
+        
+    def __enter__(self):
+        return self.acquire()
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        
+class BackgroundWriter:
+    '''A background thread which applies (data manager) operations in the order in which
+    they are submitted. If ``maxsize`` is nonzero, submission blocks while that many operations 
+    are outstanding. Once a submitted operation fails, all later operations are discarded, so that 
+    the file is left as it was after the last successful operation.'''
+    
+    def __init__(self, name='westpa-writer', maxsize=0):
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._writer_loop, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def _writer_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                fn, args, kwargs, reply = item
+                if reply is None:
+                    if self.error is None:
+                        fn(*args, **kwargs)
+                else:
+                    done, outcome = reply
+                    try:
+                        if self.error is not None:
+                            raise self.error
+                        outcome[0] = fn(*args, **kwargs)
+                    except Exception as e:
+                        outcome[1] = e
+                    finally:
+                        done.set()
+            except Exception as e:
+                log.exception('background write failed')
+                self.error = e
+            finally:
+                self.queue.task_done()
+                
+    def on_thread(self):
+        '''Whether the calling thread is the writer thread.'''
+        return threading.current_thread() is self.thread
+    
+    def check(self):
+        '''Raise the exception (if any) encountered by a previously-submitted operation.'''
+        if self.error is not None:
+            raise self.error
+    
+    def submit(self, fn, *args, **kwargs):
+        '''Queue ``fn(*args, **kwargs)`` for execution on the writer thread.'''
+        self.check()
+        self.queue.put((fn, args, kwargs, None))
+        
+    def call(self, fn, *args, **kwargs):
+        '''Execute ``fn(*args, **kwargs)`` on the writer thread, after all previously-submitted
+        operations, and return its result (or raise its exception). Failure of the call does not
+        cause later operations to be discarded.'''
+        self.check()
+        done = threading.Event()
+        outcome = [None, None] # result, exception
+        self.queue.put((fn, args, kwargs, (done, outcome)))
+        done.wait()
+        if outcome[1] is not None:
+            raise outcome[1]
+        return outcome[0]
+    
+    def barrier(self):
+        '''Wait until all previously-submitted operations have completed.'''
+        self.queue.join()
+        self.check()
+        
+    def shutdown(self):
+        '''Complete any outstanding operations and stop the writer thread.'''
+        self.queue.put(None)
+        self.thread.join()
+
 # Data types for use in the HDF5 file
 seg_id_dtype = numpy.int64  # Up to 9 quintillion segments per iteration; signed so that initial states can be stored negative
 n_iter_dtype = numpy.uint32 # Up to 4 billion iterations
@@ -185,6 +344,18 @@ nw_index_dtype = numpy.dtype([('source_type', nw_source_dtype),
                               ('target_state_id', seg_id_dtype),
                               ('initial_state_id', seg_id_dtype)])
 
+# Per-iteration timing information
+timing_dtype = numpy.dtype([('name', vstr_dtype),          # Phase, callback, or operation timed
+                            ('walltime', utime_dtype),      # Total wallclock time spent
+                            ('count', numpy.uint32)])       # Number of times timed
+
+# Per-iteration event counts
+event_dtype = numpy.dtype([('name', vstr_dtype),           # Event
+                           ('count', numpy.uint32)])        # Number of times the event occurred
+
+# Storage layouts for progress coordinate data (see the pcoord entry of the datasets option)
+pcoord_layouts = ('contiguous', 'segments', 'points', 'final-point-hot')
+
 # Storage of bin identities
 binning_index_dtype = numpy.dtype([('hash', binhash_dtype),
                                    ('pickle_len', numpy.uint32)])
@@ -197,6 +368,7 @@ class WESTDataManager:
     default_we_h5filename      = 'west.h5'
     default_we_h5file_driver   = None
     default_flush_period = 60
+    default_write_queue_size = 64
     
     # Compress any auxiliary dataset whose total size (across all segments) is more than 1MB
     default_aux_compression_threshold = 1048576
@@ -207,17 +379,28 @@ class WESTDataManager:
     # Number of rows to retrieve during a table scan
     table_scan_chunksize = 1024
     
+    # Chunk sizes (in rows) of the packed segment index and weight transfer graph
+    packed_index_chunksize = 1024
+    packed_wtgraph_chunksize = 16384
+    
+    # Number of unpickled bin mappers to keep in memory
+    bin_mapper_cache_size = 32
+    
     def flushing_lock(self):
         return flushing_lock(self.lock, self.we_h5file)
     
     def expiring_flushing_lock(self):
+        if self.write_behind:
+            # Flushed at iteration boundaries instead (see iteration_boundary())
+            return self.lock
         next_flush = self.last_flush + self.flush_period
         return expiring_flushing_lock(self.lock, self.flush_backing, next_flush)
         
     def process_config(self):
         config = self.rc.config
         
-        for (entry, type_) in [('iter_prec', int)]:
+        for (entry, type_) in [('iter_prec', int), ('write_behind', bool), ('write_queue_size', int),
+                               ('packed_storage', bool)]:
             config.require_type_if_present(['west', 'data', entry], type_)
             
         self.we_h5filename = config.get_path(['west', 'data', 'west_data_file'], default=self.default_we_h5filename)
@@ -228,6 +411,9 @@ class WESTDataManager:
         self.aux_compression_threshold = config.get(['west','data','aux_compression_threshold'],
                                                     self.default_aux_compression_threshold)
         self.flush_period = config.get(['west','data','flush_period'], self.default_flush_period)
+        self.write_behind = config.get(['west','data','write_behind'], False)
+        self.write_queue_size = config.get(['west','data','write_queue_size'], self.default_write_queue_size)
+        self.packed_storage = config.get(['west','data','packed_storage'], False)
         
         # Process dataset options
         dsopts_list = config.get(['west','data','datasets']) or []
@@ -241,6 +427,9 @@ class WESTDataManager:
         if 'pcoord' in self.dataset_options:
             if self.dataset_options['pcoord']['h5path'] != 'pcoord':
                 raise ValueError('cannot override pcoord storage location')
+            layout = self.dataset_options['pcoord'].get('layout')
+            if layout is not None and layout not in pcoord_layouts:
+                raise ValueError('invalid pcoord layout {!r}; choose one of {}'.format(layout, ', '.join(pcoord_layouts)))
     
     def __init__(self, rc=None):
         
@@ -255,10 +444,36 @@ class WESTDataManager:
         
         self.we_h5file = None
         
-        self.lock = threading.RLock()
+        # Incremented whenever a new set of target states or basis states is stored
+        self.states_generation = 0
+        
+        self.lock = write_barrier_lock(self)
         self.flush_period = None
+        
+        # Write-behind mode: writes submitted with submit_write() are made by a background thread
+        self.write_behind = False
+        self.write_queue_size = self.default_write_queue_size
+        self._writer = None
+        
+        # Whether per-iteration tables are appended to the datasets of /packed; for existing files,
+        # this is determined by the file. The index of packed iterations (a list of records) and
+        # the packed datasets are kept open.
+        self.packed_storage = False
+        self._packed_index = []
+        self._packed_datasets = {}
+        
+        # Accumulated time spent in (some) methods, as name -> [walltime, count]
+        self._call_times = {}
+        self._call_times_lock = threading.Lock()
         self.last_flush = 0
         
+        # Row in /bin_topologies for each stored bin mapper hash, and recently-used unpickled mappers
+        self._bin_mapper_rows = None
+        self._bin_mapper_cache = collections.OrderedDict()
+        
+        # Auxiliary datasets most recently written, as name -> (n_iter, dataset, dsopts, dataspace)
+        self._aux_datasets = {}
+        
         self._system = None
                  
         self.dataset_options = {}
@@ -284,6 +499,7 @@ class WESTDataManager:
         else:
             return 'iter_{:0{prec}d}'.format(int(n_iter), prec=self.iter_prec)
 
+    @writer_method
     def require_iter_group(self, n_iter):
         '''Get the group associated with n_iter, creating it if necessary.'''
         with self.lock:
@@ -291,23 +507,40 @@ class WESTDataManager:
             iter_group.attrs['n_iter'] = n_iter
         return iter_group
             
+    @writer_method
     def del_iter_group(self, n_iter):
         with self.lock:
+            self._aux_datasets.clear()
+            if self.packed_storage and h5io.find_packed_entry(self._packed_index, n_iter) is not None:
+                if n_iter != self._packed_index[-1]['n_iter']:
+                    raise ValueError('only the last stored iteration can be deleted from packed storage')
+                self.truncate_packed(n_iter)
             del self.we_h5file['/iterations/iter_{:0{prec}d}'.format(int(n_iter), prec=self.iter_prec)]
 
+    @writer_method
     def get_iter_group(self, n_iter):
+        '''Get the group associated with n_iter. In packed files, this is an ``h5io.PackedIterGroup``, in
+        which the packed tables of the iteration appear as datasets of the group.'''
         with self.lock:
             try:
-                return self.we_h5file['/iterations/iter_{:0{prec}d}'.format(int(n_iter), prec=self.iter_prec)]
+                iter_group = self.we_h5file['/iterations/iter_{:0{prec}d}'.format(int(n_iter), prec=self.iter_prec)]
             except KeyError:
                 return self.we_h5file['/iter_{:0{prec}d}'.format(int(n_iter),prec=self.iter_prec)]
             
+            if self.packed_storage:
+                entry = h5io.find_packed_entry(self._packed_index, n_iter)
+                if entry is not None:
+                    return h5io.PackedIterGroup(iter_group, h5io.packed_views(self._packed_datasets, entry))
+            return iter_group
+            
+    @writer_method
     def get_seg_index(self, n_iter):
         with self.lock:
             seg_index = self.get_iter_group(n_iter)['seg_index']
             return seg_index
         
     @property
+    @writer_method
     def current_iteration(self):
         with self.lock:
             h5file_attrs = self.we_h5file['/'].attrs
@@ -319,6 +552,7 @@ class WESTDataManager:
                 return int(self.we_h5file['/'].attrs['wemd_current_iteration'])
     
     @current_iteration.setter
+    @writer_method
     def current_iteration(self, n_iter):
         with self.lock:
             self.we_h5file['/'].attrs['west_current_iteration'] = n_iter
@@ -348,14 +582,24 @@ class WESTDataManager:
                 log.info('WEST HDF5 file format version not stored, assuming 0')
                 self.we_h5file_version = 0
                 
+            self.packed_storage = h5io.packed_group_name in self.we_h5file
+            if self.packed_storage:
+                self._load_packed_index()
+                
             log.debug('opened WEST HDF5 file version {:d}'.format(self.we_h5file_version))
+            
+            self._load_bin_mapper_index()
                                 
     def prepare_backing(self): #istates):
         '''Create new HDF5 file'''
         self.we_h5file = h5py.File(self.we_h5filename, 'w', driver=self.we_h5file_driver)
+        self._bin_mapper_rows = {}
+        self._bin_mapper_cache.clear()
+        
+        self.we_h5file_version = packed_file_format_version if self.packed_storage else file_format_version
         
         with self.flushing_lock():
-            self.we_h5file['/'].attrs['west_file_format_version'] = file_format_version
+            self.we_h5file['/'].attrs['west_file_format_version'] = self.we_h5file_version
             self.we_h5file['/'].attrs['west_iter_prec'] = self.iter_prec
             self.current_iteration = 0
             self.we_h5file['/'].create_dataset('summary',
@@ -363,19 +607,95 @@ class WESTDataManager:
                                                dtype=summary_table_dtype,
                                                maxshape=(None,))
             self.we_h5file.create_group('/iterations')
+            
+            if self.packed_storage:
+                # The progress coordinate datasets are created with the first iteration
+                packed_group = self.we_h5file.create_group(h5io.packed_group_name)
+                packed_group.create_dataset('iter_index', shape=(0,), dtype=h5io.packed_iter_index_dtype,
+                                            maxshape=(None,), chunks=(self.packed_index_chunksize,))
+                packed_group.create_dataset('seg_index', shape=(0,), dtype=seg_index_dtype,
+                                            maxshape=(None,), chunks=(self.packed_index_chunksize,))
+                packed_group.create_dataset('wtgraph', shape=(0,), dtype=seg_id_dtype, maxshape=(None,),
+                                            chunks=(self.packed_wtgraph_chunksize,), compression='gzip', shuffle=True)
+                self._load_packed_index()
         
     def close_backing(self):
+        self.shutdown_writer()
         if self.we_h5file is not None:
             with self.lock:
                 self.we_h5file.close()
             self.we_h5file = None
-        
+        self._bin_mapper_rows = None
+        self._bin_mapper_cache.clear()
+        self._aux_datasets.clear()
+        self._packed_index = []
+        self._packed_datasets = {}
+        
+    @writer_method
+    @timed_method
     def flush_backing(self):
         if self.we_h5file is not None:
             with self.lock:
                 self.we_h5file.flush()
                 self.last_flush = time.time()
 
+    def submit_write(self, fn, *args, **kwargs):
+        '''Call ``fn(*args, **kwargs)``, which writes to the HDF5 file. In write-behind mode, the call
+        is queued for a background thread instead, and this method returns immediately unless
+        ``write_queue_size`` writes are already outstanding. Any data passed must not be modified
+        until the write is complete (see ``sync_writes()``). Writes submitted while holding the
+        data manager lock are always made directly.'''
+        if not self.write_behind or self.lock.held():
+            fn(*args, **kwargs)
+            return
+        
+        if self._writer is None:
+            self._writer = BackgroundWriter(name='westpa-data-writer', maxsize=self.write_queue_size)
+        self._writer.submit(fn, *args, **kwargs)
+        
+    def sync_writes(self):
+        '''Wait for all writes queued in write-behind mode to complete, raising any exception
+        encountered in doing so. This is done implicitly on acquiring the data manager lock. A
+        thread already holding the lock only checks for failed writes.'''
+        writer = self._writer
+        if writer is None or writer.on_thread():
+            return
+        if writer.queue.unfinished_tasks and not self.lock.held():
+            t0 = time.time()
+            writer.barrier()
+            self._record_call_time('sync_writes', time.time()-t0)
+        else:
+            writer.check()
+        
+    def shutdown_writer(self):
+        '''Complete any writes queued in write-behind mode, flush the HDF5 file, and stop the 
+        background writer. If a write failed, later writes are discarded and the file is not
+        flushed again, so that it is left as of the last successful flush.'''
+        writer = self._writer
+        if writer is None:
+            return
+        self._writer = None
+        writer.shutdown()
+        if writer.error is None:
+            self.flush_backing()
+        elif sys.exc_info()[0] is None:
+            # Do not mask an exception already in flight
+            writer.check()
+        
+    def _flush_if_expired(self):
+        if time.time() > self.last_flush + self.flush_period:
+            self.flush_backing()
+            
+    def iteration_boundary(self):
+        '''Mark the end of an iteration. The HDF5 file is flushed, or, in write-behind mode, flushed
+        only if ``flush_period`` seconds have passed since the last flush. Submit this with
+        ``submit_write()`` to have it take effect after the iteration's queued writes.'''
+        if self.write_behind:
+            self._flush_if_expired()
+        else:
+            self.flush_backing()
+
+    @writer_method
     def save_target_states(self, tstates, n_iter=None):
         '''Save the given target states in the HDF5 file; they will be used for the next iteration to
         be propagated.  A complete set is required, even if nominally appending to an existing set,
@@ -426,34 +746,32 @@ class WESTDataManager:
                 master_index_row['group_ref'] = None 
                 
             master_index[set_id] = master_index_row
+            self.states_generation += 1
             
     def _find_multi_iter_group(self, n_iter, master_group_name):
         with self.lock:
             master_group = self.we_h5file[master_group_name]
             master_index = master_group['index'][...]
-            set_id = numpy.digitize([n_iter], master_index['iter_valid']) - 1
+            set_id = numpy.digitize([n_iter], master_index['iter_valid'])[0] - 1
             group_ref = master_index[set_id]['group_ref']
 
             # Check if reference is Null
             if not bool(group_ref):
                 return None
 
-            # This extra [0] is to work around a bug in h5py
-            try:
-                group = self.we_h5file[group_ref]
-            except AttributeError:
-                group = self.we_h5file[group_ref[0]]
-            else:
-                log.debug('h5py fixed; remove alternate code path')
+            group = self.we_h5file[group_ref]
             log.debug('reference {!r} points to group {!r}'.format(group_ref, group))
             return group
             
+    @writer_method
     def find_tstate_group(self, n_iter):
         return self._find_multi_iter_group(n_iter, 'tstates')
 
+    @writer_method
     def find_ibstate_group(self, n_iter):
         return self._find_multi_iter_group(n_iter, 'ibstates')
 
+    @writer_method
     def get_target_states(self, n_iter):
         '''Return a list of Target objects representing the target (sink) states that are in use for iteration n_iter.
         Future iterations are assumed to continue from the most recent set of states.'''
@@ -472,6 +790,7 @@ class WESTDataManager:
 
             return tstates
           
+    @writer_method
     def create_ibstate_group(self, basis_states, n_iter=None):
         '''Create the group used to store basis states and initial states (whose definitions are always
         coupled).  This group is hard-linked into all iteration groups that use these basis and 
@@ -514,9 +833,11 @@ class WESTDataManager:
                 state_group['bstate_pcoord'] = state_pcoords
             
             master_index[set_id] = master_index_row
+            self.states_generation += 1
             return state_group
 
 
+    @writer_method
     def get_basis_states(self, n_iter=None):
         '''Return a list of BasisState objects representing the basis states that are in use for iteration n_iter.'''
         
@@ -534,6 +855,8 @@ class WESTDataManager:
             return bstates
             
 
+    @writer_method
+    @timed_method
     def create_initial_states(self, n_states, n_iter=None):
         '''Create storage for ``n_states`` initial states associated with iteration ``n_iter``, and
         return bare InitialState objects with only state_id set.'''
@@ -571,6 +894,8 @@ class WESTDataManager:
         istate_index[first_id:len_index] = index_entries
         return new_istates
             
+    @writer_method
+    @timed_method
     def update_initial_states(self, initial_states, n_iter = None):
         '''Save the given initial states in the HDF5 file'''
         
@@ -596,6 +921,7 @@ class WESTDataManager:
             ibstate_group['istate_index'][state_ids] = index_entries
             ibstate_group['istate_pcoord'][state_ids] = pcoord_vals
     
+    @writer_method
     def get_initial_states(self, n_iter=None):
         states = []
         with self.lock:
@@ -613,6 +939,7 @@ class WESTDataManager:
                                            istate_type=int(state['istate_type']), pcoord=pcoord.copy()))
             return states
                 
+    @writer_method
     def get_segment_initial_states(self, segments, n_iter=None):
         '''Retrieve all initial states referenced by the given segments.'''
         
@@ -636,6 +963,8 @@ class WESTDataManager:
                 istates.append(istate)
             return istates 
             
+    @writer_method
+    @timed_method
     def get_unused_initial_states(self, n_states = None, n_iter = None):
         '''Retrieve any prepared but unused initial states applicable to the given iteration.
         Up to ``n_states`` states are returned; if ``n_states`` is None, then all unused states
@@ -678,13 +1007,13 @@ class WESTDataManager:
             log.debug('found {:d} unused states'.format(len(states)))
             return states[:n_states]
                 
+    @writer_method
+    @timed_method
     def prepare_iteration(self, n_iter, segments):
         """Prepare for a new iteration by creating space to store the new iteration's data.
         The number of segments, their IDs, and their lineage must be determined and included
         in the set of segments passed in."""
         
-        log.debug('preparing HDF5 group for iteration %d (%d segments)' % (n_iter, len(segments)))
-        
         # Ensure we have a list for guaranteed ordering
         segments = list(segments)
         n_particles = len(segments)
@@ -693,6 +1022,78 @@ class WESTDataManager:
         pcoord_len = system.pcoord_len
         pcoord_dtype = system.pcoord_dtype
         
+        pcoord = numpy.zeros((n_particles, pcoord_len, pcoord_ndim), pcoord_dtype)
+        full_pcoord_ids, full_pcoords = [], []
+        initial_pcoord_ids, initial_pcoords = [], []
+        
+        for (seg_id, segment) in enumerate(segments):
+            if segment.seg_id is not None:
+                assert segment.seg_id == seg_id
+            else:
+                segment.seg_id = seg_id
+            # Parent must be set, though what it means depends on initpoint_type
+            assert segment.parent_id is not None
+            
+            # Assign progress coordinate if any exists
+            if segment.pcoord is not None: 
+                if len(segment.pcoord) == 1:
+                    # Initial pcoord
+                    initial_pcoord_ids.append(seg_id)
+                    initial_pcoords.append(segment.pcoord[0,:])
+                elif segment.pcoord.shape != pcoord.shape[1:]:
+                    raise ValueError('segment pcoord shape [%r] does not match expected shape [%r]'
+                                     % (segment.pcoord.shape, pcoord.shape[1:]))
+                else:
+                    full_pcoord_ids.append(seg_id)
+                    full_pcoords.append(segment.pcoord)
+        
+        if full_pcoord_ids:
+            pcoord[full_pcoord_ids] = full_pcoords
+        if initial_pcoord_ids:
+            pcoord[initial_pcoord_ids,0] = initial_pcoords
+            
+        seg_index_table = numpy.zeros((n_particles,), dtype=seg_index_dtype)
+        seg_index_table['status'] = [segment.status for segment in segments]
+        seg_index_table['weight'] = [segment.weight for segment in segments]
+        seg_index_table['parent_id'] = [segment.parent_id for segment in segments]
+        wtg_n_parents = numpy.fromiter((len(segment.wtg_parent_ids) for segment in segments), 
+                                       dtype=seg_index_dtype['wtg_n_parents'], count=n_particles)
+        seg_index_table['wtg_n_parents'] = wtg_n_parents
+        seg_index_table['wtg_offset'] = numpy.cumsum(wtg_n_parents) - wtg_n_parents
+        wtgraph = numpy.fromiter(itertools.chain.from_iterable(segment.wtg_parent_ids for segment in segments),
+                                 dtype=seg_id_dtype, count=int(wtg_n_parents.sum()))
+        
+        self.prepare_iteration_from_arrays(n_iter, seg_index_table, pcoord, wtgraph)
+        
+    @writer_method
+    @timed_method
+    def prepare_iteration_from_arrays(self, n_iter, seg_index_table, pcoord=None, wtgraph=None):
+        """Prepare for a new iteration by creating space to store the new iteration's data, given
+        the new segments in columnar form: ``seg_index_table`` is an array of ``seg_index_dtype``
+        (indexed by seg_id) in which at least weight, parent, status, and weight transfer graph 
+        information is set, ``pcoord`` is an array of progress coordinates of shape
+        (n_segments, pcoord_len, pcoord_ndim), or None for all zeros, and ``wtgraph`` is the 
+        array of weight transfer graph parents into which ``wtg_offset`` and ``wtg_n_parents``
+        index."""
+        
+        n_particles = len(seg_index_table)
+        system = self.system
+        pcoord_ndim = system.pcoord_ndim
+        pcoord_len = system.pcoord_len
+        pcoord_dtype = system.pcoord_dtype
+        
+        log.debug('preparing HDF5 group for iteration %d (%d segments)' % (n_iter, n_particles))
+        
+        seg_index_table = numpy.asarray(seg_index_table, dtype=seg_index_dtype)
+        total_parents = int(seg_index_table['wtg_n_parents'].sum())
+        if wtgraph is None:
+            wtgraph = numpy.empty((0,), seg_id_dtype)
+        if len(wtgraph) != total_parents:
+            raise ValueError('weight transfer graph has {:d} entries but {:d} are required'.format(len(wtgraph), total_parents))
+        if pcoord is not None and pcoord.shape != (n_particles, pcoord_len, pcoord_ndim):
+            raise ValueError('pcoord shape [%r] does not match expected shape [%r]'
+                             % (pcoord.shape, (n_particles, pcoord_len, pcoord_ndim)))
+        
         with self.lock:
             # Create a table of summary information about each iteration
             summary_table = self.we_h5file['summary']
@@ -700,87 +1101,159 @@ class WESTDataManager:
                 summary_table.resize((n_iter+1,))
             
             iter_group = self.require_iter_group(n_iter)
-            
-            for linkname in ('seg_index', 'pcoord', 'wtgraph'):
-                try:
-                    del iter_group[linkname]
-                except KeyError:
-                    pass
-                        
-            # everything indexed by [particle] goes in an index table
-            seg_index_table_ds = iter_group.create_dataset('seg_index', shape=(n_particles,),
-                                                           dtype=seg_index_dtype)
-            # unfortunately, h5py doesn't like in-place modification of individual fields; it expects
-            # tuples. So, construct everything in a numpy array and then dump the whole thing into hdf5
-            # In fact, this appears to be an h5py best practice (collect as much in ram as possible and then dump)
-            seg_index_table = seg_index_table_ds[...]
+            self._aux_datasets.clear()
                     
             summary_row = numpy.zeros((1,), dtype=summary_table_dtype)
             summary_row['n_particles'] = n_particles
-            summary_row['norm'] = numpy.add.reduce(list(map(attrgetter('weight'), segments)))
+            summary_row['norm'] = numpy.add.reduce(seg_index_table['weight'])
             summary_table[n_iter-1] = summary_row
             
             # pcoord is indexed as [particle, time, dimension]
-            pcoord_opts = self.dataset_options.get('pcoord',{'name': 'pcoord',
-                                                             'h5path': 'pcoord',
-                                                             'compression': False})
             shape = (n_particles, pcoord_len, pcoord_ndim)
-            pcoord_ds = create_dataset_from_dsopts(iter_group, pcoord_opts, shape, pcoord_dtype)
-            pcoord = numpy.empty((n_particles, pcoord_len, pcoord_ndim), pcoord_dtype)
-                                    
-            
-            total_parents = 0
-            for (seg_id, segment) in enumerate(segments):
-                if segment.seg_id is not None:
-                    assert segment.seg_id == seg_id
-                else:
-                    segment.seg_id = seg_id
-                # Parent must be set, though what it means depends on initpoint_type
-                assert segment.parent_id is not None
-                segment.seg_id = seg_id
-                seg_index_table[seg_id]['status'] = segment.status
-                seg_index_table[seg_id]['weight'] = segment.weight
-                seg_index_table[seg_id]['parent_id'] = segment.parent_id                
-                seg_index_table[seg_id]['wtg_n_parents'] = len(segment.wtg_parent_ids)
-                seg_index_table[seg_id]['wtg_offset'] = total_parents
-                total_parents += len(segment.wtg_parent_ids)
-    
-                # Assign progress coordinate if any exists
-                if segment.pcoord is not None: 
-                    if len(segment.pcoord) == 1:
-                        # Initial pcoord
-                        pcoord[seg_id,0,:] = segment.pcoord[0,:]
-                    elif segment.pcoord.shape != pcoord.shape[1:]:
-                        raise ValueError('segment pcoord shape [%r] does not match expected shape [%r]'
-                                         % (segment.pcoord.shape, pcoord.shape[1:]))
-                    else:
-                        pcoord[seg_id,...] = segment.pcoord
-                    
-                        
-            if total_parents > 0:
-                wtgraph_ds = iter_group.create_dataset('wtgraph', (total_parents,), seg_id_dtype,
-                                                       compression='gzip', shuffle=True)
-                parents = numpy.empty((total_parents,), seg_id_dtype)
-            
-                for (seg_id, segment) in enumerate(segments):
-                    offset = seg_index_table[seg_id]['wtg_offset']
-                    extent = seg_index_table[seg_id]['wtg_n_parents']
-                    parent_list = list(segment.wtg_parent_ids)
-                    parents[offset:offset+extent] = parent_list[:]
-                    
-                    assert set(parents[offset:offset+extent]) == set(segment.wtg_parent_ids)
+            if self.packed_storage:
+                self.append_packed_iteration(n_iter, seg_index_table, shape, pcoord_dtype, pcoord, wtgraph)
+            else:
+                for linkname in ('seg_index', 'pcoord', 'pcoord_ends', 'wtgraph'):
+                    try:
+                        del iter_group[linkname]
+                    except KeyError:
+                        pass
                 
-                wtgraph_ds[:] = parents
+                # everything indexed by [particle] goes in an index table
+                iter_group.create_dataset('seg_index', data=seg_index_table)
+                
+                pcoord_ds, ends_ds = self._create_pcoord_datasets(iter_group, shape, pcoord_dtype)
+                if pcoord is not None:
+                    pcoord_ds[...] = pcoord
+                    if ends_ds is not None:
+                        ends_ds[...] = pcoord[:,[0,-1]]
+            
+                if total_parents > 0:
+                    iter_group.create_dataset('wtgraph', data=numpy.asarray(wtgraph, dtype=seg_id_dtype),
+                                              compression='gzip', shuffle=True)
 
             # Create convenient hard links
             self.update_iter_group_links(n_iter)
-            
-    
-            # Since we accumulated many of these changes in RAM (and not directly in HDF5), propagate
-            # the changes out to HDF5
-            seg_index_table_ds[:] = seg_index_table
-            pcoord_ds[...] = pcoord
 
+    def _create_pcoord_datasets(self, iter_group, shape, dtype, extendable=False):
+        '''Create the progress coordinate dataset for an iteration, laid out as given by the
+        ``layout`` option for the ``pcoord`` dataset. Return the dataset and, for the 
+        ``final-point-hot`` layout, the dataset of first and last points (otherwise None).
+        First and last points are stored with the same data type and scale/offset filter (and so
+        the same precision) as the full dataset, though never compressed. If ``extendable`` is true, the datasets can be extended
+        along the first dimension (as for packed storage), and so are always chunked.'''
+        pcoord_opts = dict(self.dataset_options.get('pcoord',{'name': 'pcoord',
+                                                              'h5path': 'pcoord',
+                                                              'compression': False}))
+        layout = pcoord_opts.get('layout')
+        filtered = bool(pcoord_opts.get('compression')) or pcoord_opts.get('scaleoffset') is not None
+        if layout is None:
+            layout = 'segments' if (filtered or extendable) else 'contiguous'
+        elif layout == 'contiguous' and filtered:
+            raise ValueError('compressed progress coordinate data cannot be stored contiguously')
+        elif layout == 'contiguous' and extendable:
+            layout = 'segments'
+        
+        # Extendable datasets will hold many iterations' worth of segments
+        chunk_shape = ((sys.maxsize,) + tuple(shape[1:])) if extendable else shape
+        if chunk_shape[0] and layout != 'contiguous' and pcoord_opts.get('chunks') in (None, True):
+            pcoord_opts['chunks'] = h5io.calc_pcoord_chunksize(chunk_shape, pcoord_opts.get('dtype', dtype),
+                                                               'points' if layout == 'points' else 'segments')
+        if extendable:
+            pcoord_opts['maxshape'] = (None,) + tuple(shape[1:])
+        pcoord_ds = create_dataset_from_dsopts(iter_group, pcoord_opts, shape, dtype)
+        pcoord_ds.attrs['layout'] = layout
+        
+        if layout == 'final-point-hot':
+            ends_shape = (shape[0], 2, shape[2])
+            ends_opts = {'name': 'pcoord_ends', 'h5path': 'pcoord_ends', 'compression': False,
+                         'scaleoffset': pcoord_opts.get('scaleoffset')}
+            chunk_shape = ((sys.maxsize,) + ends_shape[1:]) if extendable else ends_shape
+            if chunk_shape[0] and (extendable or ends_opts['scaleoffset'] is not None):
+                ends_opts['chunks'] = h5io.calc_pcoord_chunksize(chunk_shape, pcoord_ds.dtype)
+            if extendable:
+                ends_opts['maxshape'] = (None,) + ends_shape[1:]
+            ends_ds = create_dataset_from_dsopts(iter_group, ends_opts, ends_shape, pcoord_ds.dtype)
+        else:
+            ends_ds = None
+        return pcoord_ds, ends_ds
+    
+    @writer_method
+    def append_packed_iteration(self, n_iter, seg_index_table, pcoord_shape, pcoord_dtype, pcoord=None, wtgraph=None):
+        '''Append the segment index, progress coordinates (shaped ``pcoord_shape``, or all zeros if ``pcoord``
+        is None) and weight transfer graph of iteration ``n_iter`` to the datasets of a packed file. If the 
+        iteration is already stored, it must be the last iteration stored, and its data is replaced; otherwise
+        it must follow the last iteration stored.'''
+        
+        with self.lock:
+            packed_index = self._packed_index
+            if h5io.find_packed_entry(packed_index, n_iter) is not None:
+                if n_iter != packed_index[-1]['n_iter']:
+                    raise ValueError('cannot replace iteration {:d} in packed storage, as later iterations are stored'
+                                     .format(int(n_iter)))
+                self.truncate_packed(n_iter)
+            elif packed_index and packed_index[-1]['n_iter'] != n_iter - 1:
+                raise ValueError('iteration {:d} does not follow the last iteration in packed storage'.format(int(n_iter)))
+            
+            packed_datasets = self._packed_datasets
+            seg_index_ds = packed_datasets['seg_index']
+            wtg_ds = packed_datasets['wtgraph']
+            pcoord_ds = packed_datasets.get('pcoord')
+            ends_ds = packed_datasets.get('pcoord_ends')
+            if pcoord_ds is None:
+                packed_group = self.we_h5file[h5io.packed_group_name]
+                pcoord_ds, ends_ds = self._create_pcoord_datasets(packed_group, (0,) + tuple(pcoord_shape[1:]), 
+                                                                  pcoord_dtype, extendable=True)
+                packed_datasets['pcoord'] = pcoord_ds
+                if ends_ds is not None:
+                    packed_datasets['pcoord_ends'] = ends_ds
+            elif pcoord_ds.shape[1:] != tuple(pcoord_shape[1:]):
+                raise ValueError('progress coordinate shape {!r} does not match shape {!r} in packed storage'
+                                 .format(tuple(pcoord_shape[1:]), pcoord_ds.shape[1:]))
+            
+            n_segments = len(seg_index_table)
+            seg_offset = append_rows(seg_index_ds, seg_index_table)
+            if wtgraph is None:
+                wtgraph = numpy.empty((0,), seg_id_dtype)
+            wtg_offset = append_rows(wtg_ds, numpy.asarray(wtgraph, dtype=seg_id_dtype))
+            
+            for dataset in (pcoord_ds, ends_ds):
+                if dataset is not None:
+                    dataset.resize(seg_offset + n_segments, axis=0)
+            if pcoord is not None and n_segments:
+                pcoord_ds[seg_offset:] = pcoord
+                if ends_ds is not None:
+                    ends_ds[seg_offset:] = pcoord[:,[0,-1]]
+                    
+            entry = numpy.array([(n_iter, seg_offset, n_segments, wtg_offset, len(wtgraph))], 
+                                dtype=h5io.packed_iter_index_dtype)
+            append_rows(self.we_h5file[h5io.packed_group_name]['iter_index'], entry)
+            packed_index.append(entry[0])
+    
+    @writer_method
+    def truncate_packed(self, n_iter):
+        '''Discard the data of iteration ``n_iter`` and all later iterations from the datasets of
+        a packed file.'''
+        
+        with self.lock:
+            entry = h5io.find_packed_entry(self._packed_index, n_iter)
+            if entry is None:
+                return
+            
+            for (dsname, dataset) in self._packed_datasets.items():
+                offset_field, _length_field = h5io.packed_datasets[dsname]
+                dataset.resize(int(entry[offset_field]), axis=0)
+            irow = int(n_iter) - int(self._packed_index[0]['n_iter'])
+            self.we_h5file[h5io.packed_group_name]['iter_index'].resize((irow,))
+            del self._packed_index[irow:]
+            
+    def _load_packed_index(self):
+        packed_group = self.we_h5file[h5io.packed_group_name]
+        self._packed_index = list(packed_group['iter_index'][...])
+        self._packed_datasets = {dsname: packed_group[dsname] for dsname in h5io.packed_datasets 
+                                 if dsname in packed_group}
+    
+    @writer_method
     def update_iter_group_links(self, n_iter):
         '''Update the per-iteration hard links pointing to the tables of target and initial/basis states for the
         given iteration.  These links are not used by this class, but are remarkably convenient for third-party
@@ -801,20 +1274,25 @@ class WESTDataManager:
             if tstate_group is not None:
                 iter_group['tstates'] = tstate_group
             
+    @writer_method
     def get_iter_summary(self,n_iter=None):
         n_iter = n_iter or self.current_iteration
         with self.lock:
             return self.we_h5file['summary'][n_iter-1]
         
+    @writer_method
     def update_iter_summary(self,summary,n_iter=None):
         n_iter = n_iter or self.current_iteration
         with self.lock:
             self.we_h5file['summary'][n_iter-1] = summary
 
+    @writer_method
     def del_iter_summary(self, min_iter): #delete the iterations starting at min_iter      
         with self.lock:
             self.we_h5file['summary'].resize((min_iter - 1,))
                                      
+    @writer_method
+    @timed_method
     def update_segments(self, n_iter, segments):
         '''Update segment information in the HDF5 file; all prior information for each
         ``segment`` is overwritten, except for parent and weight transfer information.'''
@@ -824,12 +1302,15 @@ class WESTDataManager:
         with self.lock:
             iter_group = self.get_iter_group(n_iter)
     
-            pc_dsid = iter_group['pcoord'].id
-            si_dsid = iter_group['seg_index'].id
+            # In packed files, this iteration's rows start at row_offset
+            pc_ds, row_offset = h5io.unpack_dataset_view(iter_group['pcoord'])
+            si_ds, row_offset = h5io.unpack_dataset_view(iter_group['seg_index'])
+            pc_dsid = pc_ds.id
+            si_dsid = si_ds.id
             
-            seg_ids = [segment.seg_id for segment in segments]
             n_segments = len(segments)
-            n_total_segments = si_dsid.shape[0]
+            n_total_segments = len(iter_group['seg_index'])
+            seg_ids = numpy.fromiter((segment.seg_id for segment in segments), dtype=seg_id_dtype, count=n_segments)
             system = self.system
             pcoord_ndim = system.pcoord_ndim
             pcoord_len = system.pcoord_len
@@ -845,28 +1326,34 @@ class WESTDataManager:
             pc_fsel = pc_dsid.get_space()
             si_fsel = si_dsid.get_space()
             
-            for iseg in range(n_segments):
-                seg_id = seg_ids[iseg]
-                op = h5s.SELECT_OR if iseg != 0 else h5s.SELECT_SET
-                si_fsel.select_hyperslab((seg_id,), (1,), op=op)
-                pc_fsel.select_hyperslab((seg_id,0,0), (1,pcoord_len,pcoord_ndim), op=op)
+            seg_id_runs = contiguous_runs(seg_ids)
+            row_runs = [(start+row_offset, length) for (start, length) in seg_id_runs]
+            select_runs(si_fsel, row_runs)
+            select_runs(pc_fsel, row_runs, (pcoord_len,pcoord_ndim))
                 
             # read summary data so that we have valud parent and weight transfer information
             si_dsid.read(si_msel, si_fsel, seg_index_entries)            
             
-            for (iseg, (segment, ientry)) in enumerate(zip(segments,seg_index_entries)):
-                ientry['status'] = segment.status
-                ientry['endpoint_type'] = segment.endpoint_type or Segment.SEG_ENDPOINT_UNSET
-                ientry['cputime'] = segment.cputime
-                ientry['walltime'] = segment.walltime
-                ientry['weight'] = segment.weight
-    
-                pcoord_entries[iseg] = segment.pcoord
+            seg_index_entries['status'] = [segment.status for segment in segments]
+            seg_index_entries['endpoint_type'] = [segment.endpoint_type or Segment.SEG_ENDPOINT_UNSET for segment in segments]
+            seg_index_entries['cputime'] = [segment.cputime for segment in segments]
+            seg_index_entries['walltime'] = [segment.walltime for segment in segments]
+            seg_index_entries['weight'] = [segment.weight for segment in segments]
+            if n_segments:
+                pcoord_entries[...] = [segment.pcoord for segment in segments]
                 
             # write progress coordinates and index using low level HDF5 functions for efficiency            
             si_dsid.write(si_msel,si_fsel,seg_index_entries)
             pc_dsid.write(pc_msel,pc_fsel,pcoord_entries)
             
+            ends_ds = iter_group.get('pcoord_ends')
+            if ends_ds is not None and n_segments:
+                ends_ds, _ = h5io.unpack_dataset_view(ends_ds)
+                ends_entries = numpy.ascontiguousarray(pcoord_entries[:,[0,-1]])
+                ends_fsel = ends_ds.id.get_space()
+                select_runs(ends_fsel, row_runs, (2,pcoord_ndim))
+                ends_ds.id.write(h5s.create_simple(ends_entries.shape), ends_fsel, ends_entries)
+            
             # Now, to deal with auxiliary data
             # If any segment has any auxiliary data, then the aux dataset must spring into
             # existence. Each is named according to the name in segment.data, and has shape
@@ -874,122 +1361,162 @@ class WESTDataManager:
             # in the case of scalar data) and dtype is taken from the data type of the data entry
             # compression is on by default for datasets that will be more than 1MiB
             
-            # a mapping of data set name to (per-segment shape, data type) tuples
-            dsets = {}
-            
-            # First we scan for presence, shape, and data type of auxiliary data sets
+            # First we collect auxiliary data by data set, in order of seg_id, as a
+            # mapping of data set name to (seg_ids, data) lists
+            auxdata = {}
             for segment in segments:
                 if segment.data:
                     for dsname in segment.data:
                         data = numpy.asarray(segment.data[dsname],order='C')
                         segment.data[dsname] = data
-                        dsets[dsname] = (data.shape, data.dtype)
-                      
-            # Then we iterate over data sets and store data
-            if dsets:
-                for (dsname, (shape, dtype)) in dsets.items():
-                    #dset = self._require_aux_dataset(iter_group, dsname, n_total_segments, shape, dtype)
-                    try:
-                        dsopts = self.dataset_options[dsname]
-                    except KeyError:
-                        dsopts = normalize_dataset_options({'name': dsname}, path_prefix='auxdata')
-                    
-                    shape = (n_total_segments,) + shape
-                    dset = require_dataset_from_dsopts(iter_group, dsopts, shape, dtype,
-                                                       autocompress_threshold=self.aux_compression_threshold, n_iter=n_iter)
-                    if dset is None:
-                        # storage is suppressed
-                        continue
-                    for segment in segments:
                         try:
-                            auxdataset = segment.data[dsname]
+                            ds_seg_ids, ds_data = auxdata[dsname]
                         except KeyError:
-                            pass
-                        else:                        
-                            source_rank = len(auxdataset.shape)
-                            source_sel = h5s.create_simple(auxdataset.shape, (h5s.UNLIMITED,)*source_rank)
-                            source_sel.select_all()
-                            dest_sel = dset.id.get_space()
-                            dest_sel.select_hyperslab((segment.seg_id,)+(0,)*source_rank, (1,)+auxdataset.shape)
-                            dset.id.write(source_sel, dest_sel, auxdataset)                                
-                    if 'delram' in list(dsopts.keys()):
-                        del dsets[dsname]
+                            ds_seg_ids, ds_data = auxdata[dsname] = ([], [])
+                        ds_seg_ids.append(segment.seg_id)
+                        ds_data.append(data)
+                      
+            # Then we iterate over data sets and store data, with one write per data set
+            for (dsname, (ds_seg_ids, ds_data)) in auxdata.items():
+                shape = ds_data[0].shape
+                if any(data.shape != shape for data in ds_data):
+                    raise ValueError('auxiliary data {!r} has inconsistent shapes across segments'.format(dsname))
+                ds_data = numpy.array(ds_data)
+                
+                dset, dsopts, fsel = self._require_aux_dataset(iter_group, n_iter, dsname, n_total_segments, shape, ds_data.dtype)
+                if dset is None:
+                    # storage is suppressed
+                    continue
+                
+                select_runs(fsel, contiguous_runs(ds_seg_ids), shape)
+                msel = h5s.create_simple(ds_data.shape, (h5s.UNLIMITED,)*ds_data.ndim)
+                msel.select_all()
+                dset.id.write(msel, fsel, ds_data)
+                
+                if 'delram' in dsopts:
+                    # free memory as soon as the data is stored
+                    for segment in segments:
+                        segment.data.pop(dsname, None)
+                        
+    def _require_aux_dataset(self, iter_group, n_iter, dsname, n_total_segments, shape, dtype):
+        '''Return the auxiliary dataset ``dsname`` for iteration ``n_iter``, creating it if necessary,
+        along with its dataset options and a dataspace for selecting rows within it. The dataset is
+        None if its storage is suppressed. Handles are reused until the iteration changes.'''
+        
+        try:
+            cached_n_iter, dset, dsopts, fsel = self._aux_datasets[dsname]
+        except KeyError:
+            pass
+        else:
+            if cached_n_iter == n_iter:
+                return dset, dsopts, fsel
+        
+        try:
+            dsopts = self.dataset_options[dsname]
+        except KeyError:
+            dsopts = normalize_dataset_options({'name': dsname}, path_prefix='auxdata')
+        
+        dset = require_dataset_from_dsopts(iter_group, dsopts, (n_total_segments,) + shape, dtype,
+                                           autocompress_threshold=self.aux_compression_threshold, n_iter=n_iter)
+        fsel = dset.id.get_space() if dset is not None else None
+        self._aux_datasets[dsname] = (n_iter, dset, dsopts, fsel)
+        return dset, dsopts, fsel
     
+    @writer_method
+    @timed_method
     def get_segments(self, n_iter=None, seg_ids=None, load_pcoords = True):
-        '''Return the given (or all) segments from a given iteration.  
+        '''Return the given (or all) segments from a given iteration, as a list of ``Segment``
+        objects. Any auxiliary datasets whose options include ``load: True`` are loaded into
+        the ``data`` dictionary of each segment.
         
-        If the optional parameter ``load_auxdata`` is true, then all auxiliary datasets
-        available are loaded and mapped onto the ``data`` dictionary of each segment. If 
-        ``load_auxdata`` is None, then use the default ``self.auto_load_auxdata``, which can
-        be set by the option ``load_auxdata`` in the ``[data]`` section of ``west.cfg``. This
-        essentially requires as much RAM as there is per-iteration auxiliary data, so this
-        behavior is not on by default.'''
+        Where ``Segment`` objects are not needed for every segment, ``get_segments_as_arrays()``
+        is considerably cheaper.'''
+        
+        return list(self.get_segments_as_arrays(n_iter, seg_ids, load_pcoords))
+    
+    @writer_method
+    @timed_method
+    def get_segments_as_arrays(self, n_iter=None, seg_ids=None, load_pcoords = True, pcoord_points = None,
+                               load_wtgraph = True):
+        '''Return the given (or all) segments from a given iteration as a ``SegmentArrays`` object,
+        which stores segment data in arrays and creates ``Segment`` objects only on demand.
+        ``pcoord_points`` optionally selects the time points of the progress coordinate to load
+        (e.g. ``[-1]`` to load only final progress coordinate values). If ``load_wtgraph`` is
+        false, the weight transfer graph (which is stored for the whole iteration) is not read.
+        Auxiliary datasets are loaded as for ``get_segments()``.'''
         
-
         n_iter = n_iter or self.current_iteration
         file_version = self.we_h5file_version
         
-        with self.lock:            
+        with self.lock:
             iter_group = self.get_iter_group(n_iter)
             seg_index_ds = iter_group['seg_index']
             
-            if file_version < 5:
-                all_parent_ids = iter_group['parents'][...]
+            if seg_ids is not None:
+                seg_ids = numpy.unique(numpy.asarray(seg_ids, dtype=seg_id_dtype))
+                rows = seg_ids
             else:
-                all_parent_ids = iter_group['wtgraph'][...]
+                seg_ids = numpy.arange(len(seg_index_ds), dtype=seg_id_dtype)
+                rows = None
+            seg_index = read_rows(seg_index_ds, rows)
             
-            if seg_ids is not None:
-                seg_ids = list(sorted(seg_ids))
-                seg_index_entries = seg_index_ds[seg_ids]
-                if load_pcoords:
-                    pcoord_entries = iter_group['pcoord'][seg_ids]
+            pcoord = None
+            if load_pcoords:
+                pcoord_ds = iter_group['pcoord']
+                ends_ds = iter_group.get('pcoord_ends')
+                if pcoord_points is None:
+                    pcoord = read_rows(pcoord_ds, rows)
+                elif rows is None:
+                    pcoord = h5io.get_pcoord_points(iter_group, pcoord_points)
+                else:
+                    pcoord_len = pcoord_ds.shape[1]
+                    points = numpy.atleast_1d(numpy.arange(pcoord_len)[pcoord_points])
+                    if ends_ds is not None and numpy.isin(points, (0, pcoord_len-1)).all():
+                        pcoord = read_rows(ends_ds, rows)[:,numpy.where(points == 0, 0, 1)]
+                    else:
+                        pcoord = read_rows(pcoord_ds, rows)[:,points]
+            
+            if file_version < 5:
+                wtg_ds = iter_group['parents']
+                wtg_n_parents = seg_index['n_parents']
+                wtg_offsets = seg_index['parents_offset']
             else:
-                seg_ids = list(range(len(seg_index_ds)))
-                seg_index_entries = seg_index_ds[...]
-                if load_pcoords:
-                    pcoord_entries = iter_group['pcoord'][...]
-                            
-            segments = []
-                
-            for iseg, (seg_id, row) in enumerate(zip(seg_ids, seg_index_entries)):
-                segment = Segment(seg_id = seg_id,
-                                  n_iter = n_iter,
-                                  status = int(row['status']),
-                                  endpoint_type = int(row['endpoint_type']),
-                                  walltime = float(row['walltime']),
-                                  cputime = float(row['cputime']),
-                                  weight = float(row['weight']))
+                wtg_ds = iter_group.get('wtgraph')
+                wtg_n_parents = seg_index['wtg_n_parents']
+                wtg_offsets = seg_index['wtg_offset']
+            
+            if load_wtgraph:
+                all_parent_ids = wtg_ds[...] if wtg_ds is not None else numpy.empty((0,), seg_id_dtype)
                 
-                if load_pcoords:
-                    segment.pcoord = pcoord_entries[iseg]
-                    
-                if file_version < 5:
-                    wtg_n_parents = row['n_parents'] 
-                    wtg_offset = row['parents_offset']
-                    wtg_parent_ids = all_parent_ids[wtg_offset:wtg_offset+wtg_n_parents]
-                    segment.parent_id = int(wtg_parent_ids[0])
-                else:
-                    wtg_n_parents = row['wtg_n_parents']
-                    wtg_offset = row['wtg_offset']  
-                    wtg_parent_ids = all_parent_ids[wtg_offset:wtg_offset+wtg_n_parents]
-                    segment.parent_id = int(row['parent_id'])
-                segment.wtg_parent_ids = set(map(int,wtg_parent_ids))
-                assert len(segment.wtg_parent_ids) == wtg_n_parents
-                segments.append(segment)
-            del all_parent_ids
-            if load_pcoords:
-                del pcoord_entries
+                # gather the weight transfer graph of these segments into compressed sparse row form
+                csr_offsets = numpy.zeros((len(seg_ids)+1,), numpy.int64)
+                csr_offsets[1:] = numpy.cumsum(wtg_n_parents)
+                gather = (numpy.arange(csr_offsets[-1]) 
+                          + numpy.repeat(wtg_offsets.astype(numpy.int64) - csr_offsets[:-1], 
+                                         wtg_n_parents.astype(numpy.int64)))
+                wtg_parent_ids = all_parent_ids[gather]
+                del all_parent_ids
+            else:
+                csr_offsets = wtg_parent_ids = None
+            
+            if file_version >= 5:
+                parent_ids = seg_index['parent_id']
+            elif load_wtgraph:
+                parent_ids = wtg_parent_ids[csr_offsets[:-1]]
+            else:
+                # the history parent is the first weight transfer parent
+                offsets, inverse = numpy.unique(wtg_offsets, return_inverse=True)
+                parent_ids = read_rows(wtg_ds, offsets)[inverse]
         
             # If any other data sets are requested, load them as well
+            data = {}
             for dsinfo in self.dataset_options.values():
                 if dsinfo.get('load', False):
-                    dsname = dsinfo['name']
-                    ds = iter_group[dsinfo['h5path']]
-                    for (seg_id, segment) in enumerate(segments):
-                        segment.data[dsname] = ds[seg_id]
+                    data[dsinfo['name']] = read_rows(iter_group[dsinfo['h5path']], rows)
         
-        return segments
+        return SegmentArrays(n_iter, seg_ids, seg_index, pcoord, parent_ids, csr_offsets, wtg_parent_ids, data)
             
+    @writer_method
     def get_all_parent_ids(self, n_iter):
         file_version = self.we_h5file_version
         with self.lock:
@@ -1003,6 +1530,7 @@ class WESTDataManager:
             else:
                 return seg_index['parent_id']
     
+    @writer_method
     def get_parent_ids(self, n_iter, seg_ids=None):
         '''Return a sequence of the parent IDs of the given seg_ids.'''
         
@@ -1023,6 +1551,7 @@ class WESTDataManager:
                 all_parents = seg_index['parent_id']
                 return [all_parents[seg_id] for seg_id in seg_ids]
                 
+    @writer_method
     def get_weights(self, n_iter, seg_ids):
         '''Return the weights associated with the given seg_ids'''
         
@@ -1035,6 +1564,7 @@ class WESTDataManager:
             weight_map = dict(zip(unique_ids, index_subset['weight']))
             return [weight_map[seg_id] for seg_id in seg_ids]
         
+    @writer_method
     def get_child_ids(self, n_iter, seg_id):
         '''Return the seg_ids of segments who have the given segment as a parent.'''
         
@@ -1054,6 +1584,7 @@ class WESTDataManager:
                 
             return seg_ids[parent_ids == seg_id]
                     
+    @writer_method
     def get_children(self, segment):
         '''Return all segments which have the given segment as a parent'''
 
@@ -1096,6 +1627,8 @@ class WESTDataManager:
         self.flush_backing()
         self.close_backing()
         
+    @writer_method
+    @timed_method
     def save_new_weight_data(self, n_iter, new_weights):
         '''Save a set of NewWeightEntry objects to HDF5. Note that this should
         be called for the iteration in which the weights appear in their
@@ -1145,6 +1678,8 @@ class WESTDataManager:
             nwgroup['prev_final_pcoord'] = prev_final_pcoords
             nwgroup['new_init_pcoord'] = new_init_pcoords
             
+    @writer_method
+    @timed_method
     def get_new_weight_data(self, n_iter):
         with self.lock:
             iter_group = self.get_iter_group(n_iter)
@@ -1187,86 +1722,89 @@ class WESTDataManager:
             entries.append(entry)
         return entries
     
-    def find_bin_mapper(self, hashval):
-        '''Check to see if the given has value is in the binning table. Returns the index in the
-        bin data tables if found, or raises KeyError if not.'''
-
+    @staticmethod
+    def _binhash_key(hashval):
+        '''Convert a hash object, hex digest, or hex digest stored in HDF5 (as bytes) to a hex digest string.'''
         try:
             hashval = hashval.hexdigest()
         except AttributeError:
             pass
         
+        try:
+            return hashval.decode('ascii')
+        except AttributeError:
+            return hashval
+    
+    def _load_bin_mapper_index(self):
+        '''Read the hash values of all stored bin mappers, so that mappers can be looked up by hash
+        without scanning the binning table.'''
         with self.lock:
-            # these will raise KeyError if the group doesn't exist, which also means
-            # that bin data is not available, so no special treatment here
+            self._bin_mapper_rows = {}
+            self._bin_mapper_cache.clear()
             try:
-                binning_group = self.we_h5file['/bin_topologies']
-                index = binning_group['index']
+                index = self.we_h5file['/bin_topologies/index']
             except KeyError:
-                raise KeyError('hash {} not found'.format(hashval))
-            
-            n_entries = len(index)
-            if n_entries == 0:
-                raise KeyError('hash {} not found'.format(hashval))
+                return
             
-            chunksize = self.table_scan_chunksize
-            for istart in range(0,n_entries,chunksize):
-                chunk = index[istart:min(istart+chunksize,n_entries)]
-                for i in range(len(chunk)):
-                    if chunk[i]['hash'] == hashval:
-                        return istart+i
+            # If a mapper is (erroneously) stored more than once, use the first copy, as a table scan would
+            for (irow, hashval) in enumerate(index['hash'].tolist()):
+                self._bin_mapper_rows.setdefault(self._binhash_key(hashval), irow)
+        
+    @writer_method
+    def find_bin_mapper(self, hashval):
+        '''Check to see if the given has value is in the binning table. Returns the index in the
+        bin data tables if found, or raises KeyError if not.'''
+
+        hashval = self._binhash_key(hashval)
+        
+        with self.lock:
+            if self._bin_mapper_rows is None:
+                self._load_bin_mapper_index()
             
-            raise KeyError('hash {} not found'.format(hashval))
+            try:
+                return self._bin_mapper_rows[hashval]
+            except KeyError:
+                raise KeyError('hash {} not found'.format(hashval))
 
+    @writer_method
     def get_bin_mapper(self,  hashval):
         '''Look up the given hash value in the binning table, unpickling and returning the corresponding
-        bin mapper if available, or raising KeyError if not.'''
+        bin mapper if available, or raising KeyError if not. Recently-used mappers are cached, so the
+        mapper returned may be shared with other callers and should not be modified.'''
 
-        # Convert to a hex digest if we need to
-        try:
-            hashval = hashval.hexdigest()
-        except AttributeError:
-            pass
+        hashval = self._binhash_key(hashval)
 
         with self.lock:
-            # these will raise KeyError if the group doesn't exist, which also means
-            # that bin data is not available, so no special treatment here
             try:
-                binning_group = self.we_h5file['/bin_topologies']
-                index = binning_group['index']
-                pkl = binning_group['pickles']
+                mapper = self._bin_mapper_cache[hashval]
             except KeyError:
-                raise KeyError('hash {} not found. Could not retrieve binning group'.format(hashval))
-
-            n_entries = len(index)
-            if n_entries == 0:
-                raise KeyError('hash {} not found. No entries in index'.format(hashval))
-
-            chunksize = self.table_scan_chunksize
-
-            for istart in range(0, n_entries, chunksize):
-                chunk = index[istart:min(istart+chunksize, n_entries)]
-                for i in range(len(chunk)):
-                    if chunk[i]['hash'] == hashval:
-                        pkldat = bytes(pkl[istart+i, 0:chunk[i]['pickle_len']].data)
-                        mapper = pickle.loads(pkldat)
-                        log.debug('loaded {!r} from {!r}'.format(mapper, binning_group))
-                        log.debug('hash value {!r}'.format(hashval))
-                        return mapper
-
-            raise KeyError('hash {} not found'.format(hashval))
-
+                pass
+            else:
+                self._bin_mapper_cache.move_to_end(hashval)
+                return mapper
+            
+            irow = self.find_bin_mapper(hashval)
+            binning_group = self.we_h5file['/bin_topologies']
+            pickle_len = binning_group['index'][irow]['pickle_len']
+            pkldat = bytes(binning_group['pickles'][irow, 0:pickle_len].data)
+            mapper = pickle.loads(pkldat)
+            log.debug('loaded {!r} from {!r}'.format(mapper, binning_group))
+            log.debug('hash value {!r}'.format(hashval))
+            
+            self._bin_mapper_cache[hashval] = mapper
+            while len(self._bin_mapper_cache) > self.bin_mapper_cache_size:
+                self._bin_mapper_cache.popitem(last=False)
+            return mapper
+
+    @writer_method
     def save_bin_mapper(self, hashval, pickle_data):
         '''Store the given mapper in the table of saved mappers. If the mapper cannot be stored,
         PickleError will be raised. Returns the index in the bin data tables where the mapper is stored.'''
         
-        try:
-            hashval = hashval.hexdigest()
-        except AttributeError:
-            pass
+        hashval = self._binhash_key(hashval)
         pickle_data = bytes(pickle_data)
                 
-        # First, scan to see if the mapper already is in the HDF5 file
+        # First, check to see if the mapper already is in the HDF5 file
         try:
             return self.find_bin_mapper(hashval)
         except KeyError:
@@ -1296,8 +1834,11 @@ class WESTDataManager:
             index_row['pickle_len'] = len(pickle_data)
             index[n_entries-1] = index_row
             pickle_ds[n_entries-1,:len(pickle_data)] = memoryview(pickle_data)
+            self._bin_mapper_rows[hashval] = n_entries-1
             return n_entries-1
         
+    @writer_method
+    @timed_method
     def save_iter_binning(self, n_iter, hashval, pickled_mapper, target_counts):
         '''Save information about the binning used to generate segments for iteration n_iter.'''
                 
@@ -1316,6 +1857,160 @@ class WESTDataManager:
                 iter_group.attrs['binhash'] = hashval
             else:
                 iter_group.attrs['binhash'] = ''    
+                
+    def _record_call_time(self, name, walltime):
+        with self._call_times_lock:
+            try:
+                entry = self._call_times[name]
+            except KeyError:
+                self._call_times[name] = [walltime, 1]
+            else:
+                entry[0] += walltime
+                entry[1] += 1
+                
+    def pop_call_times(self):
+        '''Return a dictionary mapping method name to (walltime, count) for the time spent in
+        data manager operations since the last call to this function.'''
+        with self._call_times_lock:
+            call_times = self._call_times
+            self._call_times = {}
+        return {name: tuple(entry) for (name, entry) in call_times.items()}
+                
+    @writer_method
+    def save_iter_timing(self, n_iter, timings):
+        '''Save timing information for iteration ``n_iter``. ``timings`` is a sequence of
+        (name, walltime, count) tuples.'''
+        
+        timings = list(timings)
+        timing_table = numpy.empty((len(timings),), dtype=timing_dtype)
+        for (irow, (name, walltime, count)) in enumerate(timings):
+            timing_table[irow] = (name, walltime, count)
+        
+        with self.lock:
+            iter_group = self.get_iter_group(n_iter)
+            try:
+                del iter_group['timing']
+            except KeyError:
+                pass
+            iter_group.create_dataset('timing', data=timing_table)
+            
+    @writer_method
+    def get_iter_timing(self, n_iter):
+        '''Return the timing table for iteration ``n_iter`` as a dictionary mapping name
+        to (walltime, count), or an empty dictionary if no timing information was stored.'''
+        
+        with self.lock:
+            try:
+                timing_table = self.get_iter_group(n_iter)['timing'][...]
+            except KeyError:
+                return {}
+        
+        timings = {}
+        for row in timing_table:
+            name = row['name']
+            if isinstance(name, bytes):
+                name = name.decode()
+            timings[name] = (float(row['walltime']), int(row['count']))
+        return timings
+    
+    @writer_method
+    def save_iter_events(self, n_iter, events):
+        '''Save event counts for iteration ``n_iter``. ``events`` is a sequence of (name, count) tuples.'''
+        
+        events = list(events)
+        event_table = numpy.empty((len(events),), dtype=event_dtype)
+        for (irow, (name, count)) in enumerate(events):
+            event_table[irow] = (name, count)
+        
+        with self.lock:
+            iter_group = self.get_iter_group(n_iter)
+            try:
+                del iter_group['events']
+            except KeyError:
+                pass
+            iter_group.create_dataset('events', data=event_table)
+            
+    @writer_method
+    def get_iter_events(self, n_iter):
+        '''Return the event counts for iteration ``n_iter`` as a dictionary mapping name to count,
+        or an empty dictionary if no events were recorded.'''
+        
+        with self.lock:
+            try:
+                event_table = self.get_iter_group(n_iter)['events'][...]
+            except KeyError:
+                return {}
+        
+        events = {}
+        for row in event_table:
+            name = row['name']
+            if isinstance(name, bytes):
+                name = name.decode()
+            events[name] = int(row['count'])
+        return events
+
+def contiguous_runs(indices):
+    '''Return the start and length of each run of consecutive values in the sorted array ``indices``,
+    as a list of (start, length) tuples.'''
+    indices = numpy.asarray(indices)
+    if not len(indices):
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(indices) != 1) + 1
+    run_starts = numpy.r_[0, breaks]
+    run_lengths = numpy.diff(numpy.r_[run_starts, len(indices)])
+    return list(zip(indices[run_starts].tolist(), run_lengths.tolist()))
+
+def read_rows(dataset, rows=None):
+    '''Read the given rows (a sorted array of distinct indices along the first dimension), or
+    all rows if ``rows`` is None, of ``dataset`` (which may be a view of a packed dataset) into
+    a new array.'''
+    if rows is None:
+        return dataset[...]
+    
+    dataset, row_offset = h5io.unpack_dataset_view(dataset)
+    data = numpy.empty((len(rows),) + dataset.shape[1:], dataset.dtype)
+    if len(rows):
+        fsel = dataset.id.get_space()
+        select_runs(fsel, contiguous_runs(numpy.asarray(rows, numpy.int64) + row_offset), dataset.shape[1:])
+        dataset.id.read(h5s.create_simple(data.shape), fsel, data)
+    return data
+
+def append_rows(dataset, data):
+    '''Append ``data`` to the extendable ``dataset`` along its first dimension, returning the
+    index of the first row appended.'''
+    offset = dataset.shape[0]
+    if len(data):
+        dataset.resize(offset + len(data), axis=0)
+        dataset[offset:] = data
+    return offset
+
+# Selections of up to this many runs of rows are made as a union of hyperslabs; beyond this
+# (as with segments completing in arbitrary order), selecting individual elements is much faster,
+# provided that rows are small
+max_hyperslab_runs = 32
+max_element_row_size = 64
+
+def select_runs(dataspace, runs, extent=()):
+    '''Select the (start, length) ``runs`` of rows (along the first dimension) of the given
+    HDF5 dataspace. ``extent`` gives the extent of the selection along the remaining dimensions.'''
+    if not runs:
+        dataspace.select_none()
+        return
+    
+    extent = tuple(extent)
+    row_size = int(numpy.multiply.reduce(extent))
+    if len(runs) > max_hyperslab_runs and row_size <= max_element_row_size:
+        rows = numpy.concatenate([numpy.arange(start, start+length) for (start, length) in runs])
+        coords = numpy.empty((len(rows), row_size, 1+len(extent)), numpy.uint64)
+        coords[:,:,0] = rows[:,None]
+        if extent:
+            coords[:,:,1:] = numpy.indices(extent).reshape(len(extent), row_size).T
+        dataspace.select_elements(coords.reshape(-1, 1+len(extent)))
+    else:
+        offset = (0,)*len(extent)
+        for (irun, (start, length)) in enumerate(runs):
+            dataspace.select_hyperslab((start,)+offset, (length,)+extent, 
+                                       op=h5s.SELECT_OR if irun else h5s.SELECT_SET)
 
 def normalize_dataset_options(dsopts, path_prefix='', n_iter=0):
     dsopts = dict(dsopts)
@@ -1413,7 +2108,10 @@ def create_dataset_from_dsopts(group, dsopts, shape=None, dtype=None, data=None,
     else:
         shuffle = False
         
-    need_chunks = any([compression,scaleoffset is not None,shuffle])
+    # Extendable datasets (as for packed storage) must be chunked
+    maxshape = dsopts.get('maxshape')
+        
+    need_chunks = any([compression,scaleoffset is not None,shuffle,maxshape is not None])
         
     # We use user-provided chunks if available
     chunks_directive = dsopts.get('chunks')
@@ -1424,7 +2122,9 @@ def create_dataset_from_dsopts(group, dsopts, shape=None, dtype=None, data=None,
     elif chunks_directive is False:
         chunks = None
     else:
-        chunks = tuple(chunks_directive[i] if chunks_directive[i] <= shape[i] else shape[i] for i in range(len(shape)))
+        chunks = tuple(chunks_directive[i] if (chunks_directive[i] <= shape[i] 
+                                               or (maxshape is not None and maxshape[i] is None)) else shape[i] 
+                       for i in range(len(shape)))
     
     if not chunks and need_chunks:
         chunks = calc_chunksize(shape, h5_dtype)
@@ -1434,6 +2134,12 @@ def create_dataset_from_dsopts(group, dsopts, shape=None, dtype=None, data=None,
             'compression': compression,
             'shuffle': shuffle,
             'chunks': chunks}
+    if maxshape is not None:
+        opts['maxshape'] = maxshape
+    
+    if isinstance(compression, str):
+        # A named filter (e.g. lzf, or lz4 if available)
+        opts.update(h5io.compression_opts(compression))
     
     try:
         import h5py._hl.filters
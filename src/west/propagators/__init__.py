@@ -16,8 +16,9 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os, threading, itertools
+import multiprocessing.util
 import westpa
-import itertools
 def blocked_iter(blocksize, iterable, fillvalue = None):
     # From the Python "itertools recipes" (grouper)
     args = [iter(iterable)] * blocksize
@@ -40,6 +41,87 @@ class WESTPropagator:
         
         self.rc = rc or westpa.rc
         
+        # The process in which setup_worker() was last run (see ensure_worker_setup())
+        self._worker_pid = None
+        
+        # Contexts cached by get_context(), in a dictionary for each thread, and a list of those 
+        # dictionaries for release at worker teardown
+        self._contexts = threading.local()
+        self._context_caches = []
+        self._context_lock = threading.Lock()
+        
+    def setup_worker(self):
+        """Perform any necessary setup for a worker, before it runs the first task using this propagator.
+        This is run by the work manager, once per worker process."""
+        pass
+    
+    def teardown_worker(self):
+        """Perform any necessary cleanup for a worker, when it exits. This is run by the work manager,
+        once per worker process in which ``setup_worker()`` was run; cached contexts (see
+        ``get_context()``) are released after this returns."""
+        pass
+    
+    def ensure_worker_setup(self):
+        """Run ``setup_worker()`` if it has not been run in this process, and arrange for
+        ``teardown_worker()`` to be run when this process exits."""
+        if self._worker_pid == os.getpid():
+            return
+        
+        with self._context_lock:
+            if self._worker_pid == os.getpid():
+                return
+            
+            # Contexts created by the process from which this one was forked are not usable here
+            self._contexts = threading.local()
+            self._context_caches = []
+            self.setup_worker()
+            self._worker_pid = os.getpid()
+        
+        # Worker processes started by multiprocessing do not run atexit handlers, but do run
+        # these finalizers (as does the main process, at exit)
+        multiprocessing.util.Finalize(None, self._teardown_worker, args=(self._worker_pid,), exitpriority=0)
+        
+    def _teardown_worker(self, worker_pid):
+        if worker_pid == os.getpid() == self._worker_pid:
+            try:
+                self.teardown_worker()
+            finally:
+                self.clear_contexts()
+                self._worker_pid = None
+    
+    def get_context(self, key, create):
+        """Return the context (for instance, an MD engine initialized for a given system, integrator, and
+        platform) cached under ``key`` in the calling worker, calling ``create()`` to create it if 
+        necessary. Contexts are kept for the lifetime of the worker (across tasks and iterations), and 
+        are not shared between threads."""
+        try:
+            cache = self._contexts.cache
+        except AttributeError:
+            cache = self._contexts.cache = {}
+            with self._context_lock:
+                self._context_caches.append(cache)
+        
+        try:
+            return cache[key]
+        except KeyError:
+            context = cache[key] = create()
+            return context
+        
+    def release_context(self, key, context):
+        """Release the resources held by a context cached by ``get_context()``."""
+        pass
+    
+    def clear_contexts(self):
+        """Release all contexts cached by ``get_context()`` in this process."""
+        with self._context_lock:
+            caches = self._context_caches
+            self._context_caches = []
+            self._contexts = threading.local()
+        for cache in caches:
+            for (key, context) in cache.items():
+                self.release_context(key, context)
+            cache.clear()
+        
     def prepare_iteration(self, n_iter, segments):
         """Perform any necessary per-iteration preparation.  This is run by the work manager."""
         pass
@@ -16,8 +16,8 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import os, sys, signal, random, subprocess, time, tempfile
-import numpy
+import os, sys, signal, random, subprocess, time, tempfile, collections, threading, shutil, atexit
+import numpy, h5py
 import logging
 from west.states import BasisState, InitialState
 log = logging.getLogger(__name__)
@@ -32,32 +32,116 @@ from westpa.yamlcfg import check_bool, ConfigItemMissing
 import west
 from west import Segment
 from west.propagators import WESTPropagator
+from west.propagators.launcher import ChildLauncher
 
-def pcoord_loader(fieldname, pcoord_return_filename, destobj, single_point):
-    """Read progress coordinate data into the ``pcoord`` field on ``destobj``. 
-    An exception will be raised if the data is malformed.  If ``single_point`` is true,
-    then only one (N-dimensional) point will be read, otherwise system.pcoord_len points
-    will be read.
-    """
+def parse_cpu_set(spec):
+    '''Return the set of CPU numbers given by ``spec``, which is either a sequence of integers,
+    a single integer, or a string in the list format used by ``taskset`` and Linux cpusets
+    (e.g. "0-3,8,10-11").'''
     
-    system = westpa.rc.get_system_driver()
+    if isinstance(spec, int):
+        return {spec}
+    elif not isinstance(spec, str):
+        return {int(cpu) for cpu in spec}
     
-    assert fieldname == 'pcoord'
+    cpus = set()
+    for field in spec.split(','):
+        field = field.strip()
+        if not field:
+            continue
+        if '-' in field:
+            (first, last) = field.split('-')
+            cpus.update(range(int(first), int(last)+1))
+        else:
+            cpus.add(int(field))
+    return cpus
+
+def child_exit_code(status):
+    '''Convert an exit status as returned by ``os.wait4()`` into a return code in the form used by
+    ``subprocess.Popen`` (the negated signal number for children killed by a signal).'''
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+def check_pcoord_shape(pcoord, single_point):
+    """Return ``pcoord`` with the shape of a progress coordinate for a single (N-dimensional) point
+    if ``single_point`` is true, or for system.pcoord_len points otherwise. A ValueError
+    is raised if the data has the wrong shape.
+    """
     
-    pcoord = numpy.loadtxt(pcoord_return_filename, dtype=system.pcoord_dtype)
+    system = westpa.rc.get_system_driver()
     
     if single_point:
         expected_shape = (system.pcoord_ndim,)
         if pcoord.ndim == 0:
-            pcoord.shape = (1,)
+            pcoord = pcoord.reshape((1,))
     else:
         expected_shape = (system.pcoord_len, system.pcoord_ndim)
         if pcoord.ndim == 1:
-            pcoord.shape = (len(pcoord),1)
+            pcoord = pcoord.reshape((len(pcoord),1))
     if pcoord.shape != expected_shape:
         raise ValueError('progress coordinate data has incorrect shape {!r} [expected {!r}]'.format(pcoord.shape,
                                                                                                     expected_shape))
-    destobj.pcoord = pcoord
+    return pcoord
+
+class ReturnDirectoryPool:
+    '''A pool of directories, within a per-process directory created under ``parent_dir`` (e.g. a
+    tmpfs such as /dev/shm), in which propagators return data. Directories (and the names of the
+    return files within them) are reused from segment to segment, rather than temporary files being
+    created and deleted for each segment; a directory is in use by at most one propagator process at 
+    a time.'''
+    
+    def __init__(self, parent_dir):
+        self.parent_dir = parent_dir
+        self.owner_pid = None
+        self.base_dir = None
+        self.lock = threading.Lock()
+        self.free_dirs = []
+        self.n_dirs = 0
+        
+    def acquire(self):
+        '''Return the name of a return directory not in use.'''
+        with self.lock:
+            if self.owner_pid != os.getpid():
+                # Not created yet, or created by the process from which this one was forked
+                self.base_dir = tempfile.mkdtemp(prefix='west-{:d}-'.format(os.getpid()), dir=self.parent_dir)
+                self.owner_pid = os.getpid()
+                self.free_dirs = []
+                self.n_dirs = 0
+                atexit.register(self.remove, self.owner_pid, self.base_dir)
+            if self.free_dirs:
+                return self.free_dirs.pop()
+            else:
+                return_dir = os.path.join(self.base_dir, str(self.n_dirs))
+                os.mkdir(return_dir)
+                self.n_dirs += 1
+                return return_dir
+            
+    def release(self, return_dir):
+        '''Return ``return_dir`` to the pool.'''
+        with self.lock:
+            if return_dir.startswith(self.base_dir + os.sep):
+                self.free_dirs.append(return_dir)
+    
+    @staticmethod
+    def remove(owner_pid, base_dir):
+        if os.getpid() == owner_pid:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+def pcoord_loader(fieldname, pcoord_return_filename, destobj, single_point):
+    """Read progress coordinate data into the ``pcoord`` field on ``destobj``. 
+    An exception will be raised if the data is malformed.  If ``single_point`` is true,
+    then only one (N-dimensional) point will be read, otherwise system.pcoord_len points
+    will be read.
+    """
+    
+    system = westpa.rc.get_system_driver()
+    
+    assert fieldname == 'pcoord'
+    
+    pcoord = numpy.loadtxt(pcoord_return_filename, dtype=system.pcoord_dtype)
+    destobj.pcoord = check_pcoord_shape(pcoord, single_point)
 
 def aux_data_loader(fieldname, data_filename, segment, single_point):
     data = numpy.loadtxt(data_filename)
@@ -65,6 +149,80 @@ def aux_data_loader(fieldname, data_filename, segment, single_point):
     if data.nbytes == 0:
         raise ValueError('could not read any data for {}'.format(fieldname))
     
+class ArrayFileLoader:
+    """Read a dataset from a binary return file. ``format`` is ``npy`` (a NumPy ``.npy`` file),
+    ``raw`` (raw data of type ``dtype`` in C order, as written by e.g. ``numpy.ndarray.tofile()``),
+    or ``hdf5`` (the dataset named ``h5dataset`` in an HDF5 file; by default, the dataset
+    named for the field being loaded). ``npy`` and ``raw`` files are memory-mapped rather than read,
+    unless ``mmap`` is false.
+    
+    If ``dtype`` is given, data is converted to that type. If ``shape`` is given, data must have 
+    that shape (raw data is reshaped to it). The progress coordinate is always checked against
+    (and raw data reshaped to) the shape expected by the system.
+    """
+    
+    formats = ('npy', 'raw', 'hdf5')
+    
+    def __init__(self, format, dtype=None, shape=None, mmap=True, h5dataset=None):
+        if format not in self.formats:
+            raise ValueError('invalid return file format {!r}; expected one of {!r}'.format(format, self.formats))
+        self.format = format
+        self.dtype = numpy.dtype(dtype) if dtype is not None else None
+        self.shape = tuple(shape) if shape is not None else None
+        self.mmap = mmap
+        self.h5dataset = h5dataset
+        
+    def __repr__(self):
+        return '<{} format={!r} dtype={!r} shape={!r}>'.format(self.__class__.__name__, self.format, self.dtype, 
+                                                               self.shape)
+        
+    def read(self, fieldname, filename, dtype, shape):
+        if self.format == 'npy':
+            data = numpy.load(filename, mmap_mode='r' if self.mmap else None, allow_pickle=False)
+        elif self.format == 'raw':
+            if dtype is None:
+                raise ValueError('a data type is required to read raw data for {}'.format(fieldname))
+            if os.stat(filename).st_size == 0:
+                data = numpy.empty((0,), dtype)
+            elif self.mmap:
+                data = numpy.memmap(filename, dtype=dtype, mode='r')
+            else:
+                data = numpy.fromfile(filename, dtype=dtype)
+            if shape is not None:
+                try:
+                    data = data.reshape(shape)
+                except ValueError:
+                    raise ValueError('{} data has incorrect size {:d} [expected shape {!r}]'.format(fieldname, data.size,
+                                                                                                   shape))
+        else: # self.format == 'hdf5'
+            with h5py.File(filename, 'r') as h5file:
+                data = h5file[self.h5dataset or fieldname][...]
+        
+        if isinstance(data, numpy.memmap):
+            # A plain array, still backed by the file, so that (for instance) pickling copies the data
+            data = data.view(numpy.ndarray)
+        if dtype is not None and data.dtype != dtype:
+            data = data.astype(dtype)
+        return data
+        
+    def __call__(self, fieldname, filename, destobj, single_point):
+        if fieldname == 'pcoord':
+            system = westpa.rc.get_system_driver()
+            if single_point:
+                shape = (system.pcoord_ndim,)
+            else:
+                shape = (system.pcoord_len, system.pcoord_ndim)
+            data = self.read(fieldname, filename, self.dtype or system.pcoord_dtype, shape)
+            # Progress coordinates are small; don't hold the file open
+            destobj.pcoord = check_pcoord_shape(numpy.array(data), single_point)
+        else:
+            data = self.read(fieldname, filename, self.dtype, self.shape)
+            if self.shape is not None and data.shape != self.shape:
+                raise ValueError('{} data has incorrect shape {!r} [expected {!r}]'.format(fieldname, data.shape,
+                                                                                          self.shape))
+            if data.nbytes == 0:
+                raise ValueError('could not read any data for {}'.format(fieldname))
+            destobj.data[fieldname] = data
     
 class ExecutablePropagator(WESTPropagator):
     ENV_CURRENT_ITER         = 'WEST_CURRENT_ITER'
@@ -93,6 +251,14 @@ class ExecutablePropagator(WESTPropagator):
     ENV_RAND64               = 'WEST_RAND64'
     ENV_RAND128              = 'WEST_RAND128'
     ENV_RANDFLOAT            = 'WEST_RANDFLOAT'
+    
+    # Set for propagator processes run concurrently by one worker
+    ENV_CHILD_SLOT           = 'WEST_CHILD_SLOT'
+    ENV_CUDA_DEVICES         = 'CUDA_VISIBLE_DEVICES'
+    
+    # Interval at which to check again for exited children, when the first child found to
+    # have exited was not started by this propagator (e.g. by another thread)
+    reap_poll_interval = 0.01
         
     def __init__(self, rc=None):
         super(ExecutablePropagator,self).__init__(rc)
@@ -110,6 +276,17 @@ class ExecutablePropagator(WESTPropagator):
         self.exe_info['get_pcoord'] = {}
         self.exe_info['gen_istate'] = {}
         
+        # A mapping of formatted paths to their expansions (see cached_makepath()), valid for
+        # one iteration
+        self._expanded_paths = {}
+        self._expanded_paths_iter = None
+        
+        # A persistent server for starting child processes, if one is used (see get_launcher())
+        self._launcher = None
+        
+        # Directories in which propagators return data, if not temporary files (see prepare_return_files())
+        self.return_dir_pool = None
+        
         # A mapping of data set name ('pcoord', 'coord', 'com', etc) to a dictionary of
         # attributes like 'loader', 'dtype', etc
         self.data_info = {}
@@ -160,6 +337,41 @@ class ExecutablePropagator(WESTPropagator):
             
         log.debug('exe_info: {!r}'.format(self.exe_info))
         
+        # Return data from propagators in reused files in this directory (ideally, a tmpfs), rather 
+        # than in temporary files
+        return_dir = config.get(['west','executable','return_dir'])
+        if return_dir:
+            self.return_dir_pool = ReturnDirectoryPool(self.makepath(return_dir))
+        
+        # Start child processes from a persistent server process, rather than directly
+        self.use_launcher = config.get(['west','executable','launcher'], False)
+        check_bool(self.use_launcher)
+        if self.use_launcher and not hasattr(os, 'posix_spawnp'):
+            log.warning('posix_spawn() is not available on this platform; not using a child launcher')
+            self.use_launcher = False
+        
+        # Load configuration items relating to running several propagator processes at once;
+        # each running process occupies a slot, which may be bound to a set of CPUs and/or GPUs
+        propagator_info = config.get(['west','executable','propagator']) or {}
+        cpu_affinity = propagator_info.get('cpu_affinity')
+        gpu_devices = propagator_info.get('gpu_devices')
+        self.max_children = int(propagator_info.get('concurrency', 
+                                                    max(len(cpu_affinity or []), len(gpu_devices or []), 1)))
+        if self.max_children < 1:
+            raise ValueError('propagator concurrency must be at least 1')
+        for (key, slots) in (('cpu_affinity', cpu_affinity), ('gpu_devices', gpu_devices)):
+            if slots is not None and len(slots) < self.max_children:
+                raise ValueError('{} must be given for each of {:d} concurrent propagator processes'
+                                 .format(key, self.max_children))
+        
+        if cpu_affinity and not hasattr(os, 'sched_setaffinity'):
+            log.warning('CPU affinity is not supported on this platform; ignoring cpu_affinity')
+            cpu_affinity = None
+        self.child_cpu_sets = [parse_cpu_set(spec) for spec in cpu_affinity] if cpu_affinity else None
+        self.child_gpu_devices = [str(devices) for devices in gpu_devices] if gpu_devices else None
+        log.debug('max_children: {:d}; child_cpu_sets: {!r}; child_gpu_devices: {!r}'
+                  .format(self.max_children, self.child_cpu_sets, self.child_gpu_devices))
+        
         # Load configuration items relating to dataset input
         self.data_info['pcoord'] = {'name': 'pcoord',
                                     'loader': pcoord_loader,
@@ -179,10 +391,17 @@ class ExecutablePropagator(WESTPropagator):
                 dsinfo['enabled'] = True
             
             loader_directive = dsinfo.get('loader')
+            return_format = dsinfo.get('format', 'text')
             if loader_directive:
                 loader = get_object(loader_directive)
+            elif return_format != 'text':
+                check_bool(dsinfo.setdefault('mmap', True))
+                loader = ArrayFileLoader(return_format, dtype=dsinfo.get('dtype'), shape=dsinfo.get('shape'),
+                                         mmap=dsinfo['mmap'], h5dataset=dsinfo.get('h5dataset'))
             elif dsname != 'pcoord':
                 loader = aux_data_loader
+            else:
+                loader = pcoord_loader
                 
             dsinfo['loader'] = loader
             self.data_info.setdefault(dsname,{}).update(dsinfo)
@@ -194,12 +413,26 @@ class ExecutablePropagator(WESTPropagator):
                   expanduser = True, expandvars = True, abspath = False, realpath = False):
         template_args = template_args or {}
         path = template.format(**template_args)
+        return ExecutablePropagator.expandpath(path, expanduser, expandvars, abspath, realpath)
+    
+    @staticmethod
+    def expandpath(path, expanduser = True, expandvars = True, abspath = False, realpath = False):
         if expandvars: path = os.path.expandvars(path)
         if expanduser: path = os.path.expanduser(path)
         if realpath:   path = os.path.realpath(path)
         if abspath:    path = os.path.abspath(path)
         path = os.path.normpath(path)
         return path
+    
+    def cached_makepath(self, template, template_args = None):
+        '''As ``makepath()`` with default options, but reusing the result of expanding and normalizing
+        each formatted path until the iteration changes (see ``update_args_env_iter()``).'''
+        path = template.format(**(template_args or {}))
+        try:
+            return self._expanded_paths[path]
+        except KeyError:
+            expanded = self._expanded_paths[path] = self.expandpath(path)
+            return expanded
 
     def random_val_env_vars(self):
         '''Return a set of environment variables containing random seeds. These are returned
@@ -212,55 +445,124 @@ class ExecutablePropagator(WESTPropagator):
                 self.ENV_RAND128:              str(random.randint(0,2**128)),
                 self.ENV_RANDFLOAT:            str(random.random())}
         
-    def exec_child(self, executable, environ=None, stdin=None, stdout=None, stderr=None, cwd=None):
-        '''Execute a child process with the environment set from the current environment, the
+    def spawn_child(self, executable, environ=None, stdin=None, stdout=None, stderr=None, cwd=None, cpu_set=None):
+        '''Start a child process with the environment set from the current environment, the
         values of self.addtl_child_environ, the random numbers returned by self.random_val_env_vars, and
         the given ``environ`` (applied in that order). stdin/stdout/stderr are optionally redirected.
+        If ``cpu_set`` is given, the child is bound to that set of CPUs.
         
-        This function waits on the child process to finish, then returns
-        (rc, rusage), where rc is the child's return code and rusage is the resource usage tuple from os.wait4()'''
+        This function does not wait on the child process; it returns the ``subprocess.Popen`` object
+        for the child (or, if a launcher is used, a ``LaunchedChild``), which must be waited on
+        with ``wait_child()`` or ``reap_child()`` by the caller.'''
         
         all_environ = dict(os.environ)
         all_environ.update(self.addtl_child_environ)
         all_environ.update(self.random_val_env_vars())
         all_environ.update(environ or {})
         
-        stdin  = open(stdin, 'rb') if stdin else sys.stdin        
-        stdout = open(stdout, 'wb') if stdout else sys.stdout
+        if self.use_launcher:
+            return self.get_launcher().spawn(executable, all_environ, stdin, stdout, stderr, cwd, cpu_set)
+        
+        opened = []
+        if stdin:
+            stdin = open(stdin, 'rb')
+            opened.append(stdin)
+        else:
+            stdin = sys.stdin
+        if stdout:
+            stdout = open(stdout, 'wb')
+            opened.append(stdout)
+        else:
+            stdout = sys.stdout
         if stderr == 'stdout':
             stderr = stdout
+        elif stderr:
+            stderr = open(stderr, 'wb')
+            opened.append(stderr)
         else:
-            stderr = open(stderr, 'wb') if stderr else sys.stderr
+            stderr = sys.stderr
+        
+        try:
+            # close_fds is critical for preventing out-of-file errors
+            proc = subprocess.Popen([executable],
+                                    cwd = cwd,
+                                    stdin=stdin, stdout=stdout, stderr=stderr if stderr != stdout else subprocess.STDOUT,
+                                    close_fds=True, env=all_environ)
+        finally:
+            # The child has its own copies of these descriptors
+            for fileobj in opened:
+                fileobj.close()
                 
-        # close_fds is critical for preventing out-of-file errors
-        proc = subprocess.Popen([executable],
-                                cwd = cwd,
-                                stdin=stdin, stdout=stdout, stderr=stderr if stderr != stdout else subprocess.STDOUT,
-                                close_fds=True, env=all_environ)
-
-        # Wait on child and get resource usage
-        (_pid, _status, rusage) = os.wait4(proc.pid, 0)
-        # Do a subprocess.Popen.wait() to let the Popen instance (and subprocess module) know that
-        # we are done with the process, and to get a more friendly return code
-        rc = proc.wait()
+        # The affinity is set from the parent, as running Python code (a preexec_fn) in the child
+        # between fork() and exec() is unsafe when other threads are running
+        if cpu_set:
+            try:
+                os.sched_setaffinity(proc.pid, cpu_set)
+            except ProcessLookupError:
+                # Already exited
+                pass
+        return proc
+        
+    def exec_child(self, executable, environ=None, stdin=None, stdout=None, stderr=None, cwd=None, cpu_set=None):
+        '''Execute a child process as for ``spawn_child()``.
+        
+        This function waits on the child process to finish, then returns
+        (rc, rusage), where rc is the child's return code and rusage is the resource usage tuple from os.wait4()'''
+        
+        proc = self.spawn_child(executable, environ, stdin, stdout, stderr, cwd, cpu_set)
+        return self.wait_child(proc)
+    
+    def wait_child(self, proc):
+        '''Wait on the given child process (as returned by ``spawn_child()``) to finish, then return
+        (rc, rusage), where rc is the child's return code and rusage is the resource usage tuple from 
+        os.wait4()'''
+        
+        if self.use_launcher:
+            (_pid, status, rusage) = self.get_launcher().wait_any({proc.pid})
+        else:
+            (_pid, status, rusage) = os.wait4(proc.pid, 0)
+        # Let the Popen instance (and subprocess module) know that we are done with the process;
+        # Popen.wait() cannot be used for this, as the child has already been reaped
+        rc = proc.returncode = child_exit_code(status)
         return (rc, rusage)
     
-    def exec_child_from_child_info(self, child_info, template_args, environ):
+    def setup_worker(self):
+        if self.use_launcher:
+            self.get_launcher()
+    
+    def teardown_worker(self):
+        if self._launcher is not None and self._launcher.owner_pid == os.getpid():
+            self._launcher.close()
+            self._launcher = None
+    
+    def get_launcher(self):
+        '''Return the launcher used to start child processes in this process, starting it if necessary.'''
+        if self._launcher is None or self._launcher.owner_pid != os.getpid():
+            self._launcher = ChildLauncher()
+            log.debug('started child launcher (pid {:d})'.format(self._launcher.server.pid))
+        return self._launcher
+    
+    def child_args_from_child_info(self, child_info, template_args, environ):
+        '''Return the keyword arguments to ``exec_child()`` or ``spawn_child()`` for the child described by
+        ``child_info``, with template expansion from ``template_args``.'''
         for (key, value) in child_info.get('environ', {}).items():
-            environ[key] = self.makepath(value)        
-        return self.exec_child(executable = self.makepath(child_info['executable'], template_args),
-                               environ = environ,
-                               cwd = self.makepath(child_info['cwd'], template_args) if child_info['cwd'] else None,
-                               stdin = self.makepath(child_info['stdin'], template_args) if child_info['stdin'] else os.devnull,
-                               stdout= self.makepath(child_info['stdout'], template_args) if child_info['stdout'] else None,
-                               stderr= self.makepath(child_info['stderr'], template_args) if child_info['stderr'] else None)        
+            environ[key] = self.cached_makepath(value)        
+        return dict(executable = self.cached_makepath(child_info['executable'], template_args),
+                    environ = environ,
+                    cwd = self.cached_makepath(child_info['cwd'], template_args) if child_info['cwd'] else None,
+                    stdin = self.cached_makepath(child_info['stdin'], template_args) if child_info['stdin'] else os.devnull,
+                    stdout= self.cached_makepath(child_info['stdout'], template_args) if child_info['stdout'] else None,
+                    stderr= self.cached_makepath(child_info['stderr'], template_args) if child_info['stderr'] else None)
+    
+    def exec_child_from_child_info(self, child_info, template_args, environ):
+        return self.exec_child(**self.child_args_from_child_info(child_info, template_args, environ))
         
     
     # Functions to create template arguments and environment values for child processes
     def update_args_env_basis_state(self, template_args, environ, basis_state):
         new_template_args = {'basis_state': basis_state}
         new_env = {self.ENV_BSTATE_ID: str(basis_state.state_id if basis_state.state_id is not None else -1),
-                   self.ENV_BSTATE_DATA_REF: self.makepath(self.basis_state_ref_template, new_template_args)}
+                   self.ENV_BSTATE_DATA_REF: self.cached_makepath(self.basis_state_ref_template, new_template_args)}
         template_args.update(new_template_args)
         environ.update(new_env)
         return template_args, environ
@@ -268,7 +570,7 @@ class ExecutablePropagator(WESTPropagator):
     def update_args_env_initial_state(self, template_args, environ, initial_state):
         new_template_args = {'initial_state': initial_state}
         new_env = {self.ENV_ISTATE_ID: str(initial_state.state_id if initial_state.state_id is not None else -1),
-                   self.ENV_ISTATE_DATA_REF: self.makepath(self.initial_state_ref_template, new_template_args)}
+                   self.ENV_ISTATE_DATA_REF: self.cached_makepath(self.initial_state_ref_template, new_template_args)}
         
         if initial_state.basis_state is not None:
             basis_state = initial_state.basis_state
@@ -282,6 +584,10 @@ class ExecutablePropagator(WESTPropagator):
         return template_args, environ
     
     def update_args_env_iter(self, template_args, environ, n_iter):
+        if n_iter != self._expanded_paths_iter:
+            # Environment variables and symbolic links may have changed since the last iteration
+            self._expanded_paths.clear()
+            self._expanded_paths_iter = n_iter
         environ[self.ENV_CURRENT_ITER] = str(n_iter if n_iter is not None else -1)
         template_args['n_iter'] = int(n_iter) 
         return template_args, n_iter
@@ -301,7 +607,7 @@ class ExecutablePropagator(WESTPropagator):
             parent_template_args['segment'] = parent
             
             environ[self.ENV_PARENT_SEG_ID] = str(segment.parent_id if segment.parent_id is not None else -1)
-            environ[self.ENV_PARENT_DATA_REF] = self.makepath(self.segment_ref_template, parent_template_args)
+            environ[self.ENV_PARENT_DATA_REF] = self.cached_makepath(self.segment_ref_template, parent_template_args)
         elif segment.initpoint_type == Segment.SEG_INITPOINT_NEWTRAJ:
             # This segment is initiated from a basis state; WEST_PARENT_SEG_ID and WEST_PARENT_DATA_REF are
             # set to the basis state ID and data ref
@@ -320,7 +626,7 @@ class ExecutablePropagator(WESTPropagator):
                 environ[self.ENV_PARENT_DATA_REF] = environ[self.ENV_ISTATE_DATA_REF]
             
         environ[self.ENV_CURRENT_SEG_ID] = str(segment.seg_id if segment.seg_id is not None else -1)
-        environ[self.ENV_CURRENT_SEG_DATA_REF] = self.makepath(self.segment_ref_template, template_args)
+        environ[self.ENV_CURRENT_SEG_DATA_REF] = self.cached_makepath(self.segment_ref_template, template_args)
         return template_args, environ
     
     def template_args_for_segment(self, segment):
@@ -337,6 +643,15 @@ class ExecutablePropagator(WESTPropagator):
         self.update_args_env_segment(template_args, environ, segment)        
         environ.update(addtl_env or {})
         return self.exec_child_from_child_info(child_info, template_args, environ)
+    
+    def spawn_for_segment(self, child_info, segment, addtl_env = None, cpu_set = None):
+        '''Start a child process with environment and template expansion from the given
+        segment, returning the ``subprocess.Popen`` object for the child.'''
+        template_args, environ = {}, {}
+        self.update_args_env_iter(template_args, environ, segment.n_iter)
+        self.update_args_env_segment(template_args, environ, segment)        
+        environ.update(addtl_env or {})
+        return self.spawn_child(cpu_set=cpu_set, **self.child_args_from_child_info(child_info, template_args, environ))
             
     def exec_for_iteration(self, child_info, n_iter, addtl_env = None):
         '''Execute a child process with environment and template expansion from the given
@@ -441,73 +756,208 @@ class ExecutablePropagator(WESTPropagator):
                     log.warning('post-iteration executable {!r} returned {}'.format(child_info['executable'], rc))
         
                 
+    def prepare_return_files(self, segment):
+        '''Choose the files in which the propagator returns each enabled dataset for ``segment``.
+        Returns (addtl_env, return_files, del_return_files, return_dir), where ``addtl_env`` contains the
+        ``WEST_*_RETURN`` environment variables for the child, the next two are dictionaries
+        mapping dataset name to file name and to whether that file is temporary, and ``return_dir``
+        is the directory from ``self.return_dir_pool`` containing return files (or None), to be 
+        released once data has been loaded.'''
+        addtl_env = {}
+        return_files = {}
+        del_return_files = {}
+        return_dir = None
+        
+        for dataset in self.data_info:
+            if not self.data_info[dataset].get('enabled',False):
+                continue
+ 
+            # numpy.save() appends .npy to file names lacking it
+            loader = self.data_info[dataset]['loader']
+            suffix = '.npy' if getattr(loader, 'format', None) == 'npy' else ''
+            return_template = self.data_info[dataset].get('filename')
+            if return_template:
+                return_files[dataset] = self.cached_makepath(return_template, self.template_args_for_segment(segment))
+                del_return_files[dataset] = False
+            elif self.return_dir_pool is not None:
+                if return_dir is None:
+                    return_dir = self.return_dir_pool.acquire()
+                rfname = os.path.join(return_dir, dataset + suffix)
+                # Replace any file left by a previous segment with an empty one, so that a propagator 
+                # failing to write data is detected. The old file is unlinked rather than truncated, as
+                # data loaded from it may still be memory-mapped.
+                try:
+                    os.unlink(rfname)
+                except FileNotFoundError:
+                    pass
+                open(rfname, 'wb').close()
+                return_files[dataset] = rfname
+                del_return_files[dataset] = False
+            else: 
+                (fd, rfname) = tempfile.mkstemp(suffix=suffix)
+                os.close(fd)
+                return_files[dataset] = rfname
+                del_return_files[dataset] = True
+
+            addtl_env['WEST_{}_RETURN'.format(dataset.upper())] = return_files[dataset]
+        return addtl_env, return_files, del_return_files, return_dir
+    
+    def collect_segment_results(self, segment, rc, rusage, starttime, return_files, del_return_files, return_dir=None):
+        '''Set the status of ``segment`` from the return code ``rc`` of its propagator process, and
+        (if successful) load its data from ``return_files`` and record timing information. The 
+        directory ``return_dir`` (if any) is released for reuse.'''
+        try:
+            self._collect_segment_results(segment, rc, rusage, starttime, return_files, del_return_files)
+        finally:
+            if return_dir is not None:
+                self.return_dir_pool.release(return_dir)
+    
+    def discard_return_files(self, return_files, del_return_files, return_dir=None):
+        '''Delete the temporary files among ``return_files`` and release ``return_dir`` (if any), 
+        for a segment whose results will not be collected.'''
+        try:
+            for (dataset, filename) in return_files.items():
+                if del_return_files[dataset]:
+                    try:
+                        os.unlink(filename)
+                    except OSError as e:
+                        log.warning('could not delete {} file {!r}: {!r}'.format(dataset, filename, e))
+        finally:
+            if return_dir is not None:
+                self.return_dir_pool.release(return_dir)
+    
+    def _collect_segment_results(self, segment, rc, rusage, starttime, return_files, del_return_files):
+        if rc == 0:
+            segment.status = Segment.SEG_STATUS_COMPLETE
+        elif rc < 0:
+            log.error('child process for segment %d exited on signal %d (%s)' % (segment.seg_id, -rc, SIGNAL_NAMES[-rc]))
+            segment.status = Segment.SEG_STATUS_FAILED
+            return
+        else:
+            log.error('child process for segment %d exited with code %d' % (segment.seg_id, rc))
+            segment.status = Segment.SEG_STATUS_FAILED
+            return
+        
+        # Extract data and store on segment for recording in the master thread/process/node
+        for dataset in self.data_info:
+            # pcoord is always enabled (see __init__)
+            if not self.data_info[dataset].get('enabled',False):
+                continue
+            
+            filename = return_files[dataset]
+            loader = self.data_info[dataset]['loader']
+            try:
+                loader(dataset, filename, segment, single_point=False)
+            except Exception as e:
+                log.error('could not read {} from {!r}: {!r}'.format(dataset, filename, e))
+                segment.status = Segment.SEG_STATUS_FAILED 
+                break
+            else:
+                if del_return_files[dataset]:
+                    try:
+                        os.unlink(filename)
+                    except Exception as e:
+                        log.warning('could not delete {} file {!r}: {!r}'.format(dataset, filename, e))
+                    else:
+                        log.debug('deleted {} file {!r}'.format(dataset, filename))    
+        if segment.status == Segment.SEG_STATUS_FAILED:
+            return
+                                    
+        # Record timing info
+        segment.walltime = time.time() - starttime
+        segment.cputime = rusage.ru_utime
+    
+    def slot_environ(self, slot):
+        '''Return the additional environment variables for a propagator process running in the 
+        given slot.'''
+        environ = {self.ENV_CHILD_SLOT: str(slot)}
+        if self.child_gpu_devices:
+            environ[self.ENV_CUDA_DEVICES] = self.child_gpu_devices[slot]
+        return environ
+    
+    def reap_child(self, pids):
+        '''Wait for any of the child processes with the given ``pids`` to exit, returning
+        (pid, status, rusage) as for ``os.wait4()``. Children not in ``pids`` (such as those 
+        started by other threads) are left for their owners to wait on.'''
+        if self.use_launcher:
+            return self.get_launcher().wait_any(pids)
+        elif len(pids) == 1:
+            (pid,) = pids
+            return os.wait4(pid, 0)
+        
+        while True:
+            for pid in pids:
+                (rpid, status, rusage) = os.wait4(pid, os.WNOHANG)
+                if rpid:
+                    return (rpid, status, rusage)
+            time.sleep(self.reap_poll_interval)
+    
     def propagate(self, segments):
+        if self.max_children > 1 or self.child_cpu_sets or self.child_gpu_devices:
+            return self.propagate_concurrently(segments)
+        
         child_info = self.exe_info['propagator']
         
         for segment in segments:
             starttime = time.time()
-
-            addtl_env = {}
-            
-            return_files = {}
-            del_return_files = {}
-            
-            for dataset in self.data_info:
-                if not self.data_info[dataset].get('enabled',False):
-                    continue
- 
-                return_template = self.data_info[dataset].get('filename')
-                if return_template:
-                    return_files[dataset] = self.makepath(return_template, self.template_args_for_segment(segment))
-                    del_return_files[dataset] = False
-                else: 
-                    (fd, rfname) = tempfile.mkstemp()
-                    os.close(fd)
-                    return_files[dataset] = rfname
-                    del_return_files[dataset] = True
-
-                addtl_env['WEST_{}_RETURN'.format(dataset.upper())] = return_files[dataset]
+            addtl_env, return_files, del_return_files, return_dir = self.prepare_return_files(segment)
                                         
             # Spawn propagator and wait for its completion
-            rc, rusage = self.exec_for_segment(child_info, segment, addtl_env) 
-            
-            if rc == 0:
-                segment.status = Segment.SEG_STATUS_COMPLETE
-            elif rc < 0:
-                log.error('child process for segment %d exited on signal %d (%s)' % (segment.seg_id, -rc, SIGNAL_NAMES[-rc]))
-                segment.status = Segment.SEG_STATUS_FAILED
-                continue
-            else:
-                log.error('child process for segment %d exited with code %d' % (segment.seg_id, rc))
-                segment.status = Segment.SEG_STATUS_FAILED
-                continue
-            
-            # Extract data and store on segment for recording in the master thread/process/node
-            for dataset in self.data_info:
-                # pcoord is always enabled (see __init__)
-                if not self.data_info[dataset].get('enabled',False):
-                    continue
-                
-                filename = return_files[dataset]
-                loader = self.data_info[dataset]['loader']
+            try:
+                rc, rusage = self.exec_for_segment(child_info, segment, addtl_env) 
+            except:
+                self.discard_return_files(return_files, del_return_files, return_dir)
+                raise
+            self.collect_segment_results(segment, rc, rusage, starttime, return_files, del_return_files, return_dir)
+        return segments
+    
+    def propagate_concurrently(self, segments):
+        '''Propagate ``segments``, running up to ``self.max_children`` propagator processes at once.
+        Each process is assigned a slot, which determines its CPU affinity and GPU devices (if 
+        configured).'''
+        child_info = self.exe_info['propagator']
+        
+        pending = collections.deque(segments)
+        free_slots = collections.deque(range(self.max_children))
+        
+        # Mapping of pid to (process, segment, slot, start time, return files, temporary return files,
+        # return directory)
+        running = {}
+        
+        def start_children():
+            while pending and free_slots:
+                segment = pending.popleft()
+                slot = free_slots.popleft()
+                starttime = time.time()
+                addtl_env, return_files, del_return_files, return_dir = self.prepare_return_files(segment)
+                addtl_env.update(self.slot_environ(slot))
+                cpu_set = self.child_cpu_sets[slot] if self.child_cpu_sets else None
                 try:
-                    loader(dataset, filename, segment, single_point=False)
-                except Exception as e:
-                    log.error('could not read {} from {!r}: {!r}'.format(dataset, filename, e))
-                    segment.status = Segment.SEG_STATUS_FAILED 
-                    break
-                else:
-                    if del_return_files[dataset]:
-                        try:
-                            os.unlink(filename)
-                        except Exception as e:
-                            log.warning('could not delete {} file {!r}: {!r}'.format(dataset, filename, e))
-                        else:
-                            log.debug('deleted {} file {!r}'.format(dataset, filename))    
-            if segment.status == Segment.SEG_STATUS_FAILED:
-                continue
-                                        
-            # Record timing info
-            segment.walltime = time.time() - starttime
-            segment.cputime = rusage.ru_utime
+                    proc = self.spawn_for_segment(child_info, segment, addtl_env, cpu_set)
+                except:
+                    self.discard_return_files(return_files, del_return_files, return_dir)
+                    raise
+                log.debug('started propagator process {:d} for segment {!r} in slot {:d}'.format(proc.pid, segment, slot))
+                running[proc.pid] = (proc, segment, slot, starttime, return_files, del_return_files, return_dir)
+        
+        try:
+            while pending or running:
+                start_children()
+                
+                (pid, status, rusage) = self.reap_child(running)
+                (proc, segment, slot, starttime, return_files, del_return_files, return_dir) = running.pop(pid)
+                rc = proc.returncode = child_exit_code(status)
+                free_slots.append(slot)
+                
+                # Keep all slots busy while this segment's data is loaded
+                start_children()
+                self.collect_segment_results(segment, rc, rusage, starttime, return_files, del_return_files,
+                                             return_dir)
+        finally:
+            # Only reached with children still running if an exception was raised
+            for (proc, segment, slot, starttime, return_files, del_return_files, return_dir) in running.values():
+                log.warning('terminating propagator process {:d} for segment {!r}'.format(proc.pid, segment))
+                proc.kill()
+                proc.wait()
+                self.discard_return_files(return_files, del_return_files, return_dir)
         return segments
@@ -0,0 +1,235 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''A persistent launcher for child processes. Starting a child from a large process (such as a
+worker holding simulation data) is more expensive than starting it from a small one, so the
+``ChildLauncher`` runs a small server process (this module, run as a script) which starts
+children with ``posix_spawn()`` on request, waits on them, and reports their exit status and
+resource usage. The server uses only the standard library, and is started with a fresh
+interpreter rather than forked, so that it holds no state of the process that started it.'''
+
+import os, sys, signal, select, subprocess, pickle, struct, threading, itertools
+
+_header = struct.Struct('!Q')
+
+def _read_exact(fd, nbytes):
+    chunks = []
+    while nbytes:
+        chunk = os.read(fd, nbytes)
+        if not chunk:
+            raise EOFError
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b''.join(chunks)
+
+def read_message(fd):
+    (length,) = _header.unpack(_read_exact(fd, _header.size))
+    return pickle.loads(_read_exact(fd, length))
+
+def write_message(fd, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    data = _header.pack(len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+class LaunchedChild:
+    '''A child process started by a ``ChildLauncher``, with the parts of the interface of
+    ``subprocess.Popen`` used by the executable propagator.'''
+
+    def __init__(self, launcher, pid):
+        self.launcher = launcher
+        self.pid = pid
+        self.returncode = None
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+    def wait(self):
+        if self.returncode is None:
+            (_pid, status, _rusage) = self.launcher.wait_any({self.pid})
+            self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return self.returncode
+
+class ChildLauncher:
+    '''Start child processes from a persistent server process. Children are started with
+    ``spawn()`` and waited on with ``wait_any()``, which returns (pid, status, rusage) as for
+    ``os.wait4()``. A launcher may be used by several threads at once, but only within the
+    process that created it.'''
+
+    def __init__(self):
+        self.owner_pid = os.getpid()
+
+        (request_read_fd, self.request_fd) = os.pipe()
+        (self.reply_fd, reply_write_fd) = os.pipe()
+        try:
+            self.server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                            str(request_read_fd), str(reply_write_fd)],
+                                           pass_fds=(request_read_fd, reply_write_fd), close_fds=True)
+        finally:
+            os.close(request_read_fd)
+            os.close(reply_write_fd)
+
+        self.tokens = itertools.count()
+
+        # Replies to spawn requests, by token, and exit status and resource usage, by pid
+        self.started = {}
+        self.exited = {}
+
+        # Only one thread reads replies at a time; others wait for it to notify them
+        self.cond = threading.Condition()
+        self.reading = False
+
+    def close(self):
+        '''Shut down the server, after any children still running have exited.'''
+        if self.request_fd is not None:
+            os.close(self.request_fd)
+            self.request_fd = None
+            self.server.wait()
+            os.close(self.reply_fd)
+
+    def _wait_for(self, predicate):
+        # Must be called with self.cond held
+        while not predicate():
+            if self.reading:
+                self.cond.wait()
+                continue
+
+            self.reading = True
+            self.cond.release()
+            try:
+                message = read_message(self.reply_fd)
+            except EOFError:
+                raise OSError('child launcher exited unexpectedly')
+            finally:
+                self.cond.acquire()
+                self.reading = False
+                self.cond.notify_all()
+
+            if message[0] == 'exited':
+                (_msgtype, pid, status, rusage) = message
+                self.exited[pid] = (status, rusage)
+            else:
+                (_msgtype, token, result) = message
+                self.started[token] = result
+
+    def spawn(self, executable, environ=None, stdin=None, stdout=None, stderr=None, cwd=None, cpu_set=None):
+        '''Start ``executable`` with the environment ``environ`` (by default, the current environment
+        of this process, which is sent with each request, so that changes made to it after the
+        launcher started are seen by children), in ``cwd`` if given, with standard input and output redirected to/from the named files if given
+        (``stderr`` may be ``'stdout'``), and bound to the CPUs in ``cpu_set`` if given. Returns
+        a ``LaunchedChild``.'''
+
+        # Files are opened by the child, after changing directory
+        paths = [os.path.abspath(path) if path and path != 'stdout' else path for path in (stdin, stdout, stderr)]
+        request = (executable, dict(os.environ if environ is None else environ), paths[0], paths[1], paths[2], cwd,
+                   sorted(cpu_set) if cpu_set else None)
+        with self.cond:
+            token = next(self.tokens)
+            write_message(self.request_fd, ('spawn', token, request))
+            self._wait_for(lambda: token in self.started)
+            result = self.started.pop(token)
+        if isinstance(result, int):
+            return LaunchedChild(self, result)
+        else:
+            # An error, as the arguments to OSError
+            raise OSError(*result)
+
+    def wait_any(self, pids):
+        '''Wait for any of the children with the given ``pids`` to exit, returning (pid, status, rusage).'''
+        with self.cond:
+            self._wait_for(lambda: any(pid in self.exited for pid in pids))
+            pid = next(pid for pid in pids if pid in self.exited)
+            (status, rusage) = self.exited.pop(pid)
+        return (pid, status, rusage)
+
+# Signals ignored by this process, which children should not inherit (as for subprocess)
+default_signals = [getattr(signal, name) for name in ('SIGINT', 'SIGPIPE', 'SIGXFSZ') if hasattr(signal, name)]
+
+def spawn_child(executable, environ, stdin, stdout, stderr, cwd, cpu_set):
+    file_actions = []
+    if stdin:
+        file_actions.append((os.POSIX_SPAWN_OPEN, 0, stdin, os.O_RDONLY, 0))
+    if stdout:
+        file_actions.append((os.POSIX_SPAWN_OPEN, 1, stdout, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o666))
+    if stderr == 'stdout':
+        file_actions.append((os.POSIX_SPAWN_DUP2, 1, 2))
+    elif stderr:
+        file_actions.append((os.POSIX_SPAWN_OPEN, 2, stderr, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o666))
+
+    # posix_spawn() cannot set the working directory or CPU affinity of the child, but as this
+    # process is single-threaded, it can set its own, to be inherited by the child
+    original_cwd = os.getcwd() if cwd else None
+    original_cpu_set = os.sched_getaffinity(0) if cpu_set else None
+    try:
+        if cwd:
+            os.chdir(cwd)
+        if cpu_set:
+            os.sched_setaffinity(0, cpu_set)
+        return os.posix_spawnp(executable, [executable], environ, file_actions=file_actions,
+                               setsigdef=default_signals)
+    finally:
+        if original_cwd:
+            os.chdir(original_cwd)
+        if original_cpu_set:
+            os.sched_setaffinity(0, original_cpu_set)
+
+def serve(request_fd, reply_fd):
+    '''Start children as requested on ``request_fd``, replying on ``reply_fd``, until the request
+    pipe is closed and all children have exited.'''
+    # Be woken from select() when a child exits
+    (wakeup_read_fd, wakeup_write_fd) = os.pipe()
+    os.set_blocking(wakeup_read_fd, False)
+    os.set_blocking(wakeup_write_fd, False)
+    signal.set_wakeup_fd(wakeup_write_fd)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    children = set()
+    accepting = True
+    while accepting or children:
+        (ready, _w, _x) = select.select([wakeup_read_fd] + ([request_fd] if accepting else []), [], [])
+
+        if wakeup_read_fd in ready:
+            try:
+                while os.read(wakeup_read_fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+        while children:
+            (pid, status, rusage) = os.wait4(-1, os.WNOHANG)
+            if not pid:
+                break
+            children.discard(pid)
+            write_message(reply_fd, ('exited', pid, status, rusage))
+
+        if request_fd in ready:
+            try:
+                (_msgtype, token, request) = read_message(request_fd)
+            except EOFError:
+                accepting = False
+                continue
+            try:
+                pid = spawn_child(*request)
+            except OSError as e:
+                write_message(reply_fd, ('started', token, (e.errno, e.strerror, e.filename)))
+            else:
+                children.add(pid)
+                write_message(reply_fd, ('started', token, pid))
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]), int(sys.argv[2]))
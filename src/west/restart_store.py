@@ -0,0 +1,166 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Storage of restart data (e.g. final coordinates and velocities) outside the WEST HDF5 file.
+Propagators save the restart data of each segment they run, and load the data saved by its parent
+when running each of its children, so this data need never pass through the master. The master
+keeps a count of the incomplete segments continuing from each parent, and removes restart data
+once no segment can need it (and the changes to the simulation which make it unneeded are safely
+stored, so that a restarted simulation cannot need it either).'''
+
+import os, shutil, tempfile, logging
+import numpy
+
+from west.segment import Segment
+
+log = logging.getLogger(__name__)
+
+class RestartStore:
+    '''Restart data for segments, stored as one ``.npz`` file per segment in a directory for each
+    iteration under ``directory``. The directory must be visible to the master and all workers; for
+    simulations running on a single node, this may be local storage (such as ``/dev/shm``).'''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        # Number of incomplete segments continuing from each (n_iter, seg_id), for the
+        # iteration preceding that being propagated
+        self.refcounts = {}
+        self.refcount_iter = None
+
+        # Segments whose references have been released, so that each is released only once
+        self.released_seg_ids = set()
+
+        # Restart data found to be unneeded but not yet removed, as (n_iter, seg_id), where a
+        # seg_id of None denotes all data of the iteration
+        self.unneeded = []
+
+    def iter_dir(self, n_iter):
+        return os.path.join(self.directory, 'iter_{:08d}'.format(n_iter))
+
+    def path(self, n_iter, seg_id):
+        return os.path.join(self.iter_dir(n_iter), '{:d}.npz'.format(seg_id))
+
+    def save(self, segment, **arrays):
+        '''Save the given arrays as the restart data of ``segment``.'''
+        iter_dir = self.iter_dir(segment.n_iter)
+        os.makedirs(iter_dir, exist_ok=True)
+
+        # Write to a temporary file first, so that a propagator that dies while writing does not
+        # leave incomplete data for the (rerun) segment's children
+        with tempfile.NamedTemporaryFile(dir=iter_dir, suffix='.tmp', delete=False) as restart_file:
+            try:
+                numpy.savez(restart_file, **arrays)
+            except:
+                os.unlink(restart_file.name)
+                raise
+        os.replace(restart_file.name, self.path(segment.n_iter, segment.seg_id))
+
+    def load(self, n_iter, seg_id):
+        '''Return the restart data of segment ``seg_id`` of iteration ``n_iter``, as a dictionary of arrays.'''
+        try:
+            with numpy.load(self.path(n_iter, seg_id)) as restart_data:
+                return {name: restart_data[name] for name in restart_data.files}
+        except FileNotFoundError:
+            raise KeyError('no restart data for segment {:d} of iteration {:d}'.format(seg_id, n_iter))
+
+    def load_parent(self, segment):
+        '''Return the restart data saved by the parent of ``segment``, as a dictionary of arrays.'''
+        if segment.initpoint_type != Segment.SEG_INITPOINT_CONTINUES:
+            raise ValueError('segment {!r} does not continue a trajectory'.format(segment))
+        return self.load(segment.n_iter-1, segment.parent_id)
+
+    def remove(self, n_iter, seg_id):
+        if seg_id is None:
+            log.debug('removing restart data of iteration {:d}'.format(n_iter))
+            shutil.rmtree(self.iter_dir(n_iter), ignore_errors=True)
+        else:
+            try:
+                os.unlink(self.path(n_iter, seg_id))
+            except FileNotFoundError:
+                pass
+
+    def pop_unneeded(self):
+        '''Return (and forget) the list of restart data found to be unneeded by ``retain()`` and
+        ``release()`` since this was last called, for removal by ``remove_unneeded()``.'''
+        unneeded = self.unneeded
+        self.unneeded = []
+        return unneeded
+
+    def remove_unneeded(self, unneeded):
+        '''Remove the restart data listed in ``unneeded`` (as returned by ``pop_unneeded()``). This
+        must not be done until the changes to the simulation which made it unneeded (the completion
+        of segments, or the creation of the next iteration) are stored; otherwise, a simulation
+        restarted after an interruption could need it again.'''
+        for (n_iter, seg_id) in unneeded:
+            self.remove(n_iter, seg_id)
+
+    def stored_seg_ids(self, n_iter):
+        '''Return the IDs of the segments of iteration ``n_iter`` for which restart data is stored.'''
+        try:
+            filenames = os.listdir(self.iter_dir(n_iter))
+        except FileNotFoundError:
+            return set()
+        return {int(filename[:-4]) for filename in filenames if filename.endswith('.npz')}
+
+    def retain(self, n_iter, segments):
+        '''Count the references to restart data of iteration ``n_iter-1`` made by ``segments``, the
+        incomplete segments of iteration ``n_iter``, and mark all restart data that is no
+        longer needed (that of segments which were merged or recycled, or whose children have all
+        completed, and that of earlier iterations) for removal. Called by the master when the segments
+        of ``n_iter`` are created, and again before they are propagated.'''
+        refcounts = {}
+        for segment in segments:
+            if segment.initpoint_type == Segment.SEG_INITPOINT_CONTINUES:
+                key = (n_iter-1, segment.parent_id)
+                refcounts[key] = refcounts.get(key, 0) + 1
+        self.refcounts = refcounts
+        self.refcount_iter = n_iter
+        self.released_seg_ids = set()
+
+        for seg_id in self.stored_seg_ids(n_iter-1):
+            if (n_iter-1, seg_id) not in refcounts:
+                self.unneeded.append((n_iter-1, seg_id))
+
+        # Left over from interrupted runs, or from before restart data was collected
+        try:
+            iter_names = os.listdir(self.directory)
+        except FileNotFoundError:
+            iter_names = []
+        for iter_name in iter_names:
+            if iter_name.startswith('iter_') and int(iter_name[5:]) < n_iter-1:
+                self.unneeded.append((int(iter_name[5:]), None))
+
+    def release(self, segments):
+        '''Drop the references to parents' restart data made by those of ``segments`` which have
+        completed, marking data no longer referenced for removal. Called by the master as segments
+        complete.'''
+        for segment in segments:
+            if (segment.status != Segment.SEG_STATUS_COMPLETE
+                or segment.initpoint_type != Segment.SEG_INITPOINT_CONTINUES
+                or segment.n_iter != self.refcount_iter
+                or segment.seg_id in self.released_seg_ids):
+                continue
+            self.released_seg_ids.add(segment.seg_id)
+            key = (segment.n_iter-1, segment.parent_id)
+            try:
+                self.refcounts[key] -= 1
+            except KeyError:
+                continue
+            if self.refcounts[key] <= 0:
+                del self.refcounts[key]
+                self.unneeded.append(key)
@@ -119,3 +119,78 @@ Segment.initpoint_type_names.update({getattr(Segment, _attr): _attr for _attr in
 Segment.endpoint_type_names.update({getattr(Segment, _attr): _attr for _attr in dir(Segment) 
                                     if _attr.startswith('SEG_ENDPOINT_')})
 
+
+
+class SegmentArrays:
+    '''A columnar view of (some of) the segments of one iteration, as returned by
+    ``WESTDataManager.get_segments_as_arrays()``. Row ``i`` of each array describes the segment
+    with ID ``seg_ids[i]``:
+    
+      ``seg_index``
+        the corresponding rows of the iteration's seg_index table
+      ``pcoord``
+        progress coordinates, indexed as [segment, time point, dimension] (or None if not loaded)
+      ``parent_ids``
+        history parent IDs
+      ``wtg_offsets``, ``wtg_parent_ids``
+        the weight transfer graph, in compressed sparse row form; the weight transfer
+        parents of segment ``i`` are ``wtg_parent_ids[wtg_offsets[i]:wtg_offsets[i+1]]``
+        (or None if not loaded)
+      ``data``
+        a dictionary mapping the name of each auxiliary dataset loaded to an array of its data
+    
+    Indexing or iterating yields ``Segment`` objects, which are only created (once) on demand.
+    '''
+    
+    def __init__(self, n_iter, seg_ids, seg_index, pcoord=None, parent_ids=None, 
+                 wtg_offsets=None, wtg_parent_ids=None, data=None):
+        self.n_iter = int(n_iter)
+        self.seg_ids = numpy.asarray(seg_ids)
+        self.seg_index = seg_index
+        self.pcoord = pcoord
+        self.parent_ids = parent_ids
+        self.wtg_offsets = wtg_offsets
+        self.wtg_parent_ids = wtg_parent_ids
+        self.data = data if data else {}
+        self._segments = [None]*len(self.seg_ids)
+        
+    def __len__(self):
+        return len(self.seg_ids)
+    
+    def __repr__(self):
+        return '<{}({}) n_iter={!r} n_segments={!r}>'.format(self.__class__.__name__, hex(id(self)), 
+                                                             self.n_iter, len(self))
+    
+    weights = property(lambda s: s.seg_index['weight'])
+    statuses = property(lambda s: s.seg_index['status'])
+    endpoint_types = property(lambda s: s.seg_index['endpoint_type'])
+        
+    def wtg_parents(self, i):
+        '''Return the weight transfer parent IDs of the ``i``-th segment, as an array.'''
+        return self.wtg_parent_ids[self.wtg_offsets[i]:self.wtg_offsets[i+1]]
+    
+    def __getitem__(self, i):
+        segment = self._segments[i]
+        if segment is None:
+            segment = self._segments[i] = self._make_segment(i)
+        return segment
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def _make_segment(self, i):
+        row = self.seg_index[i]
+        segment = Segment(seg_id = self.seg_ids[i],
+                          n_iter = self.n_iter,
+                          status = row['status'],
+                          endpoint_type = row['endpoint_type'],
+                          walltime = float(row['walltime']),
+                          cputime = float(row['cputime']),
+                          weight = row['weight'],
+                          parent_id = self.parent_ids[i],
+                          wtg_parent_ids = self.wtg_parents(i).tolist() if self.wtg_offsets is not None else None,
+                          data = {dsname: values[i] for (dsname, values) in self.data.items()})
+        if self.pcoord is not None:
+            segment.pcoord = self.pcoord[i]
+        return segment
@@ -16,12 +16,18 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import time, operator, math, numpy, random
+import time, operator, math, numpy, random, sys, copy, os, contextlib, heapq, itertools
 from itertools import zip_longest
+from collections import deque
 from datetime import timedelta
 import logging
 log = logging.getLogger(__name__)
 
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
 import westpa
 import west
 from west.states import InitialState
@@ -29,7 +35,7 @@ from westpa import extloader
 from west import Segment
 
 from west import wm_ops
-from west.data_manager import weight_dtype
+from west.data_manager import weight_dtype, BackgroundWriter
 
 from pickle import PickleError
 
@@ -41,22 +47,243 @@ def grouper(n, iterable, fillvalue=None):
     args = [iter(iterable)] * n
     return zip_longest(fillvalue=fillvalue, *args)
 
+def guided_blocks(segments, costs, n_workers=None, max_block_size=1):
+    '''Split ``segments`` into blocks for propagation, given the expected cost of each. Segments are
+    ordered longest-expected-first, so that the longest segments do not start last, and blocks are
+    sized by guided self-scheduling: each block takes up to ``1/n_workers`` of the expected cost
+    remaining, but no more than ``max_block_size`` segments, so that blocks shrink towards the end of
+    the iteration. If ``n_workers`` is None (or zero), blocks are of ``max_block_size`` segments.'''
+    order = sorted(range(len(segments)), key=lambda i: costs[i], reverse=True)
+    remaining_cost = float(sum(costs))
+    
+    blocks = []
+    block = []
+    block_cost = 0.0
+    target_cost = remaining_cost / n_workers if n_workers else float('inf')
+    for i in order:
+        if block and (len(block) >= max_block_size or block_cost + costs[i] > target_cost):
+            blocks.append(block)
+            remaining_cost -= block_cost
+            target_cost = remaining_cost / n_workers if n_workers else float('inf')
+            block = []
+            block_cost = 0.0
+        block.append(segments[i])
+        block_cost += costs[i]
+    if block:
+        blocks.append(block)
+    return blocks
+
 class PropagationError(RuntimeError):
     pass 
 
+class IterationWriter(BackgroundWriter):
+    '''The background writer used by the pipelined mode of ``WESimManager``, so that committing
+    one iteration to HDF5 overlaps with propagation of the next.'''
+    
+    def __init__(self, name='westpa-iteration-writer'):
+        super(IterationWriter,self).__init__(name=name)
+
+class StragglerMonitor:
+    '''Tracks the tasks propagating blocks of segments, to find blocks which are taking too long
+    (stragglers) and should be resubmitted. A block is a straggler if it has been running for
+    longer than ``segment_timeout`` seconds per segment, or if it is among the last ``tail_fraction``
+    of the blocks of the iteration and has been running for longer than ``tail_factor`` times the
+    median time taken by completed blocks. The master does not know when a worker starts a task, so
+    this is estimated assuming that tasks are started in the order submitted, as workers
+    (``n_workers`` of them, or an unlimited number if None or zero, as for a work manager to which no
+    workers have yet connected) become free.'''
+    
+    def __init__(self, n_blocks, n_workers=None, segment_timeout=None, tail_factor=None, tail_fraction=0.05,
+                 max_resubmits=1):
+        self.n_workers = n_workers or None
+        self.segment_timeout = segment_timeout
+        self.tail_factor = tail_factor
+        self.n_tail_blocks = max(1, int(tail_fraction*n_blocks))
+        self.max_resubmits = max_resubmits
+        
+        self.block_of = {}          # block key of each task, by future
+        self.block_tasks = {}       # futures of the tasks running each outstanding block, by block key
+        self.block_sizes = {}       # number of segments in each outstanding block
+        self.first_task = {}        # future of the task first submitted for each outstanding block
+        self.latest_task = {}       # future of the task most recently submitted for each outstanding block
+        self.resubmits = {}         # number of times each outstanding block has been resubmitted
+        self.block_times = []       # time taken by each completed block
+        
+        self.n_running = 0          # number of tasks estimated to be running
+        self.started = {}           # estimated start time of each running task, by future
+        self.start_seq = {}         # sequence number of the deadline of each running task, by future
+        self.unstarted = deque()    # tasks estimated to be waiting for a worker, in the order submitted
+        
+        # Timeout deadlines of running tasks, as (deadline, block key, sequence number, future)
+        self.deadlines = []
+        self.sequence = itertools.count()
+        
+    @property
+    def enabled(self):
+        return bool(self.segment_timeout or self.tail_factor) and self.max_resubmits > 0
+        
+    @property
+    def n_outstanding(self):
+        return len(self.block_tasks)
+    
+    def submitted(self, future, block_key, n_segments, now):
+        '''Note that ``future`` represents a task propagating the block ``block_key``.'''
+        self.block_of[future] = block_key
+        self.block_tasks.setdefault(block_key, set()).add(future)
+        self.block_sizes[block_key] = n_segments
+        self.first_task.setdefault(block_key, future)
+        self.latest_task[block_key] = future
+        if self.n_workers is None or self.n_running < self.n_workers:
+            self._start(future, now)
+        else:
+            self.unstarted.append(future)
+            
+    def resubmitted(self, future, block_key, now):
+        '''Note that ``future`` represents a speculative copy of the task propagating ``block_key``.'''
+        self.resubmits[block_key] = self.resubmits.get(block_key, 0) + 1
+        self.submitted(future, block_key, self.block_sizes[block_key], now)
+        
+    def set_n_workers(self, n_workers, now):
+        '''Update the number of workers (as when workers connect to the master after tasks were submitted),
+        re-estimating which tasks are running. If the number was unknown, no task is assumed to have
+        started before ``now``; otherwise, those started earliest are assumed to be still running.'''
+        n_workers = n_workers or None
+        if n_workers == self.n_workers:
+            return
+        was_known = self.n_workers is not None
+        self.n_workers = n_workers
+        
+        running = sorted(self.started, key=self.started.get)
+        if was_known and n_workers is not None:
+            running = running[n_workers:]
+        elif n_workers is None:
+            running = []
+        for future in running:
+            del self.started[future], self.start_seq[future]
+            self.n_running -= 1
+        self.unstarted.extendleft(reversed(running))
+        self._start_waiting(now)
+        
+    def _start(self, future, now):
+        self.n_running += 1
+        self.started[future] = now
+        self.start_seq[future] = seq = next(self.sequence)
+        if self.segment_timeout:
+            block_key = self.block_of[future]
+            heapq.heappush(self.deadlines, (now + self.segment_timeout*self.block_sizes[block_key], block_key,
+                                            seq, future))
+            
+    def _start_waiting(self, now):
+        '''Start the tasks waiting on the workers free.'''
+        while self.unstarted and (self.n_workers is None or self.n_running < self.n_workers):
+            self._start(self.unstarted.popleft(), now)
+        
+    def finished(self, future, now):
+        '''Note that the task of ``future`` has finished, or has been cancelled or abandoned, and return
+        the key of its block.'''
+        block_key = self.block_of.pop(future)
+        if block_key in self.block_tasks:
+            self.block_tasks[block_key].discard(future)
+        try:
+            del self.started[future], self.start_seq[future]
+        except KeyError:
+            self.unstarted.remove(future)
+        else:
+            self.n_running -= 1
+            # The next task waiting starts on the worker freed
+            self._start_waiting(now)
+        return block_key
+    
+    def completed(self, future, now):
+        '''Note that the task of ``future`` has completed its block, returning the futures of any other
+        tasks running the same block (which should be cancelled, and passed to ``finished()``).'''
+        started = self.started.get(future)
+        block_key = self.finished(future, now)
+        if started is not None:
+            self.block_times.append(now - started)
+        others = self.block_tasks.pop(block_key)
+        del self.block_sizes[block_key], self.first_task[block_key], self.latest_task[block_key]
+        self.resubmits.pop(block_key, None)
+        return others
+    
+    def _valid(self, block_key, future):
+        return (future in self.started and self.latest_task.get(block_key) is future
+                and self.resubmits.get(block_key, 0) < self.max_resubmits)
+    
+    def _valid_deadline(self, deadline_entry):
+        (_deadline, block_key, seq, future) = deadline_entry
+        return self._valid(block_key, future) and self.start_seq[future] == seq
+    
+    def _tail_deadlines(self):
+        '''Return the deadlines of the blocks of the tail of the iteration, if speculative copies of them
+        can be run on idle workers.'''
+        if not (self.tail_factor and self.block_times and self.n_outstanding <= self.n_tail_blocks):
+            return []
+        if self.n_workers is not None and self.n_running >= self.n_workers:
+            return []
+        limit = self.tail_factor * numpy.median(self.block_times)
+        return [(self.started[future] + limit, block_key) for (block_key, future) in self.latest_task.items()
+                if self._valid(block_key, future)]
+    
+    def next_deadline(self):
+        '''Return the time at which the next block will become a straggler, or None if none will.'''
+        if not self.enabled:
+            return None
+        while self.deadlines and not self._valid_deadline(self.deadlines[0]):
+            heapq.heappop(self.deadlines)
+        deadlines = [deadline for (deadline, _block_key) in self._tail_deadlines()]
+        if self.deadlines:
+            deadlines.append(self.deadlines[0][0])
+        return min(deadlines) if deadlines else None
+    
+    def stragglers(self, now):
+        '''Return the keys of the blocks which are stragglers at time ``now``.'''
+        if not self.enabled:
+            return set()
+        stragglers = {block_key for (deadline, block_key) in self._tail_deadlines() if deadline <= now}
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline_entry = heapq.heappop(self.deadlines)
+            if self._valid_deadline(deadline_entry):
+                stragglers.add(deadline_entry[1])
+        return stragglers
+    
+    
 class WESimManager:
     def process_config(self):
         config = self.rc.config
         for (entry, type_) in [('gen_istates', bool),
                                ('block_size', int),
-                               ('save_transition_matrices', bool)]:
+                               ('save_transition_matrices', bool),
+                               ('pipeline_iterations', bool),
+                               ('save_timing', bool),
+                               ('profile_iterations', list),
+                               ('max_resubmits', int)]:
             config.require_type_if_present(['west', 'propagation', entry], type_)
+        for entry in ['segment_timeout', 'straggler_factor', 'straggler_tail']:
+            config.coerce_type_if_present(['west', 'propagation', entry], float)
             
         self.do_gen_istates = config.get(['west', 'propagation', 'gen_istates'], False) 
         self.propagator_block_size = config.get(['west', 'propagation', 'block_size'], 1)
         self.save_transition_matrices = config.get(['west', 'propagation', 'save_transition_matrices'], False)
         self.max_run_walltime = config.get(['west', 'propagation', 'max_run_wallclock'], default=None)
         self.max_total_iterations = config.get(['west', 'propagation', 'max_total_iterations'], default=None)
+        self.pipeline_iterations = config.get(['west', 'propagation', 'pipeline_iterations'], False)
+        self.save_timing = config.get(['west', 'propagation', 'save_timing'], False)
+        self.profile_iterations = set(int(n_iter) for n_iter in 
+                                      config.get(['west', 'propagation', 'profile_iterations'], None) or [])
+        self.profiler = config.get_choice(['west', 'propagation', 'profiler'], ['cprofile', 'pyinstrument'],
+                                          default='cprofile', value_transform=(lambda x: x.lower()))
+        if self.profiler == 'pyinstrument' and pyinstrument is None:
+            raise ValueError('pyinstrument profiling requested, but pyinstrument is not available')
+        self.profile_dir = config.get_path(['west', 'propagation', 'profile_dir'], 'profiles')
+        self.block_scheduling = config.get_choice(['west', 'propagation', 'block_scheduling'], ['fixed', 'guided'],
+                                                  default='fixed', value_transform=(lambda x: x.lower()))
+        
+        # Speculative resubmission of straggling blocks of segments
+        self.segment_timeout = config.get(['west', 'propagation', 'segment_timeout'], None)
+        self.straggler_factor = config.get(['west', 'propagation', 'straggler_factor'], None)
+        self.straggler_tail = config.get(['west', 'propagation', 'straggler_tail'], 0.05)
+        self.max_resubmits = config.get(['west', 'propagation', 'max_resubmits'], 1)
             
     
     def __init__(self, rc=None):        
@@ -65,6 +292,7 @@ class WESimManager:
         self.data_manager = self.rc.get_data_manager()
         self.we_driver = self.rc.get_we_driver()
         self.system = self.rc.get_system_driver()
+        self.restart_store = self.rc.get_restart_store()
                                 
         # A table of function -> list of (priority, name, callback) tuples
         self._callback_table = {}
@@ -81,6 +309,16 @@ class WESimManager:
         self.save_transition_matrices = False
         self.max_run_walltime = None
         self.max_total_iterations = None
+        self.pipeline_iterations = False
+        self.save_timing = False
+        self.profile_iterations = set()
+        self.profiler = 'cprofile'
+        self.profile_dir = None
+        self.block_scheduling = 'fixed'
+        self.segment_timeout = None
+        self.straggler_factor = None
+        self.straggler_tail = 0.05
+        self.max_resubmits = 1
         self.process_config()
                 
         # Per-iteration variables
@@ -103,10 +341,22 @@ class WESimManager:
         self.segments = None                # Mapping of seg_id to segment for all segments in this iteration
         self.completed_segments = None      # Mapping of seg_id to segment for all completed segments in this iteration
         self.incomplete_segments = None     # Mapping of seg_id to segment for all incomplete segments in this iteration
+        self.parent_walltimes = None        # Mapping of seg_id to walltime for the segments of the previous iteration
         
         # Tracking of binning
         self.bin_mapper_hash = None         # Hash of bin mapper from most recently-run WE, for use by post-WE analysis plugins
         
+        # Timing of phases of the current iteration, as name -> [walltime, count]
+        self.iter_timings = {}
+        
+        # Number of occurrences of notable events in the current iteration, as name -> count
+        self.iter_events = {}
+        
+        # Pipelined operation
+        self._writer = None                 # IterationWriter committing data in the background, if pipelining
+        self._carryover = None              # In-memory state handed from one pipelined iteration to the next
+        self._states_generation = None      # Data manager states generation when this iteration loaded its states
+        
         
     def register_callback(self, hook, function, priority=0):
         '''Registers a callback to execute during the given ``hook`` into the simulation loop. The optional
@@ -127,11 +377,111 @@ class WESimManager:
                 
     def invoke_callbacks(self, hook, *args, **kwargs):
         callbacks = self._callback_table.get(hook, [])
+        if callbacks:
+            # Plugins may read from the HDF5 file, so let pending writes land first
+            self._sync_writes()
         sorted_callbacks = sorted(callbacks)
         for (priority, name, fn) in sorted_callbacks:
             log.debug('invoking callback {!r} for hook {!r}'.format(fn,hook))
-            fn(*args, **kwargs)
+            qualname = '{}.{}'.format(getattr(fn, '__module__', None), getattr(fn, '__qualname__', name))
+            with self.timed('callback:{}:{}'.format(hook.__name__, qualname)):
+                fn(*args, **kwargs)
+                
+    def record_time(self, name, walltime, count=1):
+        '''Add ``walltime`` seconds to the timing entry ``name`` for the current iteration.'''
+        try:
+            entry = self.iter_timings[name]
+        except KeyError:
+            self.iter_timings[name] = [walltime, count]
+        else:
+            entry[0] += walltime
+            entry[1] += count
+            
+    def record_event(self, name, count=1):
+        '''Count ``count`` occurrences of the event ``name`` in the current iteration.'''
+        self.iter_events[name] = self.iter_events.get(name, 0) + count
+            
+    @contextlib.contextmanager
+    def timed(self, name):
+        '''Context manager recording the wallclock time spent in its body under the timing 
+        entry ``name`` for the current iteration.'''
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.record_time(name, time.time() - t0)
+            
+    def save_iter_timing(self):
+        '''Store this iteration's timing information, including time spent in data manager
+        operations, and any event counts, and reset them for the next iteration.'''
+        timings = [(name, walltime, count) for (name, (walltime, count)) in self.iter_timings.items()]
+        events = sorted(self.iter_events.items())
+        self.iter_timings = {}
+        self.iter_events = {}
+        self._commit(self._save_iter_timing, self.n_iter, timings, events)
+        
+    def _save_iter_timing(self, n_iter, timings, events):
+        # Called once the data manager operations of iteration ``n_iter`` have been made, so that the
+        # time spent in them is attributed to that iteration
+        call_times = self.data_manager.pop_call_times()
+        if self.save_timing:
+            timings.extend(('data_manager:{}'.format(name), walltime, count) 
+                           for (name, (walltime, count)) in sorted(call_times.items()))
+            self.data_manager.save_iter_timing(n_iter, timings)
+        if events:
+            self.data_manager.save_iter_events(n_iter, events)
+    
+    def start_profiling(self):
+        '''Start profiling the current iteration, returning the profiler object.'''
+        if self.profiler == 'pyinstrument':
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+    
+    def stop_profiling(self, profiler):
+        '''Stop the given profiler, and write its results to ``profile_dir``.'''
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if self.profiler == 'pyinstrument':
+            profiler.stop()
+            filename = os.path.join(self.profile_dir, 'iter_{:08d}.html'.format(self.n_iter))
+            with open(filename, 'wt') as output_file:
+                output_file.write(profiler.output_html())
+        else:
+            profiler.disable()
+            filename = os.path.join(self.profile_dir, 'iter_{:08d}.prof'.format(self.n_iter))
+            profiler.dump_stats(filename)
+        self.rc.pstatus('Profile for iteration {:d} written to {}'.format(self.n_iter, filename))
     
+    def _commit(self, fn, *args, **kwargs):
+        '''Call the data manager operation ``fn(*args, **kwargs)``, either immediately or,
+        in pipelined mode, by queueing it for the background writer. Otherwise, the data
+        manager may itself defer the operation, if in write-behind mode.'''
+        if self._writer is not None:
+            self._writer.submit(fn, *args, **kwargs)
+        else:
+            self.data_manager.submit_write(fn, *args, **kwargs)
+            
+    def _sync_writes(self):
+        '''Wait for any data queued for the background writer to be committed.'''
+        if self._writer is not None:
+            self._writer.barrier()
+        self.data_manager.sync_writes()
+            
+    def _shutdown_writer(self):
+        writer = self._writer
+        self._writer = None
+        self._carryover = None
+        writer.shutdown()
+        self.data_manager.flush_backing()
+        
+        # Do not mask an exception already in flight
+        if sys.exc_info()[0] is None:
+            writer.check()
+        
     def load_plugins(self):
         try:
             plugins_config = westpa.rc.config['west', 'plugins']
@@ -177,16 +527,20 @@ class WESimManager:
         self.rc.pflush()
         
         if save_summary:
-            iter_summary = self.data_manager.get_iter_summary()
-            iter_summary['n_particles'] = len(segments)
-            iter_summary['norm'] = norm
-            iter_summary['min_bin_prob'] = min_bin_prob
-            iter_summary['max_bin_prob'] = max_bin_prob
-            iter_summary['min_seg_prob'] = min_seg_prob
-            iter_summary['max_seg_prob'] = max_seg_prob
-            if numpy.isnan(iter_summary['cputime']): iter_summary['cputime'] = 0.0
-            if numpy.isnan(iter_summary['walltime']): iter_summary['walltime'] = 0.0
-            self.data_manager.update_iter_summary(iter_summary)
+            self._commit(self._save_bin_statistics, self.n_iter, len(segments), norm, 
+                         min_bin_prob, max_bin_prob, min_seg_prob, max_seg_prob)
+            
+    def _save_bin_statistics(self, n_iter, n_particles, norm, min_bin_prob, max_bin_prob, min_seg_prob, max_seg_prob):
+        iter_summary = self.data_manager.get_iter_summary(n_iter)
+        iter_summary['n_particles'] = n_particles
+        iter_summary['norm'] = norm
+        iter_summary['min_bin_prob'] = min_bin_prob
+        iter_summary['max_bin_prob'] = max_bin_prob
+        iter_summary['min_seg_prob'] = min_seg_prob
+        iter_summary['max_seg_prob'] = max_seg_prob
+        if numpy.isnan(iter_summary['cputime']): iter_summary['cputime'] = 0.0
+        if numpy.isnan(iter_summary['walltime']): iter_summary['walltime'] = 0.0
+        self.data_manager.update_iter_summary(iter_summary, n_iter)
 
     def get_bstate_pcoords(self, basis_states):
         '''For each of the given ``basis_states``, calculate progress coordinate values
@@ -335,21 +689,41 @@ class WESimManager:
     def prepare_iteration(self):
         log.debug('beginning iteration {:d}'.format(self.n_iter))
                 
+        # In pipelined mode, the state required here was left in memory by the previous iteration,
+        # since the HDF5 file may not have caught up yet
+        carryover = self._carryover
+        self._carryover = None
+        if carryover is not None and carryover['states_generation'] != self.data_manager.states_generation:
+            # Target or basis states were stored (e.g. by a plugin) since they were loaded; use the file instead
+            log.debug('target or basis states changed; discarding in-memory state')
+            carryover = None
+            self._sync_writes()
+        self._states_generation = self.data_manager.states_generation
+        
         # the WE driver needs a list of all target states for this iteration
         # along with information about any new weights introduced (e.g. by recycling)
-        target_states = self.data_manager.get_target_states(self.n_iter)
-        new_weights = self.data_manager.get_new_weight_data(self.n_iter)
+        if carryover is not None:
+            target_states = carryover['target_states']
+            new_weights = carryover['new_weights']
+        else:
+            target_states = self.data_manager.get_target_states(self.n_iter)
+            new_weights = self.data_manager.get_new_weight_data(self.n_iter)
         
         self.we_driver.new_iteration(target_states=target_states, new_weights= new_weights)
                 
         # Get basis states used in this iteration
-        self.current_iter_bstates = self.data_manager.get_basis_states(self.n_iter)
+        if carryover is not None:
+            self.current_iter_bstates = carryover['basis_states']
+        else:
+            self.current_iter_bstates = self.data_manager.get_basis_states(self.n_iter)
         
         # Get the segments for this iteration and separate into complete and incomplete
         if self.segments is None:
-            segments = self.segments = {segment.seg_id: segment for segment in self.data_manager.get_segments()}
+            segment_arrays = self.data_manager.get_segments_as_arrays()
+            segments = self.segments = {segment.seg_id: segment for segment in segment_arrays}
             log.debug('loaded {:d} segments'.format(len(segments)))
         else:
+            segment_arrays = None
             segments = self.segments
             log.debug('using {:d} pre-existing segments'.format(len(segments)))
         
@@ -362,6 +736,10 @@ class WESimManager:
                 incomplete_segments[segment.seg_id] = segment
         log.debug('{:d} segments are complete; {:d} are incomplete'.format(len(completed_segments), len(incomplete_segments)))
         
+        # Restart data saved by the previous iteration is kept until no incomplete segment continues from it
+        if self.restart_store is not None:
+            self.restart_store.retain(self.n_iter, list(incomplete_segments.values()))
+        
         if len(incomplete_segments) == len(segments):
             # Starting a new iteration
             self.rc.pstatus('Beginning iteration {:d}'.format(self.n_iter))
@@ -371,31 +749,42 @@ class WESimManager:
                                                                                      len(segments)))
         
         # Get the initial states active for this iteration (so that the propagator has them if necessary)
-        self.current_iter_istates = {state.state_id: state for state in 
-                                     self.data_manager.get_segment_initial_states(list(segments.values()))}
+        if carryover is not None:
+            self.current_iter_istates = {state.state_id: state for state in carryover['initial_states']}
+        else:
+            self.current_iter_istates = {state.state_id: state for state in 
+                                         self.data_manager.get_segment_initial_states(list(segments.values()))}
         log.debug('This iteration uses {:d} initial states'.format(len(self.current_iter_istates)))
         
         # Assign this iteration's segments' initial points to bins and report on bin population
-        initial_pcoords = self.system.new_pcoord_array(len(segments))
         initial_binning = self.system.bin_mapper.construct_bins()
-        for iseg, segment in enumerate(segments.values()):
-            initial_pcoords[iseg] = segment.pcoord[0]
+        if segment_arrays is not None:
+            initial_pcoords = numpy.ascontiguousarray(segment_arrays.pcoord[:,0], dtype=self.system.pcoord_dtype)
+        else:
+            initial_pcoords = self.system.new_pcoord_array(len(segments))
+            for iseg, segment in enumerate(segments.values()):
+                initial_pcoords[iseg] = segment.pcoord[0]
         initial_assignments = self.system.bin_mapper.assign(initial_pcoords)
         for (segment, assignment) in zip(iter(segments.values()), initial_assignments):
             initial_binning[assignment].add(segment)
         self.report_bin_statistics(initial_binning, save_summary=True)
-        del initial_pcoords, initial_binning
+        del initial_pcoords, initial_binning, segment_arrays
         
         # Let the WE driver assign completed segments 
         if completed_segments:
             self.we_driver.assign(list(completed_segments.values()))
         
         # Get the basis states and initial states for the next iteration, necessary for doing on-the-fly recycling 
-        self.next_iter_bstates = self.data_manager.get_basis_states(self.n_iter+1)
+        if carryover is not None:
+            # basis states do not change over the course of a run
+            self.next_iter_bstates = carryover['basis_states']
+            unused_istates = carryover['unused_initial_states']
+        else:
+            self.next_iter_bstates = self.data_manager.get_basis_states(self.n_iter+1)
+            unused_istates = self.data_manager.get_unused_initial_states(n_iter=self.n_iter+1)
         self.next_iter_bstate_cprobs = numpy.add.accumulate([bstate.probability for bstate in self.next_iter_bstates])
         
-        self.we_driver.avail_initial_states = {istate.state_id: istate 
-                                               for istate in self.data_manager.get_unused_initial_states(n_iter=self.n_iter+1)}
+        self.we_driver.avail_initial_states = {istate.state_id: istate for istate in unused_istates}
         log.debug('{:d} unused initial states found'.format(len(self.we_driver.avail_initial_states)))
         
         # Invoke callbacks
@@ -415,7 +804,18 @@ class WESimManager:
         log.debug('dispatching propagator post_iter to work manager')
         self.work_manager.submit(wm_ops.post_iter, args=(self.n_iter, list(self.segments.values()))).get_result()
         
-        # Move existing segments into place as new segments
+        # Hand off what the next iteration needs, rather than having it wait on the HDF5 file
+        if self._writer is not None:
+            self._carryover = {'target_states': list(self.we_driver.target_states.values()),
+                               'new_weights': list(self.we_driver.new_weights),
+                               'basis_states': self.next_iter_bstates,
+                               'initial_states': list(self.we_driver.used_initial_states.values()),
+                               'unused_initial_states': list(self.we_driver.avail_initial_states.values()),
+                               'states_generation': self._states_generation}
+        
+        # Move existing segments into place as new segments, keeping their walltimes to estimate
+        # the cost of their children
+        self.parent_walltimes = {segment.seg_id: segment.walltime for segment in self.segments.values()}
         del self.segments
         self.segments = {segment.seg_id: segment for segment in self.we_driver.next_iter_segments}
                         
@@ -454,7 +854,7 @@ class WESimManager:
                 initial_state.istate_status = InitialState.ISTATE_STATUS_PREPARED
                 self.we_driver.avail_initial_states[initial_state.state_id] = initial_state
             updated_states.append(initial_state)
-        self.data_manager.update_initial_states(updated_states, n_iter=self.n_iter+1)
+        self._commit(self.data_manager.update_initial_states, updated_states, n_iter=self.n_iter+1)
         return futures
                                     
     def propagate(self):
@@ -468,23 +868,91 @@ class WESimManager:
         # Immediately dispatch any necessary initial state generation
         istate_gen_futures = self.get_istate_futures()
         futures.update(istate_gen_futures)
+        istate_dispatch_times = dict.fromkeys(istate_gen_futures, time.time())
+        
+        # Basis and initial states are resolved once for the iteration, then divided among blocks
+        pbstates, pistates = west.states.pare_basis_initial_states(self.current_iter_bstates, 
+                                                                   list(self.current_iter_istates.values()), segments)
+        bstate_map = {state.state_id: state for state in pbstates}
+        istate_map = {state.state_id: state for state in pistates}
+        
+        # Arguments and expected cost of the propagation task for each block of segments, kept so
+        # that blocks which straggle can be resubmitted
+        # This is zero (unknown) for work managers to which no workers have yet connected
+        n_workers = getattr(self.work_manager, 'n_workers', None) or None
+        segment_costs = self.get_segment_costs(segments)
+        if self.block_scheduling == 'guided':
+            segment_blocks = guided_blocks(segments, segment_costs, n_workers, self.propagator_block_size)
+        else:
+            segment_blocks = [[_f for _f in segment_block if _f] 
+                              for segment_block in grouper(self.propagator_block_size, segments)]
+        segment_costs = {segment.seg_id: cost for (segment, cost) in zip(segments, segment_costs)}
+        block_args = {}
+        block_costs = {}
+        stragglers = StragglerMonitor(len(segment_blocks), n_workers,
+                                      segment_timeout=self.segment_timeout, tail_factor=self.straggler_factor,
+                                      tail_fraction=self.straggler_tail, max_resubmits=self.max_resubmits)
         
         # Dispatch propagation tasks using work manager                
-        for segment_block in grouper(self.propagator_block_size, segments):
-            segment_block = [_f for _f in segment_block if _f]
-            pbstates, pistates = west.states.pare_basis_initial_states(self.current_iter_bstates, 
-                                                                       list(self.current_iter_istates.values()), segment_block)
-            future = self.work_manager.submit(wm_ops.propagate, args=(pbstates, pistates, segment_block))
-            futures.add(future)
-            segment_futures.add(future)
+        with self.timed('propagate:dispatch'):
+            for (block_key, segment_block) in enumerate(segment_blocks):
+                block_istates = set(istate_map[segment.initial_state_id] for segment in segment_block
+                                    if segment.initpoint_type == Segment.SEG_INITPOINT_NEWTRAJ)
+                block_bstates = set(bstate_map[istate.basis_state_id] for istate in block_istates
+                                    if istate.basis_state_id in bstate_map)
+                block_args[block_key] = (block_bstates, block_istates, segment_block)
+                block_costs[block_key] = sum(segment_costs[segment.seg_id] for segment in segment_block)
+                future = self.work_manager.submit(wm_ops.propagate, args=block_args[block_key],
+                                                  cost_hint=block_costs[block_key])
+                stragglers.submitted(future, block_key, len(segment_block), time.time())
+                futures.add(future)
+                segment_futures.add(future)
+                
+        # Time spent waiting on the last few blocks of segments is reported separately, as a
+        # measure of the cost of stragglers
+        n_tail_blocks = max(1, int(0.05*len(segment_blocks)))
+        tail_start_time = None
         
         while futures:
-            # TODO: add capacity for timeout or SIGINT here
-            future = self.work_manager.wait_any(futures)
+            stragglers.set_n_workers(getattr(self.work_manager, 'n_workers', None), time.time())
+            if tail_start_time is None and stragglers.n_outstanding <= n_tail_blocks:
+                tail_start_time = time.time()
+                
+            # Wait no longer than until the next block becomes a straggler
+            deadline = stragglers.next_deadline()
+            with self.timed('propagate:wait'):
+                future = self.work_manager.wait_any(futures, timeout=(None if deadline is None 
+                                                                      else deadline - time.time()))
+            if future is None:
+                self.resubmit_stragglers(stragglers, block_args, block_costs, futures, segment_futures)
+                continue
             futures.remove(future)
             
             if future in segment_futures:
                 segment_futures.remove(future)
+                now = time.time()
+                block_key = stragglers.block_of[future]
+                
+                # If a copy of this block is still running, a failure here need not fail the iteration
+                if len(stragglers.block_tasks[block_key]) > 1 and not self.block_succeeded(future):
+                    stragglers.finished(future, now)
+                    self.record_event('propagate:speculative_failed')
+                    continue
+                
+                # The first result for a block is accepted, and any other copies cancelled
+                if future is not stragglers.first_task[block_key]:
+                    self.record_event('propagate:speculative_won')
+                for other in stragglers.completed(future, now):
+                    futures.discard(other)
+                    segment_futures.discard(other)
+                    stragglers.finished(other, now)
+                    if self.work_manager.cancel(other):
+                        self.record_event('propagate:speculative_cancelled')
+                    else:
+                        # Still running; its result will be ignored
+                        self.record_event('propagate:speculative_abandoned')
+                del block_args[block_key], block_costs[block_key]
+                
                 incoming = future.get_result()
                 self.n_propagated += 1
                 
@@ -492,20 +960,25 @@ class WESimManager:
                 self.completed_segments.update({segment.seg_id: segment for segment in incoming})
                 
                 self.we_driver.assign(incoming)
+                if self.restart_store is not None:
+                    self.restart_store.release(incoming)
                 new_istate_futures = self.get_istate_futures()
                 istate_gen_futures.update(new_istate_futures)
                 futures.update(new_istate_futures)
+                istate_dispatch_times.update(dict.fromkeys(new_istate_futures, time.time()))
                 
-                with self.data_manager.expiring_flushing_lock():                        
-                    self.data_manager.update_segments(self.n_iter, incoming)
+                self._commit(self._update_segments, self.n_iter, incoming)
+                
+                if tail_start_time is not None and not segment_futures:
+                    self.record_time('propagate:tail', time.time() - tail_start_time)
 
             elif future in istate_gen_futures:
                 istate_gen_futures.remove(future)
+                self.record_time('propagate:istate_generation', time.time() - istate_dispatch_times.pop(future))
                 _basis_state, initial_state = future.get_result()
                 log.debug('received newly-prepared initial state {!r}'.format(initial_state))
                 initial_state.istate_status = InitialState.ISTATE_STATUS_PREPARED
-                with self.data_manager.expiring_flushing_lock():
-                    self.data_manager.update_initial_states([initial_state], n_iter=self.n_iter+1)
+                self._commit(self._update_initial_states, [initial_state], n_iter=self.n_iter+1)
                 self.we_driver.avail_initial_states[initial_state.state_id] = initial_state
             else:
                 log.error('unknown future {!r} received from work manager'.format(future))
@@ -513,7 +986,63 @@ class WESimManager:
                     
         log.debug('done with propagation')
         self.save_bin_data()
-        self.data_manager.flush_backing()
+        if not self.data_manager.write_behind:
+            self._commit(self.data_manager.flush_backing)
+        
+    def get_segment_costs(self, segments):
+        '''Return the expected cost of propagating each of ``segments``: the walltime of its parent, or
+        for segments starting new trajectories (or whose parent's walltime is unknown), the median
+        walltime of the previous iteration. All costs are equal if no walltimes are known.'''
+        parent_walltimes = self.parent_walltimes
+        if parent_walltimes is None and self.n_iter > 1:
+            # As on starting a run; otherwise, the previous iteration's segments are still in memory
+            seg_index = self.data_manager.get_seg_index(self.n_iter-1)
+            parent_walltimes = dict(enumerate(seg_index['walltime'].tolist()))
+        known_walltimes = [walltime for walltime in (parent_walltimes or {}).values() if walltime > 0]
+        if not known_walltimes:
+            return [1.0] * len(segments)
+        
+        default_cost = float(numpy.median(known_walltimes))
+        costs = []
+        for segment in segments:
+            walltime = 0.0
+            if segment.initpoint_type == Segment.SEG_INITPOINT_CONTINUES:
+                walltime = parent_walltimes.get(segment.parent_id) or 0.0
+            costs.append(walltime if walltime > 0 else default_cost)
+        return costs
+        
+    @staticmethod
+    def block_succeeded(future):
+        '''Return True if the propagation task of ``future`` completed all of its segments.'''
+        if future.get_exception() is not None:
+            return False
+        return all(segment.status == Segment.SEG_STATUS_COMPLETE for segment in future.get_result(discard=False))
+        
+    def resubmit_stragglers(self, stragglers, block_args, block_costs, futures, segment_futures):
+        '''Submit speculative copies of the tasks propagating the blocks of segments which are straggling.'''
+        now = time.time()
+        for block_key in sorted(stragglers.stragglers(now)):
+            (pbstates, pistates, segment_block) = block_args[block_key]
+            age = now - stragglers.started[stragglers.latest_task[block_key]]
+            log.info('resubmitting block of {:d} segment(s) (seg_ids {}) after {:.1f} s'
+                     .format(len(segment_block), ', '.join(str(segment.seg_id) for segment in segment_block), age))
+            
+            # The original task may be modifying its segments in place (with in-process work managers)
+            segment_block = [self._snapshot_segment(segment) for segment in segment_block]
+            future = self.work_manager.submit(wm_ops.propagate, args=(pbstates, pistates, segment_block),
+                                              cost_hint=block_costs[block_key])
+            stragglers.resubmitted(future, block_key, now)
+            futures.add(future)
+            segment_futures.add(future)
+            self.record_event('propagate:straggler_resubmitted')
+        
+    def _update_segments(self, n_iter, segments):
+        with self.data_manager.expiring_flushing_lock():
+            self.data_manager.update_segments(n_iter, segments)
+            
+    def _update_initial_states(self, initial_states, n_iter):
+        with self.data_manager.expiring_flushing_lock():
+            self.data_manager.update_initial_states(initial_states, n_iter=n_iter)
         
     def save_bin_data(self):
         '''Calculate and write flux and transition count matrices to HDF5. Population and rate matrices 
@@ -521,15 +1050,18 @@ class WESimManager:
         # save_bin_data(self, populations, n_trans, fluxes, rates, n_iter=None)
         
         if self.save_transition_matrices:
-            with self.data_manager.expiring_flushing_lock():
-                iter_group = self.data_manager.get_iter_group(self.n_iter)
-                for key in ['bin_ntrans', 'bin_fluxes']:
-                    try:
-                        del iter_group[key]
-                    except KeyError:
-                        pass
-                iter_group['bin_ntrans'] = self.we_driver.transition_matrix
-                iter_group['bin_fluxes'] = self.we_driver.flux_matrix
+            self._commit(self._save_bin_data, self.n_iter, self.we_driver.transition_matrix, self.we_driver.flux_matrix)
+            
+    def _save_bin_data(self, n_iter, transition_matrix, flux_matrix):
+        with self.data_manager.expiring_flushing_lock():
+            iter_group = self.data_manager.get_iter_group(n_iter)
+            for key in ['bin_ntrans', 'bin_fluxes']:
+                try:
+                    del iter_group[key]
+                except KeyError:
+                    pass
+            iter_group['bin_ntrans'] = transition_matrix
+            iter_group['bin_fluxes'] = flux_matrix
         
     def check_propagation(self):
         '''Check for failures in propagation or initial state generation, and raise an exception
@@ -572,15 +1104,22 @@ class WESimManager:
         self.bin_mapper_hash = hashed
         self.we_driver.construct_next()
         
+        # Merged and recycled segments have no children to use their restart data. This is determined
+        # from the parents of the new segments rather than from endpoint types, since a parent whose
+        # children were split and then partly merged away may be marked as merged but still continue
+        if self.restart_store is not None:
+            self.restart_store.retain(self.n_iter+1, list(self.we_driver.next_iter_segments))
+        
         if self.we_driver.used_initial_states:
             for initial_state in self.we_driver.used_initial_states.values():
                 initial_state.iter_used = self.n_iter+1
-            self.data_manager.update_initial_states(list(self.we_driver.used_initial_states.values()))
+            self._commit(self.data_manager.update_initial_states, list(self.we_driver.used_initial_states.values()),
+                         n_iter=self.n_iter)
             
-        self.data_manager.update_segments(self.n_iter,list(self.segments.values()))
+        self._commit(self.data_manager.update_segments, self.n_iter, list(self.segments.values()))
         
-        self.data_manager.require_iter_group(self.n_iter+1)
-        self.data_manager.save_iter_binning(self.n_iter+1, hashed, pickled, self.we_driver.bin_target_counts)
+        self._commit(self.data_manager.require_iter_group, self.n_iter+1)
+        self._commit(self.data_manager.save_iter_binning, self.n_iter+1, hashed, pickled, self.we_driver.bin_target_counts)
         
         # Report on recycling
         recycling_events = {}
@@ -606,8 +1145,26 @@ class WESimManager:
             for segment in self.we_driver.next_iter_segments:
                 self.rc.pstatus('{!r} pcoord[0]={!r}'.format(segment, segment.pcoord[0]))
         
-        self.data_manager.prepare_iteration(self.n_iter+1, list(self.we_driver.next_iter_segments))
-        self.data_manager.save_new_weight_data(self.n_iter+1, self.we_driver.new_weights)
+        # Segment IDs are normally assigned by the data manager, but the data manager may defer
+        # writing (write-behind mode), or the next iteration may be dispatched before the writer 
+        # gets to these segments (pipelined mode)
+        segments = list(self.we_driver.next_iter_segments)
+        for (seg_id, segment) in enumerate(segments):
+            segment.seg_id = seg_id
+        if self._writer is not None:
+            # In pipelined mode, segments may be modified in place by propagation before being written
+            segments = [self._snapshot_segment(segment) for segment in segments]
+        
+        self._commit(self.data_manager.prepare_iteration, self.n_iter+1, segments)
+        self._commit(self.data_manager.save_new_weight_data, self.n_iter+1, list(self.we_driver.new_weights))
+        
+    @staticmethod
+    def _snapshot_segment(segment):
+        snapshot = copy.copy(segment)
+        snapshot.pcoord = segment.pcoord.copy()
+        snapshot.wtg_parent_ids = set(segment.wtg_parent_ids)
+        snapshot.data = dict(segment.data)
+        return snapshot
         
     def run(self):   
         run_starttime = time.time()
@@ -620,73 +1177,130 @@ class WESimManager:
         
         self.n_iter = self.data_manager.current_iteration    
         max_iter = self.max_total_iterations or self.n_iter+1
+        
+        if self.pipeline_iterations:
+            self.rc.pstatus('Committing iteration data in the background (pipelined mode)')
+            self._writer = IterationWriter()
+            
+        # Discard timing of any data manager operations prior to the first iteration
+        self.data_manager.pop_call_times()
 
         iter_elapsed = 0
-        while self.n_iter <= max_iter:
-            
-            if max_walltime and time.time() + 1.1*iter_elapsed >= run_killtime:
-                self.rc.pstatus('Iteration {:d} would require more than the allotted time. Ending run.'
-                                .format(self.n_iter))
-                return
-            
-            try:
-                iter_start_time = time.time()
-                
-                self.rc.pstatus('\n%s' % time.asctime())
-                self.rc.pstatus('Iteration %d (%d requested)' % (self.n_iter, max_iter))
-                                
-                self.prepare_iteration()
-                self.rc.pflush()
-                
-                self.pre_propagation()
-                self.propagate()
-                self.rc.pflush()
-                self.check_propagation()
-                self.rc.pflush()
-                self.post_propagation()
-                
-                cputime = sum(segment.cputime for segment in self.segments.values())
-                
-                self.rc.pflush()
-                self.pre_we()
-                self.run_we()
-                self.post_we()
-                self.rc.pflush()
-                
-                self.prepare_new_iteration()
-                
-                self.finalize_iteration()
+        try:
+            while self.n_iter <= max_iter:
                 
-                iter_elapsed = time.time() - iter_start_time
-                iter_summary = self.data_manager.get_iter_summary()
-                iter_summary['walltime'] += iter_elapsed
-                iter_summary['cputime'] = cputime
-                self.data_manager.update_iter_summary(iter_summary)
-    
-                self.n_iter += 1
-                self.data_manager.current_iteration += 1
-
-                try:
-                    #This may give NaN if starting a truncated simulation
-                    walltime = timedelta(seconds=float(iter_summary['walltime']))
-                except ValueError:
-                    walltime = 0.0 
+                if max_walltime and time.time() + 1.1*iter_elapsed >= run_killtime:
+                    self.rc.pstatus('Iteration {:d} would require more than the allotted time. Ending run.'
+                                    .format(self.n_iter))
+                    return
                 
                 try:
-                    cputime = timedelta(seconds=float(iter_summary['cputime']))
-                except ValueError:
-                    cputime = 0.0      
-
-                self.rc.pstatus('Iteration wallclock: {0!s}, cputime: {1!s}\n'\
-                                          .format(walltime,
-                                                  cputime))
-                self.rc.pflush()
-            finally:
-                self.data_manager.flush_backing()
+                    iter_start_time = time.time()
+                    self.iter_timings = {}
+                    self.iter_events = {}
+                    
+                    if self.n_iter in self.profile_iterations:
+                        profiler = self.start_profiling()
+                    else:
+                        profiler = None
+                    
+                    self.rc.pstatus('\n%s' % time.asctime())
+                    self.rc.pstatus('Iteration %d (%d requested)' % (self.n_iter, max_iter))
+                                    
+                    with self.timed('prepare_iteration'):
+                        self.prepare_iteration()
+                    self.rc.pflush()
+                    
+                    with self.timed('pre_propagation'):
+                        self.pre_propagation()
+                    with self.timed('propagate'):
+                        self.propagate()
+                    self.rc.pflush()
+                    with self.timed('check_propagation'):
+                        self.check_propagation()
+                    self.rc.pflush()
+                    with self.timed('post_propagation'):
+                        self.post_propagation()
+                    
+                    cputime = sum(segment.cputime for segment in self.segments.values())
+                    
+                    self.rc.pflush()
+                    with self.timed('pre_we'):
+                        self.pre_we()
+                    with self.timed('run_we'):
+                        self.run_we()
+                    with self.timed('post_we'):
+                        self.post_we()
+                    self.rc.pflush()
+                    
+                    with self.timed('prepare_new_iteration'):
+                        self.prepare_new_iteration()
+                    
+                    with self.timed('finalize_iteration'):
+                        self.finalize_iteration()
+                        
+                    if profiler is not None:
+                        self.stop_profiling(profiler)
+                    
+                    iter_elapsed = time.time() - iter_start_time
+                    self.record_time('iteration', iter_elapsed)
+                    self.save_iter_timing()
+                    if self._writer is not None:
+                        # The summary table may not be current yet; report this iteration's timing alone
+                        self._commit(self._save_iter_times, self.n_iter, iter_elapsed, cputime)
+                        walltime = timedelta(seconds=iter_elapsed)
+                        cputime = timedelta(seconds=float(cputime))
+                    else:
+                        iter_summary = self._save_iter_times(self.n_iter, iter_elapsed, cputime)
+                    
+                        try:
+                            #This may give NaN if starting a truncated simulation
+                            walltime = timedelta(seconds=float(iter_summary['walltime']))
+                        except ValueError:
+                            walltime = 0.0 
+                        
+                        try:
+                            cputime = timedelta(seconds=float(iter_summary['cputime']))
+                        except ValueError:
+                            cputime = 0.0      
+        
+                    self.n_iter += 1
+                    self._commit(setattr, self.data_manager, 'current_iteration', self.n_iter)
+                    
+                    # Restart data made unneeded by this iteration may be needed again if the simulation
+                    # is restarted from an earlier state, so remove it only once the new iteration is stored
+                    if self.restart_store is not None:
+                        self._commit(self.data_manager.flush_backing)
+                        self._commit(self.restart_store.remove_unneeded, self.restart_store.pop_unneeded())
+    
+                    self.rc.pstatus('Iteration wallclock: {0!s}, cputime: {1!s}\n'\
+                                              .format(walltime,
+                                                      cputime))
+                    self.rc.pflush()
+                finally:
+                    in_flight = sys.exc_info()[0] is not None
+                    try:
+                        self._commit(self.data_manager.iteration_boundary)
+                    except Exception:
+                        # Do not mask an exception already in flight with one from an earlier background write
+                        if not in_flight:
+                            raise
+                        log.exception('could not flush HDF5 file')
+        finally:
+            if self._writer is not None:
+                self._shutdown_writer()
+            self.data_manager.shutdown_writer()
                 
         self.rc.pstatus('\n%s' % time.asctime())
         self.rc.pstatus('WEST run complete.')
         
+    def _save_iter_times(self, n_iter, walltime, cputime):
+        iter_summary = self.data_manager.get_iter_summary(n_iter)
+        iter_summary['walltime'] += walltime
+        iter_summary['cputime'] = cputime
+        self.data_manager.update_iter_summary(iter_summary, n_iter)
+        return iter_summary
+        
     def prepare_run(self):
         '''Prepare a new run.'''
         self.data_manager.prepare_run()
@@ -0,0 +1,657 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, sys, shutil, subprocess, tempfile, threading, operator
+import argparse
+import numpy, h5py
+
+os.environ['WEST_SIM_ROOT'] = os.path.join(os.environ['WEST_ROOT'], 'lib/examples/odld')
+import westpa, west
+from west.data_manager import WESTDataManager, contiguous_runs, select_runs, seg_index_dtype
+from west.segment import Segment
+from westpa.binning import RectilinearBinMapper
+from westpa import h5io
+
+import nose
+import nose.tools
+
+
+class TestSelectRuns:
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.h5file = h5py.File(os.path.join(self.tempdir, 'test.h5'), 'w')
+
+    def teardown(self):
+        self.h5file.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_contiguous_runs(self):
+        assert contiguous_runs([]) == []
+        assert contiguous_runs([3]) == [(3,1)]
+        assert contiguous_runs([0,1,2,5,6,9]) == [(0,3), (5,2), (9,1)]
+
+    def check_write_rows(self, rows):
+        data = numpy.arange(200*3*2, dtype=numpy.float32).reshape(200,3,2)
+        dset = self.h5file.create_dataset('data_{:d}'.format(len(rows)), shape=data.shape, dtype=data.dtype)
+        rows = numpy.array(sorted(rows))
+
+        source = data[rows]
+        msel = h5py.h5s.create_simple(source.shape)
+        fsel = dset.id.get_space()
+        select_runs(fsel, contiguous_runs(rows), (3,2))
+        dset.id.write(msel, fsel, source)
+
+        expected = numpy.zeros_like(data)
+        expected[rows] = data[rows]
+        assert (dset[...] == expected).all()
+
+    def test_write_rows(self):
+        # few runs (hyperslabs) and many runs (element selection)
+        yield self.check_write_rows, [0,1,2,10,11,50]
+        yield self.check_write_rows, list(range(0,200,3))
+
+
+class TestBinMapperStorage:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+        self.data_manager.prepare_backing()
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+        del self.data_manager
+
+    def save_mapper(self, boundaries):
+        mapper = RectilinearBinMapper([boundaries])
+        pickled_mapper, hashval = mapper.pickle_and_hash()
+        return self.data_manager.save_bin_mapper(hashval, pickled_mapper), hashval
+
+    def test_save_and_find(self):
+        row0, hash0 = self.save_mapper([0.0, 1.0, 2.0])
+        row1, hash1 = self.save_mapper([0.0, 1.0, 3.0])
+        assert (row0, row1) == (0, 1)
+
+        # saving a mapper again does not store another copy
+        assert self.save_mapper([0.0, 1.0, 3.0]) == (1, hash1)
+        assert len(self.data_manager.we_h5file['/bin_topologies/index']) == 2
+
+        assert self.data_manager.find_bin_mapper(hash0) == 0
+        assert self.data_manager.find_bin_mapper(hash1.encode('ascii')) == 1
+        nose.tools.assert_raises(KeyError, self.data_manager.find_bin_mapper, 'x'*64)
+
+    def test_get_after_reopen(self):
+        _row, hashval = self.save_mapper([0.0, 1.0, 2.0])
+        self.save_mapper([0.0, 1.0, 3.0])
+        self.data_manager.close_backing()
+        self.data_manager.open_backing()
+
+        assert self.data_manager.find_bin_mapper(hashval) == 0
+        mapper = self.data_manager.get_bin_mapper(hashval)
+        assert list(mapper.boundaries[0]) == [0.0, 1.0, 2.0]
+
+        # a second lookup does not unpickle the mapper again
+        assert self.data_manager.get_bin_mapper(hashval) is mapper
+
+    def test_cache_eviction(self):
+        self.data_manager.bin_mapper_cache_size = 2
+        hashes = [self.save_mapper([0.0, 1.0, 2.0+i])[1] for i in range(3)]
+        mappers = [self.data_manager.get_bin_mapper(hashval) for hashval in hashes]
+
+        assert len(self.data_manager._bin_mapper_cache) == 2
+        assert self.data_manager.get_bin_mapper(hashes[2]) is mappers[2]
+        assert self.data_manager.get_bin_mapper(hashes[0]) is not mappers[0]
+
+
+class TestAuxDataStorage:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+        self.data_manager.prepare_backing()
+        self.system = self.data_manager.system
+
+        # space for 10 segments in iteration 1
+        self.n_segments = 10
+        iter_group = self.data_manager.require_iter_group(1)
+        iter_group.create_dataset('seg_index', shape=(self.n_segments,), dtype=seg_index_dtype)
+        iter_group.create_dataset('pcoord', shape=(self.n_segments, self.system.pcoord_len, self.system.pcoord_ndim),
+                                  dtype=self.system.pcoord_dtype)
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+        del self.data_manager
+
+    def segment(self, seg_id, data):
+        return Segment(n_iter=1, seg_id=seg_id, weight=1.0/self.n_segments, pcoord=self.system.new_pcoord_array(),
+                       status=Segment.SEG_STATUS_COMPLETE, data=data)
+
+    def test_aux_data(self):
+        coords = numpy.random.random((self.n_segments, 4, 3))
+        blocks = [[7, 2, 3], [0, 9, 5], [1, 4, 6, 8]]
+        for block in blocks:
+            self.data_manager.update_segments(1, [self.segment(seg_id, {'coords': coords[seg_id], 'energy': float(seg_id)})
+                                                  for seg_id in block])
+
+        auxdata = self.data_manager.get_iter_group(1)['auxdata']
+        assert numpy.allclose(auxdata['coords'][...], coords)
+        assert (auxdata['energy'][...] == numpy.arange(self.n_segments)).all()
+
+    def test_aux_data_not_stored(self):
+        self.data_manager.dataset_options['coords'] = {'name': 'coords', 'h5path': 'auxdata/coords', 'store': False}
+        self.data_manager.update_segments(1, [self.segment(0, {'coords': numpy.zeros((4,3)), 'energy': 1.0})])
+
+        auxdata = self.data_manager.get_iter_group(1)['auxdata']
+        assert 'coords' not in auxdata
+        assert 'energy' in auxdata
+
+
+
+class TestWriteBehind:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+        self.data_manager.prepare_backing()
+        self.data_manager.write_behind = True
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+        del self.data_manager
+
+    def test_reads_wait_for_writes(self):
+        release = threading.Event()
+        self.data_manager.submit_write(release.wait)
+        self.data_manager.submit_write(setattr, self.data_manager, 'current_iteration', 5)
+        # the write is still queued behind the blocked one
+        assert self.data_manager.we_h5file['/'].attrs['west_current_iteration'] == 0
+        release.set()
+        assert self.data_manager.current_iteration == 5
+
+    def test_error_discards_later_writes(self):
+        self.data_manager.submit_write(operator.truediv, 1, 0)
+        self.data_manager.submit_write(setattr, self.data_manager, 'current_iteration', 5)
+        nose.tools.assert_raises(ZeroDivisionError, self.data_manager.sync_writes)
+        nose.tools.assert_raises(ZeroDivisionError, self.data_manager.shutdown_writer)
+        assert self.data_manager.current_iteration == 0
+
+    def test_shutdown_completes_writes(self):
+        self.data_manager.submit_write(setattr, self.data_manager, 'current_iteration', 5)
+        self.data_manager.close_backing()
+        self.data_manager.open_backing()
+        assert self.data_manager.current_iteration == 5
+        
+    def test_full_queue_with_lock_held(self):
+        data_manager = self.data_manager
+        data_manager.write_queue_size = 1
+        locked = threading.Event()
+        release_lock = threading.Event()
+        release_writer = threading.Event()
+        seen = []
+        
+        def reader():
+            with data_manager.lock:
+                locked.set()
+                release_lock.wait()
+                # None of these may wait for the (blocked) writer
+                data_manager.submit_write(setattr, data_manager, 'current_iteration', 7)
+                seen.append(data_manager.current_iteration)
+                data_manager.sync_writes()
+                
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        locked.wait()
+        
+        data_manager.submit_write(release_writer.wait)
+        data_manager.submit_write(setattr, data_manager, 'current_iteration', 5)
+        # The queue is now full, so this blocks until the writer (which needs the lock) catches up
+        submit_thread = threading.Thread(target=data_manager.submit_write, 
+                                         args=(setattr, data_manager, 'current_iteration', 6))
+        submit_thread.start()
+        release_writer.set()
+        release_lock.set()
+        
+        for thread in (reader_thread, submit_thread):
+            thread.join(10)
+            assert not thread.is_alive()
+        assert seen == [7]
+        assert data_manager.current_iteration == 6
+        
+    def test_writer_owns_file(self):
+        data_manager = self.data_manager
+        threads = set()
+        
+        class RecordingFile:
+            def __init__(self, h5file):
+                self.h5file = h5file
+            def __getattr__(self, attr):
+                threads.add(threading.current_thread())
+                return getattr(self.h5file, attr)
+            def __getitem__(self, key):
+                threads.add(threading.current_thread())
+                return self.h5file[key]
+            def __contains__(self, key):
+                threads.add(threading.current_thread())
+                return key in self.h5file
+        
+        h5file = data_manager.we_h5file
+        data_manager.we_h5file = RecordingFile(h5file)
+        try:
+            data_manager.submit_write(data_manager.require_iter_group, 1)
+            data_manager.submit_write(setattr, data_manager, 'current_iteration', 1)
+            assert data_manager.current_iteration == 1
+            assert data_manager.get_iter_group(1).attrs['n_iter'] == 1
+            data_manager.flush_backing()
+            data_manager.sync_writes()
+        finally:
+            data_manager.we_h5file = h5file
+        assert threads == {data_manager._writer.thread}
+        
+    def test_flush_at_iteration_boundary(self):
+        data_manager = self.data_manager
+        data_manager.flush_period = 0
+        data_manager.submit_write(setattr, data_manager, 'current_iteration', 1)
+        data_manager.sync_writes()
+        assert data_manager.last_flush == 0
+        data_manager.submit_write(data_manager.iteration_boundary)
+        data_manager.sync_writes()
+        assert data_manager.last_flush > 0
+        
+        # Not flushed again until flush_period has passed
+        data_manager.flush_period = 3600
+        last_flush = data_manager.last_flush
+        data_manager.submit_write(data_manager.iteration_boundary)
+        data_manager.sync_writes()
+        assert data_manager.last_flush == last_flush
+
+class TestTimingStorage:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+        self.data_manager.prepare_backing()
+        self.data_manager.require_iter_group(1)
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+        del self.data_manager
+
+    def test_timing(self):
+        assert self.data_manager.get_iter_timing(1) == {}
+        self.data_manager.save_iter_timing(1, [('propagate', 2.5, 1), ('data_manager:update_segments', 0.25, 3)])
+        self.data_manager.save_iter_timing(1, [('propagate', 1.5, 1), ('callback:post_we:plugin.fn', 0.5, 2)])
+        self.data_manager.close_backing()
+        self.data_manager.open_backing()
+        # Saving again replaces the table
+        assert self.data_manager.get_iter_timing(1) == {'propagate': (1.5, 1), 'callback:post_we:plugin.fn': (0.5, 2)}
+        assert self.data_manager.get_iter_timing(2) == {}
+
+    def test_events(self):
+        assert self.data_manager.get_iter_events(1) == {}
+        self.data_manager.save_iter_events(1, [('propagate:straggler_resubmitted', 2), ('propagate:speculative_won', 1)])
+        self.data_manager.close_backing()
+        self.data_manager.open_backing()
+        assert self.data_manager.get_iter_events(1) == {'propagate:straggler_resubmitted': 2, 'propagate:speculative_won': 1}
+
+
+class TestSegmentArrays:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+        self.data_manager.prepare_backing()
+
+        # 5 segments in iteration 2; segments 1 and 3 have two weight transfer parents
+        self.n_segments = 5
+        self.parent_ids = numpy.array([0, 1, -1, 2, 2])
+        self.wtg_parent_ids = [[0], [1, 3], [-1], [2, 0], [2]]
+        seg_index = numpy.zeros((self.n_segments,), dtype=seg_index_dtype)
+        seg_index['weight'] = numpy.arange(1, self.n_segments+1) / 15.0
+        seg_index['parent_id'] = self.parent_ids
+        seg_index['endpoint_type'] = Segment.SEG_ENDPOINT_CONTINUES
+        seg_index['status'] = Segment.SEG_STATUS_COMPLETE
+        seg_index['wtg_n_parents'] = [len(parents) for parents in self.wtg_parent_ids]
+        seg_index['wtg_offset'] = numpy.r_[0, numpy.cumsum(seg_index['wtg_n_parents'])[:-1]]
+        self.pcoord = numpy.random.random((self.n_segments, 3, 2)).astype(numpy.float32)
+
+        iter_group = self.data_manager.require_iter_group(2)
+        iter_group.create_dataset('seg_index', data=seg_index)
+        iter_group.create_dataset('pcoord', data=self.pcoord)
+        iter_group.create_dataset('wtgraph', data=numpy.concatenate(self.wtg_parent_ids))
+        self.data_manager.close_backing()
+        self.data_manager.open_backing()
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+        del self.data_manager
+
+    def test_all_segments(self):
+        segment_arrays = self.data_manager.get_segments_as_arrays(2)
+        assert len(segment_arrays) == self.n_segments
+        assert (segment_arrays.seg_ids == numpy.arange(self.n_segments)).all()
+        assert (segment_arrays.parent_ids == self.parent_ids).all()
+        assert (segment_arrays.pcoord == self.pcoord).all()
+        for (i, parents) in enumerate(self.wtg_parent_ids):
+            assert segment_arrays.wtg_parents(i).tolist() == parents
+
+    def test_subset(self):
+        segment_arrays = self.data_manager.get_segments_as_arrays(2, [4, 1, 3], pcoord_points=[-1])
+        assert segment_arrays.seg_ids.tolist() == [1, 3, 4]
+        assert (segment_arrays.pcoord == self.pcoord[[1,3,4]][:,[-1]]).all()
+        assert [segment_arrays.wtg_parents(i).tolist() for i in range(3)] == [[1, 3], [2, 0], [2]]
+        assert (segment_arrays.weights == numpy.array([2, 4, 5]) / 15.0).all()
+
+    def test_without_wtgraph(self):
+        segment_arrays = self.data_manager.get_segments_as_arrays(2, [2, 3], load_pcoords=False, load_wtgraph=False)
+        assert segment_arrays.pcoord is None and segment_arrays.wtg_offsets is None
+        assert segment_arrays.parent_ids.tolist() == [-1, 2]
+        assert segment_arrays[1].wtg_parent_ids == set()
+
+    def test_segments(self):
+        segment_arrays = self.data_manager.get_segments_as_arrays(2)
+        segment = segment_arrays[3]
+        assert segment_arrays[3] is segment
+        assert (segment.seg_id, segment.n_iter, segment.parent_id) == (3, 2, 2)
+        assert segment.wtg_parent_ids == {0, 2}
+        assert segment.weight == 4/15.0
+        assert (segment.pcoord == self.pcoord[3]).all()
+
+        segments = self.data_manager.get_segments(2)
+        assert [segment.seg_id for segment in segments] == list(range(self.n_segments))
+        assert [segment.wtg_parent_ids for segment in segments] == [set(parents) for parents in self.wtg_parent_ids]
+
+
+class TestPcoordLayouts:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+        self.data_manager.prepare_backing()
+        self.system = self.data_manager.system
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+        del self.data_manager
+
+    def test_chunk_advisor(self):
+        # whole segments per chunk, or one time point of many segments per chunk
+        assert h5io.calc_pcoord_chunksize((1000, 21, 2), numpy.float32, 'segments', 16800) == (100, 21, 2)
+        assert h5io.calc_pcoord_chunksize((1000, 21, 2), numpy.float32, 'points', 4000) == (500, 1, 2)
+        assert h5io.calc_pcoord_chunksize((10, 21, 2), numpy.float32, 'points') == (10, 1, 2)
+        # segments larger than a chunk are split in time
+        assert h5io.calc_pcoord_chunksize((10, 1000, 3), numpy.float64, 'segments', 8192) == (1, 250, 3)
+
+    def check_layout(self, layout, compression=None, scaleoffset=None):
+        self.data_manager.dataset_options['pcoord'] = {'name': 'pcoord', 'h5path': 'pcoord', 
+                                                       'layout': layout, 'compression': compression,
+                                                       'scaleoffset': scaleoffset}
+        n_segments = 10
+        iter_group = self.data_manager.require_iter_group(1)
+        iter_group.create_dataset('seg_index', shape=(n_segments,), dtype=seg_index_dtype)
+        shape = (n_segments, self.system.pcoord_len, self.system.pcoord_ndim)
+        pcoord_ds, _ends_ds = self.data_manager._create_pcoord_datasets(iter_group, shape, self.system.pcoord_dtype)
+        assert pcoord_ds.attrs['layout'] == layout
+        assert (pcoord_ds.chunks is None) == (layout == 'contiguous')
+        assert pcoord_ds.compression == compression
+        
+        pcoords = numpy.random.random(shape).astype(self.system.pcoord_dtype)
+        for block in ([7, 2, 3], [0, 9, 5], [1, 4, 6, 8]):
+            self.data_manager.update_segments(1, [Segment(n_iter=1, seg_id=seg_id, weight=0.1, pcoord=pcoords[seg_id],
+                                                          status=Segment.SEG_STATUS_COMPLETE)
+                                                  for seg_id in block])
+        
+        if scaleoffset is None:
+            assert (pcoord_ds[...] == pcoords).all()
+            assert (h5io.get_pcoord_points(iter_group, [0,-1]) == pcoords[:,[0,-1]]).all()
+            assert (h5io.get_pcoord_points(iter_group, [-1]) == pcoords[:,[-1]]).all()
+        else:
+            tolerance = 10.0**-scaleoffset
+            assert numpy.allclose(pcoord_ds[...], pcoords, rtol=0, atol=tolerance)
+            assert numpy.allclose(h5io.get_pcoord_points(iter_group, [0,-1]), pcoords[:,[0,-1]], rtol=0, atol=tolerance)
+
+    def test_layouts(self):
+        yield self.check_layout, 'contiguous'
+        yield self.check_layout, 'segments', 'lzf'
+        yield self.check_layout, 'points', 'gzip'
+        yield self.check_layout, 'final-point-hot'
+
+    def test_final_point_hot_scaleoffset(self):
+        # First and last points are stored with the precision of the full dataset
+        self.check_layout('final-point-hot', scaleoffset=2)
+        iter_group = self.data_manager.get_iter_group(1)
+        ends_ds = iter_group['pcoord_ends']
+        assert ends_ds.scaleoffset == iter_group['pcoord'].scaleoffset == 2
+        assert ends_ds.dtype == iter_group['pcoord'].dtype
+        assert numpy.allclose(ends_ds[...], iter_group['pcoord'][:,[0,-1]], rtol=0, atol=0.02)
+
+    def test_final_point_hot(self):
+        self.check_layout('final-point-hot', 'lzf')
+        iter_group = self.data_manager.get_iter_group(1)
+        
+        # final points are read from the small dataset of first and last points
+        iter_group['pcoord_ends'][:,1] = -1
+        assert (h5io.get_pcoord_points(iter_group, [-1]) == -1).all()
+        assert (self.data_manager.get_segments_as_arrays(1, [2, 3], pcoord_points=[-1], load_wtgraph=False).pcoord == -1).all()
+
+
+class TestPackedStorage:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+        self.data_manager.packed_storage = True
+        self.data_manager.dataset_options['pcoord'] = {'name': 'pcoord', 'h5path': 'pcoord',
+                                                       'layout': 'final-point-hot', 'compression': 'lzf'}
+        self.data_manager.prepare_backing()
+        self.system = self.data_manager.system
+
+        # iterations 1 to 3, with 4, 6, and 5 segments, each with a single weight transfer parent
+        self.pcoords = {}
+        for (n_iter, n_segments) in [(1, 4), (2, 6), (3, 5)]:
+            self.prepare_iteration(n_iter, n_segments)
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+        del self.data_manager
+
+    def prepare_iteration(self, n_iter, n_segments):
+        seg_index = numpy.zeros((n_segments,), dtype=seg_index_dtype)
+        seg_index['weight'] = 1.0 / n_segments
+        seg_index['parent_id'] = numpy.arange(n_segments) % 3
+        seg_index['wtg_n_parents'] = 1
+        seg_index['wtg_offset'] = numpy.arange(n_segments)
+        pcoord = numpy.random.random((n_segments, self.system.pcoord_len, self.system.pcoord_ndim))
+        self.pcoords[n_iter] = pcoord = pcoord.astype(self.system.pcoord_dtype)
+        self.data_manager.require_iter_group(n_iter)
+        self.data_manager.append_packed_iteration(n_iter, seg_index, pcoord.shape, pcoord.dtype, pcoord, 
+                                                  seg_index['parent_id'])
+
+    def test_iteration_views(self):
+        assert self.data_manager.we_h5file_version == 8
+        assert self.data_manager.we_h5file['/packed/seg_index'].shape == (15,)
+        
+        iter_group = self.data_manager.get_iter_group(2)
+        assert isinstance(iter_group, h5io.PackedIterGroup)
+        assert iter_group.attrs['n_iter'] == 2
+        assert 'pcoord' in iter_group and 'auxdata' not in iter_group
+        assert iter_group['seg_index'].shape == (6,) and len(iter_group['wtgraph']) == 6
+        assert (iter_group['pcoord'][...] == self.pcoords[2]).all()
+        assert (iter_group['pcoord'][-2:,0] == self.pcoords[2][-2:,0]).all()
+        assert (iter_group['seg_index']['parent_id'] == [0, 1, 2, 0, 1, 2]).all()
+        
+        segment_arrays = self.data_manager.get_segments_as_arrays(3, [4, 1])
+        assert (segment_arrays.pcoord == self.pcoords[3][[1,4]]).all()
+        assert [segment_arrays.wtg_parents(i).tolist() for i in range(2)] == [[1], [1]]
+        
+        # analysis tools see the same view
+        self.data_manager.close_backing()
+        with h5io.WESTPAH5File(self.data_manager.we_h5filename, 'r') as h5file:
+            assert (h5file.get_iter_group(3)['pcoord'][...] == self.pcoords[3]).all()
+            assert (h5io.get_pcoord_points(h5file.get_iter_group(1), [-1]) == self.pcoords[1][:,[-1]]).all()
+        self.data_manager.open_backing()
+        assert self.data_manager.packed_storage
+        
+    def test_update_segments(self):
+        pcoords = numpy.random.random(self.pcoords[2].shape).astype(self.system.pcoord_dtype)
+        self.data_manager.update_segments(2, [Segment(n_iter=2, seg_id=seg_id, weight=0.5, pcoord=pcoords[seg_id],
+                                                      status=Segment.SEG_STATUS_COMPLETE)
+                                              for seg_id in [5, 0, 2]])
+        
+        segment_arrays = self.data_manager.get_segments_as_arrays(2)
+        assert (segment_arrays.pcoord[[0,2,5]] == pcoords[[0,2,5]]).all()
+        assert (segment_arrays.pcoord[[1,3,4]] == self.pcoords[2][[1,3,4]]).all()
+        assert (segment_arrays.weights == [0.5, 1/6, 0.5, 1/6, 1/6, 0.5]).all()
+        assert (h5io.get_pcoord_points(self.data_manager.get_iter_group(2), [-1])[[0,1]] 
+                == [pcoords[0,[-1]], self.pcoords[2][1,[-1]]]).all()
+        for n_iter in (1, 3):
+            assert (self.data_manager.get_iter_group(n_iter)['pcoord'][...] == self.pcoords[n_iter]).all()
+        
+    def test_replace_and_truncate(self):
+        # only the last iteration can be replaced or deleted
+        with nose.tools.assert_raises(ValueError):
+            self.prepare_iteration(2, 3)
+        with nose.tools.assert_raises(ValueError):
+            self.data_manager.del_iter_group(2)
+        self.prepare_iteration(3, 2)
+        assert self.data_manager.get_iter_group(3)['pcoord'].shape[0] == 2
+        
+        self.data_manager.del_iter_group(3)
+        assert self.data_manager.we_h5file['/packed/pcoord'].shape[0] == 10
+        assert len(self.data_manager.we_h5file['/packed/iter_index']) == 2
+        self.prepare_iteration(3, 7)
+        assert (self.data_manager.get_iter_group(3)['pcoord'][...] == self.pcoords[3]).all()
+
+class TestH5FileCache:
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'west.h5')
+        with h5io.WESTPAH5File(self.filename, 'w') as h5file:
+            h5file.create_iter_group(1)['pcoord'] = numpy.arange(12).reshape(4,3,1)
+
+    def teardown(self):
+        h5io.close_h5files()
+        shutil.rmtree(self.tempdir)
+
+    def test_reuse(self):
+        h5file = h5io.get_h5file(self.filename)
+        assert h5io.get_h5file(os.path.relpath(self.filename)) is h5file
+        assert h5file.id.get_access_plist().get_cache()[2] == h5io.default_rdcc_nbytes
+
+        # Dataset specifications share the open file, but do not pickle it
+        dsspec = h5io.SingleIterDSSpec(self.filename, 'pcoord', slice=numpy.index_exp[0])
+        assert dsspec.h5file is h5file
+        assert (dsspec.get_iter_data(1) == [[0],[3],[6],[9]]).all()
+        assert dsspec.__getstate__()['_h5file'] is None
+
+        h5file.close()
+        assert h5io.get_h5file(self.filename).id.valid
+
+    def test_fork(self):
+        h5file = h5io.get_h5file(self.filename)
+        (rfd, wfd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                reopened = h5io.get_h5file(self.filename) is not h5file
+                os.write(wfd, b'1' if reopened and h5file.id.valid else b'0')
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        os.waitpid(pid, 0)
+        assert os.read(rfd, 1) == b'1'
+        os.close(rfd)
+
+        # Closing files in the child does not affect the parent
+        assert h5io.get_h5file(self.filename) is h5file
+        assert h5file.id.valid
+
+    def test_reopen_modified(self):
+        h5file = h5io.get_h5file(self.filename)
+        assert 'iter_00000002' not in h5file['iterations']
+
+        # Add an iteration from another process, as a running simulation would (reading a file
+        # being written requires HDF5 file locking to be disabled)
+        environ = dict(os.environ, HDF5_USE_FILE_LOCKING='FALSE')
+        subprocess.check_call([sys.executable, '-c', 'import h5py; h5py.File({!r}, "a")["iterations/iter_00000002/pcoord"] = [1.0]'
+                               .format(self.filename)], env=environ)
+        reopened = h5io.get_h5file(self.filename)
+        assert not h5file.id.valid
+        assert 'iter_00000002' in reopened['iterations']
+        assert h5io.get_h5file(self.filename) is reopened
+
+    def test_default_rdcc_nslots(self):
+        assert h5io.rdcc_nslots_for(16*1024*1024) == 25601
+        assert h5io.rdcc_nslots_for(1024*1024) == 1601
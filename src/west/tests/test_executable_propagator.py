@@ -0,0 +1,376 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, sys, shutil, tempfile, time, threading, subprocess
+import argparse
+import numpy, h5py
+
+os.environ['WEST_SIM_ROOT'] = os.path.join(os.environ['WEST_ROOT'], 'lib/examples/odld')
+import westpa, west
+from west.segment import Segment
+from west.propagators.executable import ExecutablePropagator, ArrayFileLoader, parse_cpu_set
+
+import nose
+import nose.tools
+
+# Writes a constant progress coordinate equal to the segment ID, and records the slot and GPU
+# devices it was run with; fails for segment 3
+runseg_script = '''\
+#!/bin/sh
+sleep 0.3
+echo "$WEST_CHILD_SLOT $CUDA_VISIBLE_DEVICES" > {tempdir}/$WEST_CURRENT_SEG_ID.slot
+if [ "$WEST_CURRENT_SEG_ID" = 3 ] ; then
+    exit 1
+elif [ -n "$SKIP_RETURN" ] ; then
+    exit 0
+fi
+for i in $(seq {pcoord_len}) ; do
+    echo $WEST_CURRENT_SEG_ID
+done > $WEST_PCOORD_RETURN
+'''
+
+# Writes a constant progress coordinate (as text) and coordinates (in the format given by
+# $COORD_FORMAT, as a propagator would) equal to the segment ID
+runseg_array_script = '''\
+#!{python}
+import os
+import numpy, h5py
+seg_id = int(os.environ['WEST_CURRENT_SEG_ID'])
+numpy.savetxt(os.environ['WEST_PCOORD_RETURN'], numpy.full(({pcoord_len:d},), seg_id))
+coord = numpy.full(({pcoord_len:d}, 4, 3), seg_id, numpy.float32)
+if os.environ['COORD_FORMAT'] == 'npy':
+    numpy.save(os.environ['WEST_COORD_RETURN'], coord)
+elif os.environ['COORD_FORMAT'] == 'raw':
+    coord.tofile(os.environ['WEST_COORD_RETURN'])
+else:
+    with h5py.File(os.environ['WEST_COORD_RETURN'], 'w') as h5file:
+        h5file['coord'] = coord
+'''
+
+def test_parse_cpu_set():
+    assert parse_cpu_set('0-3,8,10-11') == {0, 1, 2, 3, 8, 10, 11}
+    assert parse_cpu_set([4, 5]) == {4, 5}
+    assert parse_cpu_set(6) == {6}
+
+class TestExecutablePropagator:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+        self.system = westpa.rc.get_system_driver()
+
+        self.tempdir = tempfile.mkdtemp()
+        self.runseg = os.path.join(self.tempdir, 'runseg.sh')
+        with open(self.runseg, 'wt') as runseg_file:
+            runseg_file.write(runseg_script.format(tempdir=self.tempdir, pcoord_len=self.system.pcoord_len))
+        os.chmod(self.runseg, 0o755)
+        self.propagators = []
+
+    def teardown(self):
+        for propagator in self.propagators:
+            if propagator._launcher is not None:
+                propagator._launcher.close()
+        del westpa.rc.config['west', 'executable']
+        westpa.rc._system = None
+        shutil.rmtree(self.tempdir)
+
+    def propagator(self, datasets=None, launcher=False, return_dir=None, **options):
+        propagator_info = {'executable': self.runseg, 'stdout': os.devnull, 'stderr': 'stdout'}
+        propagator_info.update(options)
+        westpa.rc.config['west', 'executable'] = {'propagator': propagator_info, 'environ': {}, 'datasets': datasets,
+                                                  'launcher': launcher, 'return_dir': return_dir}
+        self.propagators.append(ExecutablePropagator())
+        return self.propagators[-1]
+
+    def segments(self, n_segments):
+        return [Segment(n_iter=2, seg_id=seg_id, parent_id=0, weight=1.0/n_segments, status=Segment.SEG_STATUS_PREPARED)
+                for seg_id in range(n_segments)]
+
+    def slots(self, n_segments):
+        slots = {}
+        for seg_id in range(n_segments):
+            with open(os.path.join(self.tempdir, '{:d}.slot'.format(seg_id)), 'rt') as slot_file:
+                fields = slot_file.read().split()
+            slots[seg_id] = (int(fields[0]), fields[1] if len(fields) > 1 else None)
+        return slots
+
+    def check_segments(self, segments):
+        for segment in segments:
+            if segment.seg_id == 3:
+                assert segment.status == Segment.SEG_STATUS_FAILED
+            else:
+                assert segment.status == Segment.SEG_STATUS_COMPLETE
+                assert (segment.pcoord == segment.seg_id).all()
+                assert segment.walltime >= 0.3
+
+    def test_serial_propagation(self):
+        propagator = self.propagator()
+        assert propagator.max_children == 1
+        self.check_segments(propagator.propagate(self.segments(5)))
+
+    def test_concurrent_propagation(self):
+        propagator = self.propagator(concurrency=3, gpu_devices=['0', '1', '2,3'])
+        starttime = time.time()
+        segments = propagator.propagate(self.segments(6))
+        # Serial propagation would take 1.8 s
+        assert time.time() - starttime < 1.2
+        self.check_segments(segments)
+
+        slots = self.slots(len(segments))
+        assert {slot for (slot, devices) in slots.values()} == {0, 1, 2}
+        for (slot, devices) in slots.values():
+            assert devices == ['0', '1', '2,3'][slot]
+
+    def test_launcher(self):
+        propagator = self.propagator(launcher=True)
+        self.check_segments(propagator.propagate(self.segments(5)))
+        launcher = propagator._launcher
+        assert launcher is not None
+        self.check_segments(propagator.propagate(self.segments(5)))
+        assert propagator._launcher is launcher
+
+    def test_concurrent_launcher(self):
+        propagator = self.propagator(launcher=True, concurrency=3, gpu_devices=['0', '1', '2,3'])
+        starttime = time.time()
+        segments = propagator.propagate(self.segments(6))
+        assert time.time() - starttime < 1.2
+        self.check_segments(segments)
+        for (slot, devices) in self.slots(len(segments)).values():
+            assert devices == ['0', '1', '2,3'][slot]
+
+    @nose.tools.raises(OSError)
+    def test_launcher_missing_executable(self):
+        propagator = self.propagator(launcher=True, executable=os.path.join(self.tempdir, 'missing.sh'))
+        propagator.propagate(self.segments(1))
+
+    def test_launcher_environ(self):
+        # Changes to the environment after the launcher starts are seen by children
+        propagator = self.propagator(launcher=True)
+        propagator.get_launcher()
+        script = os.path.join(self.tempdir, 'environ.sh')
+        with open(script, 'wt') as script_file:
+            script_file.write('#!/bin/sh\necho $WEST_TEST_LAUNCHER_VAR\n')
+        os.chmod(script, 0o755)
+        output = os.path.join(self.tempdir, 'environ.out')
+        os.environ['WEST_TEST_LAUNCHER_VAR'] = 'set after start'
+        try:
+            (rc, _rusage) = propagator.exec_child(script, stdout=output)
+        finally:
+            del os.environ['WEST_TEST_LAUNCHER_VAR']
+        assert rc == 0
+        with open(output, 'rt') as output_file:
+            assert output_file.read().strip() == 'set after start'
+
+    def test_return_dir(self):
+        return_dir = os.path.join(self.tempdir, 'shm')
+        os.mkdir(return_dir)
+        propagator = self.propagator(return_dir=return_dir, concurrency=2)
+        self.check_segments(propagator.propagate(self.segments(5)))
+        self.check_segments(propagator.propagate(self.segments(5)))
+
+        # Directories of return files are reused; one for each process running at once, and one
+        # for the segment whose data is being loaded
+        (base_dir,) = os.listdir(return_dir)
+        assert sorted(os.listdir(os.path.join(return_dir, base_dir))) == ['0', '1', '2']
+        assert os.listdir(os.path.join(return_dir, base_dir, '0')) == ['pcoord']
+
+        # Data left by previous segments is not mistaken for new data
+        propagator.addtl_child_environ['SKIP_RETURN'] = '1'
+        for segment in propagator.propagate(self.segments(2)):
+            assert segment.status == Segment.SEG_STATUS_FAILED
+
+    def array_propagator(self, format, **options):
+        runseg = os.path.join(self.tempdir, 'runseg.py')
+        with open(runseg, 'wt') as runseg_file:
+            runseg_file.write(runseg_array_script.format(python=sys.executable, pcoord_len=self.system.pcoord_len))
+        os.chmod(runseg, 0o755)
+        propagator = self.propagator(datasets=[{'name': 'coord', 'format': format, 'dtype': 'float32',
+                                                'shape': [self.system.pcoord_len, 4, 3]}],
+                                     executable=runseg, **options)
+        propagator.addtl_child_environ['COORD_FORMAT'] = format
+        return propagator
+
+    def check_array_segments(self, segments):
+        for segment in segments:
+            assert segment.status == Segment.SEG_STATUS_COMPLETE
+            assert (segment.pcoord == segment.seg_id).all()
+            assert segment.data['coord'].shape == (self.system.pcoord_len, 4, 3)
+            assert (segment.data['coord'] == segment.seg_id).all()
+
+    def test_npy_return(self):
+        self.check_array_segments(self.array_propagator('npy').propagate(self.segments(3)))
+
+    def test_raw_return(self):
+        self.check_array_segments(self.array_propagator('raw').propagate(self.segments(3)))
+
+    def test_hdf5_return(self):
+        self.check_array_segments(self.array_propagator('hdf5').propagate(self.segments(3)))
+
+    def test_return_dir_arrays(self):
+        # Data memory-mapped from the return files of earlier segments is not overwritten by later ones
+        return_dir = os.path.join(self.tempdir, 'shm')
+        os.mkdir(return_dir)
+        for format in ('npy', 'raw'):
+            propagator = self.array_propagator(format, return_dir=return_dir)
+            self.check_array_segments(propagator.propagate(self.segments(4)))
+
+    def test_cpu_affinity(self):
+        cpu_set = sorted(os.sched_getaffinity(0))[:1]
+        propagator = self.propagator(cpu_affinity=[cpu_set, cpu_set])
+        assert propagator.max_children == 2
+        self.check_segments(propagator.propagate(self.segments(4)))
+
+    def test_cpu_affinity_applied(self):
+        cpu_set = sorted(os.sched_getaffinity(0))[-1:]
+        script = os.path.join(self.tempdir, 'affinity.py')
+        output = os.path.join(self.tempdir, 'affinity.out')
+        with open(script, 'wt') as script_file:
+            script_file.write('#!{}\nimport os, time\ntime.sleep(0.2)\nprint(sorted(os.sched_getaffinity(0)))\n'
+                              .format(sys.executable))
+        os.chmod(script, 0o755)
+        propagator = self.propagator()
+        (rc, _rusage) = propagator.exec_child(script, stdout=output, cpu_set=set(cpu_set))
+        assert rc == 0
+        with open(output, 'rt') as output_file:
+            assert output_file.read().strip() == str(cpu_set)
+
+    def test_reap_child_ignores_other_children(self):
+        # A child of another thread which has exited (but not been waited on) must neither be
+        # reaped nor keep the propagator from noticing the exit of its own children
+        propagator = self.propagator()
+        foreign = subprocess.Popen(['true'])
+        time.sleep(0.1)
+        procs = [propagator.spawn_child('/bin/true') for _i in range(2)]
+        reaped = []
+        reaper = threading.Thread(target=lambda: reaped.append(propagator.reap_child({proc.pid for proc in procs})))
+        reaper.daemon = True
+        reaper.start()
+        reaper.join(5)
+        try:
+            assert not reaper.is_alive()
+            assert reaped[0][0] in {proc.pid for proc in procs}
+            assert foreign.wait(5) == 0
+        finally:
+            for proc in procs:
+                if proc.pid != reaped[0][0]:
+                    os.waitpid(proc.pid, 0)
+
+    def test_spawn_failure_releases_return_files(self):
+        return_dir = os.path.join(self.tempdir, 'shm')
+        os.mkdir(return_dir)
+        for (options, concurrency) in (({}, 1), ({}, 2), ({'return_dir': return_dir}, 2)):
+            propagator = self.propagator(concurrency=concurrency, executable=os.path.join(self.tempdir, 'missing.sh'),
+                                         **options)
+            prepared = []
+            def prepare_return_files(segment, prepare_return_files=propagator.prepare_return_files):
+                prepared.append(prepare_return_files(segment))
+                return prepared[-1]
+            propagator.prepare_return_files = prepare_return_files
+            nose.tools.assert_raises(OSError, propagator.propagate, self.segments(2))
+            
+            for (_addtl_env, return_files, del_return_files, _return_dir) in prepared:
+                for (dataset, filename) in return_files.items():
+                    assert not (del_return_files[dataset] and os.path.exists(filename))
+            if propagator.return_dir_pool is not None:
+                pool = propagator.return_dir_pool
+                assert len(pool.free_dirs) == pool.n_dirs == 1
+
+    @nose.tools.raises(ValueError)
+    def test_too_few_slots(self):
+        self.propagator(concurrency=4, gpu_devices=['0', '1'])
+
+    def test_dataset_formats(self):
+        propagator = self.propagator(datasets=[{'name': 'pcoord', 'format': 'npy'},
+                                               {'name': 'coords', 'format': 'raw', 'dtype': 'float32'}])
+        assert isinstance(propagator.data_info['pcoord']['loader'], ArrayFileLoader)
+        assert propagator.data_info['coords']['loader'].dtype == numpy.float32
+
+
+class TestArrayFileLoader:
+
+    def setup(self):
+        parser = argparse.ArgumentParser()
+        westpa.rc.add_args(parser)
+        config_file_name = os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg')
+        args = parser.parse_args(['-r={}'.format(config_file_name)])
+        westpa.rc.process_args(args)
+        self.system = westpa.rc.get_system_driver()
+        self.tempdir = tempfile.mkdtemp()
+        self.segment = Segment(n_iter=1, seg_id=0)
+        self.pcoord = numpy.random.random((self.system.pcoord_len, self.system.pcoord_ndim))
+        self.coords = numpy.random.random((self.system.pcoord_len, 10, 3)).astype(numpy.float32)
+
+    def teardown(self):
+        westpa.rc._system = None
+        shutil.rmtree(self.tempdir)
+
+    def write(self, format, name, data):
+        filename = os.path.join(self.tempdir, '{}.{}'.format(name, format))
+        if format == 'npy':
+            numpy.save(filename, data)
+        elif format == 'raw':
+            data.tofile(filename)
+        else:
+            with h5py.File(filename, 'w') as h5file:
+                h5file[name] = data
+        return filename
+
+    def check_format(self, format, **options):
+        loader = ArrayFileLoader(format, **options)
+        loader('pcoord', self.write(format, 'pcoord', self.pcoord.astype(self.system.pcoord_dtype)), self.segment, False)
+        assert self.segment.pcoord.dtype == self.system.pcoord_dtype
+        assert numpy.allclose(self.segment.pcoord, self.pcoord)
+
+        loader = ArrayFileLoader(format, dtype=numpy.float32, shape=self.coords.shape, **options)
+        loader('coords', self.write(format, 'coords', self.coords), self.segment, False)
+        assert (self.segment.data['coords'] == self.coords).all()
+        assert type(self.segment.data['coords']) is numpy.ndarray
+
+    def test_npy(self):
+        self.check_format('npy')
+
+    def test_npy_no_mmap(self):
+        self.check_format('npy', mmap=False)
+
+    def test_raw(self):
+        self.check_format('raw')
+
+    def test_hdf5(self):
+        self.check_format('hdf5')
+
+    def test_single_point(self):
+        loader = ArrayFileLoader('raw')
+        loader('pcoord', self.write('raw', 'pcoord', self.pcoord[0].astype(self.system.pcoord_dtype)), self.segment, True)
+        assert self.segment.pcoord.shape == (self.system.pcoord_ndim,)
+
+    @nose.tools.raises(ValueError)
+    def test_pcoord_shape(self):
+        loader = ArrayFileLoader('npy')
+        loader('pcoord', self.write('npy', 'pcoord', self.pcoord[1:]), self.segment, False)
+
+    @nose.tools.raises(ValueError)
+    def test_raw_size(self):
+        loader = ArrayFileLoader('raw', dtype=numpy.float32, shape=(5,10,3))
+        loader('coords', self.write('raw', 'coords', self.coords), self.segment, False)
+
+    @nose.tools.raises(ValueError)
+    def test_invalid_format(self):
+        ArrayFileLoader('npz')
@@ -0,0 +1,114 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, threading, multiprocessing
+
+from west.propagators import WESTPropagator
+
+import nose
+import nose.tools
+
+
+class CountingPropagator(WESTPropagator):
+    def __init__(self, log_filename=None):
+        super(CountingPropagator,self).__init__()
+        self.log_filename = log_filename
+        self.n_setup = 0
+        self.n_created = 0
+        self.released = []
+
+    def log(self, event):
+        if self.log_filename:
+            with open(self.log_filename, 'at') as log_file:
+                log_file.write('{} {:d}\n'.format(event, os.getpid()))
+
+    def setup_worker(self):
+        self.n_setup += 1
+        self.log('setup')
+
+    def teardown_worker(self):
+        self.log('teardown')
+
+    def create(self):
+        self.n_created += 1
+        return object()
+
+    def release_context(self, key, context):
+        self.released.append(key)
+        self.log('release')
+
+def run_worker(propagator):
+    propagator.ensure_worker_setup()
+    propagator.get_context('engine', propagator.create)
+
+class TestWorkerLifetime:
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.log_filename = os.path.join(self.tempdir, 'events.log')
+        self.propagator = CountingPropagator(self.log_filename)
+
+    def teardown(self):
+        # Tear down now, rather than when the test process exits
+        self.propagator._teardown_worker(os.getpid())
+        shutil.rmtree(self.tempdir)
+
+    def test_setup_once(self):
+        self.propagator.ensure_worker_setup()
+        self.propagator.ensure_worker_setup()
+        assert self.propagator.n_setup == 1
+
+    def test_context_cache(self):
+        context = self.propagator.get_context(('system', 'integrator', 'CPU'), self.propagator.create)
+        assert self.propagator.get_context(('system', 'integrator', 'CPU'), self.propagator.create) is context
+        self.propagator.get_context(('system', 'integrator', 'CUDA'), self.propagator.create)
+        assert self.propagator.n_created == 2
+
+        self.propagator.clear_contexts()
+        assert sorted(self.propagator.released) == [('system', 'integrator', 'CPU'), ('system', 'integrator', 'CUDA')]
+        self.propagator.get_context(('system', 'integrator', 'CPU'), self.propagator.create)
+        assert self.propagator.n_created == 3
+
+    def test_contexts_per_thread(self):
+        contexts = []
+        threads = [threading.Thread(target=lambda: contexts.append(self.propagator.get_context('engine',
+                                                                                              self.propagator.create)))
+                   for _i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len({id(context) for context in contexts}) == 3
+
+        self.propagator.clear_contexts()
+        assert self.propagator.released == ['engine']*3
+
+    def test_worker_process(self):
+        # Set up in this process first, as when the master creates the propagator before forking workers
+        self.propagator.ensure_worker_setup()
+        self.propagator.get_context('engine', self.propagator.create)
+
+        worker = multiprocessing.Process(target=run_worker, args=(self.propagator,))
+        worker.start()
+        worker.join()
+        assert worker.exitcode == 0
+
+        with open(self.log_filename, 'rt') as log_file:
+            events = [line.split() for line in log_file]
+        worker_events = [event for (event, pid) in events if int(pid) == worker.pid]
+        assert worker_events == ['setup', 'teardown', 'release']
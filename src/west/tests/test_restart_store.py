@@ -0,0 +1,120 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile
+import numpy
+
+from west.segment import Segment
+from west.restart_store import RestartStore
+
+import nose
+import nose.tools
+
+
+class TestRestartStore:
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = RestartStore(os.path.join(self.tempdir, 'restarts'))
+
+        # Iteration 1: segment 0 continues into segments 0 and 1 of iteration 2, segment 1
+        # continues into segment 2, segment 2 is merged, and segment 3 is recycled
+        self.parents = [Segment(n_iter=1, seg_id=seg_id, status=Segment.SEG_STATUS_COMPLETE, endpoint_type=endpoint_type)
+                        for (seg_id, endpoint_type) in enumerate([Segment.SEG_ENDPOINT_CONTINUES,
+                                                                  Segment.SEG_ENDPOINT_CONTINUES,
+                                                                  Segment.SEG_ENDPOINT_MERGED,
+                                                                  Segment.SEG_ENDPOINT_RECYCLED])]
+        self.children = [Segment(n_iter=2, seg_id=seg_id, parent_id=parent_id, status=Segment.SEG_STATUS_PREPARED)
+                         for (seg_id, parent_id) in enumerate([0, 0, 1])]
+        self.children.append(Segment(n_iter=2, seg_id=3, parent_id=-1, status=Segment.SEG_STATUS_PREPARED))
+        for parent in self.parents:
+            self.store.save(parent, coord=numpy.full((10,3), parent.seg_id), veloc=numpy.zeros((10,3)))
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def complete(self, *seg_ids):
+        for seg_id in seg_ids:
+            self.children[seg_id].status = Segment.SEG_STATUS_COMPLETE
+        return [self.children[seg_id] for seg_id in seg_ids]
+
+    def test_load_parent(self):
+        restart_data = self.store.load_parent(self.children[2])
+        assert sorted(restart_data) == ['coord', 'veloc']
+        assert (restart_data['coord'] == 1).all()
+        assert restart_data['veloc'].shape == (10,3)
+        assert sorted(os.listdir(self.store.iter_dir(1))) == ['0.npz', '1.npz', '2.npz', '3.npz']
+
+    @nose.tools.raises(ValueError)
+    def test_load_parent_newtraj(self):
+        self.store.load_parent(self.children[3])
+
+    @nose.tools.raises(KeyError)
+    def test_load_missing(self):
+        self.store.load(1, 4)
+
+    def remove_unneeded(self):
+        self.store.remove_unneeded(self.store.pop_unneeded())
+
+    def test_refcounts(self):
+        self.store.retain(2, self.children)
+        self.remove_unneeded()
+        assert self.store.stored_seg_ids(1) == {0, 1}
+
+        # Failed segments will be rerun, and still need their parents' data
+        self.children[0].status = Segment.SEG_STATUS_FAILED
+        self.store.release([self.children[0]])
+        self.remove_unneeded()
+        assert self.store.stored_seg_ids(1) == {0, 1}
+
+        self.store.release(self.complete(0, 2, 3))
+        self.remove_unneeded()
+        assert self.store.stored_seg_ids(1) == {0}
+
+        # Each segment is released only once
+        self.store.release(self.complete(0))
+        self.remove_unneeded()
+        assert self.store.stored_seg_ids(1) == {0}
+
+        self.store.release(self.complete(1))
+        self.remove_unneeded()
+        assert self.store.stored_seg_ids(1) == set()
+
+    def test_removal_deferred(self):
+        # Nothing is removed until the master has stored the changes which made data unneeded
+        self.store.retain(2, self.children)
+        self.store.release(self.complete(0, 1, 2, 3))
+        assert self.store.stored_seg_ids(1) == {0, 1, 2, 3}
+
+        unneeded = self.store.pop_unneeded()
+        assert sorted(unneeded) == [(1, 0), (1, 1), (1, 2), (1, 3)]
+        assert self.store.pop_unneeded() == []
+        self.store.remove_unneeded(unneeded)
+        assert self.store.stored_seg_ids(1) == set()
+
+    def test_retain_incomplete(self):
+        # As on restarting an interrupted iteration, in which some segments are complete
+        self.store.retain(2, [self.children[1], self.children[3]])
+        self.remove_unneeded()
+        assert self.store.stored_seg_ids(1) == {0}
+
+        self.store.save(self.children[1], coord=numpy.zeros((10,3)))
+        self.store.retain(4, [])
+        assert os.listdir(self.store.directory)
+        self.remove_unneeded()
+        assert not os.listdir(self.store.directory)
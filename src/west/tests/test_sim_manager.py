@@ -16,17 +16,23 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import os
+import os, time, operator, collections
 import argparse
-import numpy
+from concurrent.futures import CancelledError
+import numpy, h5py
 
 os.environ['WEST_SIM_ROOT'] = os.path.join(os.environ['WEST_ROOT'], 'lib/examples/odld')
 import westpa, west
 from westpa.binning.assign import RectilinearBinMapper
+from west.states import TargetState
+from work_managers import WMFuture
+from work_managers.serial import SerialWorkManager
 
 import nose
 import nose.tools
 
+from .tsupport import SimulationRunTests
+
 
 class TestSimManager:
 
@@ -46,6 +52,46 @@ class TestSimManager:
     def test_sim_manager(self):
         assert self.sim_manager.n_propagated == 0
         assert len(self.sim_manager._callback_table) == 0
+        # Opt-in modes that change how segments are dispatched
+        assert not self.sim_manager.pipeline_iterations
+        assert not self.sim_manager.save_timing
+        assert self.sim_manager.block_scheduling == 'fixed'
+
+    def test_segment_costs(self):
+        segments = [west.Segment(n_iter=2, seg_id=seg_id, parent_id=parent_id) for (seg_id, parent_id) in enumerate([0, 1, -1, 2])]
+        self.sim_manager.n_iter = 2
+        self.sim_manager.parent_walltimes = {0: 5.0, 1: 1.0, 2: 0.0}
+        # New trajectories, and segments whose parents' walltimes are unknown, cost the median
+        assert self.sim_manager.get_segment_costs(segments) == [5.0, 1.0, 3.0, 3.0]
+
+        self.sim_manager.parent_walltimes = {0: 0.0, 1: 0.0}
+        assert self.sim_manager.get_segment_costs(segments) == [1.0]*4
+
+    def test_resubmit_cost_hint(self):
+        sim_manager = self.sim_manager
+        sim_manager.work_manager = RecordingWorkManager()
+        segment = west.Segment(n_iter=1, seg_id=0, pcoord=numpy.zeros((1,1)))
+        stragglers = west.sim_manager.StragglerMonitor(1, segment_timeout=1.0)
+        futures = {object()}
+        stragglers.submitted(next(iter(futures)), 0, 1, 0.0)
+
+        # A speculative copy of a block has the same expected cost as the original
+        sim_manager.resubmit_stragglers(stragglers, {0: (set(), set(), [segment])}, {0: 5.0}, futures, set(futures))
+        [(fn, args, cost_hint)] = sim_manager.work_manager.submitted
+        assert fn is west.wm_ops.propagate
+        assert cost_hint == 5.0
+        assert len(futures) == 2
+
+    def test_block_succeeded(self):
+        complete = west.Segment(n_iter=1, seg_id=0, status=west.Segment.SEG_STATUS_COMPLETE)
+        incomplete = west.Segment(n_iter=1, seg_id=1, status=west.Segment.SEG_STATUS_PREPARED)
+        futures = [WMFuture() for _i in range(3)]
+        futures[0]._set_result([complete])
+        futures[1]._set_result([complete, incomplete])
+        futures[2]._set_exception(RuntimeError())
+        assert [self.sim_manager.block_succeeded(future) for future in futures] == [True, False, False]
+        # The result is still available for use
+        assert futures[0].get_result() == [complete]
 
     def dummy_callback_one(self):
         system = self.sim_manager.system
@@ -80,3 +126,341 @@ class TestSimManager:
 
         system = self.sim_manager.system
         assert numpy.all(system.bin_mapper.boundaries == numpy.array([0.0, 1.0, 2.0, 3.0]))
+
+
+class RecordingWorkManager(SerialWorkManager):
+    '''A serial work manager which records the function and arguments, and the cost hint, of each task.'''
+
+    def __init__(self):
+        super().__init__()
+        self.submitted = []
+
+    def submit(self, fn, args=None, kwargs=None, priority=0, cost_hint=None):
+        self.submitted.append((fn, args, cost_hint))
+        return super().submit(fn, args, kwargs, priority, cost_hint)
+
+
+class StragglingWorkManager(RecordingWorkManager):
+    '''A serial work manager which holds back the first task propagating any of the segment IDs ``straggling``
+    in each iteration, until nothing else remains to be done. Copies of a task either run immediately or,
+    if ``fail_copies``, fail. The cputime of each segment propagated is set to 1 by an original task and 2
+    by a copy, so that it can be seen which result was kept.'''
+
+    def __init__(self, straggling, cancellable=False, fail_copies=False):
+        super().__init__()
+        self.straggling = set(straggling)
+        self.cancellable = cancellable
+        self.fail_copies = fail_copies
+        self.n_copies = collections.Counter()
+        self.held = {}
+
+    def submit(self, fn, args=None, kwargs=None, priority=0, cost_hint=None):
+        if fn is not west.wm_ops.propagate:
+            return super().submit(fn, args, kwargs, priority, cost_hint)
+        self.submitted.append((fn, args, cost_hint))
+        segment_block = args[2]
+        block_key = (segment_block[0].n_iter, tuple(segment.seg_id for segment in segment_block))
+        copy = self.n_copies[block_key]
+        self.n_copies[block_key] += 1
+
+        future = WMFuture()
+        if not copy and self.straggling.intersection(block_key[1]):
+            self.held[future] = args
+        elif copy and self.fail_copies:
+            future._set_exception(RuntimeError('copy failed'))
+        else:
+            self.propagate(future, args, cputime=2.0 if copy else 1.0)
+        return future
+
+    def propagate(self, future, args, cputime):
+        segments = west.wm_ops.propagate(*args)
+        for segment in segments:
+            segment.cputime = cputime
+        future._set_result(segments)
+
+    def cancel(self, future):
+        if self.cancellable and future in self.held:
+            del self.held[future]
+            future._set_exception(CancelledError())
+            return True
+        return False
+
+    def wait_any(self, futures, timeout=None):
+        for future in futures:
+            if future.done:
+                return future
+        if timeout is not None:
+            time.sleep(max(timeout, 0))
+            return None
+        for future in futures:
+            if future in self.held:
+                self.propagate(future, self.held.pop(future), cputime=1.0)
+                return future
+
+
+class TestSimulationRuns(SimulationRunTests):
+
+    def test_reproducible(self):
+        assert self.compare_files(self.run_sim('a'), self.run_sim('b')) == []
+
+    def test_pipelined_equivalence(self):
+        assert self.compare_files(self.run_sim('serial'), self.run_sim('pipelined', pipeline=True)) == []
+
+    def test_write_behind_equivalence(self):
+        serial = self.run_sim('serial')
+        data_options = {'write_behind': 'true', 'write_queue_size': 2}
+        assert self.compare_files(serial, self.run_sim('write_behind', data_options=data_options)) == []
+        assert self.compare_files(serial, self.run_sim('write_behind_pipelined', pipeline=True, 
+                                                       data_options=data_options)) == []
+
+    def test_pipelined_state_change(self):
+        # A plugin changing the target states must be seen by the next iteration, even though
+        # pipelined mode otherwise carries them over in memory
+        def move_target():
+            sim_manager = westpa.rc.get_sim_manager()
+            if sim_manager.n_iter == 2:
+                sim_manager.data_manager.save_target_states([TargetState('sink', [7.8])], n_iter=3)
+
+        callbacks = [('post_we', move_target)]
+        serial = self.run_sim('serial', callbacks=callbacks)
+        pipelined = self.run_sim('pipelined', pipeline=True, callbacks=callbacks)
+        assert self.compare_files(serial, pipelined) == []
+        with h5py.File(pipelined, 'r') as h5file:
+            assert h5file['iterations/iter_00000003/new_weights/index'].shape[0] > 0
+
+    def test_timing(self):
+        h5filename = self.run_sim('untimed', n_iters=2)
+        with h5py.File(h5filename, 'r') as h5file:
+            assert 'timing' not in h5file['iterations/iter_00000001']
+
+        for pipeline in (False, True):
+            # Delay the background writer, so that in pipelined mode it is still committing the
+            # segments of an iteration when the iteration ends
+            def delay_writer():
+                westpa.rc.get_sim_manager()._commit(time.sleep, 0.1)
+
+            h5filename = self.run_sim('timed_{}'.format(pipeline), n_iters=2, pipeline=pipeline,
+                                      options={'save_timing': 'true'}, callbacks=[('pre_propagation', delay_writer)])
+            data_manager = westpa.rc.get_data_manager()
+            data_manager.open_backing('r')
+            try:
+                for n_iter in (1, 2):
+                    timings = data_manager.get_iter_timing(n_iter)
+                    n_segments = len(data_manager.get_seg_index(n_iter))
+                    for name in ('iteration', 'prepare_iteration', 'propagate', 'run_we', 'callback:pre_propagation:{}.{}'
+                                 .format(delay_writer.__module__, delay_writer.__qualname__)):
+                        assert name in timings, name
+                    # Each segment is stored as it is propagated, then all after the WE step, and
+                    # this is counted in the iteration concerned
+                    assert timings['data_manager:update_segments'][1] == n_segments + 1
+            finally:
+                data_manager.close_backing()
+
+    def test_propagation_cost_hints(self):
+        work_manager = RecordingWorkManager()
+        h5filename = self.run_sim('costs', n_iters=2, work_manager=work_manager)
+        with h5py.File(h5filename, 'r') as h5file:
+            parent_walltimes = h5file['iterations/iter_00000001/seg_index']['walltime']
+
+        cost_hints = {}
+        for (fn, args, cost_hint) in work_manager.submitted:
+            if fn is west.wm_ops.propagate:
+                [segment] = args[2]
+                cost_hints[segment.n_iter, segment.seg_id] = (segment.parent_id, cost_hint)
+        assert len(cost_hints) > 4
+        for ((n_iter, seg_id), (parent_id, cost_hint)) in cost_hints.items():
+            if n_iter == 1:
+                # Nothing is known of the costs of the first iteration
+                assert cost_hint == 1.0
+            elif parent_id >= 0:
+                # Otherwise, a segment is expected to take as long as its parent...
+                assert cost_hint == parent_walltimes[parent_id]
+            else:
+                # ...or, if starting a new trajectory, as long as the median segment
+                assert cost_hint == numpy.median(parent_walltimes)
+
+    def test_error_not_masked(self):
+        # An error in the background writer must not replace the exception raised by the iteration
+        def fail():
+            writer = westpa.rc.get_sim_manager()._writer
+            writer.submit(operator.truediv, 1, 0)
+            writer.queue.join()
+            raise RuntimeError('propagation failed')
+
+        with nose.tools.assert_raises(RuntimeError):
+            self.run_sim('pipelined', pipeline=True, callbacks=[('pre_propagation', fail)])
+
+
+class TestStragglerResubmission(SimulationRunTests):
+
+    options = {'segment_timeout': 0.01, 'max_resubmits': 1}
+
+    def run_straggling(self, name, **kwargs):
+        work_manager = StragglingWorkManager([2], **kwargs)
+        h5filename = self.run_sim(name, n_iters=2, work_manager=work_manager, options=self.options)
+        with h5py.File(h5filename, 'r') as h5file:
+            cputimes = [h5file['iterations/iter_{:08d}/seg_index'.format(n_iter)]['cputime'] for n_iter in (1, 2)]
+            events = []
+            for n_iter in (1, 2):
+                event_table = h5file['iterations/iter_{:08d}/events'.format(n_iter)][...]
+                events.append({row['name'].decode() if isinstance(row['name'], bytes) else row['name']: int(row['count'])
+                               for row in event_table})
+        return work_manager, h5filename, cputimes, events
+
+    def check_cputimes(self, cputimes, straggler_cputime):
+        for iter_cputimes in cputimes:
+            assert iter_cputimes[2] == straggler_cputime
+            assert (numpy.delete(iter_cputimes, 2) == 1.0).all()
+
+    def test_copy_wins_cancelled(self):
+        work_manager, h5filename, cputimes, events = self.run_straggling('cancelled', cancellable=True)
+        for iter_events in events:
+            assert iter_events == {'propagate:straggler_resubmitted': 1, 'propagate:speculative_won': 1,
+                                   'propagate:speculative_cancelled': 1}
+        # The copy's results are kept, and are those of the original
+        self.check_cputimes(cputimes, 2.0)
+        assert self.compare_files(self.run_sim('plain', n_iters=2), h5filename, skip=('timing', 'events')) == []
+
+        # The copy has the same expected cost as the original
+        cost_hints = [cost_hint for (fn, args, cost_hint) in work_manager.submitted
+                      if fn is west.wm_ops.propagate and args[2][0].seg_id == 2]
+        assert len(cost_hints) == 4
+        assert cost_hints[0] == cost_hints[1] and cost_hints[2] == cost_hints[3]
+
+    def test_copy_wins_abandoned(self):
+        work_manager, h5filename, cputimes, events = self.run_straggling('abandoned', cancellable=False)
+        for iter_events in events:
+            assert iter_events == {'propagate:straggler_resubmitted': 1, 'propagate:speculative_won': 1,
+                                   'propagate:speculative_abandoned': 1}
+        self.check_cputimes(cputimes, 2.0)
+        # The original is left running; its result is ignored
+        assert len(work_manager.held) == 2
+
+    def test_copy_fails(self):
+        work_manager, h5filename, cputimes, events = self.run_straggling('failed', fail_copies=True)
+        for iter_events in events:
+            assert iter_events == {'propagate:straggler_resubmitted': 1, 'propagate:speculative_failed': 1}
+        # The iteration completes with the results of the original
+        self.check_cputimes(cputimes, 1.0)
+        assert not work_manager.held
+        assert self.compare_files(self.run_sim('plain', n_iters=2), h5filename, skip=('timing', 'events')) == []
+
+    def test_no_stragglers(self):
+        h5filename = self.run_sim('plain', n_iters=2, options=self.options)
+        with h5py.File(h5filename, 'r') as h5file:
+            assert 'events' not in h5file['iterations/iter_00000001']
+
+
+class TestIterationWriter:
+
+    def setup(self):
+        self.writer = west.sim_manager.IterationWriter()
+
+    def teardown(self):
+        self.writer.shutdown()
+
+    def test_ordering(self):
+        results = []
+        for i in range(100):
+            self.writer.submit(results.append, i)
+        self.writer.barrier()
+        assert results == list(range(100))
+
+    def test_error_propagation(self):
+        results = []
+        self.writer.submit(operator.truediv, 1, 0)
+        self.writer.submit(results.append, 1)
+        nose.tools.assert_raises(ZeroDivisionError, self.writer.barrier)
+        # operations following a failure are discarded
+        assert results == []
+        nose.tools.assert_raises(ZeroDivisionError, self.writer.submit, results.append, 2)
+
+
+class TestStragglerMonitor:
+
+    def submit(self, monitor, n_blocks, now=0.0, n_segments=1):
+        futures = [object() for _i in range(n_blocks)]
+        for (block_key, future) in enumerate(futures):
+            monitor.submitted(future, block_key, n_segments, now)
+        return futures
+
+    def test_start_estimate(self):
+        monitor = west.sim_manager.StragglerMonitor(4, n_workers=2)
+        futures = self.submit(monitor, 4)
+        assert set(monitor.started) == set(futures[:2])
+
+        assert monitor.completed(futures[0], 5.0) == set()
+        assert monitor.started[futures[2]] == 5.0
+        assert futures[3] not in monitor.started
+        assert monitor.block_times == [5.0]
+        assert monitor.n_outstanding == 3
+
+    def test_disabled(self):
+        monitor = west.sim_manager.StragglerMonitor(4)
+        self.submit(monitor, 4)
+        assert monitor.next_deadline() is None
+        assert monitor.stragglers(1e9) == set()
+
+    def test_timeout(self):
+        monitor = west.sim_manager.StragglerMonitor(3, n_workers=2, segment_timeout=10)
+        futures = self.submit(monitor, 3, n_segments=2)
+        assert monitor.next_deadline() == 20.0
+        assert monitor.stragglers(19.0) == set()
+        assert monitor.stragglers(20.0) == {0, 1}
+
+        # Each block is resubmitted at most max_resubmits times
+        copy = object()
+        monitor.resubmitted(copy, 0, 20.0)
+        assert monitor.stragglers(100.0) == set()
+
+        # The third block starts when the first copy to complete frees a worker
+        assert monitor.completed(copy, 25.0) == {futures[0]}
+        monitor.finished(futures[0], 25.0)
+        assert monitor.started[futures[2]] == 25.0
+        assert monitor.next_deadline() == 45.0
+
+    def test_unknown_workers(self):
+        # As for a ZeroMQ master to which no workers have yet connected
+        monitor = west.sim_manager.StragglerMonitor(3, n_workers=0, segment_timeout=10)
+        futures = self.submit(monitor, 3)
+        assert monitor.next_deadline() == 10.0
+
+        # Once workers connect, no task is taken to have started before then
+        monitor.set_n_workers(1, 5.0)
+        assert monitor.started == {futures[0]: 5.0}
+        assert monitor.next_deadline() == 15.0
+        assert monitor.stragglers(12.0) == set()
+
+        monitor.set_n_workers(2, 6.0)
+        assert monitor.started == {futures[0]: 5.0, futures[1]: 6.0}
+        monitor.set_n_workers(1, 7.0)
+        assert monitor.started == {futures[0]: 5.0}
+        assert list(monitor.unstarted) == futures[1:]
+
+        monitor.completed(futures[0], 8.0)
+        assert monitor.started == {futures[1]: 8.0}
+        assert monitor.next_deadline() == 18.0
+        assert monitor.stragglers(17.0) == set()
+        assert monitor.stragglers(18.0) == {1}
+
+    def test_tail(self):
+        monitor = west.sim_manager.StragglerMonitor(20, n_workers=20, tail_factor=3.0, tail_fraction=0.1)
+        futures = self.submit(monitor, 20)
+        for future in futures[:17]:
+            monitor.completed(future, 2.0)
+        assert monitor.stragglers(100.0) == set()
+
+        # In the tail, blocks are stragglers once they take longer than 3 times the median
+        monitor.completed(futures[17], 2.0)
+        assert monitor.next_deadline() == 6.0
+        assert monitor.stragglers(6.0) == {18, 19}
+
+
+def test_guided_blocks():
+    segments = list(range(8))
+    costs = [1.0, 8.0, 1.0, 1.0, 4.0, 1.0, 2.0, 2.0]
+
+    # Longest first, with blocks shrinking as the expected cost remaining falls
+    assert west.sim_manager.guided_blocks(segments, costs, n_workers=2, max_block_size=4) == [[1], [4, 6], [7, 0], [2], [3], [5]]
+    assert west.sim_manager.guided_blocks(segments, costs, n_workers=2, max_block_size=1) == [[i] for i in [1, 4, 6, 7, 0, 2, 3, 5]]
+    assert west.sim_manager.guided_blocks(segments, costs, max_block_size=3) == [[1, 4, 6], [7, 0, 2], [3, 5]]
@@ -16,7 +16,7 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from ..we_driver import WEDriver
+from ..we_driver import WEDriver, ArrayWEDriver
 from ..systems import WESTSystem
 from westpa.binning import RectilinearBinMapper
 from ..states import TargetState, InitialState
@@ -29,12 +29,14 @@ import nose
 import nose.tools
 
 class TestWEDriver:    
+    we_driver_class = WEDriver
+    
     def setup(self):
         system = WESTSystem()
         system.bin_mapper = RectilinearBinMapper([[0.0, 1.0, 2.0]])
         system.bin_target_counts = numpy.array([4,4])
         system.pcoord_len = 2
-        self.we_driver = WEDriver(system=system)
+        self.we_driver = self.we_driver_class(system=system)
         self.system = system
         self._seg_id = 0
 
@@ -136,7 +138,7 @@ class TestWEDriver:
         system.bin_mapper = RectilinearBinMapper([[0.0, 1.0]])
         system.bin_target_counts = numpy.array([1])
         system.pcoord_len = 2
-        self.we_driver = WEDriver(system=system)
+        self.we_driver = self.we_driver_class(system=system)
         self.system = system
         self._seg_id = 0
         
@@ -230,6 +232,29 @@ class TestWEDriver:
                               [0.25 for _i in range(4)])
         assert segments[0].endpoint_type == Segment.SEG_ENDPOINT_RECYCLED
 
+    def test_recycle_merge_istates(self):
+        # two walkers recycled into a bin with a target count of 1; the initial state of
+        # the walker merged away must be returned for future use
+        self.system.bin_target_counts = numpy.array([1,1])
+        segments = [self.segment(0.0, 1.5, weight=0.5),
+                    self.segment(0.0, 1.5, weight=0.5)]
+        tstate = TargetState('recycle', [1.5], 0)
+        istates = [InitialState(0, 0, 0, pcoord=[0.0]), InitialState(1, 0, 0, pcoord=[0.0])]
+        
+        self.we_driver.new_iteration(initial_states=istates, target_states=[tstate])
+        self.we_driver.assign(segments)
+        self.we_driver.construct_next()
+        
+        assert len(self.we_driver.next_iter_binning[0]) == 1
+        assert len(self.we_driver.next_iter_binning[1]) == 0
+        newseg = self.we_driver.next_iter_binning[0].pop()
+        assert abs(newseg.weight - 1.0) < 2*EPS
+        assert list(self.we_driver.used_initial_states) == [newseg.initial_state_id]
+        assert list(self.we_driver.avail_initial_states) == [1 - newseg.initial_state_id]
+        assert self.we_driver.avail_initial_states[1 - newseg.initial_state_id].iter_used is None
+        assert all(segment.endpoint_type == Segment.SEG_ENDPOINT_RECYCLED for segment in segments)
+        assert len(self.we_driver.new_weights) == 2
+
         
     def test_multiple_merge(self):
         
@@ -264,3 +289,46 @@ class TestWEDriver:
 
     # TODO: add test for seeding the flux matrix based on recycling 
     # TODO: add test for split after merge in adjust count
+
+class TestArrayWEDriver(TestWEDriver):
+    we_driver_class = ArrayWEDriver
+    
+    def test_split_with_adjust_istates(self):
+        # this is a split followed by merge, for segments which are initial states
+        self.system.bin_target_counts = numpy.array([5,5])
+        self.we_driver.new_iteration()
+        self.we_driver._prep_we()
+        self.we_driver.used_initial_states[0] = None
+        self.we_driver.used_initial_states[1] = None
+        
+        segments = []
+        for ibin in range(len(self.we_driver.next_iter_binning)):
+            pc = numpy.array([[0.5+ibin],[0.0]])
+            for iseg in range(6):
+                segments.append((ibin, Segment(n_iter=1, seg_id=None, weight=1.0/12.0,
+                                               parent_id=-(ibin+1), wtg_parent_ids={-(ibin+1)}, pcoord=pc)))
+        self.we_driver._load_walkers(segments, 1, continuing=False)
+        
+        # This will raise KeyError if initial state tracking is done improperly
+        self.we_driver._run_we()
+
+        assert len(self.we_driver.next_iter_binning[0]) == 5
+        assert len(self.we_driver.next_iter_binning[1]) == 5
+        
+    def test_merge_wtg(self):
+        # weight transfer graph of a merged walker includes all walkers merged into it
+        self.system.bin_target_counts = numpy.array([1,1])
+        segments = [self.segment(0.0, 0.5, weight=0.25) for _i in range(4)]
+        self.we_driver.new_iteration()
+        self.we_driver.assign(segments)
+        self.we_driver.construct_next()
+        
+        assert len(self.we_driver.next_iter_binning[0]) == 1
+        newseg = self.we_driver.next_iter_binning[0].pop()
+        assert abs(newseg.weight - 1.0) < 4*EPS
+        assert newseg.wtg_parent_ids == {segment.seg_id for segment in segments}
+        for segment in segments:
+            if segment.seg_id == newseg.parent_id:
+                assert segment.endpoint_type == Segment.SEG_ENDPOINT_CONTINUES
+            else:
+                assert segment.endpoint_type == Segment.SEG_ENDPOINT_MERGED
@@ -0,0 +1,187 @@
+# Copyright (C) 2013 Joshua L. Adelman
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Support for tests which run short simulations.'''
+
+import os, shutil, tempfile, random, operator
+import argparse
+import numpy, h5py
+
+import westpa
+from westpa.yamlcfg import YAMLConfig
+from west.propagators import WESTPropagator
+from west.states import BasisState, TargetState
+from west.we_driver import ArrayWEDriver
+from work_managers.serial import SerialWorkManager
+
+
+class OrderedWEDriver(ArrayWEDriver):
+    '''A WE driver whose results do not depend on the order in which segments are held in bins
+    (sets, and hence ordered by object identity), so that separate runs may be compared.'''
+
+    def _binned_segments(self):
+        return [(ibin, segment) for (ibin, _bin) in enumerate(self.final_binning)
+                for segment in sorted(_bin, key=operator.attrgetter('seg_id'))]
+
+    @property
+    def next_iter_segments(self):
+        for _bin in self.next_iter_binning:
+            yield from sorted(_bin, key=lambda segment: (segment.parent_id, segment.weight, sorted(segment.wtg_parent_ids)))
+
+
+class DeterministicPropagator(WESTPropagator):
+    '''Moves each segment a fixed distance (depending on its ID) down the progress coordinate.'''
+
+    def get_pcoord(self, state):
+        state.pcoord = numpy.array([8.0], dtype=numpy.float32)
+
+    def gen_istate(self, basis_state, initial_state):
+        initial_state.pcoord = numpy.array([8.0], dtype=numpy.float32)
+        initial_state.istate_status = initial_state.ISTATE_STATUS_PREPARED
+        return initial_state
+
+    def propagate(self, segments):
+        for segment in segments:
+            step = 0.1*(1 + segment.seg_id % 5)
+            n = len(segment.pcoord)
+            segment.pcoord[:,0] = segment.pcoord[0,0] - step*numpy.arange(n)/(n-1)
+            segment.walltime = 1.0 + segment.seg_id % 3
+            segment.status = segment.SEG_STATUS_COMPLETE
+        return segments
+
+
+run_config = '''---
+west:
+  drivers:
+    we_driver: {module}.OrderedWEDriver
+    module_path: [{odld_dir}]
+  system:
+    driver: odld_system.ODLDSystem
+  propagation:
+    max_total_iterations: {n_iters}
+    propagator: {module}.DeterministicPropagator
+    block_size: 1
+    pipeline_iterations: {pipeline}
+{options}
+  data:
+    west_data_file: west.h5
+{data_options}
+'''
+
+
+class SimulationRunTests:
+    '''Runs short simulations of the ODLD system, in a temporary directory, using the deterministic propagator
+    and WE driver above.'''
+
+    rc_attrs = ('config', 'work_manager', '_system', '_data_manager', '_sim_manager', '_we_driver', '_propagator',
+                '_restart_store')
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.saved_rc = {name: getattr(westpa.rc, name) for name in self.rc_attrs}
+        self.saved_sim_root = os.environ.get('WEST_SIM_ROOT')
+
+    def teardown(self):
+        data_manager = westpa.rc._data_manager
+        if data_manager is not None and data_manager.we_h5file is not None:
+            data_manager.close_backing()
+        for (name, value) in self.saved_rc.items():
+            setattr(westpa.rc, name, value)
+        if self.saved_sim_root is None:
+            del os.environ['WEST_SIM_ROOT']
+        else:
+            os.environ['WEST_SIM_ROOT'] = self.saved_sim_root
+        shutil.rmtree(self.tempdir)
+
+    def reset_rc(self, simdir, work_manager=None):
+        rc = westpa.rc
+        rc._system = rc._data_manager = rc._sim_manager = rc._we_driver = rc._propagator = rc._restart_store = None
+        rc.config = YAMLConfig()
+        rc.work_manager = work_manager or SerialWorkManager()
+        parser = argparse.ArgumentParser()
+        rc.add_args(parser)
+        rc.process_args(parser.parse_args(['-r', os.path.join(simdir, 'west.cfg'), '--quiet']))
+        data_manager = rc.get_data_manager()
+        data_manager.we_h5filename = os.path.join(simdir, 'west.h5')
+        data_manager.system = rc.get_system_driver()
+        return rc.get_sim_manager()
+
+    def run_sim(self, name, n_iters=3, pipeline=False, callbacks=(), work_manager=None, options=None,
+                data_options=None):
+        '''Initialize and run a simulation in its own directory, with the given additional propagation
+        and data options and (hook, function) callbacks, and return the name of its HDF5 file.'''
+        simdir = os.path.join(self.tempdir, name)
+        os.makedirs(simdir)
+        os.environ['WEST_SIM_ROOT'] = simdir
+        with open(os.path.join(simdir, 'west.cfg'), 'wt') as config_file:
+            config_file.write(run_config.format(module=__name__, n_iters=n_iters, pipeline='true' if pipeline else 'false',
+                                                options='\n'.join('    {}: {}'.format(*item) for item in (options or {}).items()),
+                                                data_options='\n'.join('    {}: {}'.format(*item)
+                                                                        for item in (data_options or {}).items()),
+                                                odld_dir=os.path.join(os.environ['WEST_ROOT'], 'lib/examples/odld')))
+        random.seed(1)
+        numpy.random.seed(1)
+
+        sim_manager = self.reset_rc(simdir)
+        sim_manager.initialize_simulation([BasisState('basis', 1.0)], [TargetState('sink', [7.5])], segs_per_state=4)
+        sim_manager.data_manager.close_backing()
+
+        sim_manager = self.sim_manager = self.reset_rc(simdir, work_manager)
+        for (hook, fn) in callbacks:
+            sim_manager.register_callback(hook, fn)
+        sim_manager.prepare_run()
+        try:
+            sim_manager.run()
+        finally:
+            sim_manager.finalize_run()
+            sim_manager.data_manager.close_backing()
+        return sim_manager.data_manager.we_h5filename
+
+    @staticmethod
+    def compare_files(filename1, filename2, skip=('timing',), skip_fields=('walltime', 'cputime')):
+        '''Return a list of the differences between the contents of two HDF5 files, ignoring the named
+        groups or datasets, compound fields, and object data (references).'''
+        differences = []
+        with h5py.File(filename1, 'r') as f1, h5py.File(filename2, 'r') as f2:
+            names1, names2 = [], []
+            f1.visit(names1.append)
+            f2.visit(names2.append)
+            names1 = [name for name in names1 if not set(name.split('/')) & set(skip)]
+            names2 = [name for name in names2 if not set(name.split('/')) & set(skip)]
+            if names1 != names2:
+                differences.append(('names', sorted(set(names1) ^ set(names2))))
+            for name in sorted(set(names1) & set(names2)):
+                obj1, obj2 = f1[name], f2[name]
+                if sorted(obj1.attrs.keys()) != sorted(obj2.attrs.keys()):
+                    differences.append(('attrs', name))
+                if not isinstance(obj1, h5py.Dataset):
+                    continue
+                d1, d2 = obj1[()], obj2[()]
+                for field in (d1.dtype.names or [None]):
+                    if field in skip_fields:
+                        continue
+                    f1data, f2data = (d1, d2) if field is None else (d1[field], d2[field])
+                    if f1data.dtype.kind == 'O':
+                        continue
+                    elif name == 'summary' and field.endswith(('_prob', 'norm')):
+                        # Bin probabilities are summed over sets, whose order depends on object identity
+                        equal = numpy.allclose(f1data, f2data, rtol=1e-12, atol=0)
+                    else:
+                        equal = numpy.array_equal(f1data, f2data)
+                    if not equal:
+                        differences.append(('data', name, field))
+        return differences
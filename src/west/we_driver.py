@@ -731,3 +731,432 @@ class WEDriver:
             log.log(level, log_msg)
                     
             
+
+
+class ArrayWEDriver(WEDriver):
+    '''A WEDriver which performs recycling, splitting, and merging on arrays of walker weights,
+    bin assignments, history parents, and initial progress coordinates, rather than on sets of
+    Segment objects. Splitting and merging are carried out for all bins at once, using per-bin
+    (segmented) sorts and cumulative sums; Segment objects are created only for the walkers which
+    survive into the next iteration, once resampling is complete.
+    
+    This driver is statistically equivalent to WEDriver, but does not reproduce it walker for walker,
+    as random numbers are drawn in a different order. The endpoint type of each parent segment reflects
+    the final outcome of resampling: a parent is marked as continuing if any walker in the next iteration
+    has it as its history parent, as recycled if its walker was recycled, and as merged otherwise.
+    
+    Select this driver with ``drivers: we_driver: array`` in west.cfg.
+    '''
+    
+    def __init__(self, rc=None, system=None):
+        super(ArrayWEDriver,self).__init__(rc, system)
+        self._clear_walkers()
+        
+    def _clear_walkers(self):
+        # Per-walker arrays
+        self._w_weight = None       # weight
+        self._w_bin = None          # bin assignment
+        self._w_parent = None       # history parent (negative for initial states)
+        self._w_pcoord = None       # row of self._pcoord_rows holding initial progress coordinate
+        self._w_wtg = None          # node in self._wtg_nodes describing weight transfer parents
+        
+        # Initial progress coordinates referred to by self._w_pcoord
+        self._pcoord_rows = None
+        
+        # Weight transfer graph nodes; leaves are frozensets of parent IDs, and walkers created
+        # by merging refer to tuples of the nodes of the walkers merged
+        self._wtg_nodes = None
+        
+        self._next_n_iter = None
+        self._initial_parents = None
+        self._recycled_parents = None
+        
+    def _load_walkers(self, segments, n_iter, continuing):
+        '''Load the given ``(bin index, segment)`` pairs as walkers for iteration ``n_iter``. If
+        ``continuing`` is true, each walker continues the given segment (as in ``construct_next``);
+        otherwise, each walker replaces the given segment (as in ``rebin_current``).'''
+        
+        n_walkers = len(segments)
+        
+        self._next_n_iter = n_iter
+        self._w_bin = numpy.fromiter((ibin for (ibin, _segment) in segments), numpy.intp, count=n_walkers)
+        self._w_weight = numpy.fromiter((segment.weight for (_ibin, segment) in segments), numpy.float64, count=n_walkers)
+        self._w_pcoord = numpy.arange(n_walkers, dtype=numpy.intp)
+        self._w_wtg = numpy.arange(n_walkers, dtype=numpy.intp)
+        
+        if continuing:
+            self._w_parent = numpy.fromiter((segment.seg_id for (_ibin, segment) in segments), numpy.int64, count=n_walkers)
+            self._wtg_nodes = [frozenset((seg_id,)) for seg_id in self._w_parent.tolist()]
+            pcoord_rows = [segment.pcoord[-1] for (_ibin, segment) in segments]
+        else:
+            self._w_parent = numpy.fromiter((segment.parent_id for (_ibin, segment) in segments), numpy.int64, count=n_walkers)
+            self._wtg_nodes = [frozenset(segment.wtg_parent_ids or ()) for (_ibin, segment) in segments]
+            pcoord_rows = [segment.pcoord[0] for (_ibin, segment) in segments]
+        self._pcoord_rows = numpy.array(pcoord_rows, dtype=self.system.pcoord_dtype).reshape(n_walkers, self.system.pcoord_ndim)
+        
+        self._initial_parents = numpy.unique(self._w_parent)
+        self._recycled_parents = set()
+        
+    def _keep_walkers(self, indices):
+        '''Retain only the walkers with the given ``indices`` (which may repeat), in that order.'''
+        self._w_weight = self._w_weight[indices]
+        self._w_bin = self._w_bin[indices]
+        self._w_parent = self._w_parent[indices]
+        self._w_pcoord = self._w_pcoord[indices]
+        self._w_wtg = self._w_wtg[indices]
+        
+    def _walkers_in_bins(self, bin_mask):
+        '''Return the indices of walkers in the bins for which ``bin_mask`` is true.'''
+        return numpy.flatnonzero(bin_mask[self._w_bin])
+    
+    def _sort_walkers(self, walkers):
+        '''Sort the given walkers by bin and then weight.'''
+        return walkers[numpy.lexsort((self._w_weight[walkers], self._w_bin[walkers]))]
+    
+    def _bin_runs(self, order):
+        '''Return the start (into ``order``), length, and bin index of each run of walkers in the
+        same bin in the sorted walkers ``order``.'''
+        sorted_bins = self._w_bin[order]
+        if len(order):
+            run_starts = numpy.flatnonzero(numpy.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+        else:
+            run_starts = numpy.empty((0,), numpy.intp)
+        run_lengths = numpy.diff(numpy.r_[run_starts, len(order)])
+        return run_starts, run_lengths, sorted_bins[run_starts]
+    
+    def _reinsert(self, order, removed, inserted):
+        '''Remove the walkers ``removed`` from the sorted walkers ``order``, and insert the walkers
+        ``inserted`` in sorted position. All walkers inserted into a bin must have the same weight.'''
+        
+        keep = numpy.ones((len(self._w_weight),), numpy.bool_)
+        keep[removed] = False
+        remaining = order[keep[order]]
+        if not len(inserted):
+            return remaining
+        
+        remaining_bins = self._w_bin[remaining]
+        inserted_bins = self._w_bin[inserted]
+        insert_weights = numpy.zeros((self.bin_mapper.nbins,), numpy.float64)
+        insert_weights[inserted_bins] = self._w_weight[inserted]
+        n_lighter = numpy.bincount(remaining_bins, weights=(self._w_weight[remaining] < insert_weights[remaining_bins]),
+                                   minlength=self.bin_mapper.nbins).astype(numpy.intp)
+        positions = numpy.searchsorted(remaining_bins, inserted_bins) + n_lighter[inserted_bins]
+        return numpy.insert(remaining, positions, inserted)
+    
+    @staticmethod
+    def _cumulative_weights(weights, run_lengths):
+        '''Return the cumulative sum of ``weights`` within each consecutive run of the given lengths,
+        along with the run index and position within its run of each weight. The sums are accumulated
+        in the same order (and so to the same precision) as if computed one run at a time.'''
+        run_ids = numpy.repeat(numpy.arange(len(run_lengths)), run_lengths)
+        run_starts = numpy.cumsum(run_lengths) - run_lengths
+        run_positions = numpy.arange(len(weights)) - run_starts[run_ids]
+        cumul_weights = numpy.empty_like(weights)
+        
+        # Lay out runs of similar length (within a factor of two) as the rows of a zero-padded 2-D array, 
+        # and accumulate along rows
+        length_classes = numpy.frexp(run_lengths.astype(numpy.float64))[1]
+        run_rows = numpy.empty((len(run_lengths),), numpy.intp)
+        for length_class in numpy.unique(length_classes):
+            class_runs = numpy.flatnonzero(length_classes == length_class)
+            run_rows[class_runs] = numpy.arange(len(class_runs))
+            in_class = (length_classes == length_class)[run_ids]
+            rows, cols = run_rows[run_ids[in_class]], run_positions[in_class]
+            padded_weights = numpy.zeros((len(class_runs), run_lengths[class_runs].max()), numpy.float64)
+            padded_weights[rows, cols] = weights[in_class]
+            cumul_weights[in_class] = numpy.add.accumulate(padded_weights, axis=1)[rows, cols]
+        return cumul_weights, run_ids, run_positions
+        
+    def _split_walkers(self, counts):
+        '''Split each walker into the number of walkers given in ``counts``.'''
+        indices = numpy.repeat(numpy.arange(len(self._w_weight)), counts)
+        self._keep_walkers(indices)
+        self._w_weight /= counts[indices]
+        
+    def _glom_walkers(self, walkers, group_lengths):
+        '''Merge groups of walkers into single walkers. ``walkers`` holds the indices of the walkers
+        of each group in turn (sorted by increasing weight within each group), and ``group_lengths``
+        the number of walkers in each group. The history of each merged walker is selected from
+        among those of its group with probability proportional to weight, and the walker with
+        that history is updated in place to represent the merged walker. Returns the indices of
+        the merged walkers; the caller is responsible for discarding the other walkers in each group.'''
+        
+        n_groups = len(group_lengths)
+        group_ends = numpy.cumsum(group_lengths)
+        cumul_weights, group_ids, _positions = self._cumulative_weights(self._w_weight[walkers], group_lengths)
+        glom_weights = cumul_weights[group_ends-1]
+        
+        # as in WEDriver, a walker with (e.g.) twice the weight of another has twice the probability
+        # of having its history selected for continuation
+        iparents = numpy.array([random.uniform(0,glom_weight) for glom_weight in glom_weights.tolist()])
+        iparents = numpy.bincount(group_ids, weights=(cumul_weights <= iparents[group_ids]), minlength=n_groups).astype(numpy.intp)
+        numpy.minimum(iparents, group_lengths-1, out=iparents)
+        glom_sources = walkers[group_ends - group_lengths + iparents]
+        
+        wtg_children = self._w_wtg[walkers].tolist()
+        glom_wtg = numpy.arange(len(self._wtg_nodes), len(self._wtg_nodes)+n_groups, dtype=numpy.intp)
+        self._wtg_nodes.extend(tuple(wtg_children[group_end-group_length:group_end]) 
+                               for (group_end, group_length) in zip(group_ends.tolist(), group_lengths.tolist()))
+        
+        self._w_weight[glom_sources] = glom_weights
+        self._w_wtg[glom_sources] = glom_wtg
+        return glom_sources
+        
+    def _recycle_walkers(self):
+        '''Recycle walkers'''
+        
+        self.new_weights = []
+        
+        if not self.target_states or not len(self._w_bin):
+            return
+        
+        target_bins = numpy.fromiter(self.target_states.keys(), dtype=numpy.intp)
+        recycled = numpy.flatnonzero(numpy.isin(self._w_bin, target_bins))
+        n_recycled_walkers = len(recycled)
+        if not n_recycled_walkers:
+            return
+        elif n_recycled_walkers > len(self.avail_initial_states):
+            raise ConsistencyError('need {} initial states for recycling, but only {} present'
+                                   .format(n_recycled_walkers,len(self.avail_initial_states)))
+        
+        istateiter = iter(self.avail_initial_states.values())
+        initial_states = [next(istateiter) for _i in range(n_recycled_walkers)]
+        istate_pcoords = numpy.array([initial_state.pcoord for initial_state in initial_states], 
+                                     dtype=self.system.pcoord_dtype).reshape(n_recycled_walkers, self.system.pcoord_ndim)
+        istate_assignments = self.bin_mapper.assign(istate_pcoords)
+        
+        for (iwalker, initial_state) in zip(recycled.tolist(), initial_states):
+            target_state = self.target_states[self._w_bin[iwalker]]
+            parent = self._parent_map[self._w_parent[iwalker]]
+            self._recycled_parents.add(parent.seg_id)
+            
+            self.new_weights.append(NewWeightEntry(source_type=NewWeightEntry.NW_SOURCE_RECYCLED,
+                                                   weight=parent.weight, prev_seg_id=parent.seg_id,
+                                                   prev_init_pcoord=parent.pcoord[0].copy(),
+                                                   prev_final_pcoord=parent.pcoord[-1].copy(),
+                                                   new_init_pcoord=initial_state.pcoord.copy(),
+                                                   target_state_id=target_state.state_id,
+                                                   initial_state_id=initial_state.state_id) )
+            initial_state.iter_used = self._next_n_iter
+            self.used_initial_states[initial_state.state_id] = self.avail_initial_states.pop(initial_state.state_id)
+        
+        self._w_parent[recycled] = [-(initial_state.state_id+1) for initial_state in initial_states]
+        self._w_bin[recycled] = istate_assignments
+        self._w_pcoord[recycled] = numpy.arange(len(self._pcoord_rows), len(self._pcoord_rows)+n_recycled_walkers)
+        self._pcoord_rows = numpy.concatenate([self._pcoord_rows, istate_pcoords])
+        
+    def _split_by_weight(self):
+        '''Split overweight walkers in all bins'''
+        
+        nbins = self.bin_mapper.nbins
+        bin_weights = numpy.bincount(self._w_bin, weights=self._w_weight, minlength=nbins)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ideal_weights = (bin_weights / self.bin_target_counts)[self._w_bin]
+        
+        to_split = self._w_weight > self.weight_split_threshold*ideal_weights
+        if to_split.any():
+            counts = numpy.ones((len(self._w_weight),), numpy.intp)
+            counts[to_split] = numpy.ceil(self._w_weight[to_split] / ideal_weights[to_split])
+            self._split_walkers(counts)
+    
+    def _merge_by_weight(self):
+        '''Merge underweight walkers in all bins'''
+        
+        nbins = self.bin_mapper.nbins
+        bin_weights = numpy.bincount(self._w_bin, weights=self._w_weight, minlength=nbins)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            merge_cutoffs = bin_weights / self.bin_target_counts * self.weight_merge_cutoff
+        
+        merged_away = numpy.zeros((len(self._w_weight),), numpy.bool_)
+        order = self._sort_walkers(numpy.arange(len(self._w_weight)))
+        while len(order):
+            run_starts, run_lengths, run_bins = self._bin_runs(order)
+            cumul_weights, run_ids, run_positions = self._cumulative_weights(self._w_weight[order], run_lengths)
+            
+            # The walkers to merge in each bin are a prefix of that bin's walkers sorted by weight
+            n_to_merge = numpy.bincount(run_ids, weights=(cumul_weights <= merge_cutoffs[run_bins][run_ids]),
+                                        minlength=len(run_starts)).astype(numpy.intp)
+            n_to_merge[n_to_merge < 2] = 0
+            if not n_to_merge.any():
+                break
+            
+            to_merge = order[run_positions < n_to_merge[run_ids]]
+            glom_sources = self._glom_walkers(to_merge, n_to_merge[n_to_merge > 0])
+            merged_away[to_merge] = True
+            merged_away[glom_sources] = False
+            
+            # Only bins in which walkers were merged need to be considered again
+            active_bins = numpy.zeros((nbins,), numpy.bool_)
+            active_bins[run_bins[n_to_merge > 0]] = True
+            order = self._reinsert(order[active_bins[self._w_bin[order]]], to_merge, glom_sources)
+        
+        self._keep_walkers(numpy.flatnonzero(~merged_away))
+            
+    def _adjust_count(self):
+        '''Split the highest-weight walker or merge the two lowest-weight walkers in each bin, 
+        until all bins contain their target number of walkers'''
+        
+        target_counts = numpy.asarray(self.bin_target_counts)
+        bin_counts = numpy.bincount(self._w_bin, minlength=self.bin_mapper.nbins)
+        
+        # split
+        order = self._sort_walkers(self._walkers_in_bins((bin_counts > 0) & (bin_counts < target_counts)))
+        while len(order):
+            log.debug('adjusting counts by splitting')
+            run_starts, run_lengths, run_bins = self._bin_runs(order)
+            to_split = order[run_starts + run_lengths - 1]
+            n_walkers = len(self._w_weight)
+            self._keep_walkers(numpy.r_[numpy.arange(n_walkers), to_split])
+            self._w_weight[to_split] /= 2
+            self._w_weight[n_walkers:] = self._w_weight[to_split]
+            bin_counts[run_bins] += 1
+            
+            short_bins = bin_counts < target_counts
+            new_walkers = numpy.r_[to_split, numpy.arange(n_walkers, len(self._w_weight))]
+            order = self._reinsert(order[short_bins[self._w_bin[order]]], to_split, 
+                                   new_walkers[short_bins[self._w_bin[new_walkers]]])
+        
+        # merge
+        merged_away = numpy.zeros((len(self._w_weight),), numpy.bool_)
+        order = self._sort_walkers(self._walkers_in_bins(bin_counts > target_counts))
+        while len(order):
+            log.debug('adjusting counts by merging')
+            run_starts, _run_lengths, run_bins = self._bin_runs(order)
+            to_merge = order[numpy.add.outer(run_starts, [0,1]).ravel()]
+            glom_sources = self._glom_walkers(to_merge, numpy.full((len(run_starts),), 2, numpy.intp))
+            merged_away[to_merge] = True
+            merged_away[glom_sources] = False
+            bin_counts[run_bins] -= 1
+            
+            long_bins = bin_counts > target_counts
+            order = self._reinsert(order[long_bins[self._w_bin[order]]], to_merge, 
+                                   glom_sources[long_bins[self._w_bin[glom_sources]]])
+            
+        self._keep_walkers(numpy.flatnonzero(~merged_away))
+            
+    def _check_pre(self):
+        bin_counts = numpy.bincount(self._w_bin, minlength=self.bin_mapper.nbins)
+        for ibin in numpy.flatnonzero((bin_counts > 0) & (numpy.asarray(self.bin_target_counts) == 0)):
+            raise ConsistencyError('bin {:d} has target count of 0 but contains {:d} walkers'.format(ibin, bin_counts[ibin]))
+        
+    def _check_post(self):
+        if (self._w_weight == 0).any():
+            raise ConsistencyError('{:d} walkers have weight of zero'.format((self._w_weight == 0).sum()))
+        
+    def _resolve_wtg(self, inode, _cache):
+        try:
+            return _cache[inode]
+        except KeyError:
+            pass
+        
+        node = self._wtg_nodes[inode]
+        if isinstance(node, frozenset):
+            wtg_parent_ids = node
+        else:
+            wtg_parent_ids = frozenset().union(*(self._resolve_wtg(ichild, _cache) for ichild in node))
+        _cache[inode] = wtg_parent_ids
+        return wtg_parent_ids
+    
+    def _update_parents_and_states(self):
+        '''Set endpoint types of parent segments and return initial states freed by merging
+        to the pool of available states.'''
+        
+        surviving_parents = set(self._w_parent.tolist())
+        for parent_id in self._initial_parents.tolist():
+            try:
+                parent = self._parent_map[parent_id]
+            except KeyError:
+                # an initial state
+                continue
+            if parent_id in surviving_parents:
+                parent.endpoint_type = Segment.SEG_ENDPOINT_CONTINUES
+            elif parent_id in self._recycled_parents:
+                parent.endpoint_type = Segment.SEG_ENDPOINT_RECYCLED
+            else:
+                parent.endpoint_type = Segment.SEG_ENDPOINT_MERGED
+            
+        for state_id in list(self.used_initial_states):
+            if -(state_id+1) not in surviving_parents:
+                initial_state = self.used_initial_states.pop(state_id)
+                log.debug('freeing initial state {!r} for future use (merged)'.format(initial_state))
+                if initial_state is not None:
+                    self.avail_initial_states[state_id] = initial_state
+                    initial_state.iter_used = None
+                
+    def _create_segments(self):
+        '''Create Segment objects for the walkers of the next iteration, and bin them.'''
+        
+        # Progress coordinate arrays for all new segments are views into a single array
+        pcoord_template = self.system.new_pcoord_array()
+        pcoords = numpy.zeros((len(self._w_weight),) + pcoord_template.shape, pcoord_template.dtype)
+        pcoords[:,0] = self._pcoord_rows[self._w_pcoord]
+        
+        wtg_cache = {}
+        next_iter_binning = self.next_iter_binning
+        for (weight, ibin, parent_id, wtg_node, pcoord) in zip(self._w_weight.tolist(), self._w_bin.tolist(),
+                                                               self._w_parent.tolist(), self._w_wtg.tolist(), pcoords):
+            segment = Segment(n_iter=self._next_n_iter,
+                              weight=weight,
+                              parent_id=parent_id,
+                              wtg_parent_ids=self._resolve_wtg(wtg_node, wtg_cache),
+                              pcoord=pcoord,
+                              status=Segment.SEG_STATUS_PREPARED)
+            next_iter_binning[ibin].add(segment)
+    
+    def _run_we(self):
+        '''Run recycle/split/merge. Do not call this function directly; instead, use
+        populate_initial(), rebin_current(), or construct_next().'''
+        self._recycle_walkers()
+        
+        # sanity check
+        self._check_pre()
+        
+        # Regardless of current particle count, always split overweight particles and merge underweight particles
+        # Then and only then adjust for correct particle count
+        if len(self._w_weight):
+            self._split_by_weight()
+            self._merge_by_weight()
+            if self.do_adjust_counts:
+                self._adjust_count()
+            
+        self._check_post()
+        
+        self._update_parents_and_states()
+        self._create_segments()
+        self._clear_walkers()
+        
+        self.new_weights = self.new_weights or []
+        
+        log.debug('used initial states: {!r}'.format(self.used_initial_states))
+        log.debug('available initial states: {!r}'.format(self.avail_initial_states))
+        
+    def _binned_segments(self):
+        return [(ibin, segment) for (ibin, _bin) in enumerate(self.final_binning) for segment in _bin]
+    
+    def rebin_current(self, parent_segments):
+        '''Reconstruct walkers for the current iteration based on (presumably) new binning.
+        The previous iteration's segments must be provided (as ``parent_segments``) in order
+        to update endpoint types appropriately.'''
+
+        self._prep_we()
+        self._parent_map = {segment.seg_id: segment for segment in parent_segments}
+        
+        segments = self._binned_segments()
+        n_iters = {segment.n_iter for (_ibin, segment) in segments}
+        assert len(n_iters) <= 1
+        self._load_walkers(segments, n_iters.pop() if n_iters else None, continuing=False)
+        self._run_we()
+    
+    def construct_next(self):
+        '''Construct walkers for the next iteration, by running weighted ensemble recycling
+        and bin/split/merge on the segments previously assigned to bins using ``assign``.
+        See ``WEDriver.construct_next`` for details.'''
+        
+        self._prep_we()
+        
+        segments = self._binned_segments()
+        n_iters = {segment.n_iter for (_ibin, segment) in segments}
+        assert len(n_iters) <= 1
+        self._parent_map = {segment.seg_id: segment for (_ibin, segment) in segments}
+        self._load_walkers(segments, n_iters.pop()+1 if n_iters else None, continuing=True)
+        self._run_we()
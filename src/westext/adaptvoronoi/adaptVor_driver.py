@@ -183,7 +183,7 @@ class AdaptiveVoronoiDriver:
                     Failed updating the bin mapper: {}'.format(e))
             raise
 
-    def update_centers(self, iter_group):
+    def update_centers(self, n_iter):
         '''
         Update the set of Voronoi centers according to
         Zhang 2010, J Chem Phys, 132. A short description
@@ -202,32 +202,30 @@ class AdaptiveVoronoiDriver:
         westpa.rc.pstatus('westext.adaptvoronoi: Updating Voronoi centers\n')
         westpa.rc.pflush()
 
-        # Pull the current coordinates to find distances
-        curr_pcoords = iter_group['pcoord']
+        # Pull the current final coordinates to find distances
+        final_pcoords = self.data_manager.get_segments_as_arrays(n_iter, pcoord_points=[-1], 
+                                                                 load_wtgraph=False).pcoord[:,0]
         # Initialize distance array
-        dists = np.zeros(curr_pcoords.shape[0])
-        for iwalk, walk in enumerate(curr_pcoords):
+        dists = np.zeros(final_pcoords.shape[0])
+        for iwalk, final_pcoord in enumerate(final_pcoords):
             # Calculate distances using the provided function
             # and find the distance to the closest center
-            dists[iwalk] = min(self.dfunc(walk[-1], self.centers))
+            dists[iwalk] = min(self.dfunc(final_pcoord, self.centers))
         # Find the maximum of the minimum distances
         max_ind = np.where(dists == dists.max())
         # Use the maximum progress coordinate as our next center
         self.centers = np.vstack((self.centers, 
-             curr_pcoords[max_ind[0][0]][-1]))
+             final_pcoords[max_ind[0][0]]))
 
     def prepare_new_iteration(self):
 
         n_iter = self.sim_manager.n_iter
 
-        with self.data_manager.lock:
-            iter_group = self.data_manager.get_iter_group(n_iter)
-
         # Check if we are at the correct frequency for updating the bin mapper
         if n_iter % self.center_freq == 0:
             # Check if we still need to add more centers
             if self.ncenters < self.max_centers:
                 # First find the center to add
-                self.update_centers(iter_group)
+                self.update_centers(n_iter)
                 # Update the bin mapper with the new center
                 self.update_bin_mapper()
@@ -203,21 +203,16 @@ class StringDriver(object):
         stop_iter = n_iter + 1
 
         for n in range(start_iter, stop_iter):
-            with self.data_manager.lock:
-                iter_group = self.data_manager.get_iter_group(n)
-                seg_index = iter_group['seg_index'][...]
+            # Only read final point
+            segment_arrays = self.data_manager.get_segments_as_arrays(n, pcoord_points=[-1], load_wtgraph=False)
+            pcoords = np.ascontiguousarray(segment_arrays.pcoord[:,0])
+            bin_indices = self.system.bin_mapper.assign(pcoords).astype(np.intp)
+            weights = segment_arrays.weights
 
-                pcoords = iter_group['pcoord'][:,-1,:]  # Only read final point
-                bin_indices = self.system.bin_mapper.assign(pcoords)
-                weights = seg_index['weight']
+            for idim in range(ndim):
+                avg_pos[:,idim] += np.bincount(bin_indices, weights=pcoords[:,idim]*weights, minlength=nbins)
 
-                pcoord_w = pcoords * weights[:,np.newaxis]
-                uniq_indices = np.unique(bin_indices)
-
-                for indx in uniq_indices:
-                    avg_pos[indx,:] += pcoord_w[bin_indices == indx].sum(axis=0)
-
-                sum_bin_weight += np.bincount(bin_indices.astype(np.int), weights=weights, minlength=nbins)
+            sum_bin_weight += np.bincount(bin_indices, weights=weights, minlength=nbins)
 
         # Some bins might have zero samples so exclude to avoid divide by zero
         occ_ind = np.nonzero(sum_bin_weight)